@@ -17,10 +17,17 @@
 import sys
 import os
 
-from charmhelpers.core.hookenv import action_fail
+from charmhelpers.core import tracing
+from charmhelpers.core.hookenv import (
+    action_fail,
+    action_get,
+    action_set,
+    config,
+)
 
 from hooks.glance_utils import (
     pause_unit_helper,
+    precache_images,
     resume_unit_helper,
     register_configs,
 )
@@ -42,9 +49,36 @@ def resume(args):
     resume_unit_helper(register_configs())
 
 
+def precache(args):
+    """Fetch images into the image cache of this unit.
+
+    @raises ValueError if an image ID is not a UUID
+    """
+    if not config('image-cache'):
+        action_fail('image-cache is not enabled')
+        return
+    queued = precache_images(action_get('images').split())
+    action_set({'queued': ' '.join(queued)})
+
+
+def dump_trace(args):
+    """Report the slowest spans of recent hooks and their folded stacks."""
+    metric = action_get('metric')
+    records = tracing.load(hooks=action_get('hooks'))
+    if not records:
+        action_fail('No hook traces recorded, is trace-hooks enabled?')
+        return
+    slowest = ['{:.3f}s wall {:.3f}s cpu {} {}'.format(wall, cpu, hook, stack)
+               for hook, stack, wall, cpu in
+               tracing.slowest(records, action_get('count'), metric)]
+    action_set({'slowest': '\n'.join(slowest),
+                'folded': '\n'.join(tracing.folded(records, metric))})
+
+
 # A dictionary of all the defined actions to callables (which take
 # parsed arguments).
-ACTIONS = {"pause": pause, "resume": resume}
+ACTIONS = {"pause": pause, "resume": resume, "precache-images": precache,
+           "dump-trace": dump_trace}
 
 
 def main(args):
@@ -21,6 +21,7 @@
 import subprocess
 import pwd
 import grp
+import hashlib
 import os
 import glob
 import shutil
@@ -29,6 +30,7 @@ import shlex
 import yaml
 
 from charmhelpers.core.hookenv import (
+    atexit,
     config,
     hook_name,
     local_unit,
@@ -40,6 +42,7 @@ from charmhelpers.core.hookenv import (
 
 from charmhelpers.core.host import service
 from charmhelpers.core import host
+from charmhelpers.core import unitdata
 
 # This module adds compatibility with the nrpe-external-master and plain nrpe
 # subordinate charms. To use it in your charm:
@@ -121,6 +124,11 @@ from charmhelpers.core import host
 #    ln -s hooks.py local-monitors-relation-changed
 
 
+# unitdata key under which the files written for each check are recorded, as
+# {command: {path: sha256 of content}}.
+NRPE_MANIFEST_KEY = 'nrpe.manifest'
+
+
 class CheckException(Exception):
     pass
 
@@ -190,19 +198,40 @@ define service {{
             os.remove(nrpe_check_file)
         self._remove_service_files()
 
+    def render(self, nagios_servicegroups):
+        """Content of the NRPE command definition of the check."""
+        lines = ["# check {}\n".format(self.shortname)]
+        if nagios_servicegroups:
+            lines.extend([
+                "# The following header was added automatically by juju\n",
+                "# Modifying it will affect nagios monitoring and alerting\n",
+                "# servicegroups: {}\n".format(nagios_servicegroups)])
+        lines.append("command[{}]={}\n".format(self.command, self.check_cmd))
+        return ''.join(lines)
+
+    def render_service(self, hostname, nagios_servicegroups):
+        """Content of the nagios service definition of the check."""
+        templ_vars = {
+            'nagios_hostname': hostname,
+            'nagios_servicegroup': nagios_servicegroups,
+            'description': self.description,
+            'shortname': self.shortname,
+            'command': self.command,
+        }
+        return str(Check.service_template.format(**templ_vars))
+
+    def files(self, hostname, nagios_servicegroups):
+        """The files configuring the check, as {path: content}."""
+        files = {self._get_check_filename(): self.render(nagios_servicegroups)}
+        if os.path.exists(NRPE.nagios_exportdir):
+            files[self._get_service_filename(hostname)] = \
+                self.render_service(hostname, nagios_servicegroups)
+        return files
+
     def write(self, nagios_context, hostname, nagios_servicegroups):
         nrpe_check_file = self._get_check_filename()
         with open(nrpe_check_file, 'w') as nrpe_check_config:
-            nrpe_check_config.write("# check {}\n".format(self.shortname))
-            if nagios_servicegroups:
-                nrpe_check_config.write(
-                    "# The following header was added automatically by juju\n")
-                nrpe_check_config.write(
-                    "# Modifying it will affect nagios monitoring and alerting\n")
-                nrpe_check_config.write(
-                    "# servicegroups: {}\n".format(nagios_servicegroups))
-            nrpe_check_config.write("command[{}]={}\n".format(
-                self.command, self.check_cmd))
+            nrpe_check_config.write(self.render(nagios_servicegroups))
 
         if not os.path.exists(NRPE.nagios_exportdir):
             log('Not writing service config as {} is not accessible'.format(
@@ -215,17 +244,10 @@ define service {{
                              nagios_servicegroups):
         self._remove_service_files()
 
-        templ_vars = {
-            'nagios_hostname': hostname,
-            'nagios_servicegroup': nagios_servicegroups,
-            'description': self.description,
-            'shortname': self.shortname,
-            'command': self.command,
-        }
-        nrpe_service_text = Check.service_template.format(**templ_vars)
         nrpe_service_file = self._get_service_filename(hostname)
         with open(nrpe_service_file, 'w') as nrpe_service_config:
-            nrpe_service_config.write(str(nrpe_service_text))
+            nrpe_service_config.write(
+                self.render_service(hostname, nagios_servicegroups))
 
     def run(self):
         subprocess.call(self.check_cmd)
@@ -281,6 +303,62 @@ class NRPE(object):
 
         check = Check(*args, **kwargs)
         check.remove(self.hostname)
+        db = unitdata.kv()
+        manifest = db.get(NRPE_MANIFEST_KEY, {})
+        for path in manifest.pop(check.command, {}):
+            if os.path.exists(path):
+                os.remove(path)
+        db.set(NRPE_MANIFEST_KEY, manifest)
+        # only persist the manifest if the hook completes successfully.
+        atexit(db.flush)
+
+    def _sync_files(self):
+        """Bring the files of the checks up to date.
+
+        Files are only written when the digest of their content differs from
+        that recorded in the manifest of files written by earlier hooks, or
+        when they are missing. Files recorded for a check which are no longer
+        wanted, such as service definitions for a previous hostname, are
+        removed. Checks first written before the manifest existed have stale
+        service definitions looked for in the export directory instead.
+
+        :returns: True if any file was written or removed.
+        """
+        db = unitdata.kv()
+        manifest = db.get(NRPE_MANIFEST_KEY, {})
+        changed = False
+        unrecorded = set()
+        for nrpecheck in self.checks:
+            previous = manifest.get(nrpecheck.command)
+            if previous is None:
+                unrecorded.add(nrpecheck.command)
+                previous = {}
+            current = {}
+            for path, content in nrpecheck.files(
+                    self.hostname, self.nagios_servicegroups).items():
+                digest = hashlib.sha256(content.encode('UTF-8')).hexdigest()
+                current[path] = digest
+                if previous.get(path) != digest or not os.path.exists(path):
+                    with open(path, 'w') as f:
+                        f.write(content)
+                    changed = True
+            for path in set(previous) - set(current):
+                if os.path.exists(path):
+                    os.remove(path)
+                    changed = True
+            manifest[nrpecheck.command] = current
+        if unrecorded and os.path.exists(NRPE.nagios_exportdir):
+            for f in os.listdir(NRPE.nagios_exportdir):
+                path = os.path.join(NRPE.nagios_exportdir, f)
+                for command in unrecorded:
+                    if (f.endswith('_{}.cfg'.format(command)) and
+                            path not in manifest[command]):
+                        os.remove(path)
+                        changed = True
+                        break
+        db.set(NRPE_MANIFEST_KEY, manifest)
+        atexit(db.flush)
+        return changed
 
     def write(self):
         try:
@@ -297,17 +375,19 @@ class NRPE(object):
         nrpe_monitors = {}
         monitors = {"monitors": {"remote": {"nrpe": nrpe_monitors}}}
         for nrpecheck in self.checks:
-            nrpecheck.write(self.nagios_context, self.hostname,
-                            self.nagios_servicegroups)
             nrpe_monitors[nrpecheck.shortname] = {
                 "command": nrpecheck.command,
             }
+        if not os.path.exists(NRPE.nagios_exportdir):
+            log('Not writing service config as {} is not accessible'.format(
+                NRPE.nagios_exportdir))
+        changed = self._sync_files()
 
         # update-status hooks are configured to firing every 5 minutes by
         # default. When nagios-nrpe-server is restarted, the nagios server
         # reports checks failing causing unneccessary alerts. Let's not restart
-        # on update-status hooks.
-        if not hook_name() == 'update-status':
+        # on update-status hooks, nor when no check has changed.
+        if changed and not hook_name() == 'update-status':
             service('restart', 'nagios-nrpe-server')
 
         monitor_ids = relation_ids("local-monitors") + \
@@ -410,15 +490,18 @@ def add_init_service_checks(nrpe, services, unit_name, immediate_check=True):
                 os.chmod(checkpath, 0o644)
 
 
-def copy_nrpe_checks():
+def copy_nrpe_checks(nrpe_files_dir=None):
     """
     Copy the nrpe checks into place
 
+    :param str nrpe_files_dir: directory holding the checks, by default the
+                               checks shipped with charmhelpers
     """
     NAGIOS_PLUGINS = '/usr/local/lib/nagios/plugins'
-    nrpe_files_dir = os.path.join(os.getenv('CHARM_DIR'), 'hooks',
-                                  'charmhelpers', 'contrib', 'openstack',
-                                  'files')
+    if nrpe_files_dir is None:
+        nrpe_files_dir = os.path.join(os.getenv('CHARM_DIR'), 'hooks',
+                                      'charmhelpers', 'contrib', 'openstack',
+                                      'files')
 
     if not os.path.exists(NAGIOS_PLUGINS):
         os.makedirs(NAGIOS_PLUGINS)
@@ -25,6 +25,7 @@ Helpers for clustering and determining "cluster leadership" and other
 clustering-related helpers.
 """
 
+import json
 import subprocess
 import os
 import time
@@ -34,6 +35,7 @@ from socket import gethostname as get_unit_hostname
 import six
 
 from charmhelpers.core.hookenv import (
+    atexit,
     log,
     relation_ids,
     related_units as relation_list,
@@ -44,11 +46,17 @@ from charmhelpers.core.hookenv import (
     WARNING,
     unit_get,
     is_leader as juju_is_leader,
+    leader_get,
+    leader_set,
+    local_unit,
+    relation_set,
     status_set,
 )
 from charmhelpers.core.host import (
     modulo_distribution,
+    service,
 )
+from charmhelpers.core.unitdata import kv
 from charmhelpers.core.decorators import (
     retry_on_exception,
 )
@@ -58,6 +66,12 @@ from charmhelpers.core.strutils import (
 
 DC_RESOURCE_NAME = 'DC'
 
+# Leader setting holding the units allowed to restart, as JSON
+# {unit: [request id, time granted]}.
+RESTART_GRANTS_KEY = 'restart-grants'
+# unitdata key holding the restart this unit is waiting to perform.
+PENDING_RESTART_KEY = 'hahelpers.pending-restart'
+
 
 class HAIncompleteConfig(Exception):
     pass
@@ -391,3 +405,220 @@ def distributed_wait(modulo=None, wait=None, operation_name='operation'):
     log(msg, DEBUG)
     status_set('maintenance', msg)
     time.sleep(calculated_wait)
+
+
+def _unit_number(unit):
+    return int(unit.split('/')[-1])
+
+
+def restart_requests(peer_relation='cluster'):
+    """Units, including this one, waiting for a rolling restart.
+
+    :param peer_relation: string Name of the peer relation
+    :returns: dict {unit: request id}
+    """
+    requests = {}
+    for rid in relation_ids(peer_relation):
+        for unit in [local_unit()] + relation_list(rid):
+            settings = relation_get(rid=rid, unit=unit) or {}
+            request = settings.get('restart-request')
+            if request and request != settings.get('restart-done'):
+                requests[unit] = request
+    return requests
+
+
+def grant_restarts(batch=1, expiry=600, peer_relation='cluster'):
+    """Allow units waiting for a rolling restart to restart, at most batch at
+    a time. Must be run on the leader.
+
+    A grant is released when its unit reports the restart done, or departs,
+    or after expiry seconds. Units whose grant expired go to the back of the
+    queue.
+
+    :param batch: int Number of units allowed to restart at once
+    :param expiry: int Seconds after which a grant is released
+    :param peer_relation: string Name of the peer relation
+    :returns: dict {unit: [request id, time granted]} of current grants
+    """
+    requests = restart_requests(peer_relation)
+    grants = json.loads(leader_get(RESTART_GRANTS_KEY) or '{}')
+    now = time.time()
+    active = {}
+    expired = set()
+    for unit, grant in grants.items():
+        if requests.get(unit) != grant[0]:
+            continue
+        if now - grant[1] < expiry:
+            active[unit] = grant
+        else:
+            log('Restart grant of {} expired'.format(unit), WARNING)
+            expired.add(unit)
+    for unit in sorted(requests,
+                       key=lambda u: (u in expired, _unit_number(u))):
+        if len(active) >= batch:
+            break
+        if unit not in active:
+            log('Granting restart to {}'.format(unit), DEBUG)
+            active[unit] = [requests[unit], now]
+    if active != grants:
+        leader_set({RESTART_GRANTS_KEY: json.dumps(active, sort_keys=True)})
+    return active
+
+
+def request_restart(services, stopstart=False, peer_relation='cluster'):
+    """Queue services for a restart coordinated with the peers of the unit,
+    to be performed by run_granted_restart once the leader grants it.
+
+    The pending restart is saved and the request published to the peers
+    together, when the hook completes.
+
+    :param services: list Services to restart
+    :param stopstart: bool Whether to stop and start rather than restart
+    :param peer_relation: string Name of the peer relation
+    """
+    db = kv()
+    pending = db.get(PENDING_RESTART_KEY)
+    if pending and not pending['restarted']:
+        services = pending['services'] + [s for s in services
+                                          if s not in pending['services']]
+        stopstart = stopstart or pending['stopstart']
+        request = pending['id']
+    else:
+        request = '{:.6f}'.format(time.time())
+    db.set(PENDING_RESTART_KEY, {'id': request, 'services': services,
+                                 'stopstart': stopstart, 'restarted': False})
+    atexit(db.flush)
+    log('Requesting rolling restart of {}'.format(', '.join(services)), INFO)
+    for rid in relation_ids(peer_relation):
+        relation_set(relation_id=rid,
+                     relation_settings={'restart-request': request})
+
+
+def run_granted_restart(health_check, peer_relation='cluster',
+                        restart_functions=None):
+    """Perform the restart queued by request_restart if the leader has
+    granted it, and report the restart done once the unit is healthy, which
+    frees the grant for the next unit.
+
+    Health is checked once per run rather than waited for, so that hooks
+    are not held up: a unit which is not healthy yet keeps its grant, and
+    later runs, from peer relation or update-status hooks, check it again.
+    A unit still waiting for its grant publishes its request again, in case
+    an earlier hook failed before it was sent.
+
+    :param health_check: callable returning True once the restarted services
+                         are serving again
+    :param peer_relation: string Name of the peer relation
+    :param restart_functions: dict {service: function} of nonstandard
+                              functions to restart services with
+    :returns: bool Whether no restart remains pending
+    """
+    db = kv()
+    pending = db.get(PENDING_RESTART_KEY)
+    if not pending:
+        return True
+    if not pending['restarted']:
+        grant = json.loads(leader_get(RESTART_GRANTS_KEY) or '{}').get(
+            local_unit())
+        if not grant or grant[0] != pending['id']:
+            log('Waiting for leader to grant restart of {}'.format(
+                ', '.join(pending['services'])), INFO)
+            for rid in relation_ids(peer_relation):
+                relation_set(relation_id=rid,
+                             relation_settings={'restart-request':
+                                                pending['id']})
+            return False
+        status_set('maintenance', 'Rolling restart of {}'.format(
+            ', '.join(pending['services'])))
+        _restart_services(pending['services'], pending['stopstart'],
+                          restart_functions)
+        pending['restarted'] = True
+        db.set(PENDING_RESTART_KEY, pending)
+        atexit(db.flush)
+    if not health_check():
+        log('Services not healthy yet after rolling restart, holding '
+            'restart grant', INFO)
+        return False
+    db.unset(PENDING_RESTART_KEY)
+    atexit(db.flush)
+    for rid in relation_ids(peer_relation):
+        relation_set(relation_id=rid,
+                     relation_settings={'restart-done': pending['id']})
+    return True
+
+
+def _restart_services(services, stopstart=False, restart_functions=None):
+    restart_functions = restart_functions or {}
+    actions = ('stop', 'start') if stopstart else ('restart',)
+    for service_name in services:
+        if service_name in restart_functions:
+            restart_functions[service_name](service_name)
+        else:
+            for action in actions:
+                service(action, service_name)
+
+
+def restart_pending():
+    """Whether a rolling restart of this unit is outstanding."""
+    return bool(kv().get(PENDING_RESTART_KEY))
+
+
+def coordinate_restarts(health_check, batch=1, timeout=300,
+                        peer_relation='cluster', restart_functions=None):
+    """Make progress on rolling restarts: on the leader grant waiting units
+    their turn, then perform any restart granted to this unit.
+
+    Call from the peer relation, leader-elected, leader-settings-changed and
+    update-status hooks.
+
+    :param timeout: int Seconds a restarted unit may take to become healthy
+                    before its grant expires, after twice this time
+    :returns: bool Whether no restart remains pending on this unit
+    """
+    try:
+        if juju_is_leader():
+            grant_restarts(batch, 2 * timeout, peer_relation)
+    except NotImplementedError:
+        return True
+    return run_granted_restart(health_check, peer_relation,
+                               restart_functions)
+
+
+def rolling_restart(services, health_check, stopstart=False, batch=1,
+                    timeout=300, peer_relation='cluster',
+                    restart_functions=None):
+    """Restart services so that at most batch units of the application are
+    restarting at once, each unit becoming healthy before the next one
+    starts.
+
+    Restarts are requested over the peer relation and granted by the leader
+    through leader settings, so the restart may only happen in a later hook;
+    see coordinate_restarts. Without peers, or with batch < 1, services are
+    restarted at once. Without leadership support (Juju < 1.24) units fall
+    back to distributed_wait, with groups of batch units a timeout apart.
+
+    :param services: list Services to restart
+    :param health_check: callable returning True once the restarted services
+                         are serving again
+    :param stopstart: bool Whether to stop and start rather than restart
+    :param batch: int Number of units allowed to restart at once
+    :param timeout: int Seconds a restarted unit may take to become healthy
+    :param peer_relation: string Name of the peer relation
+    :param restart_functions: dict {service: function} of nonstandard
+                              functions to restart services with
+    """
+    peers = [unit for rid in relation_ids(peer_relation)
+             for unit in relation_list(rid)]
+    if peers and batch > 0:
+        try:
+            juju_is_leader()
+        except NotImplementedError:
+            groups = -(-(len(peers) + 1) // batch)
+            distributed_wait(modulo=groups, wait=timeout,
+                             operation_name='restart')
+        else:
+            request_restart(services, stopstart, peer_relation)
+            coordinate_restarts(health_check, batch, timeout, peer_relation,
+                                restart_functions)
+            return
+    _restart_services(services, stopstart, restart_functions)
@@ -19,9 +19,19 @@ class BaseAudit(object):  # NO-QA
     The lifecycle of a hardening check is to first check to see if the system
     is in compliance for the specified check. If it is not in compliance, the
     check method will return a value which will be supplied to the.
+
+    Audits given to run_audits() in the same run may name the audits that
+    must complete before them with the requires parameter. Audits which are
+    parallel_safe may run concurrently with other independent audits.
+    Audits which set compliant to True once the resources they audit
+    comply may be skipped by incremental runs while those resources are
+    unchanged; audits which do not set it run every time.
     """
+    parallel_safe = False
+
     def __init__(self, *args, **kwargs):
         self.unless = kwargs.get('unless', None)
+        self.requires = kwargs.get('requires', None) or []
         super(BaseAudit, self).__init__()
 
     def ensure_compliance(self):
@@ -33,6 +43,11 @@ class BaseAudit(object):  # NO-QA
         """
         pass
 
+    def fingerprint_paths(self):
+        """Paths whose state the outcome of the audit depends on, for the
+        fingerprints of incremental runs."""
+        return []
+
     def _take_action(self):
         """Determines whether to perform the action or not.
 
@@ -0,0 +1,316 @@
+# Copyright 2016 Canonical Limited.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Execution of hardening audits.
+
+run_audits() stats the paths of all the audits it is given in one pass and
+shares the results, along with directory walks and file checksums, through
+an AuditCache that file audits consult while they run. Paths are dropped
+from the cache as soon as an audit has applied compliance to them, and the
+whole cache once an audit with no paths has run.
+
+Audits are run in waves. An audit runs after the audits it requires, after
+earlier audits of the same or an enclosing path, and after earlier audits
+with no paths, whose footprint is unknown, so the outcome is that of
+running them in order. Audits of one wave marked parallel_safe run
+concurrently.
+
+Given a full_audit_interval, runs are incremental: each audit is
+fingerprinted from the hardening settings, its code, its parameters and the
+inode, times, size, mode and ownership of the paths it audits, and is
+skipped while its fingerprint matches the one recorded after it last ran
+compliant. Audits which do not report compliance are never skipped.
+Changes inside audited directories, or to paths only found when
+an audit runs, do not change fingerprints; they are caught by the full
+audit run, skipping nothing, once full_audit_interval has passed.
+"""
+
+import hashlib
+import json
+import os
+import sys
+import time
+
+import six
+
+from multiprocessing.pool import ThreadPool
+
+from charmhelpers.core.hookenv import (
+    log,
+    DEBUG,
+    INFO,
+)
+from charmhelpers.core import unitdata
+from charmhelpers.core.host import file_hash
+from charmhelpers.contrib.hardening import utils
+
+MAX_WORKERS = 4
+FINGERPRINTS_KEY = 'hardening:fingerprints'
+LAST_FULL_AUDIT_KEY = 'hardening:last-full-audit'
+
+_cache = None
+
+
+class AuditCache(object):
+    """Filesystem state shared by the audits of a run."""
+
+    def __init__(self):
+        self._stats = {}
+        self._lstats = {}
+        self._walks = {}
+        self._hashes = {}
+
+    @staticmethod
+    def _cached(cache, func, path):
+        try:
+            result = cache[path]
+        except KeyError:
+            try:
+                result = func(path)
+            except OSError as e:
+                result = e
+            cache[path] = result
+        if isinstance(result, OSError):
+            raise result
+        return result
+
+    def stat(self, path):
+        """os.stat of path, raising OSError as it does."""
+        return self._cached(self._stats, os.stat, path)
+
+    def lstat(self, path):
+        """os.lstat of path, raising OSError as it does."""
+        return self._cached(self._lstats, os.lstat, path)
+
+    def exists(self, path):
+        try:
+            self.stat(path)
+        except OSError:
+            return False
+        return True
+
+    def walk(self, root):
+        """List of the os.walk entries of root."""
+        if root not in self._walks:
+            self._walks[root] = list(os.walk(root))
+        return self._walks[root]
+
+    def file_hash(self, path):
+        if path not in self._hashes:
+            self._hashes[path] = file_hash(path)
+        return self._hashes[path]
+
+    def prefetch(self, paths):
+        """Stat paths in one pass."""
+        for path in sorted(set(paths)):
+            try:
+                self.stat(path)
+            except OSError:
+                pass
+
+    def clear(self):
+        """Forget everything known about the filesystem."""
+        for cache in (self._stats, self._lstats, self._walks, self._hashes):
+            cache.clear()
+
+    def invalidate(self, path):
+        """Forget everything known about path and the paths under it."""
+        for cache in (self._stats, self._lstats, self._hashes):
+            for cached in list(cache):
+                if _contains(path, cached):
+                    cache.pop(cached, None)
+        for root in list(self._walks):
+            if _contains(path, root) or _contains(root, path):
+                self._walks.pop(root, None)
+
+
+def audit_cache():
+    """The AuditCache of the running audits, None outside run_audits()."""
+    return _cache
+
+
+def _contains(parent, path):
+    return (path == parent or
+            path.startswith(parent.rstrip('/') + '/'))
+
+
+def _paths(audit):
+    return [p for p in getattr(audit, 'paths', None) or [] if p]
+
+
+def _overlap(paths, other_paths):
+    for path in paths:
+        for other in other_paths:
+            if _contains(path, other) or _contains(other, path):
+                return True
+    return False
+
+
+def audit_waves(audits):
+    """
+    Group audits into waves which run one after the other.
+
+    :returns: list of lists of audits, in the order given within a wave.
+    """
+    paths = [_paths(audit) for audit in audits]
+    wave_of = []
+    waves = []
+    for i, audit in enumerate(audits):
+        required = getattr(audit, 'requires', None) or []
+        wave = 0
+        for j in range(i):
+            if (audits[j] in required or not paths[i] or not paths[j] or
+                    _overlap(paths[i], paths[j])):
+                wave = max(wave, wave_of[j] + 1)
+        wave_of.append(wave)
+        if wave == len(waves):
+            waves.append([])
+        waves[wave].append(audit)
+    return waves
+
+
+def _stat_fingerprint(cache, path):
+    try:
+        st = cache.stat(path)
+    except OSError:
+        return None
+    return [st.st_ino, st.st_mtime, st.st_ctime, st.st_size, st.st_mode,
+            st.st_uid, st.st_gid]
+
+
+def _module_stamp(audit):
+    # Upgrading the charm rewrites the code of the audits.
+    path = getattr(sys.modules.get(type(audit).__module__), '__file__', None)
+    if not path:
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime, st.st_size]
+
+
+def audit_fingerprint(audit, inputs, cache):
+    """Fingerprint of what the outcome of audit depends on.
+
+    :param inputs: fingerprint of the hardening settings.
+    """
+    # Private state and the outcome of the last run are no inputs.
+    params = sorted((k, v) for k, v in vars(audit).items()
+                    if not k.startswith('_') and k != 'compliant' and
+                    (v is None or isinstance(v, (six.string_types, bool,
+                                                 int, float))))
+    paths = [p for p in audit.fingerprint_paths() if p]
+    data = [inputs, type(audit).__module__, type(audit).__name__,
+            _module_stamp(audit), params,
+            [[p, _stat_fingerprint(cache, p)] for p in sorted(paths)]]
+    return hashlib.sha256(
+        json.dumps(data, sort_keys=True).encode('UTF-8')).hexdigest()
+
+
+def _audit_keys(audits):
+    # Audits are created afresh by each hook; they are told apart by class
+    # and paths, and by position among audits with the same ones.
+    keys = []
+    seen = {}
+    for audit in audits:
+        paths = sorted(str(p) for p in audit.fingerprint_paths())
+        key = '%s.%s:%s' % (type(audit).__module__, type(audit).__name__,
+                            hashlib.sha1(json.dumps(paths).encode('UTF-8'))
+                            .hexdigest())
+        seen[key] = seen.get(key, 0) + 1
+        keys.append('%s#%d' % (key, seen[key]))
+    return keys
+
+
+def _run_audit(audit):
+    log("Running '%s' check" % (audit.__class__.__name__), level=DEBUG)
+    audit.ensure_compliance()
+    if not _paths(audit):
+        # What an audit without paths changed is unknown; it runs in a wave
+        # of its own, so nothing else uses the cache meanwhile.
+        _cache.clear()
+
+
+def _run_waves(audits, workers):
+    _cache.prefetch(p for audit in audits for p in _paths(audit))
+    for wave in audit_waves(audits):
+        parallel = [a for a in wave
+                    if getattr(a, 'parallel_safe', False)]
+        if workers > 1 and len(parallel) > 1:
+            pool = ThreadPool(min(workers, len(parallel)))
+            try:
+                pool.map(_run_audit, parallel)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            parallel = []
+        for audit in wave:
+            if audit not in parallel:
+                _run_audit(audit)
+
+
+def run_audits(audits, workers=MAX_WORKERS, full_audit_interval=None):
+    """
+    Ensure the compliance of audits.
+
+    :param audits: list of audits, in the order they were registered.
+    :param workers: number of audits run concurrently.
+    :param full_audit_interval: seconds between full audits of an
+                                incremental run; runs are not incremental
+                                if not set.
+    """
+    global _cache
+    previous, _cache = _cache, AuditCache()
+    try:
+        if not full_audit_interval:
+            _run_waves(audits, workers)
+            return
+
+        db = unitdata.kv()
+        now = time.time()
+        full = now - (db.get(LAST_FULL_AUDIT_KEY) or 0) >= full_audit_interval
+        stored = {} if full else db.get(FINGERPRINTS_KEY) or {}
+        inputs = utils.settings_fingerprint()
+        keys = _audit_keys(audits)
+        pending = []
+        for audit, key in zip(audits, keys):
+            if (key in stored and
+                    stored[key] == audit_fingerprint(audit, inputs, _cache)):
+                log("Skipping unchanged '%s' check" %
+                    (audit.__class__.__name__), level=DEBUG)
+                continue
+            pending.append(audit)
+        log("Running %d of %d hardening checks%s" %
+            (len(pending), len(audits), ' (full audit)' if full else ''),
+            level=INFO)
+
+        _run_waves(pending, workers)
+
+        fingerprints = dict((k, stored[k]) for k in keys if k in stored)
+        for audit, key in zip(audits, keys):
+            if audit not in pending:
+                continue
+            if getattr(audit, 'compliant', False):
+                fingerprints[key] = audit_fingerprint(audit, inputs, _cache)
+            else:
+                fingerprints.pop(key, None)
+        db.set(FINGERPRINTS_KEY, fingerprints)
+        if full:
+            db.set(LAST_FULL_AUDIT_KEY, now)
+        db.flush()
+    finally:
+        _cache = previous
@@ -25,8 +25,13 @@ from subprocess import (
 from traceback import format_exc
 from six import string_types
 from stat import (
+    S_IROTH,
+    S_ISDIR,
     S_ISGID,
-    S_ISUID
+    S_ISREG,
+    S_ISUID,
+    S_IWGRP,
+    S_IWOTH,
 )
 
 from charmhelpers.core.hookenv import (
@@ -39,6 +44,7 @@ from charmhelpers.core.hookenv import (
 from charmhelpers.core import unitdata
 from charmhelpers.core.host import file_hash
 from charmhelpers.contrib.hardening.audits import BaseAudit
+from charmhelpers.contrib.hardening.audits.executor import audit_cache
 from charmhelpers.contrib.hardening.templating import (
     get_template_path,
     render_and_write,
@@ -46,6 +52,49 @@ from charmhelpers.contrib.hardening.templating import (
 from charmhelpers.contrib.hardening import utils
 
 
+def _exists(path):
+    cache = audit_cache()
+    if cache is None:
+        return os.path.exists(path)
+    return cache.exists(path)
+
+
+def _walk(path):
+    cache = audit_cache()
+    if cache is None:
+        return os.walk(path)
+    return cache.walk(path)
+
+
+def _file_hash(path):
+    cache = audit_cache()
+    if cache is None:
+        return file_hash(path)
+    return cache.file_hash(path)
+
+
+def _files_with_mode(path, mode, all_bits=True):
+    """Regular files at or under path with all (or any) of the bits of mode
+    set, symlinks not followed, like find -perm -mode (or /mode)."""
+    cache = audit_cache()
+    lstat = os.lstat if cache is None else cache.lstat
+    paths = [path]
+    # find does not descend into a symlink given as path either.
+    if not os.path.islink(path):
+        for root, _, files in _walk(path):
+            paths.extend(os.path.join(root, f) for f in files)
+    matches = []
+    for p in paths:
+        try:
+            st = lstat(p)
+        except OSError:
+            continue
+        bits = st.st_mode & mode
+        if S_ISREG(st.st_mode) and (bits == mode if all_bits else bits):
+            matches.append(p)
+    return matches
+
+
 class BaseFileAudit(BaseAudit):
     """Base class for file audits.
 
@@ -56,23 +105,42 @@ class BaseFileAudit(BaseAudit):
     def __init__(self, paths, always_comply=False, *args, **kwargs):
         """
         :param paths: string path of list of paths of files we want to apply
-                      compliance checks are criteria to.
+                      compliance checks are criteria to, or a callable
+                      returning the list when the audit first needs it.
         :param always_comply: if true compliance criteria is always applied
                               else compliance is skipped for non-existent
                               paths.
         """
         super(BaseFileAudit, self).__init__(*args, **kwargs)
         self.always_comply = always_comply
-        if isinstance(paths, string_types) or not hasattr(paths, '__iter__'):
-            self.paths = [paths]
+        self._find_paths = None
+        if callable(paths):
+            self._find_paths = paths
+            self._paths = None
+        elif (isinstance(paths, string_types) or
+                not hasattr(paths, '__iter__')):
+            self._paths = [paths]
         else:
-            self.paths = paths
+            self._paths = paths
+
+    @property
+    def paths(self):
+        if self._paths is None:
+            self._paths = self._find_paths()
+        return self._paths
+
+    def fingerprint_paths(self):
+        # Paths found when the audit runs are left to full audits.
+        if self._find_paths is not None:
+            return []
+        return list(self.paths)
 
     def ensure_compliance(self):
         """Ensure that the all registered files comply to registered criteria.
         """
+        self.compliant = True
         for p in self.paths:
-            if os.path.exists(p):
+            if _exists(p):
                 if self.is_compliant(p):
                     continue
 
@@ -83,9 +151,14 @@ class BaseFileAudit(BaseAudit):
                         % (p), level=INFO)
                     continue
 
-            if self._take_action():
+            if not self._take_action():
+                self.compliant = False
+            else:
                 log("Applying compliance criteria to '%s'" % (p), level=INFO)
                 self.comply(p)
+                cache = audit_cache()
+                if cache is not None:
+                    cache.invalidate(p)
 
     def is_compliant(self, path):
         """Audits the path to see if it is compliance.
@@ -109,7 +182,10 @@ class BaseFileAudit(BaseAudit):
         :returns: an st_stat object for the path or None if the path doesn't
                   exist.
         """
-        return os.stat(path)
+        cache = audit_cache()
+        if cache is None:
+            return os.stat(path)
+        return cache.stat(path)
 
 
 class FilePermissionAudit(BaseFileAudit):
@@ -119,6 +195,8 @@ class FilePermissionAudit(BaseFileAudit):
     will own the file(s) specified and that the permissions specified are
     applied properly to the file.
     """
+    parallel_safe = True
+
     def __init__(self, paths, user, group=None, mode=0o600, **kwargs):
         self.user = user
         self.group = group
@@ -211,7 +289,11 @@ class DirectoryPermissionAudit(FilePermissionAudit):
         :param path: the directory path to check
         :returns: True if the directory tree is compliant, otherwise False.
         """
-        if not os.path.isdir(path):
+        try:
+            is_dir = S_ISDIR(self._get_stat(path).st_mode)
+        except OSError:
+            is_dir = False
+        if not is_dir:
             log('Path specified %s is not a directory.' % path, level=ERROR)
             raise ValueError("%s is not a directory." % path)
 
@@ -219,7 +301,7 @@ class DirectoryPermissionAudit(FilePermissionAudit):
             return super(DirectoryPermissionAudit, self).is_compliant(path)
 
         compliant = True
-        for root, dirs, _ in os.walk(path):
+        for root, dirs, _ in _walk(path):
             if len(dirs) > 0:
                 continue
 
@@ -237,27 +319,15 @@ class DirectoryPermissionAudit(FilePermissionAudit):
 
 class ReadOnly(BaseFileAudit):
     """Audits that files and folders are read only."""
+    parallel_safe = True
+
     def __init__(self, paths, *args, **kwargs):
         super(ReadOnly, self).__init__(paths=paths, *args, **kwargs)
 
     def is_compliant(self, path):
-        try:
-            output = check_output(['find', path, '-perm', '-go+w',
-                                   '-type', 'f']).strip()
-
-            # The find above will find any files which have permission sets
-            # which allow too broad of write access. As such, the path is
-            # compliant if there is no output.
-            if output:
-                return False
-
-            return True
-        except CalledProcessError as e:
-            log('Error occurred checking finding writable files for %s. '
-                'Error information is: command %s failed with returncode '
-                '%d and output %s.\n%s' % (path, e.cmd, e.returncode, e.output,
-                                           format_exc(e)), level=ERROR)
-            return False
+        # Any file with permission sets which allow too broad of write
+        # access makes the path non-compliant.
+        return not _files_with_mode(path, S_IWGRP | S_IWOTH)
 
     def comply(self, path):
         try:
@@ -273,27 +343,15 @@ class NoReadWriteForOther(BaseFileAudit):
     """Ensures that the files found under the base path are readable or
     writable by anyone other than the owner or the group.
     """
+    parallel_safe = True
+
     def __init__(self, paths):
         super(NoReadWriteForOther, self).__init__(paths)
 
     def is_compliant(self, path):
-        try:
-            cmd = ['find', path, '-perm', '-o+r', '-type', 'f', '-o',
-                   '-perm', '-o+w', '-type', 'f']
-            output = check_output(cmd).strip()
-
-            # The find above here will find any files which have read or
-            # write permissions for other, meaning there is too broad of access
-            # to read/write the file. As such, the path is compliant if there's
-            # no output.
-            if output:
-                return False
-
-            return True
-        except CalledProcessError as e:
-            log('Error occurred while finding files which are readable or '
-                'writable to the world in %s. '
-                'Command output is: %s.' % (path, e.output), level=ERROR)
+        # Files with read or write permissions for other have too broad of
+        # access, so the path is only compliant if there are none.
+        return not _files_with_mode(path, S_IROTH | S_IWOTH, all_bits=False)
 
     def comply(self, path):
         try:
@@ -305,6 +363,8 @@ class NoReadWriteForOther(BaseFileAudit):
 
 class NoSUIDSGIDAudit(BaseFileAudit):
     """Audits that specified files do not have SUID/SGID bits set."""
+    parallel_safe = True
+
     def __init__(self, paths, *args, **kwargs):
         super(NoSUIDSGIDAudit, self).__init__(paths=paths, *args, **kwargs)
 
@@ -362,6 +422,11 @@ class TemplatedFile(BaseFileAudit):
 
         return False
 
+    def fingerprint_paths(self):
+        paths = super(TemplatedFile, self).fingerprint_paths()
+        return paths + [get_template_path(self.template_dir, p)
+                        for p in paths]
+
     def run_service_actions(self):
         """Run any actions on services requested."""
         if not self.service_actions:
@@ -417,7 +482,7 @@ class TemplatedFile(BaseFileAudit):
         """
         template_path = get_template_path(self.template_dir, path)
         key = 'hardening:template:%s' % template_path
-        template_checksum = file_hash(template_path)
+        template_checksum = _file_hash(template_path)
         kv = unitdata.kv()
         stored_tmplt_checksum = kv.get(key)
         if not stored_tmplt_checksum:
@@ -450,7 +515,7 @@ class TemplatedFile(BaseFileAudit):
 
         :param path: the file to check.
         """
-        checksum = file_hash(path)
+        checksum = _file_hash(path)
 
         kv = unitdata.kv()
         stored_checksum = kv.get('hardening:%s' % path)
@@ -486,11 +551,13 @@ class TemplatedFile(BaseFileAudit):
 
 class DeletedFile(BaseFileAudit):
     """Audit to ensure that a file is deleted."""
+    parallel_safe = True
+
     def __init__(self, paths):
         super(DeletedFile, self).__init__(paths)
 
     def is_compliant(self, path):
-        return not os.path.exists(path)
+        return not _exists(path)
 
     def comply(self, path):
         os.remove(path)
@@ -498,6 +565,8 @@ class DeletedFile(BaseFileAudit):
 
 class FileContentAudit(BaseFileAudit):
     """Audit the contents of a file."""
+    parallel_safe = True
+
     def __init__(self, paths, cases, **kwargs):
         # Cases we expect to pass
         self.pass_cases = cases.get('pass', [])
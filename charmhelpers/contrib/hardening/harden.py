@@ -22,13 +22,20 @@ from charmhelpers.core.hookenv import (
     DEBUG,
     WARNING,
 )
-from charmhelpers.contrib.hardening.host.checks import run_os_checks
-from charmhelpers.contrib.hardening.ssh.checks import run_ssh_checks
-from charmhelpers.contrib.hardening.mysql.checks import run_mysql_checks
-from charmhelpers.contrib.hardening.apache.checks import run_apache_checks
+from charmhelpers.contrib.hardening.audits.executor import run_audits
+from charmhelpers.contrib.hardening.host.checks import get_os_audits
+from charmhelpers.contrib.hardening.ssh.checks import get_ssh_audits
+from charmhelpers.contrib.hardening.mysql.checks import get_mysql_audits
+from charmhelpers.contrib.hardening.apache.checks import get_apache_audits
 
+# Modules are always audited in this order.
+AUDIT_CATALOG = OrderedDict([('os', get_os_audits),
+                             ('ssh', get_ssh_audits),
+                             ('mysql', get_mysql_audits),
+                             ('apache', get_apache_audits)])
 
-def harden(overrides=None):
+
+def harden(overrides=None, full_audit_interval=None):
     """Hardening decorator.
 
     This is the main entry point for running the hardening stack. In order to
@@ -43,36 +50,40 @@ def harden(overrides=None):
     to resources hardened by the first run (and possibly perform compliance
     actions as a result of any detected infractions).
 
+    Given a full audit interval, either as full_audit_interval or as the
+    'harden-full-audit-interval' config option, hardening is incremental:
+    audits whose inputs have not changed since they last ran compliant are
+    skipped, except by a full audit once per interval.
+
     :param overrides: Optional list of stack modules used to override those
                       provided with 'harden' config.
+    :param full_audit_interval: Optional number of seconds between full
+                                audits, used to override the config.
     :returns: Returns value returned by decorated function once executed.
     """
     def _harden_inner1(f):
         log("Hardening function '%s'" % (f.__name__), level=DEBUG)
 
         def _harden_inner2(*args, **kwargs):
-            RUN_CATALOG = OrderedDict([('os', run_os_checks),
-                                       ('ssh', run_ssh_checks),
-                                       ('mysql', run_mysql_checks),
-                                       ('apache', run_apache_checks)])
-
             enabled = overrides or (config("harden") or "").split()
             if enabled:
-                modules_to_run = []
-                # modules will always be performed in the following order
-                for module, func in six.iteritems(RUN_CATALOG):
+                audits = []
+                for module, get_audits in six.iteritems(AUDIT_CATALOG):
                     if module in enabled:
                         enabled.remove(module)
-                        modules_to_run.append(func)
+                        log("Executing hardening module '%s'" % (module),
+                            level=DEBUG)
+                        audits.extend(get_audits())
 
                 if enabled:
                     log("Unknown hardening modules '%s' - ignoring" %
                         (', '.join(enabled)), level=WARNING)
 
-                for hardener in modules_to_run:
-                    log("Executing hardening module '%s'" %
-                        (hardener.__name__), level=DEBUG)
-                    hardener()
+                # The audits of all modules share one run so that paths
+                # audited by several modules are only examined once.
+                interval = (full_audit_interval or
+                            config('harden-full-audit-interval'))
+                run_audits(audits, full_audit_interval=interval)
             else:
                 log("No hardening applied to '%s'" % (f.__name__), level=DEBUG)
 
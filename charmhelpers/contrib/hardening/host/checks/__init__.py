@@ -16,6 +16,7 @@ from charmhelpers.core.hookenv import (
     log,
     DEBUG,
 )
+from charmhelpers.contrib.hardening.audits.executor import run_audits
 from charmhelpers.contrib.hardening.host.checks import (
     apt,
     limits,
@@ -29,8 +30,7 @@ from charmhelpers.contrib.hardening.host.checks import (
 )
 
 
-def run_os_checks():
-    log("Starting OS hardening checks.", level=DEBUG)
+def get_os_audits():
     checks = apt.get_audits()
     checks.extend(limits.get_audits())
     checks.extend(login.get_audits())
@@ -40,9 +40,10 @@ def run_os_checks():
     checks.extend(securetty.get_audits())
     checks.extend(suid_sgid.get_audits())
     checks.extend(sysctl.get_audits())
+    return checks
 
-    for check in checks:
-        log("Running '%s' check" % (check.__class__.__name__), level=DEBUG)
-        check.ensure_compliance()
 
+def run_os_checks():
+    log("Starting OS hardening checks.", level=DEBUG)
+    run_audits(get_os_audits())
     log("OS hardening checks complete.", level=DEBUG)
@@ -108,8 +108,11 @@ def get_audits():
         # If the policy is a dry_run (e.g. complain only) or remove unknown
         # suid/sgid bits then find all of the paths which have the suid/sgid
         # bit set and then remove the whitelisted paths.
+        # The filesystem is only searched if the audit runs.
         root_path = settings['environment']['root_path']
-        unknown_paths = find_paths_with_suid_sgid(root_path) - set(whitelist)
+
+        def unknown_paths():
+            return find_paths_with_suid_sgid(root_path) - set(whitelist)
         checks.append(NoSUIDSGIDAudit(unknown_paths, unless=dry_run))
 
     return checks
@@ -16,14 +16,15 @@ from charmhelpers.core.hookenv import (
     log,
     DEBUG,
 )
+from charmhelpers.contrib.hardening.audits.executor import run_audits
 from charmhelpers.contrib.hardening.mysql.checks import config
 
 
+def get_mysql_audits():
+    return config.get_audits()
+
+
 def run_mysql_checks():
     log("Starting MySQL hardening checks.", level=DEBUG)
-    checks = config.get_audits()
-    for check in checks:
-        log("Running '%s' check" % (check.__class__.__name__), level=DEBUG)
-        check.ensure_compliance()
-
+    run_audits(get_mysql_audits())
     log("MySQL hardening checks complete.", level=DEBUG)
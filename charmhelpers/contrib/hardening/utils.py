@@ -14,6 +14,7 @@
 
 import glob
 import grp
+import hashlib
 import os
 import pwd
 import six
@@ -45,6 +46,25 @@ def _get_defaults(modules):
     return yaml.safe_load(open(default))
 
 
+def settings_fingerprint():
+    """sha256 of the config defaults of all modules and of the user-provided
+    overrides.
+    """
+    paths = sorted(glob.glob(os.path.join(os.path.dirname(__file__),
+                                          'defaults', '*.yaml')))
+    paths.append(os.path.join(os.environ.get('JUJU_CHARM_DIR', ''),
+                              'hardening.yaml'))
+    checksum = hashlib.sha256()
+    for path in paths:
+        checksum.update(path.encode('UTF-8'))
+        try:
+            with open(path, 'rb') as f:
+                checksum.update(f.read())
+        except IOError:
+            pass
+    return checksum.hexdigest()
+
+
 def _get_schema(modules):
     """Load the config schema for the provided modules.
 
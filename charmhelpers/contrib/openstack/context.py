@@ -60,6 +60,7 @@ from charmhelpers.core.host import (
     write_file,
     pwgen,
     lsb_release,
+    get_total_ram,
     CompareHostReleases,
     is_container,
 )
@@ -139,11 +140,18 @@ def context_complete(ctxt):
 
 
 class OSContextGenerator(object):
-    """Base class for all context generators."""
+    """Base class for all context generators.
+
+    Generators which only read charm config and relation data, and have no
+    side effects such as writing files, setting relation data or installing
+    packages, may set thread_safe so that they can be evaluated concurrently
+    with other generators.
+    """
     interfaces = []
     related = False
     complete = False
     missing_data = []
+    thread_safe = False
 
     def __call__(self):
         raise NotImplementedError
@@ -261,6 +269,7 @@ class SharedDBContext(OSContextGenerator):
 
 class PostgresqlDBContext(OSContextGenerator):
     interfaces = ['pgsql-db']
+    thread_safe = True
 
     def __init__(self, database=None):
         self.database = database
@@ -1131,6 +1140,7 @@ class OSConfigFlagContext(OSContextGenerator):
           key=value pairs and some Openstack config files support
           comma-separated lists as values.
     """
+    thread_safe = True
 
     def __init__(self, charm_flag='config-flags',
                  template_flag='user_config_flags'):
@@ -1208,6 +1218,7 @@ class SubordinateConfigContext(OSContextGenerator):
             }
         }
     """
+    thread_safe = True
 
     def __init__(self, service, config_file, interface):
         """
@@ -1275,6 +1286,7 @@ class SubordinateConfigContext(OSContextGenerator):
 
 
 class LogLevelContext(OSContextGenerator):
+    thread_safe = True
 
     def __call__(self):
         ctxt = {}
@@ -1287,6 +1299,7 @@ class LogLevelContext(OSContextGenerator):
 
 
 class SyslogContext(OSContextGenerator):
+    thread_safe = True
 
     def __call__(self):
         ctxt = {'use_syslog': config('use-syslog')}
@@ -1294,6 +1307,7 @@ class SyslogContext(OSContextGenerator):
 
 
 class BindHostContext(OSContextGenerator):
+    thread_safe = True
 
     def __call__(self):
         if config('prefer-ipv6'):
@@ -1304,32 +1318,159 @@ class BindHostContext(OSContextGenerator):
 
 MAX_DEFAULT_WORKERS = 4
 DEFAULT_MULTIPLIER = 2
+# Share of the unit's memory which worker processes may use between them.
+DEFAULT_WORKER_MEMORY_FRACTION = 0.5
+
+CGROUP_V2_CPU_MAX = '/sys/fs/cgroup/cpu.max'
+CGROUP_V1_CPU_QUOTA = '/sys/fs/cgroup/cpu/cpu.cfs_quota_us'
+CGROUP_V1_CPU_PERIOD = '/sys/fs/cgroup/cpu/cpu.cfs_period_us'
+CGROUP_V2_MEMORY_MAX = '/sys/fs/cgroup/memory.max'
+CGROUP_V1_MEMORY_LIMIT = '/sys/fs/cgroup/memory/memory.limit_in_bytes'
+
+
+def _read_cgroup_file(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _cgroup_cpu_quota():
+    '''
+    Number of CPUs the unit may use according to its cgroup CPU
+    bandwidth limit.
+
+    @returns float: CPUs available to the unit or None if unlimited
+    '''
+    value = _read_cgroup_file(CGROUP_V2_CPU_MAX)
+    if value:
+        quota, _, period = value.partition(' ')
+    else:
+        quota = _read_cgroup_file(CGROUP_V1_CPU_QUOTA)
+        period = _read_cgroup_file(CGROUP_V1_CPU_PERIOD)
+    try:
+        quota, period = int(quota), int(period)
+    except (TypeError, ValueError):
+        # 'max', -1 or no cgroup CPU controller
+        return None
+    if quota <= 0 or period <= 0:
+        return None
+    return float(quota) / period
 
 
-def _calculate_workers():
+def _cgroup_memory_limit():
+    '''
+    Memory limit of the unit's cgroup.
+
+    @returns int: limit in bytes or None if unlimited
+    '''
+    value = (_read_cgroup_file(CGROUP_V2_MEMORY_MAX) or
+             _read_cgroup_file(CGROUP_V1_MEMORY_LIMIT))
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        return None
+    # cgroup v1 reports an unlimited group as a huge page aligned value
+    if limit <= 0 or limit >= 2 ** 60:
+        return None
+    return limit
+
+
+class WorkerSizing(object):
+    '''
+    Determine the number of worker processes for a service.
+
+    The CPU bound count is the number of usable CPUs, taking any cgroup
+    CPU quota into account, times the worker-multiplier.  When the memory
+    used by each worker is known the count is also limited so that the
+    workers fit in memory_fraction of the unit's memory.  The steps taken
+    are recorded in reasons.
+    '''
+
+    def __init__(self, worker_rss=None,
+                 memory_fraction=DEFAULT_WORKER_MEMORY_FRACTION):
+        self.worker_rss = worker_rss
+        self.memory_fraction = memory_fraction
+        self.reasons = []
+
+    def _cpus(self):
+        cpus = _num_cpus()
+        quota = _cgroup_cpu_quota()
+        if quota is not None and quota < cpus:
+            self.reasons.append('cgroup CPU quota allows %.2f of %d CPUs' %
+                                (quota, cpus))
+            return quota, True
+        self.reasons.append('%d CPUs' % cpus)
+        return cpus, False
+
+    def _memory(self):
+        total = get_total_ram()
+        limit = _cgroup_memory_limit()
+        if limit is not None and limit < total:
+            self.reasons.append('cgroup memory limit %dMB of %dMB' %
+                                (limit >> 20, total >> 20))
+            return limit
+        return total
+
+    def calculate(self):
+        '''
+        @returns int: number of worker processes to use
+        '''
+        self.reasons = []
+        cpus, limited = self._cpus()
+        multiplier = config('worker-multiplier') or DEFAULT_MULTIPLIER
+        count = int(cpus * multiplier)
+        if multiplier > 0 and count == 0:
+            count = 1
+        self.reasons.append('multiplier %s gives %d' % (multiplier, count))
+
+        if (config('worker-multiplier') is None and is_container() and
+                not limited and count > MAX_DEFAULT_WORKERS):
+            # NOTE(jamespage): Limit unconfigured worker-multiplier
+            #                  to MAX_DEFAULT_WORKERS to avoid insane
+            #                  worker configuration in LXD containers
+            #                  on large servers
+            # Reference: https://pad.lv/1665270
+            count = MAX_DEFAULT_WORKERS
+            self.reasons.append('container without CPU quota, limited to '
+                                '%d' % count)
+
+        if self.worker_rss and count > 1:
+            memory = self._memory() * self.memory_fraction
+            fits = max(1, int(memory // self.worker_rss))
+            if fits < count:
+                count = fits
+                self.reasons.append(
+                    '%dMB per worker in %dMB of memory limits to %d' %
+                    (self.worker_rss >> 20, memory // 2 ** 20, count))
+
+        return count
+
+    def explain(self):
+        return ', '.join(self.reasons)
+
+
+def _calculate_workers(worker_rss=None,
+                       memory_fraction=DEFAULT_WORKER_MEMORY_FRACTION):
     '''
     Determine the number of worker processes based on the CPU
-    count of the unit containing the application.
+    count of the unit containing the application and, if worker_rss is
+    given, the memory each worker process uses.
 
     Workers will be limited to MAX_DEFAULT_WORKERS in
     container environments where no worker-multipler configuration
-    option been set.
+    option been set and no CPU quota applies.
 
+    @param worker_rss: memory used by each worker process in bytes
+    @param memory_fraction: share of the unit's memory the workers may use
     @returns int: number of worker processes to use
     '''
-    multiplier = config('worker-multiplier') or DEFAULT_MULTIPLIER
-    count = int(_num_cpus() * multiplier)
-    if multiplier > 0 and count == 0:
-        count = 1
-
-    if config('worker-multiplier') is None and is_container():
-        # NOTE(jamespage): Limit unconfigured worker-multiplier
-        #                  to MAX_DEFAULT_WORKERS to avoid insane
-        #                  worker configuration in LXD containers
-        #                  on large servers
-        # Reference: https://pad.lv/1665270
-        count = min(count, MAX_DEFAULT_WORKERS)
-
+    sizing = WorkerSizing(worker_rss=worker_rss,
+                          memory_fraction=memory_fraction)
+    count = sizing.calculate()
+    log('Using %d worker processes: %s' % (count, sizing.explain()),
+        level=INFO)
     return count
 
 
@@ -1347,9 +1488,20 @@ def _num_cpus():
 
 
 class WorkerConfigContext(OSContextGenerator):
+    thread_safe = True
+
+    def worker_rss(self):
+        '''Memory used by each worker process in bytes, if known.'''
+        return None
+
+    def memory_fraction(self):
+        '''Share of the unit's memory the workers of the service may use,
+        to be divided between services sized separately.'''
+        return DEFAULT_WORKER_MEMORY_FRACTION
 
     def __call__(self):
-        ctxt = {"workers": _calculate_workers()}
+        ctxt = {"workers": _calculate_workers(self.worker_rss(),
+                                              self.memory_fraction())}
         return ctxt
 
 
@@ -1369,7 +1521,8 @@ class WSGIWorkerConfigContext(WorkerConfigContext):
         self.public_process_weight = public_process_weight
 
     def __call__(self):
-        total_processes = _calculate_workers()
+        total_processes = _calculate_workers(self.worker_rss(),
+                                             self.memory_fraction())
         ctxt = {
             "service_name": self.service_name,
             "user": self.user,
@@ -12,34 +12,230 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextlib
+import hashlib
+import inspect
+import json
 import os
+import shutil
+import sys
+from multiprocessing.pool import ThreadPool
 
 import six
 
 from charmhelpers.fetch import apt_install, apt_update
 from charmhelpers.core.hookenv import (
+    atexit,
+    charm_dir,
     log,
     ERROR,
     INFO,
     TRACE
 )
+from charmhelpers.core import tracing
+from charmhelpers.core.host import file_hash
+from charmhelpers.core.unitdata import kv
 from charmhelpers.contrib.openstack.utils import OPENSTACK_CODENAMES
 
 try:
-    from jinja2 import FileSystemLoader, ChoiceLoader, Environment, exceptions
+    from jinja2 import (
+        BaseLoader, FileSystemLoader, ChoiceLoader, ModuleLoader, Environment,
+        FileSystemBytecodeCache, exceptions, meta
+    )
+    import jinja2
 except ImportError:
     apt_update(fatal=True)
     if six.PY2:
         apt_install('python-jinja2', fatal=True)
     else:
         apt_install('python3-jinja2', fatal=True)
-    from jinja2 import FileSystemLoader, ChoiceLoader, Environment, exceptions
+    from jinja2 import (
+        BaseLoader, FileSystemLoader, ChoiceLoader, ModuleLoader, Environment,
+        FileSystemBytecodeCache, exceptions, meta
+    )
+    import jinja2
+
+# unitdata key under which the render cache is persisted between hooks.
+RENDER_CACHE_KEY = 'templating.render-cache'
+
+# Directory, relative to the charm, holding the jinja2 bytecode cache.
+BYTECODE_CACHE_DIR = '.jinja2-cache'
+
+# Directory, relative to a charm's templates dir, holding templates
+# precompiled by precompile_templates().
+COMPILED_TEMPLATES_DIR = '.compiled'
+COMPILED_MANIFEST = 'manifest.json'
+# unitdata key recording, per precompiled template dir, the outcome of
+# checking its manifest against template sources of a given size and mtime.
+COMPILED_CHECKS_KEY = 'templating.precompiled-checks'
+
+
+def _sha256(data):
+    if isinstance(data, six.text_type):
+        data = data.encode('UTF-8')
+    return hashlib.sha256(data).hexdigest()
 
 
 class OSConfigException(Exception):
     pass
 
 
+def _template_dirs(templates_dir, os_release):
+    """
+    List of (name, path) tuples of the template dirs searched for
+    os_release, in ascending order of precedence.
+    """
+    # the bottom contains the helper templates dir, if shipped, and
+    # templates_dir.
+    dirs = []
+    helper_templates = os.path.join(os.path.dirname(__file__), 'templates')
+    if os.path.isdir(helper_templates):
+        dirs.append(('_helper', helper_templates))
+    dirs.append(('_base', templates_dir))
+
+    for rel in six.itervalues(OPENSTACK_CODENAMES):
+        tmpl_dir = os.path.join(templates_dir, rel)
+        if os.path.isdir(tmpl_dir):
+            dirs.append((rel, tmpl_dir))
+        if rel == os_release:
+            break
+    return dirs
+
+
+def _is_template(name):
+    """Whether name, relative to a template dir, is a template of that dir
+    rather than of a release sub-directory or the precompiled templates.
+    """
+    top = name.split('/')[0]
+    return (top not in (COMPILED_TEMPLATES_DIR, '__pycache__') and
+            top not in OPENSTACK_CODENAMES.values() and
+            not name.endswith(('.py', '.pyc')))
+
+
+def _template_manifest(searchpath):
+    """Digests of the templates in searchpath and the jinja2 and python
+    versions they are compiled for.
+    """
+    sources = {}
+    for name in FileSystemLoader(searchpath).list_templates():
+        if _is_template(name):
+            sources[name] = file_hash(os.path.join(searchpath, name),
+                                      hash_type='sha256')
+    return {
+        'jinja2': jinja2.__version__,
+        'python': list(sys.version_info[:2]),
+        'sources': sources,
+    }
+
+
+def _template_stamp(searchpath):
+    """Size and mtime of the templates in searchpath and the jinja2 and
+    python versions in use.
+    """
+    stats = {}
+    for name in FileSystemLoader(searchpath).list_templates():
+        if _is_template(name):
+            st = os.stat(os.path.join(searchpath, name))
+            stats[name] = [st.st_size, st.st_mtime]
+    return {
+        'jinja2': jinja2.__version__,
+        'python': list(sys.version_info[:2]),
+        'stats': stats,
+    }
+
+
+def precompile_templates(templates_dir):
+    """
+    Compile the charm's templates and those shipped with this helper into
+    python modules under templates_dir/.compiled.
+
+    Intended to be run as a build step, eg::
+
+        python -c "from charmhelpers.contrib.openstack.templating import \\
+            precompile_templates; precompile_templates('templates')"
+
+    Precompiled templates are only used at runtime if they were compiled
+    with the same jinja2 and python versions and their sources have not
+    changed since, see get_loader().
+
+    :param templates_dir (str): Base template directory containing release
+        sub-directories.
+    """
+    compiled_dir = os.path.join(templates_dir, COMPILED_TEMPLATES_DIR)
+    if os.path.isdir(compiled_dir):
+        shutil.rmtree(compiled_dir)
+    dirs = _template_dirs(templates_dir,
+                          list(OPENSTACK_CODENAMES.values())[-1])
+    for name, searchpath in dirs:
+        target = os.path.join(compiled_dir, name)
+        env = Environment(loader=FileSystemLoader(searchpath))
+        env.compile_templates(target, zip=None, filter_func=_is_template)
+        with open(os.path.join(target, COMPILED_MANIFEST), 'w') as out:
+            json.dump(_template_manifest(searchpath), out, sort_keys=True)
+
+
+class PrecompiledLoader(BaseLoader):
+    """
+    Loads templates from modules built by precompile_templates(), falling
+    back to the template sources for any template that was not compiled.
+    Template sources are always served from searchpath.
+    """
+    def __init__(self, searchpath, module_path):
+        self.searchpath = [searchpath]
+        self._source = FileSystemLoader(searchpath)
+        self._modules = ModuleLoader(module_path)
+
+    def get_source(self, environment, template):
+        return self._source.get_source(environment, template)
+
+    def list_templates(self):
+        return self._source.list_templates()
+
+    def load(self, environment, name, globals=None):
+        try:
+            return self._modules.load(environment, name, globals)
+        except exceptions.TemplateNotFound:
+            return self._source.load(environment, name, globals)
+
+
+def _precompiled_loader(templates_dir, name, searchpath):
+    """
+    PrecompiledLoader for searchpath if up to date precompiled templates
+    exist for it, otherwise None.
+
+    Template sources are only hashed to check them against the manifest
+    when their size or mtime changed since they were last checked. The
+    outcome is kept in unitdata, as the charm's templates dir is replaced
+    on upgrade and need not be writable.
+    """
+    module_path = os.path.join(templates_dir, COMPILED_TEMPLATES_DIR, name)
+    manifest = os.path.join(module_path, COMPILED_MANIFEST)
+    if not os.path.exists(manifest):
+        return None
+    stamp = _template_stamp(searchpath)
+    db = kv()
+    checks = db.get(COMPILED_CHECKS_KEY, {})
+    checked = checks.get(module_path)
+    if checked and checked.get('stamp') == stamp:
+        current = checked['current']
+    else:
+        try:
+            with open(manifest) as f:
+                compiled = json.load(f)
+        except ValueError:
+            return None
+        current = compiled == _template_manifest(searchpath)
+        checks[module_path] = {'stamp': stamp, 'current': current}
+        db.set(COMPILED_CHECKS_KEY, checks)
+        # only persist the check if the hook completes successfully.
+        atexit(db.flush)
+    if not current:
+        log('Precompiled templates at %s are stale, ignoring.' % module_path,
+            level=INFO)
+        return None
+    return PrecompiledLoader(searchpath, module_path)
+
+
 def get_loader(templates_dir, os_release):
     """
     Create a jinja2.ChoiceLoader containing template dirs up to
@@ -53,6 +249,9 @@ def get_loader(templates_dir, os_release):
 
         hooks/charmhelpers/contrib/openstack/templates
 
+    Template dirs for which up to date precompiled templates exist (see
+    precompile_templates()) are loaded from those instead.
+
     :param templates_dir (str): Base template directory containing release
         sub-directories.
     :param os_release (str): OpenStack release codename to construct template
@@ -61,26 +260,16 @@ def get_loader(templates_dir, os_release):
         jinja2.FilesystemLoaders, ordered in descending
         order by OpenStack release.
     """
-    tmpl_dirs = [(rel, os.path.join(templates_dir, rel))
-                 for rel in six.itervalues(OPENSTACK_CODENAMES)]
-
     if not os.path.isdir(templates_dir):
         log('Templates directory not found @ %s.' % templates_dir,
             level=ERROR)
         raise OSConfigException
 
-    # the bottom contains tempaltes_dir and possibly a common templates dir
-    # shipped with the helper.
-    loaders = [FileSystemLoader(templates_dir)]
-    helper_templates = os.path.join(os.path.dirname(__file__), 'templates')
-    if os.path.isdir(helper_templates):
-        loaders.append(FileSystemLoader(helper_templates))
-
-    for rel, tmpl_dir in tmpl_dirs:
-        if os.path.isdir(tmpl_dir):
-            loaders.insert(0, FileSystemLoader(tmpl_dir))
-        if rel == os_release:
-            break
+    loaders = []
+    for name, tmpl_dir in _template_dirs(templates_dir, os_release):
+        loader = (_precompiled_loader(templates_dir, name, tmpl_dir) or
+                  FileSystemLoader(tmpl_dir))
+        loaders.insert(0, loader)
     # demote this log to the lowest level; we don't really need to see these
     # lots in production even when debugging.
     log('Creating choice loader with dirs: %s' %
@@ -88,16 +277,146 @@ def get_loader(templates_dir, os_release):
     return ChoiceLoader(loaders)
 
 
+def get_bytecode_cache(os_release):
+    """
+    Create a jinja2.FileSystemBytecodeCache persisted in the charm directory
+    and keyed by charm revision and OpenStack release, removing caches left
+    behind by other revisions or releases.
+
+    :param os_release (str): OpenStack release codename.
+    :returns: jinja2.FileSystemBytecodeCache or None if the charm directory
+        is not known.
+    """
+    _charm_dir = charm_dir()
+    if not _charm_dir:
+        return None
+    revision = '0'
+    revision_file = os.path.join(_charm_dir, 'revision')
+    if os.path.exists(revision_file):
+        with open(revision_file) as f:
+            revision = f.read().strip() or revision
+    cache_root = os.path.join(_charm_dir, BYTECODE_CACHE_DIR)
+    cache_name = '{}-{}'.format(revision, os_release)
+    if os.path.isdir(cache_root):
+        for stale in os.listdir(cache_root):
+            if stale != cache_name:
+                shutil.rmtree(os.path.join(cache_root, stale),
+                              ignore_errors=True)
+    cache_dir = os.path.join(cache_root, cache_name)
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir, 0o700)
+        except OSError as e:
+            log('Unable to create template bytecode cache %s: %s' %
+                (cache_dir, e), level=INFO)
+            return None
+    return FileSystemBytecodeCache(cache_dir)
+
+
+class ContextScheduler(object):
+    """
+    Evaluates the context generators registered for a set of config files.
+
+    Generators are deduplicated on registration: generators of the same class
+    constructed with the same arguments are replaced by a single instance, so
+    a generator shared by several config files is only evaluated once.
+
+    Contexts are memoized for the requests made within a :meth:`batch`
+    block, such as those of one ``write_all()``, and evaluated again on each
+    request outside of one, as the data they depend on may change during the
+    hook.
+
+    Generators which declare themselves ``thread_safe`` are evaluated
+    concurrently in a pool of up to max_workers threads; all others are
+    evaluated serially, in registration order, in the calling thread.
+    """
+    def __init__(self, max_workers=1):
+        self.max_workers = max_workers
+        self._generators = {}
+        self._results = {}
+        self._batch = 0
+
+    @staticmethod
+    def _key(generator):
+        if inspect.isroutine(generator) or not hasattr(generator, '__dict__'):
+            # plain functions are only ever equivalent to themselves.
+            return (id(generator), None)
+        return (type(generator), repr(sorted(vars(generator).items())))
+
+    def add(self, generator):
+        """
+        Register generator, returning the equivalent instance already
+        registered if there is one.
+        """
+        return self._generators.setdefault(self._key(generator), generator)
+
+    def _evaluate(self, generator, parent=None):
+        with tracing.span('context', type(generator).__name__, parent):
+            return id(generator), generator()
+
+    def evaluate(self, generators):
+        """
+        Evaluate generators, returning their contexts in the same order.
+        """
+        known = self._results.copy()
+        pending = []
+        for generator in generators:
+            if id(generator) not in known and generator not in pending:
+                pending.append(generator)
+
+        parallel = [g for g in pending if getattr(g, 'thread_safe', False)]
+        if len(parallel) > 1 and self.max_workers > 1:
+            pool = ThreadPool(min(self.max_workers, len(parallel)))
+            parent = tracing.current()
+            try:
+                results = pool.map(
+                    lambda g: self._evaluate(g, parent), parallel)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [self._evaluate(g) for g in parallel]
+        results.extend(self._evaluate(g) for g in pending
+                       if g not in parallel)
+
+        for key, ctxt in results:
+            if self._batch:
+                self._results[key] = ctxt
+            known[key] = ctxt
+        return [known[id(g)] for g in generators]
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Evaluate contexts at most once for requests made within the block.
+        """
+        self._batch += 1
+        try:
+            yield
+        finally:
+            self._batch -= 1
+            if not self._batch:
+                self._results = {}
+
+    def invalidate(self):
+        """Discard all memoized contexts."""
+        self._results = {}
+
+
 class OSConfigTemplate(object):
     """
     Associates a config file template with a list of context generators.
     Responsible for constructing a template context based on those generators.
     """
-    def __init__(self, config_file, contexts):
+    def __init__(self, config_file, contexts, scheduler=None):
         self.config_file = config_file
 
         if hasattr(contexts, '__call__'):
-            self.contexts = [contexts]
+            contexts = [contexts]
+
+        self.scheduler = scheduler
+        if scheduler:
+            self.contexts = [scheduler.add(c) for c in contexts]
         else:
             self.contexts = contexts
 
@@ -105,8 +424,11 @@ class OSConfigTemplate(object):
 
     def context(self):
         ctxt = {}
-        for context in self.contexts:
-            _ctxt = context()
+        if self.scheduler:
+            _ctxts = self.scheduler.evaluate(self.contexts)
+        else:
+            _ctxts = [context() for context in self.contexts]
+        for context, _ctxt in zip(self.contexts, _ctxts):
             if _ctxt:
                 ctxt.update(_ctxt)
                 # track interfaces for every complete context.
@@ -197,8 +519,12 @@ class OSConfigRenderer(object):
     of generators.  When a template is rendered and written, all context
     generates are called in a chain to generate the context dictionary
     passed to the jinja2 template. See context.py for more info.
+
+    Generators registered for several config files are only evaluated once
+    by write_all() and complete_contexts(), see ContextScheduler. Set context_workers to evaluate thread
+    safe generators concurrently.
     """
-    def __init__(self, templates_dir, openstack_release):
+    def __init__(self, templates_dir, openstack_release, context_workers=1):
         if not os.path.isdir(templates_dir):
             log('Could not locate templates dir %s' % templates_dir,
                 level=ERROR)
@@ -208,6 +534,10 @@ class OSConfigRenderer(object):
         self.openstack_release = openstack_release
         self.templates = {}
         self._tmpl_env = None
+        self._source_digests = {}
+        self._render_cache = None
+        self._changes = []
+        self.scheduler = ContextScheduler(max_workers=context_workers)
 
         if None in [Environment, ChoiceLoader, FileSystemLoader]:
             # if this code is running, the object is created pre-install hook.
@@ -223,14 +553,17 @@ class OSConfigRenderer(object):
         Register a config file with a list of context generators to be called
         during rendering.
         """
-        self.templates[config_file] = OSConfigTemplate(config_file=config_file,
-                                                       contexts=contexts)
+        self.templates[config_file] = OSConfigTemplate(
+            config_file=config_file, contexts=contexts,
+            scheduler=self.scheduler)
         log('Registered config file: %s' % config_file, level=INFO)
 
     def _get_tmpl_env(self):
         if not self._tmpl_env:
             loader = get_loader(self.templates_dir, self.openstack_release)
-            self._tmpl_env = Environment(loader=loader)
+            self._tmpl_env = Environment(
+                loader=loader,
+                bytecode_cache=get_bytecode_cache(self.openstack_release))
 
     def _get_template(self, template):
         self._get_tmpl_env()
@@ -238,53 +571,159 @@ class OSConfigRenderer(object):
         log('Loaded template from %s' % template.filename, level=INFO)
         return template
 
-    def render(self, config_file):
-        if config_file not in self.templates:
-            log('Config not registered: %s' % config_file, level=ERROR)
-            raise OSConfigException
-        ctxt = self.templates[config_file].context()
+    def _template_name(self, config_file):
+        """Name of the template used to render config_file.
 
+        Templates are looked up by the basename of config_file and, failing
+        that, by a munged full path, eg:
+          /etc/apache2/apache2.conf -> etc_apache2_apache2.conf
+        """
+        self._get_tmpl_env()
         _tmpl = os.path.basename(config_file)
         try:
-            template = self._get_template(_tmpl)
+            self._tmpl_env.loader.get_source(self._tmpl_env, _tmpl)
         except exceptions.TemplateNotFound:
-            # if no template is found with basename, try looking for it
-            # using a munged full path, eg:
-            #   /etc/apache2/apache2.conf -> etc_apache2_apache2.conf
             _tmpl = '_'.join(config_file.split('/')[1:])
             try:
-                template = self._get_template(_tmpl)
+                self._tmpl_env.loader.get_source(self._tmpl_env, _tmpl)
             except exceptions.TemplateNotFound as e:
                 log('Could not load template from %s by %s or %s.' %
-                    (self.templates_dir, os.path.basename(config_file), _tmpl),
-                    level=ERROR)
+                    (self.templates_dir, os.path.basename(config_file),
+                     _tmpl), level=ERROR)
                 raise e
+        return _tmpl
+
+    def _source_digest(self, template):
+        """Digest of the source of template and every template it includes,
+        imports or extends, or None if a reference cannot be resolved
+        statically.
+        """
+        if template in self._source_digests:
+            return self._source_digests[template]
+        # Guard against recursive references.
+        self._source_digests[template] = None
+        source = self._tmpl_env.loader.get_source(self._tmpl_env,
+                                                  template)[0]
+        digests = [_sha256(source)]
+        refs = meta.find_referenced_templates(self._tmpl_env.parse(source))
+        for ref in sorted(refs, key=lambda r: r or ''):
+            digest = ref and self._source_digest(ref)
+            if digest is None:
+                return None
+            digests.append(digest)
+        self._source_digests[template] = _sha256(''.join(digests))
+        return self._source_digests[template]
+
+    def _render_key(self, template, ctxt):
+        """Cache key for rendering template with ctxt, or None if the
+        render cannot be cached.
+        """
+        try:
+            source = self._source_digest(template)
+            if source is None:
+                return None
+            return _sha256(json.dumps([template, source, ctxt],
+                                      sort_keys=True, default=repr))
+        except (TypeError, ValueError, exceptions.TemplateError):
+            return None
+
+    def _get_render_cache(self):
+        if self._render_cache is None:
+            self._render_cache = kv().get(RENDER_CACHE_KEY, {})
+            # only persist the cache if the hook completes successfully.
+            atexit(kv().flush)
+        return self._render_cache
 
+    def render(self, config_file):
+        if config_file not in self.templates:
+            log('Config not registered: %s' % config_file, level=ERROR)
+            raise OSConfigException
+        ctxt = self.templates[config_file].context()
+        _tmpl = self._template_name(config_file)
+        template = self._get_template(_tmpl)
         log('Rendering from template: %s' % _tmpl, level=INFO)
         return template.render(ctxt)
 
     def write(self, config_file):
         """
         Write a single config file, raises if config file is not registered.
+
+        Rendering is skipped if neither the template context nor the template
+        sources have changed since the file was last written, and the file is
+        only written if the rendered content differs from the file on disk.
+
+        :returns: True if the content of config_file changed.
         """
+        with tracing.span('render', config_file):
+            return self._write(config_file)
+
+    def _write(self, config_file):
         if config_file not in self.templates:
             log('Config not registered: %s' % config_file, level=ERROR)
             raise OSConfigException
 
-        _out = self.render(config_file)
+        ctxt = self.templates[config_file].context()
+        _tmpl = self._template_name(config_file)
+        key = self._render_key(_tmpl, ctxt)
+        cache = self._get_render_cache()
+        current = file_hash(config_file, hash_type='sha256')
+        cached = cache.get(config_file)
+        if (key is not None and cached and cached['key'] == key and
+                current is not None and cached['output'] == current):
+            log('Template %s unchanged, skipping write.' % config_file,
+                level=INFO)
+            return False
+
+        log('Rendering from template: %s' % _tmpl, level=INFO)
+        _out = self._get_template(_tmpl).render(ctxt)
         if six.PY3:
             _out = _out.encode('UTF-8')
+        digest = _sha256(_out)
+
+        changed = digest != current
+        if changed:
+            with open(config_file, 'wb') as out:
+                out.write(_out)
+            self._changes.append(config_file)
+            log('Wrote template %s.' % config_file, level=INFO)
+        else:
+            log('Rendered template %s unchanged on disk.' % config_file,
+                level=INFO)
 
-        with open(config_file, 'wb') as out:
-            out.write(_out)
+        if key is None:
+            cache.pop(config_file, None)
+        else:
+            cache[config_file] = {'key': key, 'output': digest}
+        kv().set(RENDER_CACHE_KEY, cache)
+        return changed
 
-        log('Wrote template %s.' % config_file, level=INFO)
+    def tracks(self, config_file):
+        """Whether changes to config_file are reported by this renderer."""
+        return config_file in self.templates
+
+    def change_mark(self):
+        """Opaque marker for use with changed_since()."""
+        return len(self._changes)
+
+    def changed_since(self, mark=0):
+        """List of config files whose content was changed by this renderer
+        since mark was taken with change_mark().
+        """
+        changed = []
+        for config_file in self._changes[mark:]:
+            if config_file not in changed:
+                changed.append(config_file)
+        return changed
 
     def write_all(self):
         """
         Write out all registered config files.
         """
-        [self.write(k) for k in six.iterkeys(self.templates)]
+        with self.scheduler.batch():
+            self.scheduler.evaluate(
+                [c for i in six.itervalues(self.templates)
+                 for c in i.contexts])
+            [self.write(k) for k in six.iterkeys(self.templates)]
 
     def set_release(self, openstack_release):
         """
@@ -292,7 +731,9 @@ class OSConfigRenderer(object):
         based on a the new openstack release.
         """
         self._tmpl_env = None
+        self._source_digests = {}
         self.openstack_release = openstack_release
+        self.scheduler.invalidate()
         self._get_tmpl_env()
 
     def complete_contexts(self):
@@ -300,10 +741,20 @@ class OSConfigRenderer(object):
         Returns a list of context interfaces that yield a complete context.
         '''
         interfaces = []
-        [interfaces.extend(i.complete_contexts())
-         for i in six.itervalues(self.templates)]
+        with self.scheduler.batch():
+            self.scheduler.evaluate(
+                [c for i in six.itervalues(self.templates)
+                 if not i._complete_contexts for c in i.contexts])
+            [interfaces.extend(i.complete_contexts())
+             for i in six.itervalues(self.templates)]
         return interfaces
 
+    def invalidate_contexts(self):
+        """
+        Discard memoized contexts, eg after changing data they depend on.
+        """
+        self.scheduler.invalidate()
+
     def get_incomplete_context_data(self, interfaces):
         '''
         Return dictionary of relation status of interfaces and any missing
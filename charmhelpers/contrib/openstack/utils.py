@@ -33,10 +33,11 @@ from charmhelpers import deprecate
 
 from charmhelpers.contrib.network import ip
 
-from charmhelpers.core import unitdata
+from charmhelpers.core import health, unitdata
 
 from charmhelpers.core.hookenv import (
     action_fail,
+    atexit,
     action_set,
     config,
     log as juju_log,
@@ -63,20 +64,20 @@ from charmhelpers.contrib.storage.linux.lvm import (
 from charmhelpers.contrib.network.ip import (
     get_ipv6_addr,
     is_ipv6,
-    port_has_listener,
 )
 
 from charmhelpers.core.host import (
     lsb_release,
     mounts,
     umount,
-    service_running,
     service_pause,
     service_resume,
     restart_on_change_helper,
 )
 from charmhelpers.fetch import (
-    apt_cache,
+    dpkg_status,
+    dpkg_status_stamp,
+    upstream_version,
     import_key as fetch_import_key,
     add_source as fetch_add_source,
     SourceConfigError,
@@ -91,6 +92,7 @@ from charmhelpers.fetch.snap import (
 )
 
 from charmhelpers.contrib.storage.linux.utils import is_block_device, zap_disk
+from charmhelpers.contrib.hahelpers.cluster import rolling_restart
 from charmhelpers.contrib.storage.linux.loopback import ensure_loopback_device
 from charmhelpers.contrib.openstack.exceptions import OSContextError
 
@@ -272,6 +274,10 @@ PACKAGE_CODENAMES = {
 
 DEFAULT_LOOPBACK_SIZE = '5G'
 
+# unitdata key of the codenames derived from installed packages, valid for
+# one dpkg_status_stamp.
+OS_CODENAME_CACHE_KEY = 'openstack.package-codenames'
+
 
 class CompareOpenStackReleases(BasicStringComparator):
     """Provide comparisons of OpenStack releases.
@@ -383,7 +389,11 @@ def get_swift_codename(version):
 
 
 def get_os_codename_package(package, fatal=True):
-    '''Derive OpenStack release codename from an installed package.'''
+    '''Derive OpenStack release codename from an installed package.
+
+    Codenames derived from the dpkg status file are kept in unitdata until
+    dpkg next changes the installed packages, so most hooks only pay for a
+    stat of the status file.'''
 
     if snap_install_requested():
         cmd = ['snap', 'list', package]
@@ -391,7 +401,7 @@ def get_os_codename_package(package, fatal=True):
             out = subprocess.check_output(cmd)
             if six.PY3:
                 out = out.decode('UTF-8')
-        except subprocess.CalledProcessError as e:
+        except subprocess.CalledProcessError:
             return None
         lines = out.split('\n')
         for line in lines:
@@ -399,29 +409,36 @@ def get_os_codename_package(package, fatal=True):
                 # Second item in list is Version
                 return line.split()[1]
 
-    import apt_pkg as apt
-
-    cache = apt_cache()
-
-    try:
-        pkg = cache[package]
-    except Exception:
-        if not fatal:
-            return None
-        # the package is unknown to the current apt cache.
-        e = 'Could not determine version of package with no installation '\
-            'candidate: %s' % package
-        error_out(e)
-
-    if not pkg.current_ver:
+    stamp = dpkg_status_stamp()
+    if stamp is None:
+        return _get_os_codename_package(package, fatal)
+    stamp = list(stamp)
+    db = unitdata.kv()
+    cache = db.get(OS_CODENAME_CACHE_KEY) or {}
+    if cache.get('stamp') != stamp:
+        cache = {'stamp': stamp, 'codenames': {}}
+    if package in cache['codenames']:
+        return cache['codenames'][package]
+    codename = _get_os_codename_package(package, fatal)
+    if codename:
+        cache['codenames'][package] = codename
+        db.set(OS_CODENAME_CACHE_KEY, cache)
+        # only persist the cache if the hook completes successfully.
+        atexit(db.flush)
+    return codename
+
+
+def _get_os_codename_package(package, fatal=True):
+    version = dpkg_status().get(package)
+    if not version:
         if not fatal:
             return None
-        # package is known, but no version is currently installed.
+        # package is unknown or no version is currently installed.
         e = 'Could not determine version of uninstalled package: %s' % package
         error_out(e)
 
-    vers = apt.upstream_version(pkg.current_ver.ver_str)
-    if 'swift' in pkg.name:
+    vers = upstream_version(version)
+    if 'swift' in package:
         # Fully x.y.z match for swift versions
         match = re.match('^(\d+)\.(\d+)\.(\d+)', vers)
     else:
@@ -442,7 +459,7 @@ def get_os_codename_package(package, fatal=True):
     else:
         # < Liberty co-ordinated project versions
         try:
-            if 'swift' in pkg.name:
+            if 'swift' in package:
                 return get_swift_codename(vers)
             else:
                 return OPENSTACK_CODENAMES[vers]
@@ -1046,7 +1063,8 @@ def _check_running_services(services):
     @returns [(service, boolean), ...], : results for checks
              [boolean]                  : just the result of the service checks
     """
-    services_running = [service_running(s) for s in services]
+    states = health.services_running(list(services))
+    services_running = [states[s] for s in services]
     return list(zip(services, services_running)), services_running
 
 
@@ -1064,7 +1082,7 @@ def _check_listening_on_services_ports(services, test=False):
     """
     test = not(not(test))  # ensure test is True or False
     all_ports = list(itertools.chain(*services.values()))
-    ports_states = [port_has_listener('0.0.0.0', p) for p in all_ports]
+    ports_states = [health.port_listening(p) for p in all_ports]
     map_ports = OrderedDict()
     matched_ports = [p for p, opened in zip(all_ports, ports_states)
                      if opened == test]  # essentially opened xor test
@@ -1084,7 +1102,7 @@ def _check_listening_on_ports_list(ports):
     @param ports: LIST or port numbers.
     @returns [(port_num, boolean), ...], [boolean]
     """
-    ports_open = [port_has_listener('0.0.0.0', p) for p in ports]
+    ports_open = [health.port_listening(p) for p in ports]
     return zip(ports, ports_open), ports_open
 
 
@@ -1417,7 +1435,7 @@ def make_assess_status_func(*args, **kwargs):
 
 
 def pausable_restart_on_change(restart_map, stopstart=False,
-                               restart_functions=None):
+                               restart_functions=None, change_tracker=None):
     """A restart_on_change decorator that checks to see if the unit is
     paused. If it is paused then the decorated function doesn't fire.
 
@@ -1441,6 +1459,8 @@ def pausable_restart_on_change(restart_map, stopstart=False,
     @param f: the function to decorate
     @param restart_map: the restart map {conf_file: [services]}
     @param stopstart: DEFAULT false; whether to stop, start or just restart
+    @param change_tracker: object reporting the files it changes, such as
+                           the charm's OSConfigRenderer
     @returns decorator to use a restart_on_change with pausability
     """
     def wrap(f):
@@ -1451,7 +1471,63 @@ def pausable_restart_on_change(restart_map, stopstart=False,
             # otherwise, normal restart_on_change functionality
             return restart_on_change_helper(
                 (lambda: f(*args, **kwargs)), restart_map, stopstart,
-                restart_functions)
+                restart_functions, change_tracker)
+        return wrapped_f
+    return wrap
+
+
+def pausable_rolling_restart_on_change(restart_map, health_check,
+                                       stopstart=False, change_tracker=None,
+                                       batch=1, timeout=300,
+                                       peer_relation='cluster',
+                                       restart_functions=None,
+                                       rolling_services=None):
+    """A pausable_restart_on_change decorator which restarts services on
+    one batch of units of the application at a time, rather than on every
+    unit as soon as its configuration changes.
+
+    The restart is coordinated with the peers of the unit and may happen in
+    a later hook; see charmhelpers.contrib.hahelpers.cluster.rolling_restart.
+
+    @param restart_map: the restart map {conf_file: [services]}
+    @param health_check: callable returning True once the restarted services
+                         are serving again
+    @param stopstart: DEFAULT false; whether to stop, start or just restart
+    @param change_tracker: object reporting the files it changes, such as
+                           the charm's OSConfigRenderer
+    @param batch: number of units allowed to restart at once, or a callable
+                  returning it
+    @param timeout: seconds a restarted unit may take to become healthy, or
+                    a callable returning it
+    @param peer_relation: name of the peer relation
+    @param restart_functions: nonstandard functions to use to restart services
+                              {svc: func, ...}
+    @param rolling_services: the services whose restarts are coordinated,
+                             defaults to all; others restart at once
+    @returns decorator to use a restart_on_change with pausability
+    """
+    def wrap(f):
+        @functools.wraps(f)
+        def wrapped_f(*args, **kwargs):
+            if is_unit_paused_set():
+                return f(*args, **kwargs)
+            services = list(OrderedDict.fromkeys(
+                itertools.chain(*restart_map.values())))
+            if rolling_services is not None:
+                services = [s for s in services if s in rolling_services]
+            deferred = []
+            functions = dict(restart_functions or {})
+            functions.update((s, deferred.append) for s in services)
+            r = restart_on_change_helper(
+                (lambda: f(*args, **kwargs)), restart_map, stopstart,
+                functions, change_tracker)
+            if deferred:
+                rolling_restart(
+                    deferred, health_check, stopstart,
+                    batch() if callable(batch) else batch,
+                    timeout() if callable(timeout) else timeout,
+                    peer_relation, restart_functions)
+            return r
         return wrapped_f
     return wrap
 
@@ -0,0 +1,137 @@
+# Copyright 2014-2015 Canonical Limited.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+In-process probing of the services and listening ports of the unit.
+
+Listening sockets are read from /proc/net/tcp and /proc/net/tcp6 in one pass
+and, on systemd hosts, the state of any number of services is read with a
+single ``systemctl is-active``::
+
+    from charmhelpers.core import health
+
+    health.services_running(['haproxy', 'apache2'])
+    health.port_listening(9292)
+
+Results are kept for the rest of the hook, until :func:`invalidate` is
+called. Starting, stopping, restarting or reloading a service through
+:func:`charmhelpers.core.host.service` invalidates them.
+"""
+
+import os
+import socket
+import struct
+import subprocess
+
+from charmhelpers.core.host import (
+    init_is_systemd,
+    service_running,
+)
+
+PROC_NET_TCP = ['/proc/net/tcp', '/proc/net/tcp6']
+TCP_LISTEN = '0A'
+WILDCARD_ADDRESSES = ('0.0.0.0', '::')
+# States for which systemctl is-active succeeds.
+SYSTEMD_RUNNING_STATES = ('active', 'reloading')
+
+_cache = {}
+
+
+def invalidate():
+    """Forget the probe results of the hook."""
+    _cache.clear()
+
+
+def _decode_address(address):
+    # /proc/net/tcp{,6} print addresses as 32 bit words in host byte order.
+    words = [int(address[i:i + 8], 16) for i in range(0, len(address), 8)]
+    packed = struct.pack('<{}I'.format(len(words)), *words)
+    if len(words) == 1:
+        return socket.inet_ntop(socket.AF_INET, packed)
+    return socket.inet_ntop(socket.AF_INET6, packed)
+
+
+def listening_ports():
+    """The set of (address, port) on which TCP sockets listen."""
+    if 'listening' not in _cache:
+        listening = set()
+        for path in PROC_NET_TCP:
+            try:
+                with open(path) as f:
+                    lines = f.readlines()[1:]
+            except IOError:
+                continue
+            for line in lines:
+                fields = line.split()
+                if len(fields) < 4 or fields[3] != TCP_LISTEN:
+                    continue
+                address, port = fields[1].split(':')
+                listening.add((_decode_address(address), int(port, 16)))
+        _cache['listening'] = listening
+    return _cache['listening']
+
+
+def port_listening(port, address=None):
+    """
+    Whether a TCP socket listens on port.
+
+    :param port: port number.
+    :param address: local address the socket must accept connections on; a
+                    socket bound to the wildcard address accepts them on all.
+                    None or '0.0.0.0' match a socket bound to any address.
+    """
+    port = int(port)
+    for bound, bound_port in listening_ports():
+        if bound_port != port:
+            continue
+        if (address in (None, '0.0.0.0', bound) or
+                bound in WILDCARD_ADDRESSES):
+            return True
+    return False
+
+
+def _systemd_active(services):
+    cmd = ['systemctl', 'is-active'] + list(services)
+    try:
+        with open(os.devnull, 'w') as devnull:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                    stderr=devnull, universal_newlines=True)
+            out, _ = proc.communicate()
+    except OSError:
+        return None
+    # One state per service, in order; anything else means systemctl could
+    # not answer and each service is asked separately.
+    states = out.split()
+    if len(states) != len(services):
+        return None
+    return dict((service, state in SYSTEMD_RUNNING_STATES)
+                for service, state in zip(services, states))
+
+
+def services_running(services):
+    """
+    Whether each of services is running.
+
+    :returns: dict of service name to boolean.
+    """
+    known = _cache.setdefault('services', {})
+    missing = [s for s in services if s not in known]
+    if missing:
+        states = None
+        if init_is_systemd():
+            states = _systemd_active(missing)
+        if states is None:
+            states = dict((s, service_running(s)) for s in missing)
+        known.update(states)
+    return dict((s, known[s]) for s in services)
@@ -34,6 +34,9 @@ import tempfile
 from subprocess import CalledProcessError
 
 import six
+
+from charmhelpers.core import jujuc, tracing
+
 if not six.PY3:
     from UserDict import UserDict
 else:
@@ -82,13 +85,16 @@ def flush(key):
     """Flushes any entries from function cache where the
     key is found in the function+args """
     flush_list = []
-    for item in cache:
+    # copy the keys as context generators may populate the cache from
+    # other threads.
+    for item in list(cache):
         if key in item:
             flush_list.append(item)
     for item in flush_list:
-        del cache[item]
+        cache.pop(item, None)
 
 
+@tracing.traced('hook-tool', 'juju-log')
 def log(message, level=None):
     """Write a message to the juju log"""
     command = ['juju-log']
@@ -100,7 +106,7 @@ def log(message, level=None):
     # Missing juju-log should not cause failures in unit tests
     # Send log output to stderr
     try:
-        subprocess.call(command)
+        jujuc.call(command)
     except OSError as e:
         if e.errno == errno.ENOENT:
             if level:
@@ -352,6 +358,7 @@ class Config(dict):
 
 
 @cached
+@tracing.traced('hook-tool', 'config-get')
 def config(scope=None):
     """Juju charm configuration"""
     config_cmd_line = ['config-get']
@@ -362,7 +369,7 @@ def config(scope=None):
     config_cmd_line.append('--format=json')
     try:
         config_data = json.loads(
-            subprocess.check_output(config_cmd_line).decode('UTF-8'))
+            jujuc.check_output(config_cmd_line).decode('UTF-8'))
         if scope is not None:
             return config_data
         return Config(config_data)
@@ -370,9 +377,133 @@ def config(scope=None):
         return None
 
 
+class RelationSnapshot(object):
+    """Snapshot of relation ids, related units and their settings.
+
+    Juju freezes remote relation data for the duration of a hook, so the
+    ids, units and settings seen by a hook only need to be read once. Rather
+    than forking ``relation-get`` for every key, the complete settings of a
+    unit are read with a single call and all further lookups are served from
+    memory.
+
+    Data is loaded lazily as it is requested; :meth:`load` can be used to
+    populate the whole snapshot up front. Local unit settings change when
+    ``relation_set`` is called, so the affected entries must be dropped with
+    :meth:`invalidate` (``relation_set`` does this automatically).
+
+    NOTE: Do not instantiate this object directly - instead call
+    ``hookenv.relation_snapshot()``, which returns the snapshot for the
+    current hook.
+    """
+
+    def __init__(self):
+        self._ids = {}
+        self._units = {}
+        self._settings = {}
+
+    def relation_ids(self, reltype):
+        """A list of relation ids for reltype"""
+        if reltype not in self._ids:
+            self._ids[reltype] = _relation_ids(reltype)
+        return list(self._ids[reltype])
+
+    def related_units(self, relid):
+        """A list of units related over relid"""
+        if relid not in self._units:
+            self._units[relid] = _related_units(relid)
+        return list(self._units[relid])
+
+    def settings(self, relid, unit):
+        """A copy of the settings of unit on relid, or None if the unit
+        has departed the relation.
+        """
+        key = (relid, unit)
+        if key not in self._settings:
+            self._settings[key] = _relation_get(unit=unit, rid=relid)
+        settings = self._settings[key]
+        pending = _relation_writes.pending(relid)
+        if pending and unit == local_unit():
+            settings = dict(settings or {})
+            for k, v in pending.items():
+                if v is None:
+                    settings.pop(k, None)
+                else:
+                    settings[k] = v
+            return settings
+        if settings is None:
+            return None
+        return dict(settings)
+
+    def load(self, reltypes=None):
+        """Populate the snapshot for every relation of the given types.
+
+        :param reltypes: list of relation names, defaults to all relation
+                         types declared in metadata.yaml.
+        :returns: The snapshot as a nested dictionary of
+                  {reltype: {relid: {unit: settings}}}
+        """
+        rels = {}
+        for reltype in reltypes or relation_types():
+            relids = {}
+            for relid in self.relation_ids(reltype):
+                units = {}
+                for unit in [local_unit()] + self.related_units(relid):
+                    units[unit] = self.settings(relid, unit)
+                relids[relid] = units
+            rels[reltype] = relids
+        return rels
+
+    def invalidate(self, relid=None, unit=None):
+        """Drop cached settings matching relid and/or unit.
+
+        With no arguments the whole snapshot, including relation ids and
+        related units, is discarded. Use ``invalidate_relation_snapshot``
+        to also drop the results cached by ``relation_ids`` and friends.
+        """
+        if relid is None and unit is None:
+            self._ids.clear()
+            self._units.clear()
+            self._settings.clear()
+            return
+        for key in list(self._settings):
+            if ((relid is None or key[0] == relid) and
+                    (unit is None or key[1] == unit)):
+                del self._settings[key]
+
+
 @cached
-def relation_get(attribute=None, unit=None, rid=None):
-    """Get relation information"""
+def relation_snapshot():
+    """The RelationSnapshot for the current hook"""
+    return RelationSnapshot()
+
+
+# Cached functions whose results depend on the relation ids or units.
+_RELATION_CACHED = ('relation_id', 'remote_service_name', 'relation_get',
+                    'relation_ids', 'related_units', 'relation_for_unit',
+                    'relations_for_id', 'relations_of_type',
+                    'peer_relation_id', 'relations', 'is_relation_made')
+
+
+def invalidate_relation_snapshot(relid=None, unit=None):
+    """Invalidate snapshot and cached relation data for relid and/or unit.
+
+    With no arguments the cached relation ids and related units are
+    discarded too. Call this after changing relation data by any means
+    other than ``relation_set``.
+    """
+    relation_snapshot().invalidate(relid=relid, unit=unit)
+    if relid is None and unit is None:
+        for name in _RELATION_CACHED:
+            flush('<function {} '.format(name))
+        return
+    for key in (relid, unit):
+        if key is not None:
+            flush(key)
+
+
+@tracing.traced('hook-tool', 'relation-get')
+def _relation_get(attribute=None, unit=None, rid=None):
+    """Get relation information by calling relation-get"""
     _args = ['relation-get', '--format=json']
     if rid:
         _args.append('-r')
@@ -381,7 +512,7 @@ def relation_get(attribute=None, unit=None, rid=None):
     if unit:
         _args.append(unit)
     try:
-        return json.loads(subprocess.check_output(_args).decode('UTF-8'))
+        return json.loads(jujuc.check_output(_args).decode('UTF-8'))
     except ValueError:
         return None
     except CalledProcessError as e:
@@ -390,29 +521,42 @@ def relation_get(attribute=None, unit=None, rid=None):
         raise
 
 
-def relation_set(relation_id=None, relation_settings=None, **kwargs):
-    """Set relation information for the current unit"""
-    relation_settings = relation_settings if relation_settings else {}
+@cached
+def relation_get(attribute=None, unit=None, rid=None):
+    """Get relation information"""
+    rid = rid or relation_id()
+    unit = unit or remote_unit()
+    if not rid or not unit:
+        # Let relation-get resolve (or reject) the defaults itself.
+        return _relation_get(attribute=attribute, unit=unit, rid=rid)
+    settings = relation_snapshot().settings(rid, unit)
+    if settings is None or attribute is None:
+        return settings
+    return settings.get(attribute)
+
+
+@cached
+def _relation_set_accepts_file():
+    """Whether relation-set supports --file, which was introduced in Juju
+    1.23.2."""
+    return "--file" in jujuc.check_output(
+        ['relation-set', '--help'], universal_newlines=True)
+
+
+@tracing.traced('hook-tool', 'relation-set')
+def _relation_set(relation_id=None, settings=None):
+    """Set relation information by calling relation-set"""
     relation_cmd_line = ['relation-set']
-    accepts_file = "--file" in subprocess.check_output(
-        relation_cmd_line + ["--help"], universal_newlines=True)
     if relation_id is not None:
         relation_cmd_line.extend(('-r', relation_id))
-    settings = relation_settings.copy()
-    settings.update(kwargs)
-    for key, value in settings.items():
-        # Force value to be a string: it always should, but some call
-        # sites pass in things like dicts or numbers.
-        if value is not None:
-            settings[key] = "{}".format(value)
-    if accepts_file:
-        # --file was introduced in Juju 1.23.2. Use it by default if
-        # available, since otherwise we'll break if the relation data is
-        # too big. Ideally we should tell relation-set to read the data from
-        # stdin, but that feature is broken in 1.23.2: Bug #1454678.
+    if _relation_set_accepts_file():
+        # Use --file by default if available, since otherwise we'll break if
+        # the relation data is too big. Ideally we should tell relation-set
+        # to read the data from stdin, but that feature is broken in 1.23.2:
+        # Bug #1454678.
         with tempfile.NamedTemporaryFile(delete=False) as settings_file:
             settings_file.write(yaml.safe_dump(settings).encode("utf-8"))
-        subprocess.check_call(
+        jujuc.check_call(
             relation_cmd_line + ["--file", settings_file.name])
         os.remove(settings_file.name)
     else:
@@ -421,9 +565,98 @@ def relation_set(relation_id=None, relation_settings=None, **kwargs):
                 relation_cmd_line.append('{}='.format(key))
             else:
                 relation_cmd_line.append('{}={}'.format(key, value))
-        subprocess.check_call(relation_cmd_line)
+        jujuc.check_call(relation_cmd_line)
+
+
+class RelationWriteBuffer(object):
+    """Relation settings set by the current hook but not yet written.
+
+    Juju only publishes the settings of the local unit once a hook completes
+    successfully, so there is nothing to gain from writing them as soon as
+    they are set. While a hook runs under ``Hooks.execute``,
+    ``relation_set`` merges settings per relation id here and the buffer is
+    flushed as an ``atexit`` callback, with one ``relation-set`` per
+    relation for only those values which differ from the settings already
+    published. Pending settings are visible to ``relation_get`` for the
+    local unit.
+
+    NOTE: Do not instantiate this object directly - instead call
+    ``hookenv.relation_write_buffer()``.
+    """
+
+    def __init__(self):
+        self.active = False
+        self._pending = {}
+        self._order = []
+
+    def start(self):
+        """Start deferring writes."""
+        self.active = True
+
+    def stop(self):
+        """Stop deferring writes, discarding any not flushed."""
+        self.active = False
+        self._pending = {}
+        self._order = []
+
+    def set(self, relid, settings):
+        """Merge settings into the pending settings of relid."""
+        if not self._order:
+            atexit(self.flush)
+        if relid not in self._pending:
+            self._pending[relid] = {}
+            self._order.append(relid)
+        self._pending[relid].update(settings)
+
+    def pending(self, relid):
+        """A copy of the pending settings of relid."""
+        return dict(self._pending.get(relid, {}))
+
+    def flush(self):
+        """Write pending settings which differ from those published."""
+        pending, order = self._pending, self._order
+        self._pending, self._order = {}, []
+        if not order:
+            return
+        unit = local_unit()
+        for relid in order:
+            current = relation_snapshot().settings(relid, unit) or {}
+            changes = dict((key, value)
+                           for key, value in pending[relid].items()
+                           if current.get(key) != value)
+            if changes:
+                _relation_set(relid, changes)
+                invalidate_relation_snapshot(relid=relid, unit=unit)
+
+
+_relation_writes = RelationWriteBuffer()
+
+
+def relation_write_buffer():
+    """The RelationWriteBuffer for the current hook"""
+    return _relation_writes
+
+
+def relation_set(relation_id=None, relation_settings=None, **kwargs):
+    """Set relation information for the current unit"""
+    relation_settings = relation_settings if relation_settings else {}
+    settings = relation_settings.copy()
+    settings.update(kwargs)
+    for key, value in settings.items():
+        # Force value to be a string: it always should, but some call
+        # sites pass in things like dicts or numbers.
+        if value is not None:
+            settings[key] = "{}".format(value)
+    relid = relation_id
+    if relid is None:
+        relid = os.environ.get('JUJU_RELATION_ID')
+    if _relation_writes.active and relid is not None:
+        _relation_writes.set(relid, settings)
+        flush(local_unit())
+        return
+    _relation_set(relation_id, settings)
     # Flush cache of any relation-gets for local unit
-    flush(local_unit())
+    invalidate_relation_snapshot(unit=local_unit())
 
 
 def relation_clear(r_id=None):
@@ -437,27 +670,40 @@ def relation_clear(r_id=None):
                  **settings)
 
 
+@tracing.traced('hook-tool', 'relation-ids')
+def _relation_ids(reltype):
+    """Get relation ids by calling relation-ids"""
+    relid_cmd_line = ['relation-ids', '--format=json', reltype]
+    return json.loads(
+        jujuc.check_output(relid_cmd_line).decode('UTF-8')) or []
+
+
 @cached
 def relation_ids(reltype=None):
     """A list of relation_ids"""
     reltype = reltype or relation_type()
-    relid_cmd_line = ['relation-ids', '--format=json']
     if reltype is not None:
-        relid_cmd_line.append(reltype)
-        return json.loads(
-            subprocess.check_output(relid_cmd_line).decode('UTF-8')) or []
+        return relation_snapshot().relation_ids(reltype)
     return []
 
 
-@cached
-def related_units(relid=None):
-    """A list of related units"""
-    relid = relid or relation_id()
+@tracing.traced('hook-tool', 'relation-list')
+def _related_units(relid=None):
+    """Get related units by calling relation-list"""
     units_cmd_line = ['relation-list', '--format=json']
     if relid is not None:
         units_cmd_line.extend(('-r', relid))
     return json.loads(
-        subprocess.check_output(units_cmd_line).decode('UTF-8')) or []
+        jujuc.check_output(units_cmd_line).decode('UTF-8')) or []
+
+
+@cached
+def related_units(relid=None):
+    """A list of related units"""
+    relid = relid or relation_id()
+    if relid is None:
+        return _related_units()
+    return relation_snapshot().related_units(relid)
 
 
 @cached
@@ -612,17 +858,7 @@ def charm_name():
 @cached
 def relations():
     """Get a nested dictionary of relation data for all related units"""
-    rels = {}
-    for reltype in relation_types():
-        relids = {}
-        for relid in relation_ids(reltype):
-            units = {local_unit(): relation_get(unit=local_unit(), rid=relid)}
-            for unit in related_units(relid):
-                reldata = relation_get(unit=unit, rid=relid)
-                units[unit] = reldata
-            relids[relid] = units
-        rels[reltype] = relids
-    return rels
+    return relation_snapshot().load()
 
 
 @cached
@@ -645,6 +881,7 @@ def is_relation_made(relation, keys='private-address'):
     return False
 
 
+@tracing.traced('hook-tool', 'port')
 def _port_op(op_name, port, protocol="TCP"):
     """Open or close a service network port"""
     _args = [op_name]
@@ -654,7 +891,7 @@ def _port_op(op_name, port, protocol="TCP"):
     else:
         _args.append('{}/{}'.format(port, protocol))
     try:
-        subprocess.check_call(_args)
+        jujuc.check_call(_args)
     except subprocess.CalledProcessError:
         # Older Juju pre 2.3 doesn't support ICMP
         # so treat it as a no-op if it fails.
@@ -672,20 +909,23 @@ def close_port(port, protocol="TCP"):
     _port_op('close-port', port, protocol)
 
 
+@tracing.traced('hook-tool', 'open-port')
 def open_ports(start, end, protocol="TCP"):
     """Opens a range of service network ports"""
     _args = ['open-port']
     _args.append('{}-{}/{}'.format(start, end, protocol))
-    subprocess.check_call(_args)
+    jujuc.check_call(_args)
 
 
+@tracing.traced('hook-tool', 'close-port')
 def close_ports(start, end, protocol="TCP"):
     """Close a range of service network ports"""
     _args = ['close-port']
     _args.append('{}-{}/{}'.format(start, end, protocol))
-    subprocess.check_call(_args)
+    jujuc.check_call(_args)
 
 
+@tracing.traced('hook-tool', 'opened-ports')
 def opened_ports():
     """Get the opened ports
 
@@ -694,15 +934,16 @@ def opened_ports():
     :returns: Opened ports as a list of strings: ``['8080/tcp', '8081-8083/tcp']``
     """
     _args = ['opened-ports', '--format=json']
-    return json.loads(subprocess.check_output(_args).decode('UTF-8'))
+    return json.loads(jujuc.check_output(_args).decode('UTF-8'))
 
 
 @cached
+@tracing.traced('hook-tool', 'unit-get')
 def unit_get(attribute):
     """Get the unit ID for the remote unit"""
     _args = ['unit-get', '--format=json', attribute]
     try:
-        return json.loads(subprocess.check_output(_args).decode('UTF-8'))
+        return json.loads(jujuc.check_output(_args).decode('UTF-8'))
     except ValueError:
         return None
 
@@ -718,6 +959,7 @@ def unit_private_ip():
 
 
 @cached
+@tracing.traced('hook-tool', 'storage-get')
 def storage_get(attribute=None, storage_id=None):
     """Get storage attributes"""
     _args = ['storage-get', '--format=json']
@@ -726,19 +968,20 @@ def storage_get(attribute=None, storage_id=None):
     if attribute:
         _args.append(attribute)
     try:
-        return json.loads(subprocess.check_output(_args).decode('UTF-8'))
+        return json.loads(jujuc.check_output(_args).decode('UTF-8'))
     except ValueError:
         return None
 
 
 @cached
+@tracing.traced('hook-tool', 'storage-list')
 def storage_list(storage_name=None):
     """List the storage IDs for the unit"""
     _args = ['storage-list', '--format=json']
     if storage_name:
         _args.append(storage_name)
     try:
-        return json.loads(subprocess.check_output(_args).decode('UTF-8'))
+        return json.loads(jujuc.check_output(_args).decode('UTF-8'))
     except ValueError:
         return None
     except OSError as e:
@@ -794,13 +1037,18 @@ class Hooks(object):
         _run_atstart()
         hook_name = os.path.basename(args[0])
         if hook_name in self._hooks:
+            _relation_writes.start()
             try:
-                self._hooks[hook_name]()
-            except SystemExit as x:
-                if x.code is None or x.code == 0:
-                    _run_atexit()
-                raise
-            _run_atexit()
+                try:
+                    with tracing.span('hook', hook_name):
+                        self._hooks[hook_name]()
+                except SystemExit as x:
+                    if x.code is None or x.code == 0:
+                        _run_atexit()
+                    raise
+                _run_atexit()
+            finally:
+                _relation_writes.stop()
         else:
             raise UnregisteredHookError(hook_name)
 
@@ -827,29 +1075,32 @@ def charm_dir():
 
 
 @cached
+@tracing.traced('hook-tool', 'action-get')
 def action_get(key=None):
     """Gets the value of an action parameter, or all key/value param pairs"""
     cmd = ['action-get']
     if key is not None:
         cmd.append(key)
     cmd.append('--format=json')
-    action_data = json.loads(subprocess.check_output(cmd).decode('UTF-8'))
+    action_data = json.loads(jujuc.check_output(cmd).decode('UTF-8'))
     return action_data
 
 
+@tracing.traced('hook-tool', 'action-set')
 def action_set(values):
     """Sets the values to be returned after the action finishes"""
     cmd = ['action-set']
     for k, v in list(values.items()):
         cmd.append('{}={}'.format(k, v))
-    subprocess.check_call(cmd)
+    jujuc.check_call(cmd)
 
 
+@tracing.traced('hook-tool', 'action-fail')
 def action_fail(message):
     """Sets the action status to failed and sets the error message.
 
     The results set by action_set are preserved."""
-    subprocess.check_call(['action-fail', message])
+    jujuc.check_call(['action-fail', message])
 
 
 def action_name():
@@ -867,6 +1118,7 @@ def action_tag():
     return os.environ.get('JUJU_ACTION_TAG')
 
 
+@tracing.traced('hook-tool', 'status-set')
 def status_set(workload_state, message):
     """Set the workload state with a message
 
@@ -884,7 +1136,7 @@ def status_set(workload_state, message):
         )
     cmd = ['status-set', workload_state, message]
     try:
-        ret = subprocess.call(cmd)
+        ret = jujuc.call(cmd)
         if ret == 0:
             return
     except OSError as e:
@@ -895,6 +1147,7 @@ def status_set(workload_state, message):
     log(log_message, level='INFO')
 
 
+@tracing.traced('hook-tool', 'status-get')
 def status_get():
     """Retrieve the previously set juju workload state and message
 
@@ -904,7 +1157,7 @@ def status_get():
     """
     cmd = ['status-get', "--format=json", "--include-data"]
     try:
-        raw_status = subprocess.check_output(cmd)
+        raw_status = jujuc.check_output(cmd)
     except OSError as e:
         if e.errno == errno.ENOENT:
             return ('unknown', "")
@@ -929,6 +1182,7 @@ def translate_exc(from_exc, to_exc):
     return inner_translate_exc1
 
 
+@tracing.traced('hook-tool', 'application-version-set')
 def application_version_set(version):
     """Charm authors may trigger this command from any hook to output what
     version of the application is running. This could be a package version,
@@ -938,29 +1192,32 @@ def application_version_set(version):
     cmd = ['application-version-set']
     cmd.append(version)
     try:
-        subprocess.check_call(cmd)
+        jujuc.check_call(cmd)
     except OSError:
         log("Application Version: {}".format(version))
 
 
 @translate_exc(from_exc=OSError, to_exc=NotImplementedError)
+@tracing.traced('hook-tool', 'is-leader')
 def is_leader():
     """Does the current unit hold the juju leadership
 
     Uses juju to determine whether the current unit is the leader of its peers
     """
     cmd = ['is-leader', '--format=json']
-    return json.loads(subprocess.check_output(cmd).decode('UTF-8'))
+    return json.loads(jujuc.check_output(cmd).decode('UTF-8'))
 
 
 @translate_exc(from_exc=OSError, to_exc=NotImplementedError)
+@tracing.traced('hook-tool', 'leader-get')
 def leader_get(attribute=None):
     """Juju leader get value(s)"""
     cmd = ['leader-get', '--format=json'] + [attribute or '-']
-    return json.loads(subprocess.check_output(cmd).decode('UTF-8'))
+    return json.loads(jujuc.check_output(cmd).decode('UTF-8'))
 
 
 @translate_exc(from_exc=OSError, to_exc=NotImplementedError)
+@tracing.traced('hook-tool', 'leader-set')
 def leader_set(settings=None, **kwargs):
     """Juju leader set value(s)"""
     # Don't log secrets.
@@ -973,7 +1230,7 @@ def leader_set(settings=None, **kwargs):
             cmd.append('{}='.format(k))
         else:
             cmd.append('{}={}'.format(k, v))
-    subprocess.check_call(cmd)
+    jujuc.check_call(cmd)
 
 
 @translate_exc(from_exc=OSError, to_exc=NotImplementedError)
@@ -983,7 +1240,7 @@ def payload_register(ptype, klass, pid):
     cmd = ['payload-register']
     for x in [ptype, klass, pid]:
         cmd.append(x)
-    subprocess.check_call(cmd)
+    jujuc.check_call(cmd)
 
 
 @translate_exc(from_exc=OSError, to_exc=NotImplementedError)
@@ -995,7 +1252,7 @@ def payload_unregister(klass, pid):
     cmd = ['payload-unregister']
     for x in [klass, pid]:
         cmd.append(x)
-    subprocess.check_call(cmd)
+    jujuc.check_call(cmd)
 
 
 @translate_exc(from_exc=OSError, to_exc=NotImplementedError)
@@ -1007,10 +1264,11 @@ def payload_status_set(klass, pid, status):
     cmd = ['payload-status-set']
     for x in [klass, pid, status]:
         cmd.append(x)
-    subprocess.check_call(cmd)
+    jujuc.check_call(cmd)
 
 
 @translate_exc(from_exc=OSError, to_exc=NotImplementedError)
+@tracing.traced('hook-tool', 'resource-get')
 def resource_get(name):
     """used to fetch the resource path of the given name.
 
@@ -1023,7 +1281,7 @@ def resource_get(name):
 
     cmd = ['resource-get', name]
     try:
-        return subprocess.check_output(cmd).decode('UTF-8')
+        return jujuc.check_output(cmd).decode('UTF-8')
     except subprocess.CalledProcessError:
         return False
 
@@ -1095,6 +1353,7 @@ def _run_atexit():
 
 
 @translate_exc(from_exc=OSError, to_exc=NotImplementedError)
+@tracing.traced('hook-tool', 'network-get')
 def network_get_primary_address(binding):
     '''
     Retrieve the primary network address for a named binding
@@ -1104,10 +1363,11 @@ def network_get_primary_address(binding):
     :raise: NotImplementedError if run on Juju < 2.0
     '''
     cmd = ['network-get', '--primary-address', binding]
-    return subprocess.check_output(cmd).decode('UTF-8').strip()
+    return jujuc.check_output(cmd).decode('UTF-8').strip()
 
 
 @translate_exc(from_exc=OSError, to_exc=NotImplementedError)
+@tracing.traced('hook-tool', 'network-get')
 def network_get(endpoint, relation_id=None):
     """
     Retrieve the network details for a relation endpoint
@@ -1122,7 +1382,7 @@ def network_get(endpoint, relation_id=None):
         cmd.append('-r')
         cmd.append(relation_id)
     try:
-        response = subprocess.check_output(
+        response = jujuc.check_output(
             cmd,
             stderr=subprocess.STDOUT).decode('UTF-8').strip()
     except CalledProcessError as e:
@@ -1136,6 +1396,7 @@ def network_get(endpoint, relation_id=None):
     return yaml.safe_load(response)
 
 
+@tracing.traced('hook-tool', 'add-metric')
 def add_metric(*args, **kwargs):
     """Add metric values. Values may be expressed with keyword arguments. For
     metric names containing dashes, these may be expressed as one or more
@@ -1147,7 +1408,7 @@ def add_metric(*args, **kwargs):
     _kvpairs.extend(['{}={}'.format(k, v) for k, v in kwargs.items()])
     _args.extend(sorted(_kvpairs))
     try:
-        subprocess.check_call(_args)
+        jujuc.check_call(_args)
         return
     except EnvironmentError as e:
         if e.errno != errno.ENOENT:
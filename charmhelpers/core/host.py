@@ -36,6 +36,7 @@ from contextlib import contextmanager
 from collections import OrderedDict
 from .hookenv import log, DEBUG, local_unit
 from .fstab import Fstab
+from . import tracing
 from charmhelpers.osplatform import get_platform
 
 __platform__ = get_platform()
@@ -261,7 +262,13 @@ def service(action, service_name, **kwargs):
         for key, value in six.iteritems(kwargs):
             parameter = '%s=%s' % (key, value)
             cmd.append(parameter)
-    return subprocess.call(cmd) == 0
+    with tracing.span('service', '{} {}'.format(action, service_name)):
+        result = subprocess.call(cmd) == 0
+    if action not in ('is-active', 'status'):
+        # Imported here as health builds on this module.
+        from charmhelpers.core import health
+        health.invalidate()
+    return result
 
 
 _UPSTART_CONF = "/etc/init/{}.conf"
@@ -635,7 +642,8 @@ def file_hash(path, hash_type='md5'):
     if os.path.exists(path):
         h = getattr(hashlib, hash_type)()
         with open(path, 'rb') as source:
-            h.update(source.read())
+            for chunk in iter(lambda: source.read(65536), b''):
+                h.update(chunk)
         return h.hexdigest()
     else:
         return None
@@ -655,6 +663,24 @@ def path_hash(path):
     }
 
 
+def path_stat(path):
+    """Inode, size and modification time of all files matching 'path'.
+    Standard wildcards like '*' and '?' are supported, see documentation for
+    the 'glob' module for more information.
+
+    :return: dict: A { filename: (inode, size, mtime) } dictionary for all
+                   matched files. Empty if none found.
+    """
+    stats = {}
+    for filename in glob.iglob(path):
+        try:
+            st = os.stat(filename)
+        except OSError:
+            continue
+        stats[filename] = (st.st_ino, st.st_size, st.st_mtime)
+    return stats
+
+
 def check_hash(path, checksum, hash_type='md5'):
     """Validate a file using a cryptographic checksum.
 
@@ -675,7 +701,8 @@ class ChecksumError(ValueError):
     pass
 
 
-def restart_on_change(restart_map, stopstart=False, restart_functions=None):
+def restart_on_change(restart_map, stopstart=False, restart_functions=None,
+                      change_tracker=None):
     """Restart services based on configuration files changing
 
     This function is used a decorator, for example::
@@ -698,6 +725,8 @@ def restart_on_change(restart_map, stopstart=False, restart_functions=None):
     @param stopstart: DEFAULT false; whether to stop, start OR restart
     @param restart_functions: nonstandard functions to use to restart services
                               {svc: func, ...}
+    @param change_tracker: object reporting the files it changes, see
+                           restart_on_change_helper()
     @returns result from decorated function
     """
     def wrap(f):
@@ -705,13 +734,13 @@ def restart_on_change(restart_map, stopstart=False, restart_functions=None):
         def wrapped_f(*args, **kwargs):
             return restart_on_change_helper(
                 (lambda: f(*args, **kwargs)), restart_map, stopstart,
-                restart_functions)
+                restart_functions, change_tracker)
         return wrapped_f
     return wrap
 
 
 def restart_on_change_helper(lambda_f, restart_map, stopstart=False,
-                             restart_functions=None):
+                             restart_functions=None, change_tracker=None):
     """Helper function to perform the restart_on_change function.
 
     This is provided for decorators to restart services if files described
@@ -722,16 +751,40 @@ def restart_on_change_helper(lambda_f, restart_map, stopstart=False,
     @param stopstart: whether to stop, start or restart a service
     @param restart_functions: nonstandard functions to use to restart services
                               {svc: func, ...}
+    @param change_tracker: optional object reporting the files it changes,
+                           such as an OSConfigRenderer. Paths for which
+                           change_tracker.tracks(path) is True are checked
+                           against change_tracker.changed_since(mark), with
+                           mark taken from change_tracker.change_mark()
+                           before lambda_f() is called. Tracked paths are
+                           not hashed; those not reported as changed count
+                           as changed if their inode, size or modification
+                           time changed, as when written other than through
+                           change_tracker.
     @returns result of lambda_f()
     """
     if restart_functions is None:
         restart_functions = {}
-    checksums = {path: path_hash(path) for path in restart_map}
+    tracked = set()
+    if change_tracker is not None:
+        tracked = set(path for path in restart_map
+                      if change_tracker.tracks(path))
+        mark = change_tracker.change_mark()
+    stats = {path: path_stat(path) for path in tracked}
+    checksums = {path: path_hash(path) for path in restart_map
+                 if path not in tracked}
     r = lambda_f()
+    reported = set()
+    if tracked:
+        reported = set(change_tracker.changed_since(mark))
+
+    def _changed(path):
+        if path in tracked:
+            return path in reported or path_stat(path) != stats[path]
+        return path_hash(path) != checksums[path]
+
     # create a list of lists of the services to restart
-    restarts = [restart_map[path]
-                for path in restart_map
-                if path_hash(path) != checksums[path]]
+    restarts = [restart_map[path] for path in restart_map if _changed(path)]
     # create a flat list of ordered services without duplicates from lists
     services_list = list(OrderedDict.fromkeys(itertools.chain(*restarts)))
     if services_list:
@@ -0,0 +1,643 @@
+# Copyright 2014-2015 Canonical Limited.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Run hook tools without forking.
+
+Hook tools such as relation-get are links to the jujuc binary, which passes
+its command line to the unit agent over a unix socket using Go's net/rpc
+protocol with gob encoding, and prints the output sent back.  This module
+speaks that protocol directly over one connection kept open for the life of
+the hook, so hook tools cost a round trip to the agent rather than a fork
+and exec.
+
+:func:`check_output`, :func:`check_call` and :func:`call` are drop-in
+replacements for the subprocess functions of the same names for hook tool
+command lines.  They use the subprocess functions whenever the agent socket
+is not available - outside of a hook, with a TCP agent socket, or once the
+connection has failed.
+
+:class:`StandInServer` serves the same protocol, to run hook tool clients
+without a Juju agent::
+
+    python -m charmhelpers.core.jujuc /tmp/agent.socket
+
+serves hook tool requests by running the tool of the same name from PATH.
+"""
+
+from __future__ import print_function
+
+import os
+import socket
+import struct
+import subprocess
+import sys
+import threading
+
+import six
+
+JUJUC_SERVICE_METHOD = 'Jujuc.Main'
+
+
+class GobError(Exception):
+    """Malformed or unsupported gob stream."""
+
+
+class JujucError(Exception):
+    """Request rejected by the hook tool server."""
+
+
+class ResponseLost(Exception):
+    """Request sent to the hook tool server, which may have run the tool,
+    without its response being read."""
+
+
+# Type ids predefined by gob.
+BOOL = 1
+INT = 2
+UINT = 3
+FLOAT = 4
+BYTES = 5
+STRING = 6
+INTERFACE = 8
+WIRE_TYPE = 16
+FIRST_USER_TYPE = 65
+
+# Schemas describe the Go types encoded: a predefined type id, or
+# ('struct', name, ((field name, schema), ...)) or ('slice', name, schema).
+COMMON_TYPE = ('struct', 'CommonType', (('Name', STRING), ('Id', INT)))
+ARRAY_TYPE = ('struct', 'arrayType',
+              (('CommonType', COMMON_TYPE), ('Elem', INT), ('Len', INT)))
+SLICE_TYPE = ('struct', 'sliceType',
+              (('CommonType', COMMON_TYPE), ('Elem', INT)))
+FIELD_TYPE = ('struct', 'fieldType', (('Name', STRING), ('Id', INT)))
+STRUCT_TYPE = ('struct', 'structType',
+               (('CommonType', COMMON_TYPE),
+                ('Field', ('slice', '[]*gob.fieldType', FIELD_TYPE))))
+MAP_TYPE = ('struct', 'mapType',
+            (('CommonType', COMMON_TYPE), ('Key', INT), ('Elem', INT)))
+GOB_ENCODER_TYPE = ('struct', 'gobEncoderType',
+                    (('CommonType', COMMON_TYPE),))
+WIRE_TYPE_SCHEMA = ('struct', 'wireType',
+                    (('ArrayT', ARRAY_TYPE), ('SliceT', SLICE_TYPE),
+                     ('StructT', STRUCT_TYPE), ('MapT', MAP_TYPE),
+                     ('GobEncoderT', GOB_ENCODER_TYPE),
+                     ('BinaryMarshalerT', GOB_ENCODER_TYPE),
+                     ('TextMarshalerT', GOB_ENCODER_TYPE)))
+
+RPC_REQUEST = ('struct', 'Request',
+               (('ServiceMethod', STRING), ('Seq', UINT)))
+RPC_RESPONSE = ('struct', 'Response',
+                (('ServiceMethod', STRING), ('Seq', UINT), ('Error', STRING)))
+JUJUC_REQUEST = ('struct', 'Request',
+                 (('ContextId', STRING), ('Dir', STRING),
+                  ('CommandName', STRING),
+                  ('Args', ('slice', '[]string', STRING)),
+                  ('StdinSet', BOOL), ('Stdin', BYTES), ('Token', STRING)))
+JUJUC_RESPONSE = ('struct', 'Response',
+                  (('Code', INT), ('Stdout', BYTES), ('Stderr', BYTES)))
+INVALID_REQUEST = ('struct', 'invalidRequest', ())
+
+
+def _encode_uint(n):
+    if n < 0x80:
+        return six.int2byte(n)
+    data = b''
+    while n:
+        data = six.int2byte(n & 0xff) + data
+        n >>= 8
+    return six.int2byte(256 - len(data)) + data
+
+
+def _encode_int(i):
+    return _encode_uint((~i << 1) | 1 if i < 0 else i << 1)
+
+
+class _Reader(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def read(self, n):
+        if self.pos + n > len(self.data):
+            raise GobError('Truncated gob message')
+        data = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return data
+
+    def uint(self):
+        n = six.indexbytes(self.read(1), 0)
+        if n < 0x80:
+            return n
+        size = 256 - n
+        if size > 8:
+            raise GobError('Invalid gob unsigned integer')
+        value = 0
+        for byte in six.iterbytes(self.read(size)):
+            value = (value << 8) | byte
+        return value
+
+    def int(self):
+        u = self.uint()
+        return ~(u >> 1) if u & 1 else u >> 1
+
+    def float(self):
+        return struct.unpack('>d', struct.pack('<Q', self.uint()))[0]
+
+    def bytes(self):
+        return self.read(self.uint())
+
+
+class Encoder(object):
+    """
+    Encodes values of schema types onto a gob stream, sending each type
+    definition once.
+    """
+
+    def __init__(self, write):
+        self._write = write
+        self._ids = {}
+        self._next_id = FIRST_USER_TYPE
+
+    def _send_type(self, schema):
+        if isinstance(schema, int):
+            return schema
+        if schema in self._ids:
+            return self._ids[schema]
+        kind, name = schema[:2]
+        if kind == 'struct':
+            fields = [{'Name': field, 'Id': self._send_type(field_schema)}
+                      for field, field_schema in schema[2]]
+        else:
+            elem = self._send_type(schema[2])
+        type_id = self._ids[schema] = self._next_id
+        self._next_id += 1
+        common = {'Name': name, 'Id': type_id}
+        if kind == 'struct':
+            wire = {'StructT': {'CommonType': common, 'Field': fields}}
+        else:
+            wire = {'SliceT': {'CommonType': common, 'Elem': elem}}
+        self._message(_encode_int(-type_id) +
+                      self._value(WIRE_TYPE_SCHEMA, wire))
+        return type_id
+
+    def _value(self, schema, value):
+        if schema == BOOL:
+            return _encode_uint(1 if value else 0)
+        if schema == INT:
+            return _encode_int(value)
+        if schema == UINT:
+            return _encode_uint(value)
+        if schema in (BYTES, STRING):
+            if isinstance(value, six.text_type):
+                value = value.encode('UTF-8')
+            return _encode_uint(len(value)) + value
+        if schema[0] == 'slice':
+            return _encode_uint(len(value)) + b''.join(
+                self._value(schema[2], v) for v in value)
+        if schema[0] != 'struct':
+            raise GobError('Unsupported schema {}'.format(schema))
+        data = []
+        last = -1
+        for index, (field, field_schema) in enumerate(schema[2]):
+            v = value.get(field)
+            # zero values other than structs are not sent
+            if v is None or (not v and not isinstance(v, dict)):
+                continue
+            data.append(_encode_uint(index - last))
+            data.append(self._value(field_schema, v))
+            last = index
+        data.append(b'\x00')
+        return b''.join(data)
+
+    def _message(self, data):
+        self._write(_encode_uint(len(data)) + data)
+
+    def encode(self, schema, value):
+        type_id = self._send_type(schema)
+        data = _encode_int(type_id)
+        if isinstance(schema, int) or schema[0] != 'struct':
+            data += b'\x00'
+        self._message(data + self._value(schema, value))
+
+
+class Decoder(object):
+    """
+    Decodes values from a gob stream into dicts, lists and scalars, using
+    the type definitions sent on the stream.
+    """
+
+    def __init__(self, read):
+        self._read = read
+        self._types = {WIRE_TYPE: WIRE_TYPE_SCHEMA}
+
+    def _schema(self, type_id):
+        if type_id in (BOOL, INT, UINT, FLOAT, BYTES, STRING):
+            return type_id
+        try:
+            return self._types[type_id]
+        except KeyError:
+            raise GobError('Unknown gob type id {}'.format(type_id))
+
+    def _define(self, type_id, wire):
+        if 'StructT' in wire:
+            fields = tuple((f.get('Name', ''), f.get('Id', 0))
+                           for f in wire['StructT'].get('Field', []))
+            self._types[type_id] = ('struct', '', fields)
+        elif 'SliceT' in wire:
+            self._types[type_id] = ('slice', '', wire['SliceT']['Elem'])
+        elif 'ArrayT' in wire:
+            self._types[type_id] = ('array', '', wire['ArrayT']['Elem'])
+        elif 'MapT' in wire:
+            self._types[type_id] = ('map', wire['MapT']['Key'],
+                                    wire['MapT']['Elem'])
+        else:
+            self._types[type_id] = ('opaque', '', None)
+
+    def _value(self, reader, schema):
+        if not isinstance(schema, tuple):
+            schema = self._schema(schema)
+        if schema == BOOL:
+            return reader.uint() != 0
+        if schema == INT:
+            return reader.int()
+        if schema == UINT:
+            return reader.uint()
+        if schema == FLOAT:
+            return reader.float()
+        if schema == BYTES:
+            return reader.bytes()
+        if schema == STRING:
+            return reader.bytes().decode('UTF-8')
+        kind = schema[0]
+        if kind == 'struct':
+            value = {}
+            index = -1
+            while True:
+                delta = reader.uint()
+                if not delta:
+                    return value
+                index += delta
+                if index >= len(schema[2]):
+                    raise GobError('Invalid gob field number')
+                field, field_schema = schema[2][index]
+                value[field] = self._value(reader, field_schema)
+        if kind in ('slice', 'array'):
+            return [self._value(reader, schema[2])
+                    for _ in range(reader.uint())]
+        if kind == 'map':
+            return dict((self._value(reader, schema[1]),
+                         self._value(reader, schema[2]))
+                        for _ in range(reader.uint()))
+        raise GobError('Unsupported gob type {}'.format(schema))
+
+    def decode(self):
+        """Read the next value from the stream."""
+        while True:
+            header = self._read(1)
+            # the message length is itself a gob unsigned integer
+            first = six.indexbytes(header, 0)
+            if first < 0x80:
+                size = first
+            else:
+                size = _Reader(header + self._read(256 - first)).uint()
+            reader = _Reader(self._read(size))
+            type_id = reader.int()
+            if type_id < 0:
+                self._define(-type_id, self._value(reader, WIRE_TYPE_SCHEMA))
+                continue
+            schema = self._schema(type_id)
+            if not isinstance(schema, tuple) or schema[0] != 'struct':
+                reader.uint()
+            return self._value(reader, schema)
+
+
+class _Connection(object):
+    """gob streams over a connected socket."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.encoder = Encoder(sock.sendall)
+        self.decoder = Decoder(self._read)
+
+    def _read(self, n):
+        data = b''
+        while len(data) < n:
+            chunk = self.sock.recv(n - len(data))
+            if not chunk:
+                raise socket.error('Connection closed')
+            data += chunk
+        return data
+
+    def close(self):
+        self.sock.close()
+
+
+def _socket_address(address):
+    # Linux abstract namespace sockets are named with a leading '@'.
+    if address.startswith('@'):
+        return '\0' + address[1:]
+    return address
+
+
+class JujucClient(object):
+    """
+    Runs hook tools through the unit agent over a persistent connection.
+
+    :param address: path of the agent's unix socket.
+    :param context_id: the hook context, JUJU_CONTEXT_ID.
+    """
+
+    def __init__(self, address, context_id, token=''):
+        self.address = address
+        self.context_id = context_id
+        self.token = token
+        self._conn = None
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(_socket_address(self.address))
+        except socket.error:
+            sock.close()
+            raise
+        return _Connection(sock)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def run(self, cmd, stdin=None):
+        """
+        Run hook tool command line cmd.
+
+        :returns: (exit code, stdout, stderr)
+        :raises socket.error: if the agent cannot be reached.
+        :raises JujucError: if the agent rejects the request.
+        :raises ResponseLost: if the request was sent but the response could
+                              not be read.
+        """
+        request = {
+            'ContextId': self.context_id,
+            'Dir': os.getcwd(),
+            'CommandName': os.path.basename(cmd[0]),
+            'Args': list(cmd[1:]),
+            'StdinSet': stdin is not None,
+            'Stdin': stdin or b'',
+            'Token': self.token,
+        }
+        with self._lock:
+            if self._conn is None:
+                self._conn = self._connect()
+            self._seq += 1
+            try:
+                self._conn.encoder.encode(RPC_REQUEST, {
+                    'ServiceMethod': JUJUC_SERVICE_METHOD,
+                    'Seq': self._seq})
+                self._conn.encoder.encode(JUJUC_REQUEST, request)
+            except (socket.error, GobError):
+                self._conn.close()
+                self._conn = None
+                raise
+            try:
+                header = self._conn.decoder.decode()
+                response = self._conn.decoder.decode()
+            except (socket.error, GobError) as e:
+                self._conn.close()
+                self._conn = None
+                raise ResponseLost('{}: {}'.format(request['CommandName'], e))
+        if header.get('Error'):
+            raise JujucError(header['Error'])
+        return (response.get('Code', 0), response.get('Stdout', b''),
+                response.get('Stderr', b''))
+
+
+_client = None
+_client_lock = threading.Lock()
+_disabled = False
+
+
+def client():
+    """
+    The client for the agent of the current hook, or None if the agent
+    socket is not available.
+    """
+    global _client, _disabled
+    with _client_lock:
+        if _client is None and not _disabled:
+            address = (os.environ.get('JUJU_AGENT_SOCKET_ADDRESS') or
+                       os.environ.get('JUJU_AGENT_SOCKET'))
+            network = os.environ.get('JUJU_AGENT_SOCKET_NETWORK', 'unix')
+            context_id = os.environ.get('JUJU_CONTEXT_ID')
+            if address and context_id and network == 'unix':
+                _client = JujucClient(address, context_id)
+            else:
+                _disabled = True
+        return _client
+
+
+def disable():
+    """Use subprocesses for all further hook tool calls."""
+    global _client, _disabled
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = None
+        _disabled = True
+
+
+def _run(cmd, stderr=None):
+    """Run cmd through the agent, returning (code, stdout) or None if it
+    has to be run as a subprocess.
+
+    Once the request is sent the tool may have run, so ResponseLost is
+    raised rather than running it again as a subprocess.
+    """
+    jujuc = client()
+    if jujuc is None:
+        return None
+    try:
+        code, out, err = jujuc.run(cmd)
+    except (socket.error, GobError, JujucError):
+        disable()
+        return None
+    if stderr == subprocess.STDOUT:
+        out += err
+    elif err:
+        if six.PY3:
+            sys.stderr.buffer.write(err)
+        else:
+            sys.stderr.write(err)
+        sys.stderr.flush()
+    return code, out
+
+
+def check_output(cmd, **kwargs):
+    """subprocess.check_output for hook tools."""
+    result = None
+    if set(kwargs) <= set(['stderr', 'universal_newlines']):
+        result = _run(cmd, kwargs.get('stderr'))
+    if result is None:
+        return subprocess.check_output(cmd, **kwargs)
+    code, out = result
+    if kwargs.get('universal_newlines'):
+        out = out.decode('UTF-8')
+    if code:
+        raise subprocess.CalledProcessError(code, cmd, output=out)
+    return out
+
+
+def call(cmd, **kwargs):
+    """subprocess.call for hook tools."""
+    result = None if kwargs else _run(cmd)
+    if result is None:
+        return subprocess.call(cmd, **kwargs)
+    code, out = result
+    if out:
+        if six.PY3:
+            sys.stdout.buffer.write(out)
+        else:
+            sys.stdout.write(out)
+        sys.stdout.flush()
+    return code
+
+
+def check_call(cmd, **kwargs):
+    """subprocess.check_call for hook tools."""
+    if kwargs:
+        return subprocess.check_call(cmd, **kwargs)
+    code = call(cmd)
+    if code:
+        raise subprocess.CalledProcessError(code, cmd)
+    return 0
+
+
+def run_tool(command, args, stdin):
+    """Handler for :class:`StandInServer` running the hook tool from PATH."""
+    proc = subprocess.Popen([command] + list(args),
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    out, err = proc.communicate(stdin)
+    return proc.returncode, out, err
+
+
+class StandInServer(object):
+    """
+    Serves the hook tool protocol on a unix socket without a Juju agent.
+
+    :param path: socket path, '@' prefixed for an abstract socket.
+    :param handler: callable(command, args, stdin) returning
+                    (exit code, stdout, stderr) for each request.
+    :param context_id: if set, requests for other contexts are rejected as
+                       the agent does.
+    """
+
+    def __init__(self, path, handler=run_tool, context_id=None):
+        self.path = path
+        self.handler = handler
+        self.context_id = context_id
+        self._sock = None
+
+    def environ(self):
+        """Environment pointing clients at this server."""
+        return {'JUJU_AGENT_SOCKET': self.path,
+                'JUJU_AGENT_SOCKET_NETWORK': 'unix',
+                'JUJU_CONTEXT_ID': self.context_id or 'stand-in'}
+
+    def start(self):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(_socket_address(self.path))
+        self._sock.listen(8)
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            if not self.path.startswith('@') and os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def _accept(self):
+        while self._sock is not None:
+            try:
+                sock, _ = self._sock.accept()
+            except (socket.error, AttributeError):
+                return
+            thread = threading.Thread(target=self._serve,
+                                      args=(_Connection(sock),))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, conn):
+        try:
+            while True:
+                header = conn.decoder.decode()
+                request = conn.decoder.decode()
+                error = None
+                if header.get('ServiceMethod') != JUJUC_SERVICE_METHOD:
+                    error = 'rpc: can\'t find service {}'.format(
+                        header.get('ServiceMethod'))
+                elif (self.context_id and
+                        request.get('ContextId') != self.context_id):
+                    error = 'bad request: unknown context "{}"'.format(
+                        request.get('ContextId', ''))
+                reply = {'ServiceMethod': header.get('ServiceMethod', ''),
+                         'Seq': header.get('Seq', 0)}
+                if error:
+                    reply['Error'] = error
+                    conn.encoder.encode(RPC_RESPONSE, reply)
+                    conn.encoder.encode(INVALID_REQUEST, {})
+                    continue
+                stdin = (request.get('Stdin', b'')
+                         if request.get('StdinSet') else None)
+                code, out, err = self.handler(request.get('CommandName', ''),
+                                              request.get('Args', []), stdin)
+                conn.encoder.encode(RPC_RESPONSE, reply)
+                conn.encoder.encode(JUJUC_RESPONSE, {
+                    'Code': code, 'Stdout': out or b'', 'Stderr': err or b''})
+        except (socket.error, GobError):
+            pass
+        finally:
+            conn.close()
+
+
+def main(args=None):
+    args = sys.argv[1:] if args is None else args
+    if len(args) != 1:
+        print('usage: python -m charmhelpers.core.jujuc SOCKET',
+              file=sys.stderr)
+        return 2
+    server = StandInServer(args[0]).start()
+    print('Serving hook tools on {}, set:'.format(args[0]))
+    for key, value in sorted(server.environ().items()):
+        print('  {}={}'.format(key, value))
+    try:
+        threading.Event().wait(2 ** 31)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
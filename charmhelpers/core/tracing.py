@@ -0,0 +1,252 @@
+# Copyright 2014-2015 Canonical Limited.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Opt-in timing of the work done by a hook.
+
+Tracing is off until :func:`enable` is called, typically by the charm's hook
+entry point when a config option is set; until then :func:`span` and
+:func:`traced` do nothing.  Once enabled, each span records its wall clock
+and CPU time, along with the stack of spans it ran in::
+
+    from charmhelpers.core import tracing
+
+    tracing.enable()
+
+    with tracing.span('render', '/etc/foo.conf'):
+        ...
+
+    @tracing.traced('hook-tool')
+    def relation_get(...):
+        ...
+
+CPU time is that of the whole process and its waited-for children, so a
+span covering a subprocess includes the CPU time of the subprocess, and
+spans running concurrently in several threads overlap.
+
+When the process exits the trace of the hook invocation is appended as one
+JSON line to TRACE_FILE in the charm directory, which keeps about the last
+TRACE_MAX_HOOKS invocations.  :func:`load`, :func:`slowest` and
+:func:`folded` read traces back; the latter produces the folded stack
+format read by flamegraph.pl and similar tools.
+"""
+
+import atexit
+import contextlib
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+TRACE_FILE = '.hook-traces'
+TRACE_MAX_HOOKS = 100
+
+_trace = None
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def _cpu_time():
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def trace_file():
+    """Path of the trace file of the charm."""
+    return os.path.join(os.environ.get('JUJU_CHARM_DIR') or
+                        os.environ.get('CHARM_DIR') or '', TRACE_FILE)
+
+
+def enabled():
+    return _trace is not None
+
+
+def enable(hook=None, path=None):
+    """
+    Start tracing the current hook invocation.
+
+    :param hook: name the invocation is recorded under, by default the name
+                 the program was called by.
+    :param path: trace file to append to, by default :func:`trace_file`.
+    """
+    global _trace
+    if _trace is not None:
+        return
+    _trace = {
+        'hook': hook or os.path.basename(sys.argv[0]),
+        'path': path or trace_file(),
+        'start': time.time(),
+        'cpu': _cpu_time(),
+        'spans': [],
+    }
+    atexit.register(save)
+
+
+def current():
+    """The stack of spans open in the calling thread, to be passed as the
+    parent of spans started in other threads."""
+    return list(_stack())
+
+
+@contextlib.contextmanager
+def span(kind, name, parent=None):
+    """
+    Record the time taken by the block.
+
+    :param kind: kind of work, e.g. 'hook-tool' or 'render'.
+    :param name: what the work is done on.
+    :param parent: stack from :func:`current` to nest the span under if the
+                   calling thread has no open span.
+    """
+    if _trace is None:
+        yield
+        return
+    stack = _stack()
+    base = list(parent or []) if not stack else []
+    stack.append('{}:{}'.format(kind, name))
+    path = base + stack
+    start = time.time()
+    cpu = _cpu_time()
+    try:
+        yield
+    finally:
+        wall = time.time() - start
+        cpu = _cpu_time() - cpu
+        stack.pop()
+        with _lock:
+            if _trace is not None:
+                _trace['spans'].append([path, round(wall, 6),
+                                        round(cpu, 6)])
+
+
+def traced(kind, name=None):
+    """Decorator recording each call of the function as a span, named after
+    the function unless name is given."""
+    def wrapper(f):
+        span_name = name or f.__name__
+
+        @functools.wraps(f)
+        def wrapped(*args, **kwargs):
+            if _trace is None:
+                return f(*args, **kwargs)
+            with span(kind, span_name):
+                return f(*args, **kwargs)
+        return wrapped
+    return wrapper
+
+
+def save():
+    """Stop tracing and append the trace to the trace file."""
+    global _trace
+    with _lock:
+        trace, _trace = _trace, None
+    if trace is None:
+        return
+    record = {
+        'hook': trace['hook'],
+        'start': trace['start'],
+        'wall': round(time.time() - trace['start'], 6),
+        'cpu': round(_cpu_time() - trace['cpu'], 6),
+        'spans': trace['spans'],
+    }
+    path = trace['path']
+    try:
+        with open(path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+        # Trim the file once it holds twice as many invocations as kept.
+        with open(path) as f:
+            lines = f.readlines()
+        if len(lines) > 2 * TRACE_MAX_HOOKS:
+            with open(path + '.tmp', 'w') as f:
+                f.writelines(lines[-TRACE_MAX_HOOKS:])
+            os.rename(path + '.tmp', path)
+    except (IOError, OSError):
+        pass
+
+
+def load(hooks=None, path=None):
+    """
+    Read traces back from the trace file.
+
+    :param hooks: number of most recent hook invocations to return, all if
+                  None.
+    :returns: list of trace records, oldest first.
+    """
+    try:
+        with open(path or trace_file()) as f:
+            lines = f.readlines()
+    except (IOError, OSError):
+        return []
+    if hooks is not None:
+        lines = lines[-hooks:] if hooks > 0 else []
+    return [json.loads(line) for line in lines if line.strip()]
+
+
+def _metric_index(metric):
+    if metric not in ('wall', 'cpu'):
+        raise ValueError('Unknown metric: {}'.format(metric))
+    return 1 if metric == 'wall' else 2
+
+
+def slowest(records, count=20, metric='wall'):
+    """
+    The longest spans of records.
+
+    :returns: list of (hook, stack, wall, cpu) tuples, longest first, where
+              stack is the ';' separated list of enclosing spans.
+    """
+    index = _metric_index(metric)
+    spans = []
+    for record in records:
+        for s in record['spans']:
+            spans.append((s[index], record['hook'], ';'.join(s[0]),
+                          s[1], s[2]))
+    spans.sort(key=lambda s: s[0], reverse=True)
+    return [s[1:] for s in spans[:count]]
+
+
+def folded(records, metric='wall'):
+    """
+    Aggregate records into folded stacks.
+
+    Each line is a ';' separated stack, rooted at the hook name, followed by
+    the time in microseconds spent in the innermost frame itself.
+
+    :returns: list of lines, sorted by stack.
+    """
+    index = _metric_index(metric)
+    totals = {}
+    for record in records:
+        stacks = {(record['hook'],): record[metric]}
+        for s in record['spans']:
+            stack = (record['hook'],) + tuple(s[0])
+            stacks[stack] = stacks.get(stack, 0) + s[index]
+        children = {}
+        for stack, total in stacks.items():
+            if len(stack) > 1:
+                children[stack[:-1]] = children.get(stack[:-1], 0) + total
+        for stack, total in stacks.items():
+            own = max(total - children.get(stack, 0), 0)
+            totals[stack] = totals.get(stack, 0) + own
+    return ['{} {}'.format(';'.join(stack), int(total * 1000000))
+            for stack, total in sorted(totals.items())]
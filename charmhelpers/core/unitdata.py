@@ -156,6 +156,8 @@ import pprint
 import sqlite3
 import sys
 
+import six
+
 __author__ = 'Kapil Thangavelu <kapil.foss@gmail.com>'
 
 
@@ -166,7 +168,24 @@ class Storage(object):
 
     To support dicts, lists, integer, floats, and booleans values
     are automatically json encoded/decoded.
+
+    Rows read from the kv table are cached in memory while this Storage
+    holds a write transaction, which keeps other processes from changing
+    them, and are read again once it is committed or rolled back. Within
+    :meth:`batch` (and :meth:`hook_scope`) writes are buffered and applied
+    with a single ``executemany`` per table when the batch ends or the data
+    is next queried in bulk.
     """
+
+    # Number of prepared statements kept by the sqlite3 connection.
+    CACHED_STATEMENTS = 128
+
+    # Maximum number of keys looked up in a single query.
+    QUERY_CHUNK_SIZE = 500
+
+    # Index kv_revisions by revision, used when pruning history.
+    REVISION_INDEX = True
+
     def __init__(self, path=None):
         self.db_path = path
         if path is None:
@@ -175,10 +194,15 @@ class Storage(object):
             else:
                 self.db_path = os.path.join(
                     os.environ.get('CHARM_DIR', ''), '.unit-state.db')
-        self.conn = sqlite3.connect('%s' % self.db_path)
+        self.conn = sqlite3.connect('%s' % self.db_path,
+                                    cached_statements=self.CACHED_STATEMENTS)
         self.cursor = self.conn.cursor()
         self.revision = None
         self._closed = False
+        self._cache = {}
+        self._pending = None
+        self._undo = None
+        self._writing = False
         self._init()
 
     def close(self):
@@ -189,35 +213,84 @@ class Storage(object):
         self.conn.close()
         self._closed = True
 
-    def get(self, key, default=None, record=False):
+    def _get(self, key):
+        """Serialized value of key, or None if not set."""
+        if self._pending and key in self._pending:
+            return self._pending[key]
+        if key in self._cache:
+            return self._cache[key]
         self.cursor.execute('select data from kv where key=?', [key])
         result = self.cursor.fetchone()
-        if not result:
+        data = result[0] if result else None
+        if self._writing:
+            self._cache[key] = data
+        return data
+
+    def get(self, key, default=None, record=False):
+        result = self._get(key)
+        if result is None:
             return default
         if record:
-            return Record(json.loads(result[0]))
-        return json.loads(result[0])
+            return Record(json.loads(result))
+        return json.loads(result)
+
+    @staticmethod
+    def _prefix_range(prefix):
+        """SQL condition and arguments matching keys starting with prefix.
+
+        Uses a key range rather than LIKE so that the primary key index can
+        be used. Keys are compared as UTF-8, which sorts in code point
+        order, so keys starting with prefix sort before prefix with its last
+        code point incremented; trailing code points that cannot be
+        incremented are dropped first.
+        """
+        if not prefix:
+            return '1', []
+        upper = prefix
+        while upper:
+            code = ord(upper[-1]) + 1
+            if code <= sys.maxunicode:
+                if 0xD800 <= code <= 0xDFFF:
+                    # skip the surrogates, which are not valid in UTF-8
+                    code = 0xE000
+                upper = upper[:-1] + six.unichr(code)
+                return 'key >= ? and key < ?', [prefix, upper]
+            upper = upper[:-1]
+        return 'key >= ?', [prefix]
+
+    def _iterrange(self, key_prefix, strip=False):
+        """Iterate over (key, serialized data) for keys starting with
+        key_prefix, in key order.
+        """
+        self._write_pending()
+        if isinstance(key_prefix, six.binary_type):
+            key_prefix = key_prefix.decode('UTF-8')
+        condition, args = self._prefix_range(key_prefix)
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute('select key, data from kv where %s order by key' %
+                           condition, args)
+            offset = len(key_prefix) if strip else 0
+            for key, data in cursor:
+                yield key[offset:], data
+        finally:
+            cursor.close()
 
     def getrange(self, key_prefix, strip=False):
         """
         Get a range of keys starting with a common prefix as a mapping of
         keys to values.
 
+        The prefix is matched literally and case sensitively: '_' and '%'
+        have no special meaning, as they would in a SQL LIKE pattern.
+
         :param str key_prefix: Common prefix among all keys
         :param bool strip: Optionally strip the common prefix from the key
             names in the returned dict
         :return dict: A (possibly empty) dict of key-value mappings
         """
-        self.cursor.execute("select key, data from kv where key like ?",
-                            ['%s%%' % key_prefix])
-        result = self.cursor.fetchall()
-
-        if not result:
-            return {}
-        if not strip:
-            key_prefix = ''
-        return dict([
-            (k[len(key_prefix):], json.loads(v)) for k, v in result])
+        return dict((k, json.loads(v))
+                    for k, v in self._iterrange(key_prefix, strip))
 
     def update(self, mapping, prefix=""):
         """
@@ -227,14 +300,19 @@ class Storage(object):
         :param str prefix: Optional prefix to apply to all keys in `mapping`
             before setting
         """
-        for k, v in mapping.items():
-            self.set("%s%s" % (prefix, k), v)
+        self._set(dict(("%s%s" % (prefix, k), json.dumps(v))
+                       for k, v in mapping.items()))
 
     def unset(self, key):
         """
         Remove a key from the database entirely.
         """
+        self._write_pending()
+        if self._undo is not None and key not in self._undo:
+            self._undo[key] = self._get(key)
         self.cursor.execute('delete from kv where key=?', [key])
+        self._writing = True
+        self._cache[key] = None
         if self.revision and self.cursor.rowcount:
             self.cursor.execute(
                 'insert into kv_revisions values (?, ?, ?)',
@@ -245,20 +323,38 @@ class Storage(object):
         Remove a range of keys starting with a common prefix, from the database
         entirely.
 
+        As with :meth:`getrange`, the prefix is matched literally and is case
+        sensitive.
+
         :param list keys: List of keys to remove.
         :param str prefix: Optional prefix to apply to all keys in ``keys``
             before removing.
         """
+        self._write_pending()
         if keys is not None:
             keys = ['%s%s' % (prefix, key) for key in keys]
+            if self._undo is not None:
+                for key, data in self._fetch(
+                        [k for k in keys if k not in self._undo]).items():
+                    self._undo[key] = data
             self.cursor.execute('delete from kv where key in (%s)' % ','.join(['?'] * len(keys)), keys)
+            self._writing = True
+            for key in keys:
+                self._cache[key] = None
             if self.revision and self.cursor.rowcount:
                 self.cursor.execute(
                     'insert into kv_revisions values %s' % ','.join(['(?, ?, ?)'] * len(keys)),
                     list(itertools.chain.from_iterable((key, self.revision, json.dumps('DELETED')) for key in keys)))
         else:
-            self.cursor.execute('delete from kv where key like ?',
-                                ['%s%%' % prefix])
+            if self._undo is not None:
+                for key, data in self._iterrange(prefix):
+                    self._undo.setdefault(key, data)
+            if isinstance(prefix, six.binary_type):
+                prefix = prefix.decode('UTF-8')
+            condition, args = self._prefix_range(prefix)
+            self.cursor.execute('delete from kv where %s' % condition, args)
+            self._writing = True
+            self._cache.clear()
             if self.revision and self.cursor.rowcount:
                 self.cursor.execute(
                     'insert into kv_revisions values (?, ?, ?)',
@@ -271,109 +367,278 @@ class Storage(object):
         :param str key: Key to set the value for
         :param value: Any JSON-serializable value to be set
         """
-        serialized = json.dumps(value)
+        self._set({key: json.dumps(value)})
+        return value
 
-        self.cursor.execute('select data from kv where key=?', [key])
-        exists = self.cursor.fetchone()
+    def _set(self, serialized):
+        """Set keys to their serialized values, buffering the writes if a
+        batch is in progress.
+        """
+        if self._pending is not None:
+            self._pending.update(serialized)
+        else:
+            self._write(serialized)
+
+    def _write_pending(self):
+        if self._pending:
+            pending, self._pending = self._pending, {}
+            self._write(pending)
+
+    def _fetch(self, keys):
+        """Serialized values of keys, None for those not set."""
+        fetched = {}
+        for i in range(0, len(keys), self.QUERY_CHUNK_SIZE):
+            chunk = keys[i:i + self.QUERY_CHUNK_SIZE]
+            fetched.update((k, None) for k in chunk)
+            self.cursor.execute(
+                'select key, data from kv where key in (%s)' %
+                ','.join(['?'] * len(chunk)), chunk)
+            fetched.update(self.cursor.fetchall())
+        return fetched
+
+    def _write(self, serialized):
+        """Write keys whose serialized values differ from those stored."""
+        current = self._fetch([k for k in serialized if k not in self._cache])
+        current.update((k, self._cache[k]) for k in serialized
+                       if k in self._cache)
 
         # Skip mutations to the same value
-        if exists:
-            if exists[0] == serialized:
-                return value
+        changed = sorted((k, v) for k, v in serialized.items()
+                         if current[k] != v)
+        if not changed:
+            if self._writing:
+                self._cache.update(current)
+            return
 
-        if not exists:
-            self.cursor.execute(
-                'insert into kv (key, data) values (?, ?)',
-                (key, serialized))
-        else:
-            self.cursor.execute('''
-            update kv
-            set data = ?
-            where key = ?''', [serialized, key])
+        if self._undo is not None:
+            for k, v in changed:
+                self._undo.setdefault(k, current[k])
+        self.cursor.executemany(
+            'insert or replace into kv (key, data) values (?, ?)', changed)
+        self._writing = True
+        self._cache.update(current)
+        self._cache.update(changed)
 
         # Save
         if not self.revision:
-            return value
+            return
 
-        self.cursor.execute(
-            'select 1 from kv_revisions where key=? and revision=?',
-            [key, self.revision])
-        exists = self.cursor.fetchone()
+        self.cursor.executemany(
+            '''insert or replace into kv_revisions (
+            revision, key, data) values (?, ?, ?)''',
+            [(self.revision, k, v) for k, v in changed])
 
-        if not exists:
-            self.cursor.execute(
-                '''insert into kv_revisions (
-                revision, key, data) values (?, ?, ?)''',
-                (self.revision, key, serialized))
-        else:
-            self.cursor.execute(
-                '''
-                update kv_revisions
-                set data = ?
-                where key = ?
-                and   revision = ?''',
-                [serialized, key, self.revision])
+    @contextlib.contextmanager
+    def batch(self):
+        """Buffer all writes made in scope, writing them in bulk on exit.
 
-        return value
+        Nested batches are written when the outermost batch exits. If an
+        exception leaves the outermost batch, the keys set or unset in it
+        are restored to their values from before it; revision history is
+        left to :meth:`hook_scope`, which rolls back the whole hook.
+        """
+        if self._pending is not None:
+            yield
+            return
+        self._pending = {}
+        self._undo = {}
+        try:
+            yield
+            self._write_pending()
+        except Exception:
+            self._pending = None
+            self._undo_batch()
+            raise
+        finally:
+            self._pending = None
+            self._undo = None
+
+    def _undo_batch(self):
+        """Restore the keys written by the batch in progress."""
+        undo, self._undo = self._undo, None
+        restore = sorted((k, v) for k, v in undo.items() if v is not None)
+        if restore:
+            self.cursor.executemany(
+                'insert or replace into kv (key, data) values (?, ?)',
+                restore)
+        removed = sorted([k] for k, v in undo.items() if v is None)
+        if removed:
+            self.cursor.executemany('delete from kv where key=?', removed)
+        self._cache.update(undo)
 
     def delta(self, mapping, prefix):
         """
         return a delta containing values that have changed.
+
+        Stored values are streamed in key order and compared with mapping
+        one at a time rather than being loaded into a dict first; only the
+        keys of mapping not yet seen are kept.
         """
-        previous = self.getrange(prefix, strip=True)
-        if not previous:
-            pk = set()
-        else:
-            pk = set(previous.keys())
-        ck = set(mapping.keys())
         delta = DeltaSet()
-
-        # added
-        for k in ck.difference(pk):
-            delta[k] = Delta(None, mapping[k])
-
-        # removed
-        for k in pk.difference(ck):
-            delta[k] = Delta(previous[k], None)
-
-        # changed
-        for k in pk.intersection(ck):
+        unseen = set(mapping)
+
+        for k, p in self._iterrange(prefix, strip=True):
+            unseen.discard(k)
+            # removed
+            if k not in mapping:
+                delta[k] = Delta(json.loads(p), None)
+                continue
+            # changed
             c = mapping[k]
-            p = previous[k]
+            if json.dumps(c) == p:
+                continue
+            p = json.loads(p)
             if c != p:
                 delta[k] = Delta(p, c)
 
+        # added
+        for k in unseen:
+            delta[k] = Delta(None, mapping[k])
+
         return delta
 
     @contextlib.contextmanager
     def hook_scope(self, name=""):
         """Scope all future interactions to the current hook execution
-        revision."""
+        revision.
+
+        Writes made in scope are batched, see :meth:`batch`."""
         assert not self.revision
         self.cursor.execute(
             'insert into hooks (hook, date) values (?, ?)',
             (name or sys.argv[0],
              datetime.datetime.utcnow().isoformat()))
         self.revision = self.cursor.lastrowid
+        self._writing = True
         try:
-            yield self.revision
-            self.revision = None
+            with self.batch():
+                yield self.revision
         except Exception:
             self.flush(False)
             self.revision = None
             raise
         else:
             self.flush()
+            self.revision = None
+        finally:
+            self._cache.clear()
 
     def flush(self, save=True):
         if save:
+            self._write_pending()
             self.conn.commit()
         elif self._closed:
             return
         else:
+            if self._pending:
+                self._pending = {}
             self.conn.rollback()
+        self._writing = False
+        self._cache.clear()
+
+    def prune(self, keep_revisions=None, keep_days=None):
+        """Delete hook history outside the retention window.
+
+        Hooks, and the kv_revisions recorded by them, are kept if they are
+        among the last keep_revisions hooks or ran within the last keep_days
+        days. If neither is set nothing is pruned. The rows are deleted in
+        the current transaction; :meth:`compact` returns the space they used
+        to the filesystem once it has been committed.
+
+        :param int keep_revisions: Number of most recent hooks to keep.
+        :param int keep_days: Keep hooks that ran in this many days.
+        :return int: Number of hooks pruned.
+        """
+        self._write_pending()
+        cutoffs = []
+        if keep_revisions:
+            self.cursor.execute(
+                'select version from hooks order by version desc '
+                'limit 1 offset ?', [keep_revisions - 1])
+            result = self.cursor.fetchone()
+            cutoffs.append(result[0] if result else 0)
+        if keep_days:
+            since = (datetime.datetime.utcnow() -
+                     datetime.timedelta(days=keep_days)).isoformat()
+            self.cursor.execute(
+                'select coalesce(min(version), ('
+                '    select coalesce(max(version), 0) + 1 from hooks)) '
+                'from hooks where date >= ?', [since])
+            cutoffs.append(self.cursor.fetchone()[0])
+        if not cutoffs or not min(cutoffs):
+            return 0
+
+        cutoff = min(cutoffs)
+        self.cursor.execute(
+            'delete from kv_revisions where revision < ?', [cutoff])
+        self.cursor.execute(
+            'delete from hooks where version < ?', [cutoff])
+        self._writing = True
+        return self.cursor.rowcount
+
+    def compact(self, vacuum_pages=None):
+        """Return the space of deleted rows to the filesystem.
+
+        Any pending changes are committed first, so this is meant to be
+        called once the changes of a hook are complete, eg from a callback
+        registered with hookenv.atexit().
+
+        Databases are created with incremental auto vacuum, which releases
+        free pages incrementally. A database created without it is converted
+        by a full vacuum the first time it is compacted. The write-ahead log
+        is then checkpointed and truncated.
+
+        :param int vacuum_pages: Maximum number of free pages released by an
+            incremental vacuum, defaults to all.
+        :return dict: :meth:`stats` after compaction
+        """
+        assert not self.revision
+        self.flush()
+        self.cursor.execute('pragma auto_vacuum')
+        if self.cursor.fetchone()[0] == 2:
+            self.cursor.execute('pragma incremental_vacuum(%d)' %
+                                int(vacuum_pages or 0))
+            self.cursor.fetchall()
+        else:
+            # Only takes effect on an existing database through a vacuum.
+            self.cursor.execute('pragma auto_vacuum=incremental')
+            self.cursor.execute('vacuum')
+        # Fold the write-ahead log back into the database and truncate it.
+        self.cursor.execute('pragma wal_checkpoint(truncate)')
+        self.cursor.fetchall()
+        return self.stats()
+
+    def stats(self):
+        """Size of the database and number of rows in each table.
+
+        :return dict: with keys 'db_size' and 'wal_size' (bytes),
+            'page_count', 'freelist_count' and 'rows', a dict of row
+            counts by table name.
+        """
+        self._write_pending()
+        stats = {'rows': {}}
+        for table in ('kv', 'kv_revisions', 'hooks'):
+            self.cursor.execute('select count(*) from %s' % table)
+            stats['rows'][table] = self.cursor.fetchone()[0]
+        for pragma in ('page_count', 'freelist_count'):
+            self.cursor.execute('pragma %s' % pragma)
+            stats[pragma] = self.cursor.fetchone()[0]
+        for key, path in (('db_size', self.db_path),
+                          ('wal_size', '%s-wal' % self.db_path)):
+            stats[key] = (os.path.getsize(path)
+                          if os.path.exists(path) else 0)
+        return stats
 
     def _init(self):
+        # Takes effect if the database is new, see compact().
+        self.cursor.execute('pragma auto_vacuum=incremental')
+        try:
+            # Write-ahead logging lets readers proceed while a hook holds a
+            # write transaction, and avoids rewriting the db on each commit.
+            self.cursor.execute('pragma journal_mode=wal')
+            self.cursor.execute('pragma synchronous=normal')
+        except sqlite3.DatabaseError:
+            pass
         self.cursor.execute('''
             create table if not exists kv (
                key text,
@@ -387,6 +652,10 @@ class Storage(object):
                data text,
                primary key (key, revision)
                )''')
+        if self.REVISION_INDEX:
+            self.cursor.execute('''
+                create index if not exists kv_revisions_revision
+                on kv_revisions (revision)''')
         self.cursor.execute('''
             create table if not exists hooks (
                version integer primary key autoincrement,
@@ -396,6 +665,7 @@ class Storage(object):
         self.conn.commit()
 
     def gethistory(self, key, deserialize=False):
+        self._write_pending()
         self.cursor.execute(
             '''
             select kv.revision, kv.key, kv.data, h.hook, h.date
@@ -409,6 +679,7 @@ class Storage(object):
         return map(_parse_history, self.cursor.fetchall())
 
     def debug(self, fh=sys.stderr):
+        self._write_pending()
         self.cursor.execute('select * from kv')
         pprint.pprint(self.cursor.fetchall(), stream=fh)
         self.cursor.execute('select * from kv_revisions')
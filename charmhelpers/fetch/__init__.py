@@ -92,6 +92,10 @@ add_source = fetch.add_source
 
 if __platform__ == "ubuntu":
     apt_cache = fetch.apt_cache
+    apt_plan = fetch.apt_plan
+    dpkg_status = fetch.dpkg_status
+    dpkg_status_stamp = fetch.dpkg_status_stamp
+    upstream_version = fetch.upstream_version
     apt_install = fetch.apt_install
     apt_update = fetch.apt_update
     apt_upgrade = fetch.apt_upgrade
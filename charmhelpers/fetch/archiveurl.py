@@ -15,6 +15,8 @@
 import os
 import hashlib
 import re
+import shutil
+from tempfile import mkstemp
 
 from charmhelpers.fetch import (
     BaseFetchHandler,
@@ -24,25 +26,33 @@ from charmhelpers.payload.archive import (
     get_archive_handler,
     extract,
 )
-from charmhelpers.core.host import mkdir, check_hash
+from charmhelpers.core.host import mkdir, ChecksumError
 
 import six
 if six.PY3:
     from urllib.request import (
-        build_opener, install_opener, urlopen, urlretrieve,
+        build_opener, install_opener, urlopen, Request,
         HTTPPasswordMgrWithDefaultRealm, HTTPBasicAuthHandler,
     )
     from urllib.parse import urlparse, urlunparse, parse_qs
-    from urllib.error import URLError
+    from urllib.error import URLError, HTTPError
 else:
-    from urllib import urlretrieve
     from urllib2 import (
-        build_opener, install_opener, urlopen,
+        build_opener, install_opener, urlopen, Request,
         HTTPPasswordMgrWithDefaultRealm, HTTPBasicAuthHandler,
-        URLError
+        URLError, HTTPError
     )
     from urlparse import urlparse, urlunparse, parse_qs
 
+CHUNK_SIZE = 64 * 1024
+# Verified downloads, shared by the units of a machine and stored as
+# CACHE_DIR/<hash type>/<checksum>.
+CACHE_DIR = '/var/cache/charmhelpers/fetch'
+PARTIAL_SUFFIX = '.part'
+# Sent by servers that cannot serve the range asked for.
+HTTP_RANGE_NOT_SATISFIABLE = 416
+HTTP_PARTIAL_CONTENT = 206
+
 
 def splituser(host):
     '''urllib.splituser(), but six's support of this seems broken'''
@@ -62,6 +72,45 @@ def splitpasswd(user):
     return user, None
 
 
+def hash_algorithms():
+    if not six.PY3:
+        return hashlib.algorithms
+    return hashlib.algorithms_available
+
+
+def _remove(*paths):
+    for path in paths:
+        if os.path.isfile(path):
+            os.unlink(path)
+
+
+def _read_file(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except IOError:
+        return None
+
+
+def _file_hashes(path, hash_types):
+    hashes = dict((t, hashlib.new(t)) for t in hash_types)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            for h in hashes.values():
+                h.update(chunk)
+    return hashes
+
+
+def _link_or_copy(source, dest):
+    tmp = dest + '.tmp'
+    _remove(tmp)
+    try:
+        os.link(source, tmp)
+    except OSError:
+        shutil.copyfile(source, tmp)
+    os.rename(tmp, dest)
+
+
 class ArchiveUrlFetchHandler(BaseFetchHandler):
     """
     Handler to download archive files from arbitrary URLs.
@@ -82,12 +131,21 @@ class ArchiveUrlFetchHandler(BaseFetchHandler):
             return True
         return False
 
-    def download(self, source, dest):
+    def download(self, source, dest, hash_types=()):
         """
         Download an archive file.
 
+        The response is written to disk CHUNK_SIZE bytes at a time. An http
+        or https download which fails part way is kept alongside dest and
+        resumed by the next download to dest with a Range request, provided
+        the server says through the ETag or Last-Modified of the first
+        response that the file has not changed since.
+
         :param str source: URL pointing to an archive file.
         :param str dest: Local path location to download archive file to.
+        :param hash_types: hash algorithms to compute over the file while it
+            is written.
+        :returns: dict of hash type to hex digest of the downloaded file.
         """
         # propogate all exceptions
         # URLError, OSError, etc
@@ -104,19 +162,106 @@ class ArchiveUrlFetchHandler(BaseFetchHandler):
                 authhandler = HTTPBasicAuthHandler(passman)
                 opener = build_opener(authhandler)
                 install_opener(opener)
-        response = urlopen(source)
+        resumable = proto in ('http', 'https')
+        partial = dest + PARTIAL_SUFFIX
+        validator_file = partial + '.validator'
+        response, offset = self._open(source, partial, validator_file,
+                                      resumable)
         try:
-            with open(dest, 'wb') as dest_file:
-                dest_file.write(response.read())
+            if offset:
+                hashes = _file_hashes(partial, hash_types)
+            else:
+                hashes = dict((t, hashlib.new(t)) for t in hash_types)
+            headers = response.info()
+            validator = headers.get('ETag') or headers.get('Last-Modified')
+            if resumable and validator:
+                with open(validator_file, 'w') as f:
+                    f.write(validator)
+            else:
+                _remove(validator_file)
+            with open(partial, 'ab' if offset else 'wb') as dest_file:
+                for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+                    dest_file.write(chunk)
+                    for h in hashes.values():
+                        h.update(chunk)
         except Exception as e:
-            if os.path.isfile(dest):
-                os.unlink(dest)
+            if not os.path.isfile(validator_file):
+                _remove(partial)
             raise e
+        finally:
+            response.close()
+        os.rename(partial, dest)
+        _remove(validator_file)
+        return dict((t, h.hexdigest()) for t, h in hashes.items())
+
+    def _open(self, source, partial, validator_file, resumable):
+        """Open source, resuming partial if it can be.
+
+        :returns: the response and the offset it starts at.
+        """
+        validator = _read_file(validator_file)
+        if resumable and validator and os.path.isfile(partial):
+            offset = os.path.getsize(partial)
+            request = Request(source)
+            request.add_header('Range', 'bytes=%d-' % offset)
+            request.add_header('If-Range', validator)
+            try:
+                response = urlopen(request)
+            except HTTPError as e:
+                if e.code != HTTP_RANGE_NOT_SATISFIABLE:
+                    raise
+            else:
+                if response.getcode() == HTTP_PARTIAL_CONTENT:
+                    return response, offset
+                # The file changed; the whole of it follows.
+                return response, 0
+        _remove(partial, validator_file)
+        return urlopen(source), 0
+
+    def cached_path(self, hash_type, checksum):
+        """Path of the cached download with checksum, None if the checksum
+        cannot name a file."""
+        if (hash_type not in hash_algorithms() or
+                not re.match('^[0-9a-fA-F]+$', checksum)):
+            return None
+        return os.path.join(CACHE_DIR, hash_type, checksum.lower())
+
+    def _install_cached(self, checksums, dest):
+        """Copy a cached download matching all checksums to dest.
+
+        :returns: True if one was found.
+        """
+        for hash_type, checksum in checksums:
+            cached = self.cached_path(hash_type, checksum)
+            if not cached or not os.path.isfile(cached):
+                continue
+            hashes = _file_hashes(cached, set(t for t, _ in checksums))
+            if all(hashes[t].hexdigest() == c.lower() for t, c in checksums):
+                _link_or_copy(cached, dest)
+                return True
+            _remove(cached)
+        return False
+
+    def _cache(self, checksums, path):
+        for hash_type, checksum in checksums:
+            cached = self.cached_path(hash_type, checksum)
+            if not cached:
+                continue
+            try:
+                if not os.path.exists(os.path.dirname(cached)):
+                    mkdir(os.path.dirname(cached), perms=0o755)
+                _link_or_copy(path, cached)
+            except (IOError, OSError):
+                # Caching is an optimisation only.
+                pass
 
     # Mandatory file validation via Sha1 or MD5 hashing.
     def download_and_validate(self, url, hashsum, validate="sha1"):
-        tempfile, headers = urlretrieve(url)
-        check_hash(tempfile, hashsum, validate)
+        fd, tempfile = mkstemp()
+        os.close(fd)
+        digests = self.download(url, tempfile, [validate])
+        if digests[validate] != hashsum:
+            raise ChecksumError("'%s' != '%s'" % (hashsum, digests[validate]))
         return tempfile
 
     def install(self, source, dest=None, checksum=None, hash_type='sha1'):
@@ -136,30 +281,37 @@ class ArchiveUrlFetchHandler(BaseFetchHandler):
             Can be any hash alrgorithm supported by :mod:`hashlib`,
             such as md5, sha1, sha256, sha512, etc.
 
+        Downloads are validated from the hashes computed while they are
+        written, then kept in CACHE_DIR under their checksums; installing a
+        source whose checksum is already cached does not touch the network.
+
         """
         url_parts = self.parse_url(source)
         dest_dir = os.path.join(os.environ.get('CHARM_DIR'), 'fetched')
         if not os.path.exists(dest_dir):
             mkdir(dest_dir, perms=0o755)
         dld_file = os.path.join(dest_dir, os.path.basename(url_parts.path))
-        try:
-            self.download(source, dld_file)
-        except URLError as e:
-            raise UnhandledSource(e.reason)
-        except OSError as e:
-            raise UnhandledSource(e.strerror)
+        checksums = []
         options = parse_qs(url_parts.fragment)
         for key, value in options.items():
-            if not six.PY3:
-                algorithms = hashlib.algorithms
-            else:
-                algorithms = hashlib.algorithms_available
-            if key in algorithms:
+            if key in hash_algorithms():
                 if len(value) != 1:
                     raise TypeError(
                         "Expected 1 hash value, not %d" % len(value))
-                expected = value[0]
-                check_hash(dld_file, expected, key)
+                checksums.append((key, value[0]))
         if checksum:
-            check_hash(dld_file, checksum, hash_type)
+            checksums.append((hash_type, checksum))
+        if self._install_cached(checksums, dld_file):
+            return extract(dld_file, dest)
+        try:
+            digests = self.download(source, dld_file,
+                                    set(t for t, _ in checksums))
+        except URLError as e:
+            raise UnhandledSource(e.reason)
+        except OSError as e:
+            raise UnhandledSource(e.strerror)
+        for key, expected in checksums:
+            if digests[key] != expected.lower():
+                raise ChecksumError("'%s' != '%s'" % (expected, digests[key]))
+        self._cache(checksums, dld_file)
         return extract(dld_file, dest)
@@ -13,6 +13,7 @@
 # limitations under the License.
 
 from collections import OrderedDict
+import io
 import os
 import platform
 import re
@@ -29,6 +30,7 @@ from charmhelpers.core.hookenv import (
     DEBUG,
     WARNING,
 )
+from charmhelpers.core import tracing
 from charmhelpers.fetch import SourceConfigError, GPGKeyError
 
 PROPOSED_POCKET = (
@@ -163,21 +165,144 @@ CLOUD_ARCHIVE_POCKETS = {
 APT_NO_LOCK = 100  # The return code for "couldn't acquire lock" in APT.
 CMD_RETRY_DELAY = 10  # Wait 10 seconds between command retries.
 CMD_RETRY_COUNT = 3  # Retry a failing fatal command X times.
+DPKG_STATUS = '/var/lib/dpkg/status'
+
+_dpkg_status = {}
 
 
 def filter_installed_packages(packages):
     """Return a list of packages that require installation."""
-    cache = apt_cache()
-    _pkgs = []
-    for package in packages:
-        try:
-            p = cache[package]
-            p.current_ver or _pkgs.append(package)
-        except KeyError:
-            log('Package {} has no installation candidate.'.format(package),
-                level='WARNING')
-            _pkgs.append(package)
-    return _pkgs
+    installed = dpkg_status()
+    return [package for package in packages if package not in installed]
+
+
+def _parse_dpkg_status(path):
+    installed = {}
+    fields = {}
+    with io.open(path, encoding='UTF-8', errors='replace') as f:
+        for line in f:
+            if not line.strip():
+                _add_installed(installed, fields)
+                fields = {}
+            elif line[0] not in ' \t':
+                name, _, value = line.partition(':')
+                if name in ('Package', 'Status', 'Version', 'Architecture'):
+                    fields[name] = value.strip()
+    _add_installed(installed, fields)
+    return installed
+
+
+def _add_installed(installed, fields):
+    # Only fully installed packages count; unpacked or half-configured ones
+    # are left for apt to finish.
+    if fields.get('Status', '').split()[-1:] != ['installed']:
+        return
+    version = fields.get('Version')
+    installed[fields['Package']] = version
+    if fields.get('Architecture'):
+        name = '{}:{}'.format(fields['Package'], fields['Architecture'])
+        installed[name] = version
+
+
+def dpkg_status_stamp(path=DPKG_STATUS):
+    """The (mtime, size) of the dpkg status file, None if it is missing.
+
+    The stamp changes whenever dpkg installs, removes or upgrades a package.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size)
+
+
+def dpkg_status(path=DPKG_STATUS):
+    """
+    Installed packages and their versions, read from the dpkg status file.
+
+    The file is only parsed again once its :func:`dpkg_status_stamp` has
+    changed, so repeated calls in a hook cost a stat.
+
+    :returns: dict of package name to version. Packages are also listed as
+              name:arch.
+    """
+    key = dpkg_status_stamp(path)
+    if key is None:
+        return {}
+    cached = _dpkg_status.get(path)
+    if cached is None or cached[0] != key:
+        cached = _dpkg_status[path] = (key, _parse_dpkg_status(path))
+    return cached[1]
+
+
+def upstream_version(version):
+    """The upstream part of a Debian version, without epoch or revision."""
+    if ':' in version:
+        version = version.split(':', 1)[1]
+    if '-' in version:
+        version = version.rsplit('-', 1)[0]
+    return version
+
+
+class AptPlan(object):
+    """
+    Packages a hook needs, installed in as few apt transactions as possible.
+
+    Requests are only resolved against :func:`dpkg_status` when the plan is
+    executed, so packages already installed cost nothing and all requests
+    made with the same options share a single ``apt-get install``::
+
+        plan = apt_plan()
+        plan.add(['glance', 'haproxy'], fatal=True)
+        plan.add(['python-dbus'])
+        plan.execute()
+
+    A transaction is fatal if any of the requests it merges was. Packages
+    which are reinstalled, installed from a target release or needed before
+    a hook runs, such as on import, still go through :func:`apt_install`.
+    """
+
+    def __init__(self):
+        self._requests = OrderedDict()
+
+    def add(self, packages, options=None, fatal=False):
+        """Request packages, installed with options, for the next execute."""
+        if isinstance(packages, six.string_types):
+            packages = [packages]
+        key = tuple(options) if options is not None else None
+        request = self._requests.setdefault(key, [OrderedDict(), False])
+        for package in packages:
+            request[0][package] = True
+        request[1] = request[1] or fatal
+
+    def pending(self):
+        """
+        The transactions execute would run.
+
+        :returns: list of (options, packages, fatal) tuples.
+        """
+        transactions = []
+        for key, (packages, fatal) in self._requests.items():
+            missing = filter_installed_packages(packages)
+            if missing:
+                options = list(key) if key is not None else None
+                transactions.append((options, missing, fatal))
+        return transactions
+
+    def execute(self):
+        """Install the missing packages and empty the plan."""
+        transactions = self.pending()
+        self._requests.clear()
+        for options, packages, fatal in transactions:
+            apt_install(packages, options=options, fatal=fatal)
+
+
+_apt_plan = AptPlan()
+
+
+def apt_plan():
+    """The :class:`AptPlan` of the current hook."""
+    return _apt_plan
 
 
 def apt_cache(in_memory=True, progress=None):
@@ -190,6 +315,7 @@ def apt_cache(in_memory=True, progress=None):
     return apt_pkg.Cache(progress)
 
 
+@tracing.traced('apt')
 def apt_install(packages, options=None, fatal=False):
     """Install one or more packages."""
     if options is None:
@@ -207,6 +333,7 @@ def apt_install(packages, options=None, fatal=False):
     _run_apt_command(cmd, fatal)
 
 
+@tracing.traced('apt')
 def apt_upgrade(options=None, fatal=False, dist=False):
     """Upgrade all packages."""
     if options is None:
@@ -222,12 +349,14 @@ def apt_upgrade(options=None, fatal=False, dist=False):
     _run_apt_command(cmd, fatal)
 
 
+@tracing.traced('apt')
 def apt_update(fatal=False):
     """Update local apt cache."""
     cmd = ['apt-get', 'update']
     _run_apt_command(cmd, fatal)
 
 
+@tracing.traced('apt')
 def apt_purge(packages, fatal=False):
     """Purge one or more packages."""
     cmd = ['apt-get', '--assume-yes', 'purge']
@@ -239,6 +368,7 @@ def apt_purge(packages, fatal=False):
     _run_apt_command(cmd, fatal)
 
 
+@tracing.traced('apt')
 def apt_mark(packages, mark, fatal=False):
     """Flag one or more packages using apt-mark."""
     log("Marking {} as {}".format(packages, mark))
@@ -568,16 +698,8 @@ def get_upstream_version(package):
 
     @returns None (if not installed) or the upstream version
     """
-    import apt_pkg
-    cache = apt_cache()
-    try:
-        pkg = cache[package]
-    except Exception:
-        # the package is unknown to the current apt cache.
-        return None
-
-    if not pkg.current_ver:
-        # package is known, but no version is currently installed.
+    version = dpkg_status().get(package)
+    if not version:
+        # package is unknown or not installed.
         return None
-
-    return apt_pkg.upstream_version(pkg.current_ver.ver_str)
+    return upstream_version(version)
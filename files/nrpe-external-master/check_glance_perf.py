@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+# --------------------------------------------
+# This file is managed by Juju
+# --------------------------------------------
+#
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Nagios plugin for glance performance.
+
+    check_glance_perf.py api-latency --url URL -w MS -c MS
+    check_glance_perf.py store-rtt -w MS -c MS
+    check_glance_perf.py cache-fill -w PERCENT -c PERCENT
+    check_glance_perf.py haproxy-sessions -w COUNT -c COUNT
+    check_glance_perf.py haproxy-queue -w COUNT -c COUNT
+
+api-latency is measured when the check runs. The other metrics need access
+to credentials, the image cache and the haproxy admin socket which the
+nagios user lacks, so they are gathered by
+
+    check_glance_perf.py probe
+
+run as root from cron, which writes them to a status file read by the
+checks.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import socket
+import sys
+import time
+
+try:
+    from ConfigParser import RawConfigParser
+except ImportError:
+    from configparser import RawConfigParser
+
+try:
+    from urllib2 import urlopen, HTTPError, URLError
+except ImportError:
+    from urllib.request import urlopen
+    from urllib.error import HTTPError, URLError
+
+OK, WARNING, CRITICAL, UNKNOWN = 0, 1, 2, 3
+STATUS = ['OK', 'WARNING', 'CRITICAL', 'UNKNOWN']
+
+STATUS_FILE = '/var/lib/nagios/glance-perf.json'
+GLANCE_API_CONF = '/etc/glance/glance-api.conf'
+GLANCE_SWIFT_CONF = '/etc/glance/glance-swift.conf'
+HAPROXY_SOCKET = '/var/run/haproxy/admin.sock'
+DEFAULT_CACHE_DIR = '/var/lib/glance/image-cache'
+DEFAULT_CACHE_MAX_SIZE = 10 * 1024 ** 3
+RBD_PROBE_OBJECT = 'glance-perf-probe'
+
+
+def glance_option(conf, option, default=None):
+    """The value of option in whichever section of conf sets it."""
+    for section in ['DEFAULT'] + conf.sections():
+        if conf.has_option(section, option):
+            return conf.get(section, option)
+    return default
+
+
+def probe_rbd(conf, timeout):
+    import rados
+    cluster = rados.Rados(
+        conffile=glance_option(conf, 'rbd_store_ceph_conf',
+                               '/etc/ceph/ceph.conf'),
+        rados_id=glance_option(conf, 'rbd_store_user', 'glance'))
+    cluster.connect(timeout=timeout)
+    try:
+        ioctx = cluster.open_ioctx(glance_option(conf, 'rbd_store_pool',
+                                                 'glance'))
+        try:
+            start = time.time()
+            try:
+                ioctx.stat(RBD_PROBE_OBJECT)
+            except rados.ObjectNotFound:
+                pass
+            return (time.time() - start) * 1000
+        finally:
+            ioctx.close()
+    finally:
+        cluster.shutdown()
+
+
+def probe_swift(conf, timeout):
+    from swiftclient import client
+    user = glance_option(conf, 'swift_store_user')
+    key = glance_option(conf, 'swift_store_key')
+    authurl = glance_option(conf, 'swift_store_auth_address')
+    auth_version = glance_option(conf, 'swift_store_auth_version', '2')
+    if not user and os.path.exists(GLANCE_SWIFT_CONF):
+        swift_conf = RawConfigParser()
+        swift_conf.read(GLANCE_SWIFT_CONF)
+        reference = glance_option(conf, 'default_swift_reference', 'ref1')
+        user = swift_conf.get(reference, 'user')
+        key = swift_conf.get(reference, 'key')
+        authurl = swift_conf.get(reference, 'auth_address')
+        if swift_conf.has_option(reference, 'auth_version'):
+            auth_version = swift_conf.get(reference, 'auth_version')
+    conn = client.Connection(authurl=authurl, user=user, key=key,
+                             auth_version=auth_version, timeout=timeout,
+                             retries=0)
+    conn.get_auth()
+    start = time.time()
+    conn.head_container(glance_option(conf, 'swift_store_container',
+                                      'glance'))
+    return (time.time() - start) * 1000
+
+
+def probe_store(conf, timeout):
+    store = glance_option(conf, 'default_store', 'file')
+    result = {'backend': store}
+    probes = {'rbd': probe_rbd, 'swift': probe_swift}
+    if store in probes:
+        try:
+            result['rtt'] = probes[store](conf, timeout)
+        except Exception as e:
+            result['error'] = '{}: {}'.format(e.__class__.__name__, e)
+    return result
+
+
+def probe_cache(conf):
+    cache_dir = glance_option(conf, 'image_cache_dir', DEFAULT_CACHE_DIR)
+    max_size = int(glance_option(conf, 'image_cache_max_size',
+                                 DEFAULT_CACHE_MAX_SIZE))
+    size = 0
+    # Cached images are the regular files at the top of the cache directory;
+    # incomplete, invalid and queued images live in subdirectories.
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if os.path.isfile(path):
+            size += os.path.getsize(path)
+    return {'size': size, 'max_size': max_size}
+
+
+def probe_haproxy(paths, timeout):
+    """Sessions, queued requests and session limit of each backend, summed
+    over the haproxy processes answering on the admin sockets at paths.
+    """
+    backends = {}
+    for path in paths:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(path)
+            sock.sendall(b'show stat\n')
+            data = b''
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+        finally:
+            sock.close()
+        lines = data.decode('UTF-8').splitlines()
+        fields = lines[0].lstrip('# ').split(',')
+        for line in lines[1:]:
+            row = dict(zip(fields, line.split(',')))
+            if row.get('svname') == 'BACKEND':
+                backend = backends.setdefault(
+                    row['pxname'], {'scur': 0, 'qcur': 0, 'slim': 0})
+                for k in ('scur', 'qcur', 'slim'):
+                    backend[k] += int(row[k] or 0)
+    return backends
+
+
+def probe(args):
+    conf = RawConfigParser()
+    conf.read(GLANCE_API_CONF)
+    status = {'time': time.time(), 'store': probe_store(conf, args.timeout)}
+    try:
+        status['cache'] = probe_cache(conf)
+    except (IOError, OSError, ValueError) as e:
+        status['cache'] = {'error': str(e)}
+    try:
+        status['haproxy'] = probe_haproxy(
+            args.socket or [HAPROXY_SOCKET], args.timeout)
+    except (IOError, OSError, IndexError, ValueError) as e:
+        status['haproxy'] = {'error': str(e)}
+    # /var/lib/nagios is created by nagios-nrpe-server, which may not be
+    # installed yet.
+    if not os.path.isdir(os.path.dirname(args.file)):
+        os.makedirs(os.path.dirname(args.file))
+    tmp = args.file + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(status, f)
+    os.chmod(tmp, 0o644)
+    os.rename(tmp, args.file)
+    return OK, 'probe written to {}'.format(args.file), None
+
+
+def api_latency(args):
+    start = time.time()
+    try:
+        urlopen(args.url, timeout=args.timeout).read()
+    except HTTPError as e:
+        # GET /versions answers 300 Multiple Choices.
+        if e.code >= 500:
+            return CRITICAL, '{} returned {}'.format(args.url, e.code), None
+    except (URLError, socket.error) as e:
+        return CRITICAL, '{} unreachable: {}'.format(args.url, e), None
+    latency = (time.time() - start) * 1000
+    return threshold(args, latency, '{} responded in {:.0f}ms'.format(
+        args.url, latency), 'latency', 'ms')
+
+
+def read_status(args):
+    try:
+        with open(args.file) as f:
+            status = json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        raise Unknown('cannot read probe status {}: {}'.format(args.file, e))
+    age = time.time() - status.get('time', 0)
+    if age > args.max_age:
+        raise Unknown('probe status is {:.0f}s old'.format(age))
+    return status
+
+
+class Unknown(Exception):
+    pass
+
+
+def store_rtt(args):
+    store = read_status(args)['store']
+    if 'error' in store:
+        return CRITICAL, '{} store probe failed: {}'.format(
+            store['backend'], store['error']), None
+    if 'rtt' not in store:
+        raise Unknown('no probe for {} store'.format(store['backend']))
+    return threshold(args, store['rtt'], '{} store round trip {:.0f}ms'.format(
+        store['backend'], store['rtt']), 'rtt', 'ms')
+
+
+def cache_fill(args):
+    cache = read_status(args)['cache']
+    if 'error' in cache:
+        raise Unknown('image cache probe failed: {}'.format(cache['error']))
+    fill = 100.0 * cache['size'] / max(cache['max_size'], 1)
+    return threshold(args, fill, 'image cache {:.1f}% full ({}MB of {}MB)'
+                     .format(fill, cache['size'] // 1024 ** 2,
+                             cache['max_size'] // 1024 ** 2), 'fill', '%')
+
+
+def haproxy_metric(key, label):
+    def check(args):
+        backends = read_status(args)['haproxy']
+        if 'error' in backends:
+            raise Unknown('haproxy probe failed: {}'.format(
+                backends['error']))
+        if not backends:
+            raise Unknown('no haproxy backends')
+        worst = max(sorted(backends), key=lambda b: backends[b][key])
+        value = backends[worst][key]
+        code, message, _ = threshold(
+            args, value, 'most {} on {}: {}'.format(label, worst, value))
+        perfdata = ' '.join('{}={};{};{}'.format(
+            b, backends[b][key], args.warning, args.critical)
+            for b in sorted(backends))
+        return code, message, perfdata
+    return check
+
+
+def threshold(args, value, message, label=None, unit=''):
+    code = OK
+    if args.critical is not None and value >= args.critical:
+        code = CRITICAL
+    elif args.warning is not None and value >= args.warning:
+        code = WARNING
+    perfdata = None
+    if label:
+        perfdata = '{}={:.1f}{};{};{}'.format(
+            label, value, unit, '' if args.warning is None else args.warning,
+            '' if args.critical is None else args.critical)
+    return code, message, perfdata
+
+
+METRICS = {
+    'probe': probe,
+    'api-latency': api_latency,
+    'store-rtt': store_rtt,
+    'cache-fill': cache_fill,
+    'haproxy-sessions': haproxy_metric('scur', 'sessions'),
+    'haproxy-queue': haproxy_metric('qcur', 'queued requests'),
+}
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Check glance performance')
+    parser.add_argument('metric', choices=sorted(METRICS))
+    parser.add_argument('-w', '--warning', type=float)
+    parser.add_argument('-c', '--critical', type=float)
+    parser.add_argument('--url', default='http://127.0.0.1:9292/versions')
+    parser.add_argument('--file', default=STATUS_FILE,
+                        help='status file written by the probe')
+    parser.add_argument('--max-age', type=int, default=600,
+                        help='seconds after which the probe status is stale')
+    parser.add_argument('--socket', action='append',
+                        help='haproxy admin socket, repeated for each '
+                             'haproxy process')
+    parser.add_argument('--timeout', type=int, default=10)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        code, message, perfdata = METRICS[args.metric](args)
+    except Unknown as e:
+        code, message, perfdata = UNKNOWN, str(e), None
+    except Exception as e:
+        code, message, perfdata = UNKNOWN, '{}: {}'.format(
+            e.__class__.__name__, e), None
+    output = '{}: {}'.format(STATUS[code], message)
+    if perfdata:
+        output += ' | ' + perfdata
+    print(output)
+    return code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
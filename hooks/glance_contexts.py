@@ -13,7 +13,10 @@
 # limitations under the License.
 
 from charmhelpers.core.hookenv import (
+    atexit,
     is_relation_made,
+    log,
+    WARNING,
     relation_ids,
     relation_get,
     related_units,
@@ -24,12 +27,27 @@ from charmhelpers.core.hookenv import (
 from charmhelpers.contrib.openstack.context import (
     OSContextGenerator,
     ApacheSSLContext as SSLContext,
-    BindHostContext
+    BindHostContext,
+    MemcacheContext as BaseMemcacheContext,
+    WorkerConfigContext,
+)
+
+from charmhelpers.core.host import (
+    CompareHostReleases,
+    get_total_ram,
+    lsb_release,
+    mkdir,
 )
 
 from charmhelpers.contrib.hahelpers.cluster import (
     determine_apache_port,
     determine_api_port,
+    https,
+)
+
+from charmhelpers.contrib.network.ip import (
+    format_ipv6_addr,
+    get_relation_ip,
 )
 
 from charmhelpers.contrib.openstack.utils import (
@@ -37,8 +55,74 @@ from charmhelpers.contrib.openstack.utils import (
     CompareOpenStackReleases,
 )
 
+from charmhelpers.core.unitdata import kv
+
+from charmhelpers.fetch import apt_install
+
+import os
+import time
+
+try:
+    import psutil
+except ImportError:
+    # Imported before any hook runs, so not through apt_plan().
+    apt_install('python-psutil', fatal=True)
+    import psutil
+
+# Estimated resident memory of an idle glance worker, in bytes.
+WORKER_BASE_RSS = 96 * 1024 * 1024
+# unitdata key of the peak measured memory of a worker of each service, the
+# step, in bytes, by which it is rounded up, and the seconds after which it
+# is replaced by the memory measured then.
+WORKER_RSS_KEY = 'glance.worker-rss'
+WORKER_RSS_STEP = 64 * 1024 * 1024
+WORKER_RSS_EXPIRY = 7 * 24 * 60 * 60
+# Services whose workers share the memory available to workers.
+WORKER_SERVICES = ('glance-api', 'glance-registry')
+# Estimated memory each glance-api worker buffers for image data when the
+# store related over the given relation is in use, in bytes.
+STORE_BUFFER_RSS = {
+    'ceph': 64 * 1024 * 1024,
+    'object-store': 200 * 1024 * 1024,
+    'cinder-volume-service': 32 * 1024 * 1024,
+    'storage-backend': 32 * 1024 * 1024,
+}
+
+# Store tuning options: charm option, template variable, the first release
+# whose glance_store supports it and its default.
+STORE_TUNING_OPTIONS = [
+    ('rbd-store-chunk-size', 'rbd_store_chunk_size', 'icehouse', 8),
+    ('swift-store-large-object-size', 'swift_store_large_object_size',
+     'icehouse', 5120),
+    ('swift-store-large-object-chunk-size',
+     'swift_store_large_object_chunk_size', 'icehouse', 200),
+    ('swift-buffer-on-upload', 'swift_buffer_on_upload', 'pike', False),
+    ('swift-upload-buffer-dir', 'swift_upload_buffer_dir', 'pike',
+     '/var/lib/glance/swift-upload-buffer'),
+]
+# Health check of the glance-api backends in the haproxy HTTP profile.
+HAPROXY_HTTP_CHECK = [
+    {'option': 'httpchk GET /versions'},
+    {'http-check': 'expect rstatus ^[23]'},
+]
+
+# memcached memory is 1/MEMCACHE_RAM_SHARE of the unit's memory, in MB
+# between MEMCACHE_MIN_MEMORY and MEMCACHE_MAX_MEMORY.
+MEMCACHE_RAM_SHARE = 64
+MEMCACHE_MIN_MEMORY = 64
+MEMCACHE_MAX_MEMORY = 1024
+# Connections kept open to memcached by each glance worker, the
+# keystonemiddleware memcache_pool_maxsize default.
+MEMCACHE_WORKER_CONNECTIONS = 10
+MEMCACHE_MIN_CONNECTIONS = 1024
+MEMCACHE_MAX_THREADS = 16
+
+# Largest object Swift stores without segmenting, in MB.
+SWIFT_MAX_OBJECT_SIZE = 5120
+
 
 class GlanceContext(OSContextGenerator):
+    thread_safe = True
 
     def __call__(self):
         ctxt = {
@@ -51,6 +135,7 @@ class GlanceContext(OSContextGenerator):
 
 class CephGlanceContext(OSContextGenerator):
     interfaces = ['ceph-glance']
+    thread_safe = True
 
     def __call__(self):
         """Used to generate template context to be added to glance-api.conf in
@@ -70,6 +155,7 @@ class CephGlanceContext(OSContextGenerator):
 
 class ObjectStoreContext(OSContextGenerator):
     interfaces = ['object-store']
+    thread_safe = True
 
     def __call__(self):
         """Object store config.
@@ -85,6 +171,7 @@ class ObjectStoreContext(OSContextGenerator):
 
 class CinderStoreContext(OSContextGenerator):
     interfaces = ['cinder-volume-service', 'storage-backend']
+    thread_safe = True
 
     def __call__(self):
         """Cinder store config.
@@ -126,8 +213,79 @@ class MultiStoreContext(OSContextGenerator):
         }
 
 
+def validate_store_tuning():
+    """Check the store tuning options.
+
+    :returns: list of messages describing invalid options, empty if all are
+              valid.
+    """
+    errors = []
+    chunk_size = config('rbd-store-chunk-size')
+    if not 1 <= chunk_size <= 32 or chunk_size & (chunk_size - 1):
+        errors.append('rbd-store-chunk-size must be a power of two between '
+                      '1 and 32')
+    object_size = config('swift-store-large-object-size')
+    if not 1 <= object_size <= SWIFT_MAX_OBJECT_SIZE:
+        errors.append('swift-store-large-object-size must be between 1 and '
+                      '{}'.format(SWIFT_MAX_OBJECT_SIZE))
+    segment_size = config('swift-store-large-object-chunk-size')
+    if not 1 <= segment_size <= object_size:
+        errors.append('swift-store-large-object-chunk-size must be between 1 '
+                      'and swift-store-large-object-size')
+    buffer_dir = config('swift-upload-buffer-dir') or ''
+    if config('swift-buffer-on-upload') and not os.path.isabs(buffer_dir):
+        errors.append('swift-upload-buffer-dir must be an absolute path')
+    return errors
+
+
+class StoreTuningContext(OSContextGenerator):
+
+    def __call__(self):
+        """Throughput tuning for the rbd and swift stores.
+
+        Options the release does not support are left out, and the defaults
+        are used if any option is invalid.
+        """
+        release = CompareOpenStackReleases(os_release('glance-common'))
+        errors = validate_store_tuning()
+        if errors:
+            log('Invalid store tuning, using defaults: {}'
+                .format('; '.join(errors)), level=WARNING)
+        ctxt = {}
+        for option, key, since, default in STORE_TUNING_OPTIONS:
+            if release < since:
+                continue
+            ctxt[key] = default if errors else config(option)
+
+        if ctxt.get('swift_buffer_on_upload'):
+            if relation_ids('object-store'):
+                mkdir(ctxt['swift_upload_buffer_dir'], owner='glance',
+                      group='glance', perms=0o750)
+        else:
+            ctxt.pop('swift_upload_buffer_dir', None)
+        return ctxt
+
+
+class ImageCacheContext(OSContextGenerator):
+    thread_safe = True
+
+    def __call__(self):
+        """Local image cache of glance-api and its maintenance jobs."""
+        return {
+            'image_cache': config('image-cache'),
+            'image_cache_max_size':
+                config('image-cache-max-size') * 1024 * 1024,
+            'image_cache_stall_time': config('image-cache-stall-time'),
+            'image_cache_prune_schedule':
+                config('image-cache-prune-schedule'),
+            'image_cache_clean_schedule':
+                config('image-cache-clean-schedule'),
+        }
+
+
 class HAProxyContext(OSContextGenerator):
     interfaces = ['cluster']
+    thread_safe = True
 
     def __call__(self):
         '''Extends the main charmhelpers HAProxyContext with a port mapping
@@ -142,6 +300,56 @@ class HAProxyContext(OSContextGenerator):
             'service_ports': {'glance_api': [haproxy_port, apache_port]},
             'bind_port': api_port,
         }
+        ctxt.update(self.tuning())
+        return ctxt
+
+    def tuning(self):
+        '''haproxy process, connection limit and HTTP profile settings.'''
+        ctxt = {}
+        series = CompareHostReleases(lsb_release()['DISTRIB_CODENAME'])
+        if config('haproxy-maxconn'):
+            ctxt['haproxy_maxconn'] = config('haproxy-maxconn')
+        if config('haproxy-nbproc'):
+            ctxt['haproxy_nbproc'] = config('haproxy-nbproc')
+        if config('haproxy-nbthread'):
+            if series >= 'bionic':
+                ctxt['haproxy_nbthread'] = config('haproxy-nbthread')
+            else:
+                log('haproxy-nbthread requires haproxy 1.8, ignoring',
+                    level=WARNING)
+
+        server_options = []
+        if config('haproxy-backend-maxconn'):
+            server_options.append(
+                'maxconn {}'.format(config('haproxy-backend-maxconn')))
+        if config('haproxy-backend-maxqueue'):
+            server_options.append(
+                'maxqueue {}'.format(config('haproxy-backend-maxqueue')))
+
+        if config('haproxy-http-mode'):
+            backend_options = list(HAPROXY_HTTP_CHECK)
+            if https():
+                # Traffic to the apache SSL frontends is encrypted so only
+                # the health check can use HTTP, over SSL from haproxy 1.5.
+                if series >= 'xenial':
+                    server_options.append('check-ssl verify none')
+                else:
+                    backend_options = []
+            else:
+                ctxt['frontend_options'] = {'glance_api': [
+                    {'mode': 'http'},
+                    {'option': 'httplog'},
+                    {'option': 'http-keep-alive'},
+                    {'option': 'forwardfor'},
+                ]}
+                backend_options.insert(0, {'mode': 'http'})
+                if series >= 'xenial':
+                    backend_options.append({'http-reuse': 'safe'})
+            if backend_options:
+                ctxt['backend_options'] = {'glance_api': backend_options}
+
+        if server_options:
+            ctxt['server_options'] = {'glance_api': ' '.join(server_options)}
         return ctxt
 
 
@@ -155,6 +363,7 @@ class ApacheSSLContext(SSLContext):
 
 
 class LoggingConfigContext(OSContextGenerator):
+    thread_safe = True
 
     def __call__(self):
         return {'debug': config('debug'), 'verbose': config('verbose')}
@@ -170,3 +379,129 @@ class GlanceIPv6Context(BindHostContext):
             ctxt['registry_host'] = '0.0.0.0'
 
         return ctxt
+
+
+class GlanceWorkerConfigContext(WorkerConfigContext):
+    """Worker count for a glance service taking the memory used by each
+    worker into account.
+
+    The memory per worker is the worker-memory option if set, otherwise
+    the larger of an estimate based on the stores glance-api is related to
+    and the peak memory of a worker. The peak is the largest worker
+    measured in any hook, rounded up to WORKER_RSS_STEP, so the worker
+    count does not follow the memory in use whenever a hook runs. A peak
+    older than WORKER_RSS_EXPIRY gives way to the memory measured then, so
+    a passing spike does not limit the workers for good.
+
+    The workers of WORKER_SERVICES share the memory available to workers.
+    """
+    # The peak is recorded in unitdata, which is not shared across threads.
+    thread_safe = False
+
+    def __init__(self, service):
+        self.service = service
+
+    def _measured_rss(self):
+        rss = 0
+        for proc in psutil.process_iter():
+            try:
+                if proc.name() == self.service:
+                    rss = max(rss, proc.memory_info().rss)
+            except (psutil.Error, AttributeError, TypeError):
+                continue
+        return rss
+
+    def _peak_rss(self):
+        db = kv()
+        peaks = db.get(WORKER_RSS_KEY) or {}
+        peak, recorded = peaks.get(self.service) or (0, 0)
+        measured = self._measured_rss()
+        now = time.time()
+        expired = now - recorded >= WORKER_RSS_EXPIRY
+        if measured and (measured > peak or expired):
+            peak = -(-measured // WORKER_RSS_STEP) * WORKER_RSS_STEP
+            peaks[self.service] = [peak, now]
+            db.set(WORKER_RSS_KEY, peaks)
+            atexit(db.flush)
+        return peak
+
+    def memory_fraction(self):
+        fraction = super(GlanceWorkerConfigContext, self).memory_fraction()
+        return fraction / len(WORKER_SERVICES)
+
+    def worker_rss(self):
+        if config('worker-memory'):
+            return config('worker-memory') * 1024 * 1024
+        estimate = WORKER_BASE_RSS
+        if self.service == 'glance-api':
+            estimate += sum(buffer_rss for relation, buffer_rss
+                            in STORE_BUFFER_RSS.items()
+                            if relation_ids(relation))
+        return max(estimate, self._peak_rss())
+
+
+def memcache_address():
+    """Return the address memcached listens on with memcache-share-peers.
+
+    It is published to the peers as memcache-address.
+    """
+    return get_relation_ip('cluster')
+
+
+def memcache_peers():
+    """Return the memcache-address published by each peer."""
+    peers = []
+    for rid in relation_ids('cluster'):
+        for unit in related_units(rid):
+            peer = relation_get('memcache-address', rid=rid, unit=unit)
+            if peer:
+                peers.append(peer)
+    return peers
+
+
+class MemcacheContext(BaseMemcacheContext):
+    """Sizes memcached from the unit's memory, CPUs and glance worker count.
+
+    With memcache-share-peers set, memcached also listens on the cluster
+    address of the unit and glance uses the memcached of every unit of the
+    service, so that cached tokens are shared.
+    """
+    # Sized from GlanceWorkerConfigContext, which is not thread safe.
+    thread_safe = False
+
+    def __call__(self):
+        ctxt = super(MemcacheContext, self).__call__()
+        if not ctxt.get('use_memcache'):
+            return ctxt
+
+        memory = get_total_ram() // (MEMCACHE_RAM_SHARE * 1024 * 1024)
+        ctxt['memcache_memory'] = max(MEMCACHE_MIN_MEMORY,
+                                      min(memory, MEMCACHE_MAX_MEMORY))
+        ctxt['memcache_threads'] = max(4, min(psutil.cpu_count() // 4,
+                                              MEMCACHE_MAX_THREADS))
+
+        servers = []
+        if config('memcache-share-peers'):
+            ctxt['memcache_share_peers'] = True
+            address = memcache_address()
+            ctxt['memcache_listen'] = [address]
+            servers.append(address)
+            servers.extend(memcache_peers())
+        workers = sum(GlanceWorkerConfigContext(service)()['workers']
+                      for service in ('glance-api', 'glance-registry'))
+        ctxt['memcache_connections'] = max(
+            MEMCACHE_MIN_CONNECTIONS,
+            workers * MEMCACHE_WORKER_CONNECTIONS * max(len(servers), 1))
+
+        if len(servers) > 1:
+            # Every unit must list the servers in the same order for keys to
+            # be distributed to the same server.
+            urls = []
+            for server in sorted(set(servers)):
+                if format_ipv6_addr(server):
+                    urls.append('inet6:{}:{}'.format(
+                        format_ipv6_addr(server), ctxt['memcache_port']))
+                else:
+                    urls.append('{}:{}'.format(server, ctxt['memcache_port']))
+            ctxt['memcache_url'] = ','.join(urls)
+        return ctxt
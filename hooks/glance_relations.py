@@ -14,6 +14,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
+import os
 import sys
 
 from subprocess import (
@@ -21,6 +23,7 @@ from subprocess import (
     check_call,
 )
 
+from glance_contexts import memcache_address
 from glance_utils import (
     do_openstack_upgrade,
     migrate_database,
@@ -29,20 +32,37 @@ from glance_utils import (
     services,
     CLUSTER_RES,
     determine_packages,
+    determine_relation_packages,
     SERVICES,
     CHARM,
     GLANCE_REGISTRY_CONF,
     GLANCE_API_CONF,
     HAPROXY_CONF,
+    MEMCACHED_CONF,
     ceph_config_file,
     setup_ipv6,
     swift_temp_url_key,
     assess_status,
     reinstall_paste_ini,
+    require_full_restart,
     is_api_ready,
     update_image_location_policy,
+    update_memcache_access,
+    compact_unit_state,
+    update_perf_checks,
+    remove_perf_probe,
+    coordinate_rolling_restarts,
+    is_healthy,
+    GRACEFUL_RESTART_FUNCTIONS,
+    ROLLING_RESTART_SERVICES,
+    rolling_restart_batch,
+    rolling_restart_timeout,
+    CEPH_PACKAGES,
+    CINDER_STORE_PACKAGES,
+    NRPE_PACKAGES,
 )
 from charmhelpers.core.hookenv import (
+    charm_dir,
     config,
     Hooks,
     log as juju_log,
@@ -65,10 +85,10 @@ from charmhelpers.core.host import (
     service_restart,
     service_stop,
 )
+from charmhelpers.core import tracing
 from charmhelpers.fetch import (
-    apt_install,
+    apt_plan,
     apt_update,
-    filter_installed_packages
 )
 from charmhelpers.contrib.hahelpers.cluster import (
     is_clustered,
@@ -84,7 +104,7 @@ from charmhelpers.contrib.openstack.utils import (
     openstack_upgrade_available,
     os_release,
     sync_db_with_multi_ipv6_addresses,
-    pausable_restart_on_change as restart_on_change,
+    pausable_rolling_restart_on_change,
     is_unit_paused_set,
     os_requires_version,
 )
@@ -115,6 +135,14 @@ from charmhelpers.contrib.charmsupport import nrpe
 from charmhelpers.contrib.hardening.harden import harden
 
 hooks = Hooks()
+
+restart_on_change = functools.partial(
+    pausable_rolling_restart_on_change,
+    health_check=is_healthy,
+    batch=rolling_restart_batch,
+    timeout=rolling_restart_timeout,
+    restart_functions=GRACEFUL_RESTART_FUNCTIONS,
+    rolling_services=ROLLING_RESTART_SERVICES)
 CONFIGS = register_configs()
 
 
@@ -132,7 +160,9 @@ def install_hook():
 
     status_set('maintenance', 'Installing apt packages')
     apt_update(fatal=True)
-    apt_install(determine_packages(), fatal=True)
+    plan = apt_plan()
+    plan.add(determine_packages(), fatal=True)
+    plan.execute()
 
     for service in SERVICES:
         service_stop(service)
@@ -159,7 +189,7 @@ def db_joined():
 
 
 @hooks.hook('shared-db-relation-changed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map(), change_tracker=CONFIGS)
 def db_changed():
     rel = os_release('glance-common')
 
@@ -221,7 +251,7 @@ def image_service_joined(relation_id=None):
 
 
 @hooks.hook('object-store-relation-joined')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map(), change_tracker=CONFIGS)
 def object_store_joined():
 
     if 'identity-service' not in CONFIGS.complete_contexts():
@@ -240,7 +270,9 @@ def object_store_joined():
 
 @hooks.hook('ceph-relation-joined')
 def ceph_joined():
-    apt_install(['ceph-common', 'python-ceph'])
+    plan = apt_plan()
+    plan.add(CEPH_PACKAGES)
+    plan.execute()
 
 
 def get_ceph_request():
@@ -259,7 +291,7 @@ def get_ceph_request():
 
 
 @hooks.hook('ceph-relation-changed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map(), change_tracker=CONFIGS)
 def ceph_changed():
     if 'ceph' not in CONFIGS.complete_contexts():
         juju_log('ceph relation incomplete. Peer not ready?')
@@ -311,7 +343,7 @@ def keystone_joined(relation_id=None):
 
 
 @hooks.hook('identity-service-relation-changed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map(), change_tracker=CONFIGS)
 def keystone_changed():
     if 'identity-service' not in CONFIGS.complete_contexts():
         juju_log('identity-service relation incomplete. Peer not ready?')
@@ -333,7 +365,8 @@ def keystone_changed():
 
 
 @hooks.hook('config-changed')
-@restart_on_change(restart_map(), stopstart=True)
+@restart_on_change(restart_map(), stopstart=True,
+                   change_tracker=CONFIGS)
 @harden()
 def config_changed():
     if config('prefer-ipv6'):
@@ -364,6 +397,7 @@ def config_changed():
     #                  for cephx permissions restrictions
     ceph_changed()
     update_image_location_policy()
+    update_memcache_access()
 
 
 @hooks.hook('cluster-relation-joined')
@@ -378,24 +412,44 @@ def cluster_joined(relation_id=None):
             settings['{}-address'.format(addr_type)] = address
 
     settings['private-address'] = get_relation_ip('cluster')
+    settings['memcache-address'] = memcache_address()
 
     relation_set(relation_id=relation_id, relation_settings=settings)
 
 
 @hooks.hook('cluster-relation-changed')
 @hooks.hook('cluster-relation-departed')
-@restart_on_change(restart_map(), stopstart=True)
+@restart_on_change(restart_map(), stopstart=True,
+                   change_tracker=CONFIGS)
 def cluster_changed():
     configure_https()
     CONFIGS.write(GLANCE_API_CONF)
     CONFIGS.write(HAPROXY_CONF)
+    if config('memcache-share-peers'):
+        CONFIGS.write(GLANCE_REGISTRY_CONF)
+        if MEMCACHED_CONF in CONFIGS.templates:
+            CONFIGS.write(MEMCACHED_CONF)
+    update_memcache_access()
+    coordinate_rolling_restarts()
+
+
+@hooks.hook('leader-elected')
+@hooks.hook('leader-settings-changed')
+def leader_changed():
+    coordinate_rolling_restarts()
 
 
 @hooks.hook('upgrade-charm')
-@restart_on_change(restart_map(), stopstart=True)
+@restart_on_change(restart_map(), stopstart=True,
+                   change_tracker=CONFIGS)
 @harden()
 def upgrade_charm():
-    apt_install(filter_installed_packages(determine_packages()), fatal=True)
+    plan = apt_plan()
+    plan.add(determine_packages(), fatal=True)
+    plan.add(determine_relation_packages())
+    plan.execute()
+    # the charm may have installed or upgraded packages
+    require_full_restart()
     reinstall_paste_ini()
     configure_https()
     update_nrpe_config()
@@ -530,7 +584,7 @@ def amqp_joined():
 
 
 @hooks.hook('amqp-relation-changed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map(), change_tracker=CONFIGS)
 def amqp_changed():
     if 'amqp' not in CONFIGS.complete_contexts():
         juju_log('amqp relation incomplete. Peer not ready?')
@@ -541,33 +595,46 @@ def amqp_changed():
 @hooks.hook('nrpe-external-master-relation-joined',
             'nrpe-external-master-relation-changed')
 def update_nrpe_config():
-    # python-dbus is used by check_upstart_job
-    apt_install('python-dbus')
+    plan = apt_plan()
+    plan.add(NRPE_PACKAGES)
+    plan.execute()
     hostname = nrpe.get_nagios_hostname()
     current_unit = nrpe.get_nagios_unit_name()
     nrpe_setup = nrpe.NRPE(hostname=hostname)
     nrpe.copy_nrpe_checks()
+    nrpe.copy_nrpe_checks(nrpe_files_dir=os.path.join(
+        charm_dir(), 'files', 'nrpe-external-master'))
     nrpe.add_init_service_checks(nrpe_setup, services(), current_unit)
     nrpe.add_haproxy_checks(nrpe_setup, current_unit)
+    update_perf_checks(nrpe_setup, current_unit)
     nrpe_setup.write()
 
 
+@hooks.hook('nrpe-external-master-relation-broken')
+def nrpe_external_master_broken():
+    remove_perf_probe()
+
+
 @hooks.hook('update-status')
 @harden()
 def update_status():
     juju_log('Updating status.')
+    compact_unit_state()
+    # the rules do not survive a reboot
+    update_memcache_access()
+    coordinate_rolling_restarts()
 
 
 def install_packages_for_cinder_store():
-    optional_packages = ["python-cinderclient",
-                         "python-os-brick",
-                         "python-oslo.rootwrap"]
-    apt_install(filter_installed_packages(optional_packages), fatal=True)
+    plan = apt_plan()
+    plan.add(CINDER_STORE_PACKAGES, fatal=True)
+    plan.execute()
 
 
 @hooks.hook('cinder-volume-service-relation-joined')
 @os_requires_version('mitaka', 'glance-common')
-@restart_on_change(restart_map(), stopstart=True)
+@restart_on_change(restart_map(), stopstart=True,
+                   change_tracker=CONFIGS)
 def cinder_volume_service_relation_joined(relid=None):
     install_packages_for_cinder_store()
     CONFIGS.write_all()
@@ -575,7 +642,8 @@ def cinder_volume_service_relation_joined(relid=None):
 
 @hooks.hook('storage-backend-relation-changed')
 @os_requires_version('mitaka', 'glance-common')
-@restart_on_change(restart_map(), stopstart=True)
+@restart_on_change(restart_map(), stopstart=True,
+                   change_tracker=CONFIGS)
 def storage_backend_hook():
     if 'storage-backend' not in CONFIGS.complete_contexts():
         juju_log('storage-backend relation incomplete. Peer not ready?')
@@ -585,6 +653,8 @@ def storage_backend_hook():
 
 
 if __name__ == '__main__':
+    if config('trace-hooks'):
+        tracing.enable()
     try:
         hooks.execute(sys.argv)
     except UnregisteredHookError as e:
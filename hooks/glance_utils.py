@@ -16,7 +16,10 @@
 
 import json
 import os
+import socket
 import subprocess
+import time
+import uuid
 from itertools import chain
 
 import glance_contexts
@@ -24,15 +27,20 @@ import glance_contexts
 from collections import OrderedDict
 
 from charmhelpers.fetch import (
+    apt_plan,
     apt_upgrade,
     apt_update,
     apt_install,
     add_source)
 
 from charmhelpers.core.hookenv import (
+    atexit,
     config,
+    local_unit,
     log,
+    DEBUG,
     INFO,
+    WARNING,
     relation_ids,
     service_name,
 )
@@ -40,11 +48,14 @@ from charmhelpers.core.hookenv import (
 
 from charmhelpers.core.host import (
     CompareHostReleases,
+    init_is_systemd,
     lsb_release,
     mkdir,
     pwgen,
+    service_running,
     service_stop,
     service_start,
+    write_file,
 )
 
 from charmhelpers.contrib.openstack import (
@@ -52,10 +63,14 @@ from charmhelpers.contrib.openstack import (
     context,)
 
 from charmhelpers.contrib.hahelpers.cluster import (
+    determine_api_port,
     is_elected_leader,
+    coordinate_restarts,
     get_hacluster_config,
+    restart_pending,
 )
 
+from charmhelpers.contrib.network.ip import is_ipv6
 from charmhelpers.contrib.openstack.alternatives import install_alternative
 from charmhelpers.contrib.openstack.utils import (
     CompareOpenStackReleases,
@@ -80,6 +95,13 @@ from charmhelpers.core.decorators import (
 
 from charmhelpers.core.unitdata import kv
 
+try:
+    import requests
+except ImportError:
+    # Imported before any hook runs, so not through apt_plan().
+    apt_install('python-requests', fatal=True)
+    import requests
+
 
 CLUSTER_RES = "grp_glance_vips"
 
@@ -87,6 +109,13 @@ PACKAGES = [
     "apache2", "glance", "python-mysqldb", "python-swiftclient",
     "python-psycopg2", "python-keystone", "python-six", "uuid", "haproxy", ]
 
+# Packages needed by optional relations, installed when they join.
+CEPH_PACKAGES = ['ceph-common', 'python-ceph']
+CINDER_STORE_PACKAGES = [
+    "python-cinderclient", "python-os-brick", "python-oslo.rootwrap"]
+# python-dbus is used by check_upstart_job
+NRPE_PACKAGES = ['python-dbus']
+
 VERSION_PACKAGE = 'glance-common'
 
 SERVICES = [
@@ -104,6 +133,9 @@ GLANCE_REGISTRY_PASTE = os.path.join(GLANCE_CONF_DIR,
 GLANCE_API_PASTE = os.path.join(GLANCE_CONF_DIR,
                                 'glance-api-paste.ini')
 GLANCE_POLICY_FILE = os.path.join(GLANCE_CONF_DIR, "policy.json")
+GLANCE_CACHE_CONF = os.path.join(GLANCE_CONF_DIR, 'glance-cache.conf')
+GLANCE_IMAGE_CACHE_DIR = '/var/lib/glance/image-cache'
+IMAGE_CACHE_CRON = '/etc/cron.d/glance-image-cache'
 CEPH_CONF = "/etc/ceph/ceph.conf"
 CHARM_CEPH_CONF = '/var/lib/charm/{}/ceph.conf'
 
@@ -112,9 +144,29 @@ HTTPS_APACHE_CONF = "/etc/apache2/sites-available/openstack_https_frontend"
 HTTPS_APACHE_24_CONF = "/etc/apache2/sites-available/" \
     "openstack_https_frontend.conf"
 MEMCACHED_CONF = '/etc/memcached.conf'
+MEMCACHED_PORT = '11211'
+# Chain accepting connections to the shared memcached from peers only.
+MEMCACHED_ACCESS_CHAIN = 'glance-memcached'
+HAPROXY_ADMIN_SOCKET = '/var/run/haproxy/admin.sock'
+# Admin sockets of the haproxy processes after the first, see haproxy.cfg.
+HAPROXY_PROCESS_ADMIN_SOCKET = '/var/run/haproxy/admin-{}.sock'
+
+# First release whose glance-api and glance-registry reload their
+# configuration and replace their workers gracefully on SIGHUP.
+SIGHUP_RELOAD_RELEASE = 'liberty'
+# unitdata key holding how each service was last restarted.
+RESTART_OUTCOMES_KEY = 'glance.restart-outcomes'
+# unitdata key listing the services to stop and start rather than reload,
+# so that they load upgraded packages.
+FULL_RESTART_KEY = 'glance.full-restart'
+PERF_PROBE_CRON = '/etc/cron.d/glance-perf-probe'
+PERF_CHECK = '/usr/local/lib/nagios/plugins/check_glance_perf.py'
 
 TEMPLATES = 'templates/'
 
+# Number of threads used to evaluate independent context generators.
+CONTEXT_WORKERS = 4
+
 # The interface is said to be satisfied if anyone of the interfaces in the
 # list has a complete context.
 REQUIRED_INTERFACES = {
@@ -135,11 +187,12 @@ CONFIG_FILES = OrderedDict([
                           context.SyslogContext(),
                           glance_contexts.LoggingConfigContext(),
                           glance_contexts.GlanceIPv6Context(),
-                          context.WorkerConfigContext(),
+                          glance_contexts.GlanceWorkerConfigContext(
+                              'glance-registry'),
                           context.OSConfigFlagContext(
                               charm_flag='registry-config-flags',
                               template_flag='registry_config_flags'),
-                          context.MemcacheContext()],
+                          glance_contexts.MemcacheContext()],
         'services': ['glance-registry']
     }),
     (GLANCE_API_CONF, {
@@ -156,8 +209,11 @@ CONFIG_FILES = OrderedDict([
                           context.SyslogContext(),
                           glance_contexts.LoggingConfigContext(),
                           glance_contexts.GlanceIPv6Context(),
-                          context.WorkerConfigContext(),
+                          glance_contexts.GlanceWorkerConfigContext(
+                              'glance-api'),
                           glance_contexts.MultiStoreContext(),
+                          glance_contexts.StoreTuningContext(),
+                          glance_contexts.ImageCacheContext(),
                           context.OSConfigFlagContext(
                               charm_flag='api-config-flags',
                               template_flag='api_config_flags'),
@@ -166,9 +222,19 @@ CONFIG_FILES = OrderedDict([
                               interface=['storage-backend'],
                               service=['glance-api'],
                               config_file=GLANCE_API_CONF),
-                          context.MemcacheContext()],
+                          glance_contexts.MemcacheContext()],
         'services': ['glance-api']
     }),
+    (GLANCE_CACHE_CONF, {
+        'hook_contexts': [glance_contexts.ImageCacheContext(),
+                          glance_contexts.LoggingConfigContext(),
+                          glance_contexts.GlanceIPv6Context()],
+        'services': []
+    }),
+    (IMAGE_CACHE_CRON, {
+        'hook_contexts': [glance_contexts.ImageCacheContext()],
+        'services': []
+    }),
     (ceph_config_file(), {
         'hook_contexts': [context.CephContext()],
         'services': ['glance-api', 'glance-registry']
@@ -195,10 +261,13 @@ def register_configs():
     # existing of certain relations.
     release = os_release('glance-common')
     configs = templating.OSConfigRenderer(templates_dir=TEMPLATES,
-                                          openstack_release=release)
+                                          openstack_release=release,
+                                          context_workers=CONTEXT_WORKERS)
 
     confs = [GLANCE_REGISTRY_CONF,
              GLANCE_API_CONF,
+             GLANCE_CACHE_CONF,
+             IMAGE_CACHE_CRON,
              HAPROXY_CONF]
 
     if relation_ids('ceph'):
@@ -226,7 +295,7 @@ def register_configs():
                          CONFIG_FILES[HTTPS_APACHE_CONF]['hook_contexts'])
 
     if enable_memcache(release=release):
-        configs.register(MEMCACHED_CONF, [context.MemcacheContext()])
+        configs.register(MEMCACHED_CONF, [glance_contexts.MemcacheContext()])
     return configs
 
 
@@ -236,6 +305,20 @@ def determine_packages():
     return sorted(packages)
 
 
+def determine_relation_packages():
+    """Packages needed by the optional relations the unit has joined."""
+    packages = []
+    if relation_ids('ceph'):
+        packages.extend(CEPH_PACKAGES)
+    if relation_ids('nrpe-external-master'):
+        packages.extend(NRPE_PACKAGES)
+    if relation_ids('cinder-volume-service'):
+        release = CompareOpenStackReleases(os_release('glance-common'))
+        if release >= 'mitaka':
+            packages.extend(CINDER_STORE_PACKAGES)
+    return packages
+
+
 # NOTE(jamespage): Retry deals with sync issues during one-shot HA deploys.
 #                  mysql might be restarting or suchlike.
 @retry_on_exception(5, base_delay=3, exc_type=subprocess.CalledProcessError)
@@ -268,7 +351,13 @@ def do_openstack_upgrade(configs):
     apt_update()
     apt_upgrade(options=dpkg_opts, fatal=True, dist=True)
     reset_os_release()
-    apt_install(determine_packages(), fatal=True)
+    require_full_restart()
+    # Most packages are current after the dist-upgrade; install whatever
+    # is still missing in one transaction.
+    plan = apt_plan()
+    plan.add(determine_packages(), fatal=True)
+    plan.add(determine_relation_packages())
+    plan.execute()
 
     # set CONFIGS to load templates from new release and regenerate config
     configs.set_release(openstack_release=new_os_rel)
@@ -323,6 +412,7 @@ def setup_ipv6():
         add_source('deb http://archive.ubuntu.com/ubuntu trusty-backports '
                    'main')
         apt_update()
+        # apt_plan() would skip haproxy as it is already installed.
         apt_install('haproxy/trusty-backports', fatal=True)
 
 
@@ -350,7 +440,8 @@ def get_optional_interfaces():
 
 def check_optional_relations(configs):
     """Check that if we have a relation_id for high availability that we can
-    get the hacluster config.  If we can't then we are blocked.
+    get the hacluster config.  If we can't then we are blocked.  We are also
+    blocked if the store tuning options are invalid.
 
     This function is called from assess_status/set_os_workload_status as the
     charm_func and needs to return either None, None if there is no problem or
@@ -366,6 +457,12 @@ def check_optional_relations(configs):
             return ('blocked',
                     'hacluster missing configuration: '
                     'vip, vip_iface, vip_cidr')
+    errors = glance_contexts.validate_store_tuning()
+    if errors:
+        return ('blocked',
+                'Invalid store tuning: {}'.format('; '.join(errors)))
+    if restart_pending():
+        return 'waiting', 'Waiting for rolling restart'
     # return 'unknown' as the lowest priority to not clobber an existing
     # status.
     return "unknown", ""
@@ -375,7 +472,6 @@ def swift_temp_url_key():
     """Generate a temp URL key, post it to Swift and return its value.
        If it is already posted, the current value of the key will be returned.
     """
-    import requests
     keystone_ctxt = context.IdentityServiceContext(service='glance',
                                                    service_user='glance')()
     if not keystone_ctxt:
@@ -510,11 +606,12 @@ def reinstall_paste_ini():
                            GLANCE_API_PASTE]:
             if os.path.exists(paste_file):
                 os.remove(paste_file)
+        # A reinstall, which apt_plan() would skip.
         apt_install(packages=['glance-api', 'glance-registry'],
                     options=REINSTALL_OPTIONS,
                     fatal=True)
         db.set(PASTE_INI_MARKER, True)
-        db.flush()
+        atexit(db.flush)
 
 
 def is_api_ready(configs):
@@ -543,7 +640,7 @@ def update_image_location_policy():
             p = json.loads(open(GLANCE_POLICY_FILE).read())
             if policy_key in p:
                 db.set(db_key, p[policy_key])
-                db.flush()
+                atexit(db.flush)
             else:
                 log("key '{}' not found in policy file".format(policy_key),
                     level=INFO)
@@ -552,3 +649,401 @@ def update_image_location_policy():
         log("Updating Glance policy file setting policy "
             "'{}':'{}'".format(policy_key, policy_value), level=INFO)
         update_json_file(GLANCE_POLICY_FILE, {policy_key: policy_value})
+
+
+def update_memcache_access():
+    """Only let the peers connect to memcached on the cluster address.
+
+    memcached does not authenticate its clients, so while it is shared with
+    memcache-share-peers, connections to its port go through a chain that
+    accepts the memcache-address of each peer and the loopback interface,
+    and drops the rest. The chain is removed once memcached is not shared.
+    """
+    address = None
+    if config('memcache-share-peers'):
+        address = glance_contexts.memcache_address()
+    for family, ipv6 in (('iptables', False), ('ip6tables', True)):
+        if address and is_ipv6(address) == ipv6:
+            peers = [peer for peer in glance_contexts.memcache_peers()
+                     if is_ipv6(peer) == ipv6]
+            _restrict_memcache_access(family, peers)
+        else:
+            _remove_memcache_access(family)
+
+
+def _memcache_access_jump():
+    return ['INPUT', '-p', 'tcp', '--dport', MEMCACHED_PORT,
+            '-j', MEMCACHED_ACCESS_CHAIN]
+
+
+def _restrict_memcache_access(family, peers):
+    with open(os.devnull, 'w') as devnull:
+        subprocess.call([family, '-w', '-N', MEMCACHED_ACCESS_CHAIN],
+                        stderr=devnull)
+        current = subprocess.check_output(
+            [family, '-w', '-S', MEMCACHED_ACCESS_CHAIN])
+        # The new rules are appended before the current ones are deleted so
+        # that the port is never open while they are replaced.
+        rules = [['-s', peer, '-j', 'ACCEPT'] for peer in sorted(peers)]
+        rules.extend([['-i', 'lo', '-j', 'ACCEPT'], ['-j', 'DROP']])
+        for rule in rules:
+            subprocess.check_call(
+                [family, '-w', '-A', MEMCACHED_ACCESS_CHAIN] + rule)
+        for rule in current.splitlines():
+            if rule.startswith(b'-A '):
+                subprocess.check_call(
+                    [family, '-w', '-D', MEMCACHED_ACCESS_CHAIN, '1'])
+        jump = _memcache_access_jump()
+        if subprocess.call([family, '-w', '-C'] + jump, stderr=devnull):
+            subprocess.check_call([family, '-w', '-I'] + jump)
+    log('Restricted memcached to {} peers with {}'.format(len(peers),
+                                                          family),
+        level=DEBUG)
+
+
+def _remove_memcache_access(family):
+    jump = _memcache_access_jump()
+    with open(os.devnull, 'w') as devnull:
+        while subprocess.call([family, '-w', '-D'] + jump,
+                              stderr=devnull) == 0:
+            pass
+        for action in ('-F', '-X'):
+            subprocess.call([family, '-w', action, MEMCACHED_ACCESS_CHAIN],
+                            stderr=devnull)
+
+
+def compact_unit_state():
+    """Return the space freed in the unit state database to the filesystem,
+    and log its size and row counts, once the hook has completed.
+
+    The charm does not record hook history, so there is none to prune.
+    """
+    atexit(vacuum_unit_state)
+
+
+def vacuum_unit_state():
+    """Compact the unit state database and log its size and row counts."""
+    stats = kv().compact()
+    log("Unit state database: {} bytes ({} bytes WAL), rows: {}".format(
+        stats['db_size'], stats['wal_size'],
+        ', '.join('{}={}'.format(table, count)
+                  for table, count in sorted(stats['rows'].items()))),
+        level=DEBUG)
+
+
+def precache_images(image_ids):
+    """Queue images for the local image cache and fetch them.
+
+    :param image_ids: list of image IDs
+    :returns: list of the IDs of images that were not cached already
+    :raises ValueError: if an image ID is not a UUID
+    """
+    image_ids = [str(uuid.UUID(image_id)) for image_id in image_ids]
+    queue_dir = os.path.join(GLANCE_IMAGE_CACHE_DIR, 'queue')
+    mkdir(queue_dir, owner='glance', group='glance', perms=0o750)
+    queued = []
+    for image_id in image_ids:
+        if os.path.exists(os.path.join(GLANCE_IMAGE_CACHE_DIR, image_id)):
+            continue
+        write_file(os.path.join(queue_dir, image_id), '',
+                   owner='glance', group='glance', perms=0o640)
+        queued.append(image_id)
+    if queued:
+        subprocess.check_call(['sudo', '-u', 'glance',
+                               'glance-cache-prefetcher',
+                               '--config-file', GLANCE_API_CONF,
+                               '--config-file', GLANCE_CACHE_CONF])
+    return queued
+
+
+def update_perf_checks(nrpe_setup, unit_name):
+    """Register the glance performance checks with the thresholds from
+    config, and schedule the probe gathering the metrics most of them read
+    while the nrpe-external-master relation exists.
+
+    Checks for a store or the image cache are removed when not in use.
+
+    :param nrpe_setup: NRPE object to add the checks to
+    :param unit_name: unit name to use in check descriptions
+    """
+    if relation_ids('nrpe-external-master'):
+        probe_cmd = [PERF_CHECK, 'probe']
+        if len(haproxy_admin_sockets()) > 1:
+            for path in haproxy_admin_sockets():
+                probe_cmd.append('--socket {}'.format(path))
+        write_file(PERF_PROBE_CRON,
+                   '* * * * * root {} > /dev/null 2>&1\n'.format(
+                       ' '.join(probe_cmd)),
+                   perms=0o644)
+    else:
+        # Nothing reads the metrics without the nrpe subordinate.
+        remove_perf_probe()
+    api_url = 'http://127.0.0.1:{}/versions'.format(
+        determine_api_port(9292, singlenode_mode=True))
+    checks = [
+        ('glance_api_latency', 'glance-api latency',
+         'api-latency --url {}'.format(api_url), 'nrpe-api-latency', True),
+        ('glance_store_rtt', 'glance store round trip', 'store-rtt',
+         'nrpe-store-rtt',
+         bool(relation_ids('ceph') or relation_ids('object-store'))),
+        ('glance_image_cache_fill', 'glance image cache fill', 'cache-fill',
+         'nrpe-image-cache-fill', config('image-cache')),
+        ('glance_haproxy_sessions', 'haproxy sessions per backend',
+         'haproxy-sessions', 'nrpe-haproxy-sessions', True),
+        ('glance_haproxy_queue', 'haproxy queued requests per backend',
+         'haproxy-queue', 'nrpe-haproxy-queue', True),
+    ]
+    for shortname, description, args, option, enabled in checks:
+        if not enabled:
+            nrpe_setup.remove_check(shortname=shortname)
+            continue
+        check_cmd = ['check_glance_perf.py', args]
+        for flag, suffix in (('-w', '-warn'), ('-c', '-crit')):
+            if config(option + suffix) is not None:
+                check_cmd.append('{} {}'.format(flag, config(option + suffix)))
+        nrpe_setup.add_check(
+            shortname=shortname,
+            description='{} {{{}}}'.format(description, unit_name),
+            check_cmd=' '.join(check_cmd))
+
+
+def remove_perf_probe():
+    """Stop gathering the metrics of the glance performance checks."""
+    if os.path.exists(PERF_PROBE_CRON):
+        os.remove(PERF_PROBE_CRON)
+
+
+def haproxy_admin_sockets():
+    """The admin sockets of the local haproxy, one for each of its
+    processes.
+    """
+    nbproc = config('haproxy-nbproc') or 1
+    return [HAPROXY_ADMIN_SOCKET] + [HAPROXY_PROCESS_ADMIN_SOCKET.format(n)
+                                     for n in range(2, nbproc + 1)]
+
+
+def haproxy_admin(command, path=HAPROXY_ADMIN_SOCKET):
+    """Run command on an admin socket of the local haproxy.
+
+    :param path: admin socket of the haproxy process to run command on
+    :returns: the response, or None if haproxy is not running
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(5)
+    try:
+        sock.connect(path)
+        sock.sendall(command.encode('UTF-8') + b'\n')
+        data = b''
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    except socket.error:
+        return None
+    finally:
+        sock.close()
+    return data.decode('UTF-8')
+
+
+def haproxy_server_up(status):
+    """Whether haproxy sends requests to a server with status."""
+    # A server without a health check is reported as 'no check'.
+    return status.startswith('UP') or status == 'no check'
+
+
+def haproxy_server_stats():
+    """The statistics of each of this unit's servers in the local haproxy.
+
+    Every haproxy process checks and counts the sessions of its servers on
+    its own: sessions are summed over the processes, and a server takes the
+    status of the first process which does not consider it up.
+
+    :returns: dict {backend: {statistic: value}}, empty if haproxy is not
+              running
+    """
+    server = local_unit().replace('/', '-')
+    stats = {}
+    for path in haproxy_admin_sockets():
+        lines = (haproxy_admin('show stat', path) or '').splitlines()
+        if not lines:
+            continue
+        fields = lines[0].lstrip('# ').split(',')
+        for line in lines[1:]:
+            row = dict(zip(fields, line.split(',')))
+            if row.get('svname') != server:
+                continue
+            merged = stats.setdefault(row['pxname'], row)
+            if merged is row:
+                continue
+            merged['scur'] = str(sum(int(r.get('scur') or 0)
+                                     for r in (merged, row)))
+            merged_up = haproxy_server_up(merged.get('status', ''))
+            if merged_up and not haproxy_server_up(row.get('status', '')):
+                merged['status'] = row.get('status', '')
+    return stats
+
+
+def haproxy_server_states():
+    """The state of each of this unit's servers in the local haproxy.
+
+    :returns: dict {backend: status}, empty if haproxy is not running
+    """
+    return dict((backend, row.get('status', ''))
+                for backend, row in haproxy_server_stats().items())
+
+
+def is_healthy():
+    """Whether glance-api answers on its local port and the local haproxy
+    considers this unit's servers up.
+    """
+    url = 'http://127.0.0.1:{}/versions'.format(
+        determine_api_port(9292, singlenode_mode=True))
+    try:
+        if requests.get(url, timeout=5).status_code >= 500:
+            return False
+    except requests.exceptions.RequestException:
+        return False
+    return all(haproxy_server_up(state)
+               for state in haproxy_server_states().values())
+
+
+def rolling_restart_batch():
+    return config('rolling-restart-batch')
+
+
+def rolling_restart_timeout():
+    return config('rolling-restart-timeout')
+
+
+def coordinate_rolling_restarts():
+    """Make progress on rolling restarts of the application's units."""
+    return coordinate_restarts(
+        is_healthy, batch=rolling_restart_batch(),
+        timeout=rolling_restart_timeout(),
+        restart_functions=GRACEFUL_RESTART_FUNCTIONS)
+
+
+def drain_haproxy_servers(timeout):
+    """Stop the local haproxy sending new requests to this unit, and wait
+    for the requests in flight to complete.
+
+    :param timeout: seconds to wait for requests to complete
+    :returns: tuple (list of backends drained, whether all requests
+              completed)
+    """
+    server = local_unit().replace('/', '-')
+    backends = sorted(haproxy_server_stats())
+    for backend in backends:
+        for path in haproxy_admin_sockets():
+            haproxy_admin('disable server {}/{}'.format(backend, server),
+                          path)
+    deadline = time.time() + timeout
+    while True:
+        sessions = sum(int(row.get('scur') or 0)
+                       for row in haproxy_server_stats().values())
+        if not sessions:
+            return backends, True
+        if time.time() >= deadline:
+            log('{} requests still in flight after draining for {}s'.format(
+                sessions, timeout), level=WARNING)
+            return backends, False
+        time.sleep(1)
+
+
+def enable_haproxy_servers(backends):
+    """Let the local haproxy send requests to this unit again."""
+    server = local_unit().replace('/', '-')
+    for backend in backends:
+        for path in haproxy_admin_sockets():
+            haproxy_admin('enable server {}/{}'.format(backend, server),
+                          path)
+
+
+def sighup_reload_supported():
+    release = CompareOpenStackReleases(os_release('glance-common'))
+    return release >= SIGHUP_RELOAD_RELEASE
+
+
+def require_full_restart():
+    """Have graceful_restart stop and start the glance services the next
+    time they are restarted, rather than reload them, as a reload does not
+    load upgraded package code.
+    """
+    db = kv()
+    db.set(FULL_RESTART_KEY, sorted(GRACEFUL_RESTART_FUNCTIONS))
+    atexit(db.flush)
+
+
+def graceful_restart(service_name):
+    """Restart service_name without dropping the requests it is serving.
+
+    Releases which support it reload on SIGHUP, replacing their workers once
+    they finish their current requests, unless require_full_restart() was
+    called since the service was last stopped and started. Otherwise the
+    local haproxy is drained of this unit before the service is stopped and
+    started.
+
+    How the service was restarted is recorded in unitdata under
+    RESTART_OUTCOMES_KEY, see restart_outcomes().
+    """
+    db = kv()
+    full_restart = db.get(FULL_RESTART_KEY, [])
+    outcome = {'time': time.time()}
+    reload = service_name not in full_restart and sighup_reload_supported()
+    if reload and service_running(service_name):
+        if init_is_systemd():
+            cmd = ['systemctl', 'kill', '--kill-who=main', '--signal=HUP',
+                   service_name]
+        else:
+            cmd = ['initctl', 'reload', service_name]
+        outcome['method'] = 'reload'
+        outcome['success'] = subprocess.call(cmd) == 0
+    else:
+        backends, drained = drain_haproxy_servers(
+            config('restart-drain-timeout'))
+        outcome['method'] = 'drain-restart' if backends else 'restart'
+        outcome['drained'] = drained
+        service_stop(service_name)
+        outcome['success'] = service_start(service_name)
+        enable_haproxy_servers(backends)
+        if service_name in full_restart:
+            full_restart.remove(service_name)
+            db.set(FULL_RESTART_KEY, full_restart)
+    if not outcome['success']:
+        log('{} of {} failed, restarting'.format(outcome['method'],
+                                                 service_name), level=WARNING)
+        service_stop(service_name)
+        outcome['success'] = service_start(service_name)
+        outcome['method'] += '+restart'
+    log('{} {}: {}'.format(service_name, outcome['method'],
+                           'ok' if outcome['success'] else 'failed'),
+        level=INFO)
+    outcomes = db.get(RESTART_OUTCOMES_KEY, {})
+    outcomes[service_name] = outcome
+    db.set(RESTART_OUTCOMES_KEY, outcomes)
+    atexit(db.flush)
+    return outcome['success']
+
+
+def restart_outcomes():
+    """How each service was last restarted by graceful_restart.
+
+    :returns: dict {service: {'time': ..., 'method': 'reload', 'restart',
+              'drain-restart', with '+restart' appended when it failed and
+              was followed by a plain restart, 'success': bool, 'drained':
+              bool, only for drain-restart}}
+    """
+    return kv().get(RESTART_OUTCOMES_KEY, {})
+
+
+# Restart functions for restart_on_change, restarting the glance services
+# without dropping requests.
+GRACEFUL_RESTART_FUNCTIONS = {
+    'glance-api': graceful_restart,
+    'glance-registry': graceful_restart,
+}
+# Services restarted on one batch of units at a time, see
+# rolling-restart-batch; the others restart as soon as their configuration
+# changes.
+ROLLING_RESTART_SERVICES = ('glance-api', 'glance-registry')
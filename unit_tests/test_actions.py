@@ -46,6 +46,59 @@ class ResumeTestCase(CharmTestCase):
         self.resume_unit_helper.assert_called_once_with('test-config')
 
 
+class PrecacheTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(PrecacheTestCase, self).setUp(
+            actions.actions, ["config", "action_get", "action_set",
+                              "action_fail", "precache_images"])
+
+    def test_precaches_images(self):
+        self.config.return_value = True
+        self.action_get.return_value = 'id1 id2'
+        self.precache_images.return_value = ['id2']
+        actions.actions.precache([])
+        self.precache_images.assert_called_once_with(['id1', 'id2'])
+        self.action_set.assert_called_once_with({'queued': 'id2'})
+
+    def test_image_cache_disabled(self):
+        self.config.return_value = False
+        actions.actions.precache([])
+        self.assertFalse(self.precache_images.called)
+        self.action_fail.assert_called_once_with(
+            'image-cache is not enabled')
+
+
+class DumpTraceTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(DumpTraceTestCase, self).setUp(
+            actions.actions, ["action_get", "action_set", "action_fail",
+                              "tracing"])
+        self.params = {'hooks': 10, 'count': 20, 'metric': 'wall'}
+        self.action_get.side_effect = lambda k: self.params[k]
+
+    def test_dumps_trace(self):
+        self.tracing.load.return_value = ['record']
+        self.tracing.slowest.return_value = [
+            ('config-changed', 'hook:config-changed', 2.5, 1.25)]
+        self.tracing.folded.return_value = ['config-changed 100',
+                                            'config-changed;a 200']
+        actions.actions.dump_trace([])
+        self.tracing.load.assert_called_once_with(hooks=10)
+        self.tracing.slowest.assert_called_once_with(['record'], 20, 'wall')
+        self.action_set.assert_called_once_with({
+            'slowest': '2.500s wall 1.250s cpu config-changed '
+                       'hook:config-changed',
+            'folded': 'config-changed 100\nconfig-changed;a 200'})
+
+    def test_no_traces(self):
+        self.tracing.load.return_value = []
+        actions.actions.dump_trace([])
+        self.assertTrue(self.action_fail.called)
+        self.assertFalse(self.action_set.called)
+
+
 class MainTestCase(CharmTestCase):
 
     def setUp(self):
@@ -0,0 +1,179 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from charmhelpers.core.host import ChecksumError
+from charmhelpers.fetch import archiveurl
+
+URL = 'http://example.com/glance-simplestreams.tgz'
+CONTENT = b'0123456789' * 10
+
+
+class FakeResponse(io.BytesIO):
+
+    def __init__(self, data, code=200, headers=None, fail_after=None):
+        super(FakeResponse, self).__init__(data)
+        self.code = code
+        self.headers = headers or {}
+        self.fail_after = fail_after
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return self.code
+
+    def read(self, size=-1):
+        if self.fail_after is not None and self.tell() >= self.fail_after:
+            raise IOError('Connection reset')
+        return super(FakeResponse, self).read(size)
+
+
+class FakeServer(object):
+    """Serves CONTENT with an ETag, honouring Range unless told not to."""
+
+    def __init__(self):
+        self.requests = []
+        self.fail_after = None
+        self.honour_range = True
+        self.etag = '"v1"'
+
+    def __call__(self, request):
+        if isinstance(request, archiveurl.Request):
+            headers = {'Range': request.get_header('Range'),
+                       'If-Range': request.get_header('If-range')}
+        else:
+            headers = {}
+        self.requests.append(headers)
+        data, code = CONTENT, 200
+        current = headers.get('If-Range') == self.etag
+        if self.honour_range and headers.get('Range') and current:
+            offset = int(headers['Range'][len('bytes='):-1])
+            data, code = CONTENT[offset:], archiveurl.HTTP_PARTIAL_CONTENT
+        fail_after, self.fail_after = self.fail_after, None
+        return FakeResponse(data, code, {'ETag': self.etag}, fail_after)
+
+
+class DownloadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.dest = os.path.join(self.tmp, 'file.tgz')
+        self.server = FakeServer()
+        self.handler = archiveurl.ArchiveUrlFetchHandler()
+        for name, value in (('urlopen', self.server), ('CHUNK_SIZE', 16)):
+            _m = patch.object(archiveurl, name, value)
+            _m.start()
+            self.addCleanup(_m.stop)
+
+    def download(self):
+        return self.handler.download(URL, self.dest, ['sha1'])
+
+    def interrupted_download(self):
+        self.server.fail_after = 32
+        self.assertRaises(IOError, self.download)
+        self.assertFalse(os.path.exists(self.dest))
+        self.assertEqual(os.path.getsize(self.dest + '.part'), 32)
+
+    def assertDownloaded(self, digests):
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(f.read(), CONTENT)
+        self.assertEqual(digests,
+                         {'sha1': hashlib.sha1(CONTENT).hexdigest()})
+        self.assertEqual(os.listdir(self.tmp), ['file.tgz'])
+
+    def test_download(self):
+        self.assertDownloaded(self.download())
+        self.assertEqual(self.server.requests, [{}])
+
+    def test_resume(self):
+        self.interrupted_download()
+        self.assertDownloaded(self.download())
+        self.assertEqual(self.server.requests[1],
+                         {'Range': 'bytes=32-', 'If-Range': '"v1"'})
+
+    def test_resume_ignored(self):
+        self.interrupted_download()
+        # the whole file follows
+        self.server.honour_range = False
+        self.assertDownloaded(self.download())
+        self.assertEqual(self.server.requests[1]['Range'], 'bytes=32-')
+
+    def test_resume_changed_file(self):
+        self.interrupted_download()
+        self.server.etag = '"v2"'
+        self.assertDownloaded(self.download())
+
+
+class InstallTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.cache_dir = os.path.join(self.tmp, 'cache')
+        self.server = FakeServer()
+        self.handler = archiveurl.ArchiveUrlFetchHandler()
+        for name, value in (('urlopen', self.server),
+                            ('CACHE_DIR', self.cache_dir),
+                            ('extract', lambda path, dest: path)):
+            _m = patch.object(archiveurl, name, value)
+            _m.start()
+            self.addCleanup(_m.stop)
+        _m = patch.dict(os.environ, {'CHARM_DIR': self.tmp})
+        _m.start()
+        self.addCleanup(_m.stop)
+        self.sha1 = hashlib.sha1(CONTENT).hexdigest()
+        self.cached = os.path.join(self.cache_dir, 'sha1', self.sha1)
+
+    def install(self, checksum):
+        path = self.handler.install(URL, checksum=checksum)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), CONTENT)
+
+    def test_cache_miss(self):
+        # checksums are compared regardless of case
+        self.install(self.sha1.upper())
+        self.assertEqual(len(self.server.requests), 1)
+        with open(self.cached, 'rb') as f:
+            self.assertEqual(f.read(), CONTENT)
+
+    def test_cache_hit(self):
+        os.makedirs(os.path.dirname(self.cached))
+        with open(self.cached, 'wb') as f:
+            f.write(CONTENT)
+        self.install(self.sha1.upper())
+        self.assertEqual(self.server.requests, [])
+
+    def test_corrupt_cache_entry(self):
+        os.makedirs(os.path.dirname(self.cached))
+        with open(self.cached, 'wb') as f:
+            f.write(b'corrupt')
+        self.install(self.sha1)
+        self.assertEqual(len(self.server.requests), 1)
+        with open(self.cached, 'rb') as f:
+            self.assertEqual(f.read(), CONTENT)
+
+    def test_checksum_mismatch(self):
+        self.assertRaises(ChecksumError, self.handler.install, URL,
+                          checksum=hashlib.sha1(b'other').hexdigest())
+        self.assertFalse(os.path.exists(self.cache_dir))
@@ -0,0 +1,289 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import unittest
+
+from mock import patch, MagicMock
+
+from charmhelpers.contrib.hahelpers import cluster
+
+from test_utils import SimpleKV
+
+
+class RollingRestartTestCase(unittest.TestCase):
+    """Units glance/0, the local unit, to glance/3 related over cluster:0.
+    """
+
+    def setUp(self):
+        self.kv = SimpleKV()
+        self.leader = {}
+        self.peers = ['glance/1', 'glance/2', 'glance/3']
+        self.settings = {}
+        self.now = 1000.0
+        self.is_leader = True
+        self.healthy = True
+        self.health_checks = 0
+        self.exit_callbacks = []
+        for name, value in (
+                ('atexit', self.exit_callbacks.append),
+                ('kv', lambda: self.kv),
+                ('leader_get', self.leader.get),
+                ('leader_set', MagicMock(side_effect=self.leader.update)),
+                ('local_unit', lambda: 'glance/0'),
+                ('relation_ids', lambda r: ['cluster:0']),
+                ('relation_list', lambda rid: list(self.peers)),
+                ('relation_get', lambda rid, unit: self.settings.get(unit)),
+                ('relation_set', self.relation_set),
+                ('juju_is_leader', lambda: self.juju_is_leader()),
+                ('log', MagicMock()),
+                ('status_set', MagicMock()),
+                ('service', MagicMock()),
+                ('distributed_wait', MagicMock())):
+            _m = patch.object(cluster, name, value)
+            _m.start()
+            self.addCleanup(_m.stop)
+        _m = patch.object(cluster.time, 'time', lambda: self.now)
+        _m.start()
+        self.addCleanup(_m.stop)
+        _m = patch.object(cluster.time, 'sleep', self.sleep)
+        _m.start()
+        self.addCleanup(_m.stop)
+
+    def juju_is_leader(self):
+        if self.is_leader is None:
+            raise NotImplementedError()
+        return self.is_leader
+
+    def relation_set(self, relation_id, relation_settings):
+        self.settings.setdefault('glance/0', {}).update(relation_settings)
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def health_check(self):
+        self.health_checks += 1
+        return self.healthy
+
+    def request(self, unit, request='1'):
+        self.settings.setdefault(unit, {})['restart-request'] = request
+
+    def done(self, unit):
+        settings = self.settings[unit]
+        settings['restart-done'] = settings['restart-request']
+
+    def grants(self):
+        return json.loads(self.leader.get(cluster.RESTART_GRANTS_KEY) or '{}')
+
+    def restarted(self):
+        return [c[0] for c in cluster.service.call_args_list]
+
+    def test_restart_requests(self):
+        self.request('glance/1')
+        self.request('glance/2')
+        self.done('glance/2')
+        self.assertEqual(cluster.restart_requests(), {'glance/1': '1'})
+
+    def test_grant_batch(self):
+        self.peers.append('glance/10')
+        for unit in ('glance/10', 'glance/3', 'glance/2'):
+            self.request(unit)
+        self.assertEqual(cluster.grant_restarts(batch=2), {
+            'glance/2': ['1', 1000.0], 'glance/3': ['1', 1000.0]})
+        self.assertEqual(sorted(self.grants()), ['glance/2', 'glance/3'])
+        # nothing changes until a grant is released
+        cluster.leader_set.reset_mock()
+        self.now += 10
+        self.assertEqual(sorted(cluster.grant_restarts(batch=2)),
+                         ['glance/2', 'glance/3'])
+        self.assertFalse(cluster.leader_set.called)
+
+    def test_grant_released_when_done(self):
+        self.request('glance/1')
+        self.request('glance/2')
+        cluster.grant_restarts()
+        self.done('glance/1')
+        self.now += 10
+        self.assertEqual(cluster.grant_restarts(),
+                         {'glance/2': ['1', 1010.0]})
+
+    def test_grant_released_on_departure(self):
+        self.request('glance/1')
+        self.request('glance/2')
+        cluster.grant_restarts()
+        self.peers.remove('glance/1')
+        self.assertEqual(sorted(cluster.grant_restarts()), ['glance/2'])
+
+    def test_grant_released_on_new_request(self):
+        self.request('glance/1')
+        self.request('glance/2')
+        cluster.grant_restarts()
+        # a new request is queued behind the others
+        self.request('glance/1', '2')
+        self.assertEqual(sorted(cluster.grant_restarts()), ['glance/1'])
+        self.assertEqual(self.grants(), {'glance/1': ['2', 1000.0]})
+
+    def test_grant_expiry(self):
+        self.request('glance/1')
+        self.request('glance/2')
+        self.assertEqual(sorted(cluster.grant_restarts(expiry=600)),
+                         ['glance/1'])
+        self.now += 599
+        self.assertEqual(sorted(cluster.grant_restarts(expiry=600)),
+                         ['glance/1'])
+        self.now += 1
+        # the expired unit goes to the back of the queue
+        self.assertEqual(cluster.grant_restarts(expiry=600),
+                         {'glance/2': ['1', 1600.0]})
+        self.done('glance/2')
+        self.assertEqual(cluster.grant_restarts(expiry=600),
+                         {'glance/1': ['1', 1600.0]})
+
+    def test_request_restart(self):
+        cluster.request_restart(['glance-api'])
+        self.assertEqual(self.kv.get(cluster.PENDING_RESTART_KEY), {
+            'id': '1000.000000', 'services': ['glance-api'],
+            'stopstart': False, 'restarted': False})
+        self.assertEqual(self.settings['glance/0'],
+                         {'restart-request': '1000.000000'})
+        # saved when the hook completes
+        self.assertEqual(self.exit_callbacks, [self.kv.flush])
+        self.assertFalse(self.kv.flushed)
+        # further requests join the pending one
+        self.now += 1
+        cluster.request_restart(['glance-registry', 'glance-api'],
+                                stopstart=True)
+        self.assertEqual(self.kv.get(cluster.PENDING_RESTART_KEY), {
+            'id': '1000.000000',
+            'services': ['glance-api', 'glance-registry'],
+            'stopstart': True, 'restarted': False})
+
+    def test_request_after_restart(self):
+        self.kv.set(cluster.PENDING_RESTART_KEY, {
+            'id': '1.000000', 'services': ['glance-api'],
+            'stopstart': False, 'restarted': True})
+        cluster.request_restart(['glance-registry'])
+        self.assertEqual(self.kv.get(cluster.PENDING_RESTART_KEY), {
+            'id': '1000.000000', 'services': ['glance-registry'],
+            'stopstart': False, 'restarted': False})
+
+    def test_run_nothing_pending(self):
+        self.assertTrue(cluster.run_granted_restart(self.health_check))
+        self.assertEqual(self.health_checks, 0)
+
+    def test_run_not_granted(self):
+        cluster.request_restart(['glance-api'])
+        # the request is published again, if a hook failed to send it
+        del self.settings['glance/0']
+        self.assertFalse(cluster.run_granted_restart(self.health_check))
+        self.assertEqual(self.restarted(), [])
+        self.assertTrue(cluster.restart_pending())
+        self.assertEqual(self.settings['glance/0'],
+                         {'restart-request': '1000.000000'})
+
+    def test_run_granted(self):
+        cluster.request_restart(['glance-api'])
+        cluster.grant_restarts()
+        self.assertTrue(cluster.run_granted_restart(self.health_check))
+        self.assertEqual(self.restarted(), [('restart', 'glance-api')])
+        self.assertFalse(cluster.restart_pending())
+        self.assertEqual(self.settings['glance/0']['restart-done'],
+                         '1000.000000')
+        self.assertFalse(self.kv.flushed)
+        # which releases the grant
+        self.assertEqual(cluster.grant_restarts(), {})
+
+    def test_run_granted_stopstart_and_restart_functions(self):
+        restart = MagicMock()
+        cluster.request_restart(['glance-api', 'haproxy'], stopstart=True)
+        cluster.grant_restarts()
+        cluster.run_granted_restart(self.health_check,
+                                    restart_functions={'glance-api': restart})
+        restart.assert_called_once_with('glance-api')
+        self.assertEqual(self.restarted(), [('stop', 'haproxy'),
+                                            ('start', 'haproxy')])
+
+    def test_unhealthy_keeps_grant(self):
+        cluster.request_restart(['glance-api'])
+        cluster.grant_restarts(expiry=600)
+        self.healthy = False
+        self.assertFalse(cluster.run_granted_restart(self.health_check))
+        # checked once, without waiting
+        self.assertEqual(self.now, 1000.0)
+        self.assertEqual(self.health_checks, 1)
+        self.assertNotIn('restart-done', self.settings['glance/0'])
+        self.assertTrue(cluster.restart_pending())
+        self.request('glance/1')
+        self.assertEqual(sorted(cluster.grant_restarts(expiry=600)),
+                         ['glance/0'])
+
+    def test_unhealthy_checked_once_in_later_hooks(self):
+        cluster.request_restart(['glance-api'])
+        cluster.grant_restarts()
+        self.healthy = False
+        cluster.run_granted_restart(self.health_check)
+        self.health_checks = 0
+        self.assertFalse(cluster.run_granted_restart(self.health_check))
+        self.assertEqual(self.health_checks, 1)
+        self.healthy = True
+        self.assertTrue(cluster.run_granted_restart(self.health_check))
+        # restarted only once
+        self.assertEqual(self.restarted(), [('restart', 'glance-api')])
+        self.assertIn('restart-done', self.settings['glance/0'])
+
+    def test_coordinate_restarts_not_leader(self):
+        self.is_leader = False
+        self.request('glance/1')
+        cluster.coordinate_restarts(self.health_check)
+        self.assertFalse(cluster.leader_set.called)
+
+    def test_coordinate_restarts_no_leadership(self):
+        self.is_leader = None
+        self.assertTrue(cluster.coordinate_restarts(self.health_check))
+
+    def test_rolling_restart(self):
+        self.request('glance/1')
+        cluster.grant_restarts()
+        cluster.rolling_restart(['glance-api'], self.health_check)
+        # waits for glance/1 to restart first
+        self.assertEqual(self.restarted(), [])
+        self.assertEqual(sorted(self.grants()), ['glance/1'])
+        self.done('glance/1')
+        cluster.coordinate_restarts(self.health_check)
+        self.assertEqual(self.restarted(), [('restart', 'glance-api')])
+        self.assertFalse(cluster.restart_pending())
+
+    def test_rolling_restart_no_peers(self):
+        self.peers = []
+        cluster.rolling_restart(['glance-api'], self.health_check)
+        self.assertEqual(self.restarted(), [('restart', 'glance-api')])
+        self.assertFalse(cluster.restart_pending())
+        self.assertEqual(self.leader, {})
+
+    def test_rolling_restart_batch_zero(self):
+        cluster.rolling_restart(['glance-api'], self.health_check,
+                                stopstart=True, batch=0)
+        self.assertEqual(self.restarted(), [('stop', 'glance-api'),
+                                            ('start', 'glance-api')])
+        self.assertFalse(cluster.restart_pending())
+
+    def test_rolling_restart_distributed_wait(self):
+        self.is_leader = None
+        cluster.rolling_restart(['glance-api'], self.health_check, batch=3,
+                                timeout=120)
+        # four units in groups of three
+        cluster.distributed_wait.assert_called_once_with(
+            modulo=2, wait=120, operation_name='restart')
+        self.assertEqual(self.restarted(), [('restart', 'glance-api')])
+        self.assertFalse(cluster.restart_pending())
@@ -0,0 +1,168 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from mock import patch
+
+from charmhelpers.contrib.openstack import context
+
+GB = 1024 ** 3
+MB = 1024 ** 2
+
+
+class CgroupTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.files = {}
+        _m = patch.object(context, '_read_cgroup_file',
+                          lambda path: self.files.get(path))
+        _m.start()
+        self.addCleanup(_m.stop)
+
+    def test_cpu_quota_v2(self):
+        self.files[context.CGROUP_V2_CPU_MAX] = '150000 100000'
+        self.assertEqual(context._cgroup_cpu_quota(), 1.5)
+
+    def test_cpu_quota_v2_unlimited(self):
+        self.files[context.CGROUP_V2_CPU_MAX] = 'max 100000'
+        self.assertIsNone(context._cgroup_cpu_quota())
+
+    def test_cpu_quota_v1(self):
+        self.files[context.CGROUP_V1_CPU_QUOTA] = '50000'
+        self.files[context.CGROUP_V1_CPU_PERIOD] = '100000'
+        self.assertEqual(context._cgroup_cpu_quota(), 0.5)
+
+    def test_cpu_quota_v1_unlimited(self):
+        self.files[context.CGROUP_V1_CPU_QUOTA] = '-1'
+        self.files[context.CGROUP_V1_CPU_PERIOD] = '100000'
+        self.assertIsNone(context._cgroup_cpu_quota())
+
+    def test_cpu_quota_no_controller(self):
+        self.assertIsNone(context._cgroup_cpu_quota())
+
+    def test_cpu_quota_invalid_period(self):
+        self.files[context.CGROUP_V2_CPU_MAX] = '100000 0'
+        self.assertIsNone(context._cgroup_cpu_quota())
+
+    def test_memory_limit_v2(self):
+        self.files[context.CGROUP_V2_MEMORY_MAX] = str(2 * GB)
+        self.assertEqual(context._cgroup_memory_limit(), 2 * GB)
+
+    def test_memory_limit_v2_unlimited(self):
+        self.files[context.CGROUP_V2_MEMORY_MAX] = 'max'
+        self.assertIsNone(context._cgroup_memory_limit())
+
+    def test_memory_limit_v1(self):
+        self.files[context.CGROUP_V1_MEMORY_LIMIT] = str(512 * MB)
+        self.assertEqual(context._cgroup_memory_limit(), 512 * MB)
+
+    def test_memory_limit_v1_unlimited(self):
+        self.files[context.CGROUP_V1_MEMORY_LIMIT] = '9223372036854771712'
+        self.assertIsNone(context._cgroup_memory_limit())
+
+    def test_memory_no_controller(self):
+        self.assertIsNone(context._cgroup_memory_limit())
+
+
+class WorkerSizingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.config = {}
+        self.cpus = 8
+        self.quota = None
+        self.ram = 16 * GB
+        self.memory_limit = None
+        self.container = False
+        for name, value in (
+                ('config', lambda k: self.config.get(k)),
+                ('_num_cpus', lambda: self.cpus),
+                ('_cgroup_cpu_quota', lambda: self.quota),
+                ('get_total_ram', lambda: self.ram),
+                ('_cgroup_memory_limit', lambda: self.memory_limit),
+                ('is_container', lambda: self.container)):
+            _m = patch.object(context, name, value)
+            _m.start()
+            self.addCleanup(_m.stop)
+
+    def workers(self, worker_rss=None):
+        return context.WorkerSizing(worker_rss=worker_rss).calculate()
+
+    def test_cpu_bound(self):
+        self.assertEqual(self.workers(), 16)
+        self.config['worker-multiplier'] = 0.5
+        self.assertEqual(self.workers(), 4)
+
+    def test_at_least_one_worker(self):
+        self.cpus = 1
+        self.config['worker-multiplier'] = 0.25
+        self.assertEqual(self.workers(), 1)
+
+    def test_cpu_quota(self):
+        self.quota = 1.5
+        sizing = context.WorkerSizing()
+        self.assertEqual(sizing.calculate(), 3)
+        self.assertIn('cgroup CPU quota allows 1.50 of 8 CPUs',
+                      sizing.explain())
+
+    def test_cpu_quota_above_cpus_ignored(self):
+        self.quota = 16
+        self.assertEqual(self.workers(), 16)
+
+    def test_container_default_limit(self):
+        self.container = True
+        self.assertEqual(self.workers(), context.MAX_DEFAULT_WORKERS)
+
+    def test_container_with_multiplier(self):
+        self.container = True
+        self.config['worker-multiplier'] = 2
+        self.assertEqual(self.workers(), 16)
+
+    def test_container_with_cpu_quota(self):
+        self.container = True
+        self.quota = 4
+        self.assertEqual(self.workers(), 8)
+
+    def test_memory_cap(self):
+        # half of 16GB in 1GB workers
+        sizing = context.WorkerSizing(worker_rss=1 * GB)
+        self.assertEqual(sizing.calculate(), 8)
+        self.assertIn('1024MB per worker in 8192MB of memory limits to 8',
+                      sizing.explain())
+
+    def test_memory_not_limiting(self):
+        self.assertEqual(self.workers(worker_rss=100 * MB), 16)
+
+    def test_cgroup_memory_cap(self):
+        self.memory_limit = 2 * GB
+        self.assertEqual(self.workers(worker_rss=256 * MB), 4)
+
+    def test_cgroup_memory_above_ram_ignored(self):
+        self.memory_limit = 64 * GB
+        self.assertEqual(self.workers(worker_rss=1 * GB), 8)
+
+    def test_memory_cap_at_least_one(self):
+        self.ram = 1 * GB
+        self.assertEqual(self.workers(worker_rss=4 * GB), 1)
+
+    def test_memory_fraction(self):
+        sizing = context.WorkerSizing(worker_rss=1 * GB,
+                                      memory_fraction=0.25)
+        self.assertEqual(sizing.calculate(), 4)
+
+    def test_cpu_and_memory_caps(self):
+        self.quota = 2
+        self.memory_limit = 1 * GB
+        # 4 CPU bound workers, of which 2 fit in half of 1GB
+        self.assertEqual(self.workers(worker_rss=256 * MB), 2)
@@ -0,0 +1,211 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch, call
+
+from charmhelpers.fetch import ubuntu
+
+DPKG_STATUS = """\
+Package: glance
+Status: install ok installed
+Priority: optional
+Architecture: all
+Version: 2:12.0.0-0ubuntu1
+Description: OpenStack Image Registry and Delivery Service
+ Package: not-a-package
+ Status: install ok installed
+
+Package: libc6
+Status: install ok installed
+Architecture: amd64
+Multi-Arch: same
+Version: 2.23-0ubuntu10
+
+Package: libc6
+Status: install ok installed
+Architecture: i386
+Multi-Arch: same
+Version: 2.23-0ubuntu10
+
+Package: haproxy
+Status: hold ok installed
+Architecture: amd64
+Version: 1.6.3-1ubuntu0.1
+
+Package: python-glance
+Status: install ok half-installed
+Architecture: all
+Version: 2:12.0.0-0ubuntu1
+
+Package: memcached
+Status: install ok unpacked
+Architecture: amd64
+Version: 1.4.25-2ubuntu1
+
+Package: apache2
+Status: deinstall ok config-files
+Architecture: amd64
+Version: 2.4.18-2ubuntu3
+
+Package: python-six
+Status: install ok installed
+Architecture: all
+Version: 1.10.0-3"""
+
+
+class DpkgStatusTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.path = os.path.join(self.tmp, 'status')
+        self.write(DPKG_STATUS)
+        _m = patch.dict(ubuntu._dpkg_status, clear=True)
+        _m.start()
+        self.addCleanup(_m.stop)
+
+    def write(self, content, mtime=None):
+        with open(self.path, 'w') as f:
+            f.write(content)
+        if mtime is not None:
+            os.utime(self.path, (mtime, mtime))
+
+    def test_parse(self):
+        self.assertEqual(ubuntu._parse_dpkg_status(self.path), {
+            'glance': '2:12.0.0-0ubuntu1',
+            'glance:all': '2:12.0.0-0ubuntu1',
+            'libc6': '2.23-0ubuntu10',
+            'libc6:amd64': '2.23-0ubuntu10',
+            'libc6:i386': '2.23-0ubuntu10',
+            'haproxy': '1.6.3-1ubuntu0.1',
+            'haproxy:amd64': '1.6.3-1ubuntu0.1',
+            'python-six': '1.10.0-3',
+            'python-six:all': '1.10.0-3',
+        })
+
+    def test_parse_blank_lines(self):
+        self.write('\n\n' + DPKG_STATUS.replace('\n\n', '\n\n\n') + '\n\n')
+        self.assertEqual(len(ubuntu._parse_dpkg_status(self.path)), 9)
+
+    def test_filter_installed_packages(self):
+        status = ubuntu.dpkg_status(self.path)
+        with patch.object(ubuntu, 'dpkg_status', lambda: status):
+            self.assertEqual(ubuntu.filter_installed_packages(
+                ['glance', 'python-glance', 'memcached', 'apache2',
+                 'haproxy', 'libc6:i386', 'libc6:arm64']),
+                ['python-glance', 'memcached', 'apache2', 'libc6:arm64'])
+
+    def test_dpkg_status_cached_by_stamp(self):
+        self.write(DPKG_STATUS, mtime=1000)
+        with patch.object(ubuntu, '_parse_dpkg_status',
+                          wraps=ubuntu._parse_dpkg_status) as parse:
+            self.assertIn('glance', ubuntu.dpkg_status(self.path))
+            self.assertIn('glance', ubuntu.dpkg_status(self.path))
+            self.assertEqual(parse.call_count, 1)
+            self.write(DPKG_STATUS.replace('Package: glance\n',
+                                           'Package: glance-api\n'),
+                       mtime=1001)
+            status = ubuntu.dpkg_status(self.path)
+            self.assertEqual(parse.call_count, 2)
+        self.assertIn('glance-api', status)
+        self.assertNotIn('glance', status)
+
+    def test_dpkg_status_missing(self):
+        self.assertEqual(ubuntu.dpkg_status(self.path + '.missing'), {})
+        self.assertIsNone(ubuntu.dpkg_status_stamp(self.path + '.missing'))
+
+    def test_upstream_version(self):
+        self.assertEqual(ubuntu.upstream_version('2:12.0.0-0ubuntu1'),
+                         '12.0.0')
+        self.assertEqual(ubuntu.upstream_version('1.10.0-3'), '1.10.0')
+        self.assertEqual(ubuntu.upstream_version('1.0'), '1.0')
+
+
+class AptPlanTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.installed = {'haproxy': '1.6.3'}
+        _m = patch.object(ubuntu, 'filter_installed_packages',
+                          lambda packages: [p for p in packages
+                                            if p not in self.installed])
+        _m.start()
+        self.addCleanup(_m.stop)
+        _m = patch.object(ubuntu, 'apt_install')
+        self.apt_install = _m.start()
+        self.addCleanup(_m.stop)
+        self.plan = ubuntu.AptPlan()
+
+    def test_requests_merged(self):
+        self.plan.add(['glance', 'haproxy'])
+        self.plan.add('python-six')
+        self.plan.add(['glance', 'memcached'])
+        self.assertEqual(self.plan.pending(), [
+            (None, ['glance', 'python-six', 'memcached'], False)])
+
+    def test_options_kept_apart(self):
+        options = ['--option=Dpkg::Options::=--force-confnew']
+        self.plan.add(['glance'])
+        self.plan.add(['python-ceph'], options=options)
+        self.plan.add(['ceph-common'], options=tuple(options))
+        self.assertEqual(self.plan.pending(), [
+            (None, ['glance'], False),
+            (options, ['python-ceph', 'ceph-common'], False)])
+
+    def test_fatal_propagates(self):
+        self.plan.add(['glance'])
+        self.plan.add(['memcached'], fatal=True)
+        self.plan.add(['python-six'])
+        self.assertEqual(self.plan.pending(), [
+            (None, ['glance', 'memcached', 'python-six'], True)])
+
+    def test_fatal_only_for_its_options(self):
+        self.plan.add(['glance'], fatal=True)
+        self.plan.add(['python-ceph'], options=[])
+        self.assertEqual(self.plan.pending(), [
+            (None, ['glance'], True),
+            ([], ['python-ceph'], False)])
+
+    def test_installed_skipped(self):
+        self.plan.add(['haproxy'], fatal=True)
+        self.assertEqual(self.plan.pending(), [])
+        self.plan.execute()
+        self.assertFalse(self.apt_install.called)
+
+    def test_resolved_when_executed(self):
+        self.plan.add(['glance', 'memcached'])
+        self.installed['glance'] = '12.0.0'
+        self.plan.execute()
+        self.apt_install.assert_called_once_with(['memcached'], options=None,
+                                                 fatal=False)
+
+    def test_execute_empties_plan(self):
+        options = ['--no-install-recommends']
+        self.plan.add(['glance'], fatal=True)
+        self.plan.add(['python-ceph'], options=options)
+        self.plan.execute()
+        self.assertEqual(self.apt_install.call_args_list, [
+            call(['glance'], options=None, fatal=True),
+            call(['python-ceph'], options=options, fatal=False)])
+        self.assertEqual(self.plan.pending(), [])
+        self.apt_install.reset_mock()
+        self.plan.execute()
+        self.assertFalse(self.apt_install.called)
+
+    def test_apt_plan_shared(self):
+        self.assertIs(ubuntu.apt_plan(), ubuntu.apt_plan())
@@ -0,0 +1,295 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from mock import patch
+
+from test_utils import SimpleKV
+
+from charmhelpers.contrib.hardening.audits import BaseAudit
+from charmhelpers.contrib.hardening.audits import executor
+from charmhelpers.contrib.hardening.audits import file as file_audits
+
+
+class FakeAudit(BaseAudit):
+
+    def __init__(self, name, paths=None, action=None, **kwargs):
+        super(FakeAudit, self).__init__(**kwargs)
+        self.name = name
+        self.paths = paths or []
+        self.action = action
+
+    def ensure_compliance(self):
+        if self.action:
+            self.action()
+
+    def __repr__(self):
+        return self.name
+
+
+class WavesTestCase(unittest.TestCase):
+
+    def names(self, audits):
+        return [[a.name for a in wave]
+                for wave in executor.audit_waves(audits)]
+
+    def test_disjoint_paths_share_a_wave(self):
+        audits = [FakeAudit('a', ['/etc/a']), FakeAudit('b', ['/etc/b']),
+                  FakeAudit('c', ['/etc/ab'])]
+        self.assertEqual(self.names(audits), [['a', 'b', 'c']])
+
+    def test_same_path(self):
+        audits = [FakeAudit('a', ['/etc/a']), FakeAudit('b', ['/etc/a']),
+                  FakeAudit('c', ['/etc/c'])]
+        self.assertEqual(self.names(audits), [['a', 'c'], ['b']])
+
+    def test_enclosing_path(self):
+        audits = [FakeAudit('a', ['/etc/a/b']), FakeAudit('b', ['/etc/a/']),
+                  FakeAudit('c', ['/etc/a/b/c'])]
+        self.assertEqual(self.names(audits), [['a'], ['b'], ['c']])
+
+    def test_requires(self):
+        a = FakeAudit('a', ['/etc/a'])
+        b = FakeAudit('b', ['/etc/b'], requires=[a])
+        c = FakeAudit('c', ['/etc/c'])
+        self.assertEqual(self.names([a, b, c]), [['a', 'c'], ['b']])
+
+    def test_no_paths_is_a_barrier(self):
+        audits = [FakeAudit('a', ['/etc/a']), FakeAudit('b'),
+                  FakeAudit('c', ['/etc/c']), FakeAudit('d'),
+                  FakeAudit('e')]
+        self.assertEqual(self.names(audits),
+                         [['a'], ['b'], ['c'], ['d'], ['e']])
+
+
+class RunWavesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.path = os.path.join(self.tmp, 'file')
+        with open(self.path, 'w'):
+            pass
+        os.chmod(self.path, 0o600)
+        _m = patch.object(executor, 'log')
+        _m.start()
+        self.addCleanup(_m.stop)
+
+    def mode_seen(self, modes):
+        return lambda: modes.append(
+            executor.audit_cache().stat(self.path).st_mode & 0o777)
+
+    def test_cache_cleared_after_audit_without_paths(self):
+        modes = []
+        executor.run_audits([
+            FakeAudit('a', [self.path], self.mode_seen(modes)),
+            FakeAudit('b', action=lambda: os.chmod(self.path, 0o644)),
+            FakeAudit('c', [self.path], self.mode_seen(modes))])
+        self.assertEqual(modes, [0o600, 0o644])
+
+    def test_cache_kept_after_audit_with_paths(self):
+        modes = []
+        other = os.path.join(self.tmp, 'other')
+        executor.run_audits([
+            FakeAudit('a', [self.path], self.mode_seen(modes)),
+            FakeAudit('b', [other], lambda: os.chmod(self.path, 0o644)),
+            FakeAudit('c', [self.path], self.mode_seen(modes))])
+        # b changed what it did not audit, which the cache does not see
+        self.assertEqual(modes, [0o600, 0o600])
+
+
+class IncrementalRunTestCase(unittest.TestCase):
+
+    INTERVAL = 3600
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.path = os.path.join(self.tmp, 'file')
+        with open(self.path, 'w'):
+            pass
+        os.chmod(self.path, 0o600)
+        self.kv = SimpleKV()
+        self.settings = 'settings'
+        self.now = 1000000
+        for target, name, value in (
+                (executor, 'log', lambda *args, **kwargs: None),
+                (file_audits, 'log', lambda *args, **kwargs: None),
+                (executor.unitdata, 'kv', lambda: self.kv),
+                (executor.utils, 'settings_fingerprint',
+                 lambda: self.settings),
+                (executor.time, 'time', lambda: self.now)):
+            _m = patch.object(target, name, value)
+            _m.start()
+            self.addCleanup(_m.stop)
+
+    def run_audits(self, with_other=True, **kwargs):
+        # the audits of each hook are created afresh
+        audits = [file_audits.ReadOnly(self.path, **kwargs)]
+        if with_other:
+            audits.append(file_audits.NoReadWriteForOther(self.path))
+        with patch.object(executor, '_run_audit',
+                          wraps=executor._run_audit) as run_audit:
+            executor.run_audits(audits, full_audit_interval=self.INTERVAL)
+        return [type(c[0][0]).__name__ for c in run_audit.call_args_list]
+
+    def test_compliant_skipped(self):
+        self.assertEqual(self.run_audits(),
+                         ['ReadOnly', 'NoReadWriteForOther'])
+        self.assertEqual(self.run_audits(), [])
+        self.assertTrue(self.kv.flushed)
+
+    def test_changed_path_rerun(self):
+        self.run_audits()
+        os.chmod(self.path, 0o640)
+        self.assertEqual(self.run_audits(),
+                         ['ReadOnly', 'NoReadWriteForOther'])
+        self.assertEqual(self.run_audits(), [])
+
+    def test_settings_change_rerun(self):
+        self.run_audits()
+        self.settings = 'other settings'
+        self.assertEqual(self.run_audits(),
+                         ['ReadOnly', 'NoReadWriteForOther'])
+
+    def test_dry_run_non_compliant_not_recorded(self):
+        os.chmod(self.path, 0o622)
+        for _ in range(2):
+            self.assertEqual(
+                self.run_audits(with_other=False, unless=True),
+                ['ReadOnly'])
+            self.assertEqual(self.kv.get(executor.FINGERPRINTS_KEY), {})
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o622)
+        # recorded once compliant
+        os.chmod(self.path, 0o600)
+        self.assertEqual(self.run_audits(with_other=False, unless=True),
+                         ['ReadOnly'])
+        self.assertEqual(self.run_audits(with_other=False, unless=True),
+                         [])
+
+    def test_audit_not_reporting_compliance_not_recorded(self):
+        runs = []
+        for _ in range(2):
+            executor.run_audits(
+                [FakeAudit('a', [self.path], lambda: runs.append('a'))],
+                full_audit_interval=self.INTERVAL)
+        self.assertEqual(runs, ['a', 'a'])
+        self.assertEqual(self.kv.get(executor.FINGERPRINTS_KEY), {})
+
+    def test_full_audit_after_interval(self):
+        self.run_audits()
+        self.now += self.INTERVAL - 1
+        self.assertEqual(self.run_audits(), [])
+        self.now += 1
+        self.assertEqual(self.run_audits(),
+                         ['ReadOnly', 'NoReadWriteForOther'])
+        self.assertEqual(self.kv.get(executor.LAST_FULL_AUDIT_KEY), self.now)
+        self.assertEqual(self.run_audits(), [])
+
+
+class FindSemanticsTestCase(unittest.TestCase):
+    """ReadOnly and NoReadWriteForOther used to shell out to find."""
+
+    MODES = {
+        'g+w': 0o620,
+        'o+w': 0o602,
+        'go+w': 0o622,
+        'o+r': 0o604,
+        'o+rw': 0o606,
+        'owner': 0o600,
+        'sub/go+w': 0o622,
+        'sub/o+r': 0o604,
+        'sub/owner': 0o600,
+    }
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.tree = os.path.join(self.tmp, 'tree')
+        outside = os.path.join(self.tmp, 'outside')
+        for d in (self.tree, os.path.join(self.tree, 'sub'), outside):
+            os.mkdir(d)
+        for name, mode in self.MODES.items():
+            self.touch(os.path.join(self.tree, name), mode)
+        self.touch(os.path.join(outside, 'go+w'), 0o666)
+        os.chmod(os.path.join(self.tree, 'sub'), 0o777)
+        os.symlink(os.path.join(self.tree, 'go+w'),
+                   os.path.join(self.tree, 'file-link'))
+        os.symlink(outside, os.path.join(self.tree, 'dir-link'))
+        self.dir_link = os.path.join(self.tmp, 'dir-link')
+        os.symlink(self.tree, self.dir_link)
+        _m = patch.object(file_audits, 'log')
+        _m.start()
+        self.addCleanup(_m.stop)
+
+    def touch(self, path, mode):
+        with open(path, 'w'):
+            pass
+        os.chmod(path, mode)
+
+    def find(self, path, *args):
+        out = subprocess.check_output(['find', path] + list(args))
+        return sorted(out.decode('UTF-8').split())
+
+    def cases(self):
+        return [self.tree, self.dir_link,
+                os.path.join(self.tree, 'sub'),
+                os.path.join(self.tree, 'file-link')] + [
+            os.path.join(self.tree, name) for name in self.MODES]
+
+    def test_read_only(self):
+        for path in self.cases():
+            found = self.find(path, '-perm', '-go+w', '-type', 'f')
+            self.assertEqual(
+                sorted(file_audits._files_with_mode(
+                    path, file_audits.S_IWGRP | file_audits.S_IWOTH)),
+                found, path)
+            self.assertEqual(
+                file_audits.ReadOnly(path).is_compliant(path), not found,
+                path)
+
+    def test_no_read_write_for_other(self):
+        for path in self.cases():
+            found = self.find(path, '-perm', '-o+r', '-type', 'f', '-o',
+                              '-perm', '-o+w', '-type', 'f')
+            self.assertEqual(
+                sorted(file_audits._files_with_mode(
+                    path, file_audits.S_IROTH | file_audits.S_IWOTH,
+                    all_bits=False)),
+                found, path)
+            self.assertEqual(
+                file_audits.NoReadWriteForOther(path).is_compliant(path),
+                not found, path)
+
+    def test_within_run_audits(self):
+        # the same through the AuditCache of a run
+        results = []
+
+        def check():
+            results.append(
+                file_audits.ReadOnly(self.tree).is_compliant(self.tree))
+
+        with patch.object(executor, 'log'):
+            executor.run_audits([FakeAudit('a', [self.tree], check)])
+        self.assertEqual(results, [False])
+        os.chmod(os.path.join(self.tree, 'go+w'), 0o620)
+        os.chmod(os.path.join(self.tree, 'sub', 'go+w'), 0o620)
+        with patch.object(executor, 'log'):
+            executor.run_audits([FakeAudit('a', [self.tree], check)])
+        self.assertEqual(results, [False, True])
@@ -0,0 +1,201 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch, MagicMock
+
+from charmhelpers.core import health, host
+
+HEADER = ('  sl  local_address rem_address   st tx_queue rx_queue tr '
+          'tm->when retrnsmt   uid  timeout inode\n')
+
+PROC_NET_TCP = HEADER + (
+    # 0.0.0.0:9292
+    '   0: 00000000:244C 00000000:0000 0A 00000000:00000000 00:00000000 '
+    '00000000     0        0 15293 1 0000000000000000 100 0 0 10 0\n'
+    # 127.0.0.1:11211
+    '   1: 0100007F:2BCB 00000000:0000 0A 00000000:00000000 00:00000000 '
+    '00000000   112        0 14851 1 0000000000000000 100 0 0 10 0\n'
+    # 10.0.0.2:9282
+    '   2: 0200000A:2442 00000000:0000 0A 00000000:00000000 00:00000000 '
+    '00000000   116        0 16012 1 0000000000000000 100 0 0 10 0\n'
+    # 10.0.0.2:9191 connected to 10.0.0.3:54321, not listening
+    '   3: 0200000A:23E7 0300000A:D431 01 00000000:00000000 00:00000000 '
+    '00000000   116        0 16013 1 0000000000000000 20 4 30 10 -1\n')
+
+PROC_NET_TCP6 = HEADER + (
+    # [::]:9696
+    '   0: 00000000000000000000000000000000:25E0 '
+    '00000000000000000000000000000000:0000 0A 00000000:00000000 '
+    '00:00000000 00000000     0        0 17001 1 0000000000000000 100 0 0 '
+    '10 0\n'
+    # [2001:db8::5]:80
+    '   1: B80D0120000000000000000005000000:0050 '
+    '00000000000000000000000000000000:0000 0A 00000000:00000000 '
+    '00:00000000 00000000    33        0 17002 1 0000000000000000 100 0 0 '
+    '10 0\n')
+
+
+class ListeningTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.tcp = os.path.join(self.tmp, 'tcp')
+        self.tcp6 = os.path.join(self.tmp, 'tcp6')
+        self.write(self.tcp, PROC_NET_TCP)
+        self.write(self.tcp6, PROC_NET_TCP6)
+        _m = patch.object(health, 'PROC_NET_TCP', [self.tcp, self.tcp6])
+        _m.start()
+        self.addCleanup(_m.stop)
+        health.invalidate()
+        self.addCleanup(health.invalidate)
+
+    def write(self, path, content):
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def test_decode_address(self):
+        self.assertEqual(health._decode_address('0100007F'), '127.0.0.1')
+        self.assertEqual(health._decode_address('0200000A'), '10.0.0.2')
+        self.assertEqual(health._decode_address('0' * 32), '::')
+        self.assertEqual(
+            health._decode_address('00000000000000000000000001000000'),
+            '::1')
+        self.assertEqual(
+            health._decode_address('B80D0120000000000000000005000000'),
+            '2001:db8::5')
+
+    def test_listening_ports(self):
+        self.assertEqual(health.listening_ports(), set([
+            ('0.0.0.0', 9292), ('127.0.0.1', 11211), ('10.0.0.2', 9282),
+            ('::', 9696), ('2001:db8::5', 80)]))
+
+    def test_missing_tcp6(self):
+        os.remove(self.tcp6)
+        self.assertEqual(len(health.listening_ports()), 3)
+
+    def test_port_listening(self):
+        self.assertTrue(health.port_listening(9292))
+        self.assertTrue(health.port_listening('9282'))
+        self.assertFalse(health.port_listening(9191))
+        self.assertFalse(health.port_listening(8080))
+
+    def test_port_listening_address(self):
+        self.assertTrue(health.port_listening(11211, '127.0.0.1'))
+        self.assertFalse(health.port_listening(11211, '10.0.0.2'))
+        self.assertTrue(health.port_listening(11211, '0.0.0.0'))
+        self.assertTrue(health.port_listening(80, '2001:db8::5'))
+        self.assertFalse(health.port_listening(80, '::1'))
+
+    def test_port_listening_wildcard(self):
+        self.assertTrue(health.port_listening(9292, '10.0.0.2'))
+        # the IPv6 wildcard also accepts IPv4 connections
+        self.assertTrue(health.port_listening(9696, '10.0.0.2'))
+        self.assertTrue(health.port_listening(9696, '2001:db8::5'))
+
+    def test_cached_until_invalidated(self):
+        self.assertTrue(health.port_listening(9292))
+        self.write(self.tcp, HEADER)
+        self.assertTrue(health.port_listening(9292))
+        health.invalidate()
+        self.assertFalse(health.port_listening(9292))
+
+
+class ServicesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.systemd = True
+        self.running = {}
+        for name, value in (
+                ('init_is_systemd', lambda: self.systemd),
+                ('service_running', MagicMock(
+                    side_effect=lambda s: self.running.get(s, False)))):
+            _m = patch.object(health, name, value)
+            _m.start()
+            self.addCleanup(_m.stop)
+        _m = patch.object(health.subprocess, 'Popen')
+        self.popen = _m.start()
+        self.addCleanup(_m.stop)
+        health.invalidate()
+        self.addCleanup(health.invalidate)
+
+    def is_active(self, out):
+        self.popen.return_value.communicate.return_value = (out, None)
+
+    def commands(self):
+        return [c[0][0] for c in self.popen.call_args_list]
+
+    def test_one_systemctl_call(self):
+        self.is_active('active\ninactive\nreloading\n')
+        self.assertEqual(
+            health.services_running(['haproxy', 'memcached', 'apache2']),
+            {'haproxy': True, 'memcached': False, 'apache2': True})
+        self.assertEqual(self.commands(), [
+            ['systemctl', 'is-active', 'haproxy', 'memcached', 'apache2']])
+        self.assertFalse(health.service_running.called)
+
+    def test_only_unknown_services_asked(self):
+        self.is_active('active\n')
+        health.services_running(['haproxy'])
+        self.is_active('failed\n')
+        self.assertEqual(health.services_running(['haproxy', 'glance-api']),
+                         {'haproxy': True, 'glance-api': False})
+        self.assertEqual(self.commands(), [
+            ['systemctl', 'is-active', 'haproxy'],
+            ['systemctl', 'is-active', 'glance-api']])
+        self.assertEqual(health.services_running(['glance-api']),
+                         {'glance-api': False})
+        self.assertEqual(len(self.commands()), 2)
+
+    def test_fallback_on_unexpected_output(self):
+        self.is_active('Failed to connect to bus\n')
+        self.running['haproxy'] = True
+        self.assertEqual(health.services_running(['haproxy', 'memcached']),
+                         {'haproxy': True, 'memcached': False})
+        self.assertEqual(health.service_running.call_count, 2)
+
+    def test_fallback_without_systemctl(self):
+        self.popen.side_effect = OSError()
+        self.running['haproxy'] = True
+        self.assertEqual(health.services_running(['haproxy']),
+                         {'haproxy': True})
+
+    def test_not_systemd(self):
+        self.systemd = False
+        self.running['haproxy'] = True
+        self.assertEqual(health.services_running(['haproxy', 'memcached']),
+                         {'haproxy': True, 'memcached': False})
+        self.assertFalse(self.popen.called)
+
+    @patch.object(host.subprocess, 'call')
+    @patch.object(host, 'init_is_systemd')
+    def test_invalidated_by_service(self, init_is_systemd, call):
+        init_is_systemd.return_value = True
+        call.return_value = 0
+        self.is_active('inactive\n')
+        health.services_running(['haproxy'])
+        # querying a service keeps the results
+        host.service('is-active', 'haproxy')
+        host.service('status', 'haproxy')
+        self.is_active('active\n')
+        self.assertEqual(health.services_running(['haproxy']),
+                         {'haproxy': False})
+        host.service('restart', 'haproxy')
+        self.assertEqual(health.services_running(['haproxy']),
+                         {'haproxy': True})
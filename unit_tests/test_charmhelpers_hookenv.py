@@ -0,0 +1,186 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import unittest
+
+from mock import patch
+
+from charmhelpers.core import hookenv
+
+
+class FakeRelations(object):
+    """Relation data of glance/0, related to glance/1 over cluster:1."""
+
+    def __init__(self):
+        self.ids = {'cluster': ['cluster:1']}
+        self.units = {'cluster:1': ['glance/1']}
+        self.settings = {
+            ('cluster:1', 'glance/0'): {'private-address': '10.0.0.1'},
+            ('cluster:1', 'glance/1'): {'private-address': '10.0.0.2'}}
+        self.calls = []
+
+    def relation_ids(self, reltype):
+        self.calls.append(('relation-ids', reltype))
+        return list(self.ids.get(reltype, []))
+
+    def related_units(self, relid=None):
+        self.calls.append(('relation-list', relid))
+        return list(self.units.get(relid, []))
+
+    def relation_get(self, attribute=None, unit=None, rid=None):
+        self.calls.append(('relation-get', rid, unit))
+        return dict(self.settings[(rid, unit)])
+
+    def relation_set(self, relation_id=None, settings=None):
+        self.calls.append(('relation-set', relation_id, settings))
+        current = self.settings[(relation_id, 'glance/0')]
+        for key, value in settings.items():
+            if value is None:
+                current.pop(key, None)
+            else:
+                current[key] = value
+
+    def writes(self):
+        return [c[1:] for c in self.calls if c[0] == 'relation-set']
+
+
+class RelationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.rels = FakeRelations()
+        for name, value in (('_relation_ids', self.rels.relation_ids),
+                            ('_related_units', self.rels.related_units),
+                            ('_relation_get', self.rels.relation_get),
+                            ('_relation_set', self.rels.relation_set),
+                            ('_atexit', [])):
+            _m = patch.object(hookenv, name, value)
+            _m.start()
+            self.addCleanup(_m.stop)
+        _m = patch.dict(os.environ, {'JUJU_UNIT_NAME': 'glance/0'})
+        _m.start()
+        self.addCleanup(_m.stop)
+        os.environ.pop('JUJU_RELATION_ID', None)
+        self.addCleanup(hookenv.relation_write_buffer().stop)
+        self.addCleanup(hookenv.cache.clear)
+        hookenv.cache.clear()
+
+    def run_hook(self, func):
+        hooks = hookenv.Hooks()
+        hooks.register('cluster-relation-changed', func)
+        hooks.execute(['hooks/cluster-relation-changed'])
+
+    def test_snapshot_reads_each_unit_once(self):
+        for _ in range(2):
+            self.assertEqual(
+                hookenv.relation_get('private-address', rid='cluster:1',
+                                     unit='glance/1'), '10.0.0.2')
+            self.assertEqual(
+                hookenv.relation_get(rid='cluster:1', unit='glance/1'),
+                {'private-address': '10.0.0.2'})
+        self.assertEqual(self.rels.calls,
+                         [('relation-get', 'cluster:1', 'glance/1')])
+
+    def test_snapshot_load(self):
+        self.assertEqual(hookenv.relation_snapshot().load(['cluster']), {
+            'cluster': {'cluster:1': {
+                'glance/0': {'private-address': '10.0.0.1'},
+                'glance/1': {'private-address': '10.0.0.2'}}}})
+        hookenv.relation_ids('cluster')
+        hookenv.related_units('cluster:1')
+        self.assertEqual(len(self.rels.calls), 4)
+
+    def test_buffered_writes_coalesced(self):
+        def hook():
+            hookenv.relation_set('cluster:1', {'a': '1', 'b': '1'})
+            hookenv.relation_set('cluster:1', b=2, c=None)
+            # unchanged from the published settings, as is c
+            hookenv.relation_set('cluster:1',
+                                 {'private-address': '10.0.0.1'})
+            self.assertEqual(self.rels.writes(), [])
+
+        self.run_hook(hook)
+        self.assertEqual(self.rels.writes(),
+                         [('cluster:1', {'a': '1', 'b': '2'})])
+
+    def test_buffered_writes_flushed_after_atexit(self):
+        def hook():
+            # registered before the first relation_set, so run after it
+            hookenv.atexit(lambda: self.rels.calls.append(('atexit',)))
+            hookenv.relation_set('cluster:1', a='1')
+
+        self.run_hook(hook)
+        self.assertEqual([c[0] for c in self.rels.calls],
+                         ['relation-get', 'relation-set', 'atexit'])
+        self.assertFalse(hookenv.relation_write_buffer().active)
+
+    def test_buffered_writes_dropped_if_hook_fails(self):
+        def hook():
+            hookenv.relation_set('cluster:1', a='1')
+            raise ValueError('hook failed')
+
+        self.assertRaises(ValueError, self.run_hook, hook)
+        self.assertEqual(self.rels.writes(), [])
+        self.assertEqual(hookenv.relation_write_buffer().pending('cluster:1'),
+                         {})
+
+    def test_read_your_writes(self):
+        def hook():
+            self.assertEqual(
+                hookenv.relation_get('a', rid='cluster:1', unit='glance/0'),
+                None)
+            hookenv.relation_set('cluster:1', a='1', **{
+                'private-address': None})
+            self.assertEqual(
+                hookenv.relation_get(rid='cluster:1', unit='glance/0'),
+                {'a': '1'})
+            # remote units are not affected
+            self.assertEqual(
+                hookenv.relation_get('a', rid='cluster:1', unit='glance/1'),
+                None)
+
+        self.run_hook(hook)
+        self.assertEqual(self.rels.settings[('cluster:1', 'glance/0')],
+                         {'a': '1'})
+
+    def test_unbuffered_write_invalidates_local_unit(self):
+        hookenv.relation_get(rid='cluster:1', unit='glance/0')
+        hookenv.relation_set('cluster:1', a='1')
+        self.assertEqual(self.rels.writes(), [('cluster:1', {'a': '1'})])
+        self.assertEqual(
+            hookenv.relation_get('a', rid='cluster:1', unit='glance/0'), '1')
+
+    def test_invalidate_relid(self):
+        hookenv.relation_get(rid='cluster:1', unit='glance/1')
+        hookenv.relation_ids('cluster')
+        self.rels.settings[('cluster:1', 'glance/1')]['a'] = '1'
+        hookenv.invalidate_relation_snapshot(relid='cluster:1')
+        self.assertEqual(
+            hookenv.relation_get('a', rid='cluster:1', unit='glance/1'), '1')
+        hookenv.relation_ids('cluster')
+        self.assertEqual([c[0] for c in self.rels.calls],
+                         ['relation-get', 'relation-ids', 'relation-get'])
+
+    def test_invalidate_all(self):
+        self.assertEqual(hookenv.relation_ids('cluster'), ['cluster:1'])
+        self.assertEqual(hookenv.related_units('cluster:1'), ['glance/1'])
+        self.rels.ids['cluster'].append('cluster:2')
+        self.rels.units['cluster:1'].append('glance/2')
+        self.assertEqual(hookenv.relation_ids('cluster'), ['cluster:1'])
+        hookenv.invalidate_relation_snapshot()
+        self.assertEqual(hookenv.relation_ids('cluster'),
+                         ['cluster:1', 'cluster:2'])
+        self.assertEqual(hookenv.related_units('cluster:1'),
+                         ['glance/1', 'glance/2'])
+        self.assertEqual(len(self.rels.calls), 4)
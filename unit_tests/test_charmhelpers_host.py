@@ -0,0 +1,119 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch, call
+
+from charmhelpers.core import host
+
+
+class FakeTracker(object):
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.changes = []
+
+    def tracks(self, path):
+        return path in self.paths
+
+    def change_mark(self):
+        return len(self.changes)
+
+    def changed_since(self, mark=0):
+        return self.changes[mark:]
+
+    def write(self, path, content):
+        with open(path, 'w') as f:
+            f.write(content)
+        self.changes.append(path)
+
+
+class RestartOnChangeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.tracked = os.path.join(self.tmp, 'tracked.conf')
+        self.untracked = os.path.join(self.tmp, 'untracked.conf')
+        for path in (self.tracked, self.untracked):
+            with open(path, 'w') as f:
+                f.write('initial')
+        self.restart_map = {
+            self.tracked: ['svc-tracked'],
+            self.untracked: ['svc-untracked'],
+        }
+        self.tracker = FakeTracker([self.tracked])
+        _m = patch.object(host, 'service')
+        self.service = _m.start()
+        self.addCleanup(_m.stop)
+
+    def run_helper(self, f):
+        host.restart_on_change_helper(f, self.restart_map,
+                                      change_tracker=self.tracker)
+        return [c[0][1] for c in self.service.call_args_list]
+
+    def rewrite(self, path, content):
+        st = os.stat(path)
+        with open(path, 'w') as f:
+            f.write(content)
+        # make the write visible on filesystems with coarse timestamps
+        os.utime(path, (st.st_atime, st.st_mtime + 1))
+
+    def test_nothing_changed(self):
+        self.assertEqual(self.run_helper(lambda: None), [])
+
+    def test_reported_change(self):
+        with patch.object(host, 'path_hash', wraps=host.path_hash) as ph:
+            restarted = self.run_helper(
+                lambda: self.tracker.write(self.tracked, 'new'))
+        self.assertEqual(restarted, ['svc-tracked'])
+        # tracked paths are never hashed
+        self.assertNotIn(call(self.tracked), ph.call_args_list)
+
+    def test_tracked_unchanged_not_hashed(self):
+        with patch.object(host, 'path_hash', wraps=host.path_hash) as ph:
+            self.run_helper(lambda: None)
+        self.assertNotIn(call(self.tracked), ph.call_args_list)
+        self.assertEqual(ph.call_args_list.count(call(self.untracked)), 2)
+
+    def test_tracked_written_elsewhere(self):
+        restarted = self.run_helper(
+            lambda: self.rewrite(self.tracked, 'other'))
+        self.assertEqual(restarted, ['svc-tracked'])
+
+    def test_tracked_rewritten_with_same_content(self):
+        # without a checksum from before the hook this counts as changed
+        restarted = self.run_helper(
+            lambda: self.rewrite(self.tracked, 'initial'))
+        self.assertEqual(restarted, ['svc-tracked'])
+
+    def test_untracked_rewritten_with_same_content(self):
+        restarted = self.run_helper(
+            lambda: self.rewrite(self.untracked, 'initial'))
+        self.assertEqual(restarted, [])
+
+    def test_untracked_change(self):
+        restarted = self.run_helper(
+            lambda: self.rewrite(self.untracked, 'other'))
+        self.assertEqual(restarted, ['svc-untracked'])
+
+    def test_no_tracker(self):
+        self.tracker = None
+        restarted = self.run_helper(
+            lambda: self.rewrite(self.tracked, 'other'))
+        self.assertEqual(restarted, ['svc-tracked'])
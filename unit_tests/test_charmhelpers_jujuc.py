@@ -0,0 +1,273 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+import unittest
+
+from mock import patch
+
+from charmhelpers.core import hookenv, jujuc
+
+
+class GobTestCase(unittest.TestCase):
+
+    def roundtrip(self, schema, value, count=1):
+        messages = []
+        encoder = jujuc.Encoder(messages.append)
+        for _ in range(count):
+            encoder.encode(schema, value)
+        stream = jujuc._Reader(b''.join(messages))
+        decoder = jujuc.Decoder(stream.read)
+        return [decoder.decode() for _ in range(count)], messages
+
+    def test_integers(self):
+        for value in (0, 1, 127, 128, 255, 256, 2 ** 40):
+            self.assertEqual(
+                jujuc._Reader(jujuc._encode_uint(value)).uint(), value)
+        for value in (0, 1, -1, 63, -64, 2 ** 40, -2 ** 40):
+            self.assertEqual(
+                jujuc._Reader(jujuc._encode_int(value)).int(), value)
+        # gob encodes values below 128 in a single byte
+        self.assertEqual(jujuc._encode_uint(127), b'\x7f')
+        self.assertEqual(jujuc._encode_uint(256), b'\xfe\x01\x00')
+
+    def test_request(self):
+        request = {
+            'ContextId': 'glance/0-config-changed-1',
+            'Dir': '/var/lib/juju',
+            'CommandName': 'relation-get',
+            'Args': ['--format=json', '-r', 'db:1', '-', u'mysql/0'],
+            'StdinSet': True,
+            'Stdin': b'\x00\xff',
+            'Token': '',
+        }
+        values, _ = self.roundtrip(jujuc.JUJUC_REQUEST, request)
+        # zero values are not sent
+        del request['Token']
+        self.assertEqual(values, [request])
+
+    def test_zero_values_omitted(self):
+        values, _ = self.roundtrip(jujuc.JUJUC_RESPONSE,
+                                   {'Code': 0, 'Stdout': b'', 'Stderr': b''})
+        self.assertEqual(values, [{}])
+        values, _ = self.roundtrip(jujuc.JUJUC_RESPONSE,
+                                   {'Code': -2, 'Stdout': b'out'})
+        self.assertEqual(values, [{'Code': -2, 'Stdout': b'out'}])
+
+    def test_types_sent_once(self):
+        response = {'Code': 1, 'Stdout': b'out', 'Stderr': b'err'}
+        values, messages = self.roundtrip(jujuc.JUJUC_RESPONSE, response,
+                                          count=2)
+        self.assertEqual(values, [response, response])
+        # one type definition, then the two values
+        self.assertEqual(len(messages), 3)
+        self.assertEqual(messages[1], messages[2])
+
+    def test_non_struct_value(self):
+        values, _ = self.roundtrip(('slice', '[]string', jujuc.STRING),
+                                   [u'a', u'b\xe9'])
+        self.assertEqual(values, [[u'a', u'b\xe9']])
+
+    def test_unknown_type(self):
+        messages = []
+        jujuc.Encoder(messages.append).encode(jujuc.RPC_REQUEST, {
+            'ServiceMethod': jujuc.JUJUC_SERVICE_METHOD, 'Seq': 1})
+        # drop the type definition
+        stream = jujuc._Reader(b''.join(messages[1:]))
+        self.assertRaises(jujuc.GobError,
+                          jujuc.Decoder(stream.read).decode)
+
+    def test_truncated(self):
+        messages = []
+        jujuc.Encoder(messages.append).encode(jujuc.RPC_REQUEST, {
+            'ServiceMethod': jujuc.JUJUC_SERVICE_METHOD, 'Seq': 1})
+        stream = jujuc._Reader(b''.join(messages)[:-3])
+        self.assertRaises(jujuc.GobError,
+                          jujuc.Decoder(stream.read).decode)
+
+
+class FakeTools(object):
+    """Hook tools of a unit related to mysql/0 over db:1."""
+
+    def __init__(self):
+        self.calls = []
+        self.config = {'debug': True, 'workers': 4}
+        self.settings = {'db:1': {'mysql/0': {'host': '10.0.0.1'}}}
+        self.code = 0
+
+    def __call__(self, command, args, stdin):
+        self.calls.append([command] + list(args))
+        if self.code:
+            return self.code, b'failed out', b'failed err'
+        if command == 'config-get':
+            value = (self.config if args[0] == '--all'
+                     else self.config[args[0]])
+            return 0, json.dumps(value).encode('UTF-8'), b''
+        if command == 'relation-get':
+            rid = args[args.index('-r') + 1]
+            settings = self.settings[rid][args[-1]]
+            return 0, json.dumps(settings).encode('UTF-8'), b''
+        return 0, b'', b''
+
+
+class JujucTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.path = os.path.join(self.tmp, 'agent.socket')
+        self.tools = FakeTools()
+        self.server = jujuc.StandInServer(self.path, self.tools,
+                                          context_id='glance/0-hook-1')
+        for name, value in (('_client', None), ('_disabled', False)):
+            _m = patch.object(jujuc, name, value)
+            _m.start()
+            self.addCleanup(_m.stop)
+        environ = dict(self.server.environ(), JUJU_UNIT_NAME='glance/0')
+        _m = patch.dict(os.environ, environ)
+        _m.start()
+        self.addCleanup(_m.stop)
+        self.addCleanup(jujuc.disable)
+        self.addCleanup(hookenv.cache.clear)
+        hookenv.cache.clear()
+
+    def start(self):
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+    def test_hook_tools_roundtrip(self):
+        self.start()
+        self.assertEqual(hookenv.config('workers'), 4)
+        self.assertEqual(hookenv.relation_get('host', rid='db:1',
+                                              unit='mysql/0'), '10.0.0.1')
+        hookenv.status_set('active', 'Unit is ready')
+        self.assertEqual(self.tools.calls, [
+            ['config-get', 'workers', '--format=json'],
+            ['relation-get', '--format=json', '-r', 'db:1', '-', 'mysql/0'],
+            ['status-set', 'active', 'Unit is ready']])
+
+    def test_persistent_connection(self):
+        self.start()
+        with patch.object(jujuc.JujucClient, '_connect',
+                          autospec=True,
+                          side_effect=jujuc.JujucClient._connect) as connect:
+            for _ in range(3):
+                jujuc.check_call(['status-set', 'active', ''])
+        self.assertEqual(connect.call_count, 1)
+        self.assertEqual(len(self.tools.calls), 3)
+
+    def test_error_maps_to_called_process_error(self):
+        self.start()
+        self.tools.code = 2
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            jujuc.check_output(['relation-get', '-r', 'db:1', '-',
+                                'mysql/0'])
+        self.assertEqual(cm.exception.returncode, 2)
+        self.assertEqual(cm.exception.output, b'failed out')
+        with patch.object(jujuc.sys, 'stdout'), \
+                patch.object(jujuc.sys, 'stderr'):
+            self.assertEqual(jujuc.call(['status-set', 'active', '']), 2)
+            self.assertRaises(subprocess.CalledProcessError,
+                              jujuc.check_call, ['status-set', 'active', ''])
+        # a failing tool does not disable the client
+        self.assertIsNotNone(jujuc.client())
+
+    def test_stderr_to_stdout(self):
+        self.start()
+        self.tools.code = 1
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            jujuc.check_output(['config-get'], stderr=subprocess.STDOUT)
+        self.assertEqual(cm.exception.output, b'failed outfailed err')
+
+    @patch.object(jujuc.subprocess, 'check_output')
+    def test_fallback_socket_missing(self, check_output):
+        check_output.return_value = b'8'
+        self.assertEqual(hookenv.config('workers'), 8)
+        check_output.assert_called_once_with(
+            ['config-get', 'workers', '--format=json'])
+        # further calls go straight to subprocesses
+        self.assertIsNone(jujuc.client())
+
+    @patch.object(jujuc.subprocess, 'check_output')
+    def test_fallback_socket_refused(self, check_output):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        sock.close()
+        check_output.return_value = b'out'
+        self.assertEqual(jujuc.check_output(['config-get']), b'out')
+        self.assertIsNone(jujuc.client())
+
+    @patch.object(jujuc.subprocess, 'call')
+    def test_fallback_rejected_context(self, call):
+        self.start()
+        call.return_value = 0
+        with patch.dict(os.environ, {'JUJU_CONTEXT_ID': 'other'}):
+            self.assertEqual(jujuc.call(['status-set', 'active', '']), 0)
+        call.assert_called_once_with(['status-set', 'active', ''])
+        self.assertEqual(self.tools.calls, [])
+
+    @patch.object(jujuc.subprocess, 'call')
+    def test_fallback_request_not_sent(self, call):
+        self.start()
+        call.return_value = 0
+        with patch.object(jujuc.Encoder, 'encode',
+                          side_effect=socket.error('Broken pipe')):
+            self.assertEqual(jujuc.call(['status-set', 'active', '']), 0)
+        call.assert_called_once_with(['status-set', 'active', ''])
+        self.assertEqual(self.tools.calls, [])
+
+    @patch.object(jujuc.subprocess, 'call')
+    def test_no_fallback_after_request_sent(self, call):
+        self.start()
+        jujuc.check_call(['status-set', 'active', ''])
+
+        def reset():
+            # the agent runs the tool but the response is lost
+            for _ in range(500):
+                if len(self.tools.calls) == 2:
+                    break
+                time.sleep(0.01)
+            raise socket.error('Connection reset')
+
+        with patch.object(jujuc.client()._conn.decoder, 'decode',
+                          side_effect=reset):
+            self.assertRaises(jujuc.ResponseLost, jujuc.call,
+                              ['juju-reboot'])
+        self.assertFalse(call.called)
+        # the tool is not run again, and the next call reconnects
+        jujuc.check_call(['status-set', 'active', ''])
+        self.assertEqual(self.tools.calls, [
+            ['status-set', 'active', ''], ['juju-reboot'],
+            ['status-set', 'active', '']])
+
+    @patch.object(jujuc.subprocess, 'check_output')
+    def test_fallback_outside_hook(self, check_output):
+        self.start()
+        with patch.dict(os.environ, {'JUJU_CONTEXT_ID': ''}):
+            jujuc.check_output(['config-get'])
+        check_output.assert_called_once_with(['config-get'])
+        self.assertEqual(self.tools.calls, [])
+
+    @patch.object(jujuc.subprocess, 'check_output')
+    def test_fallback_unsupported_arguments(self, check_output):
+        self.start()
+        jujuc.check_output(['config-get'], cwd='/')
+        check_output.assert_called_once_with(['config-get'], cwd='/')
+        self.assertEqual(self.tools.calls, [])
@@ -0,0 +1,163 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch, MagicMock
+
+from charmhelpers.contrib.charmsupport import nrpe
+from charmhelpers.core import unitdata
+
+
+class ManifestTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.confdir = os.path.join(self.tmp, 'nrpe.d')
+        self.exportdir = os.path.join(self.tmp, 'export')
+        os.mkdir(self.confdir)
+        os.mkdir(self.exportdir)
+        for name, path in (('nrpe_confdir', self.confdir),
+                           ('nagios_exportdir', self.exportdir),
+                           ('nagios_logdir', self.tmp)):
+            _m = patch.object(nrpe.NRPE, name, path)
+            _m.start()
+            self.addCleanup(_m.stop)
+        self.db = unitdata.Storage(os.path.join(self.tmp, 'state.db'))
+        self.addCleanup(self.db.close)
+        self.exit_callbacks = []
+        for name, value in (
+                ('config', lambda: {'nagios_context': 'juju',
+                                    'nagios_servicegroups': ''}),
+                ('local_unit', lambda: 'glance/0'),
+                ('relation_ids', lambda r: []),
+                ('relations_of_type', lambda r: []),
+                ('hook_name', lambda: 'config-changed'),
+                ('log', lambda *args, **kwargs: None),
+                ('atexit', self.exit_callbacks.append),
+                ('pwd', MagicMock()),
+                ('grp', MagicMock())):
+            _m = patch.object(nrpe, name, value)
+            _m.start()
+            self.addCleanup(_m.stop)
+        _m = patch.object(nrpe.unitdata, 'kv', lambda: self.db)
+        _m.start()
+        self.addCleanup(_m.stop)
+        _m = patch.object(nrpe.Check, '_locate_cmd',
+                          lambda self, check_cmd: check_cmd)
+        _m.start()
+        self.addCleanup(_m.stop)
+        _m = patch.object(nrpe, 'service')
+        self.service = _m.start()
+        self.addCleanup(_m.stop)
+
+    def write(self, checks, hostname=None):
+        self.service.reset_mock()
+        compat = nrpe.NRPE(hostname=hostname)
+        for shortname, cmd in checks:
+            compat.add_check(shortname=shortname,
+                             description='check {}'.format(shortname),
+                             check_cmd=cmd)
+        compat.write()
+        return self.service.called
+
+    def check_file(self, command):
+        return os.path.join(self.confdir, '{}.cfg'.format(command))
+
+    def service_file(self, hostname, command):
+        return os.path.join(self.exportdir, 'service__{}_{}.cfg'.format(
+            hostname, command))
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_first_write(self):
+        self.assertTrue(self.write([('disk', 'check_disk -w 10')]))
+        self.assertIn('command[check_disk]=',
+                      self.read(self.check_file('check_disk')))
+        self.assertIn('juju-glance-0[disk] check disk',
+                      self.read(self.service_file('juju-glance-0',
+                                                  'check_disk')))
+        manifest = self.db.get(nrpe.NRPE_MANIFEST_KEY)
+        self.assertEqual(sorted(manifest['check_disk']), sorted([
+            self.check_file('check_disk'),
+            self.service_file('juju-glance-0', 'check_disk')]))
+
+    def test_unchanged_not_rewritten(self):
+        self.write([('disk', 'check_disk -w 10')])
+        with patch.object(nrpe, 'open', create=True) as _open:
+            self.assertFalse(self.write([('disk', 'check_disk -w 10')]))
+        self.assertFalse(_open.called)
+
+    def test_changed_check_rewritten(self):
+        self.write([('disk', 'check_disk -w 10'), ('load', 'check_load')])
+        load = self.read(self.check_file('check_load'))
+        self.assertTrue(self.write([('disk', 'check_disk -w 20'),
+                                    ('load', 'check_load')]))
+        self.assertIn('check_disk -w 20',
+                      self.read(self.check_file('check_disk')))
+        self.assertEqual(self.read(self.check_file('check_load')), load)
+
+    def test_missing_file_rewritten(self):
+        self.write([('disk', 'check_disk -w 10')])
+        os.remove(self.check_file('check_disk'))
+        self.assertTrue(self.write([('disk', 'check_disk -w 10')]))
+        self.assertTrue(os.path.exists(self.check_file('check_disk')))
+
+    def test_hostname_change_removes_old_service(self):
+        self.write([('disk', 'check_disk -w 10')])
+        self.assertTrue(self.write([('disk', 'check_disk -w 10')],
+                                   hostname='other'))
+        self.assertFalse(os.path.exists(
+            self.service_file('juju-glance-0', 'check_disk')))
+        self.assertTrue(os.path.exists(
+            self.service_file('other', 'check_disk')))
+
+    def test_unrecorded_check_removes_stale_services(self):
+        stale = self.service_file('old-host', 'check_disk')
+        unrelated = self.service_file('old-host', 'check_load')
+        for path in (stale, unrelated):
+            with open(path, 'w') as f:
+                f.write('stale')
+        self.write([('disk', 'check_disk -w 10')])
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(unrelated))
+        self.assertTrue(os.path.exists(
+            self.service_file('juju-glance-0', 'check_disk')))
+
+    def test_update_status_does_not_restart(self):
+        with patch.object(nrpe, 'hook_name', lambda: 'update-status'):
+            self.assertFalse(self.write([('disk', 'check_disk -w 10')]))
+        self.assertTrue(os.path.exists(self.check_file('check_disk')))
+
+    def test_remove_check(self):
+        self.write([('disk', 'check_disk -w 10'), ('load', 'check_load')])
+        nrpe.NRPE().remove_check(shortname='disk')
+        self.assertFalse(os.path.exists(self.check_file('check_disk')))
+        self.assertFalse(os.path.exists(
+            self.service_file('juju-glance-0', 'check_disk')))
+        self.assertEqual(sorted(self.db.get(nrpe.NRPE_MANIFEST_KEY)),
+                         ['check_load'])
+
+    def test_manifest_flushed_at_exit(self):
+        self.write([('disk', 'check_disk -w 10')])
+        self.assertEqual(self.exit_callbacks, [self.db.flush])
+        # nothing is committed until the hook exits
+        self.db.flush(False)
+        self.assertIsNone(self.db.get(nrpe.NRPE_MANIFEST_KEY))
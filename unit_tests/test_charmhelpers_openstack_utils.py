@@ -0,0 +1,131 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from collections import OrderedDict
+
+from mock import MagicMock, patch
+
+from charmhelpers.contrib.openstack import utils
+
+from test_utils import SimpleKV
+
+
+class CodenameCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.kv = SimpleKV()
+        self.stamp = (1000.0, 4096)
+        self.installed = {'glance-common': '2:12.0.0-0ubuntu1'}
+        self.exit_callbacks = []
+        for name, value in (
+                ('snap_install_requested', lambda: False),
+                ('dpkg_status_stamp', lambda: self.stamp),
+                ('dpkg_status', lambda: self.installed),
+                ('atexit', self.exit_callbacks.append)):
+            _m = patch.object(utils, name, value)
+            _m.start()
+            self.addCleanup(_m.stop)
+        _m = patch.object(utils.unitdata, 'kv', lambda: self.kv)
+        _m.start()
+        self.addCleanup(_m.stop)
+
+    def codename(self, package='glance-common'):
+        with patch.object(utils, '_get_os_codename_package',
+                          wraps=utils._get_os_codename_package) as get:
+            codename = utils.get_os_codename_package(package, fatal=False)
+        return codename, get.call_count
+
+    def test_cached_until_stamp_changes(self):
+        self.assertEqual(self.codename(), ('mitaka', 1))
+        self.assertEqual(self.exit_callbacks, [self.kv.flush])
+        self.assertFalse(self.kv.flushed)
+        self.assertEqual(self.kv.get(utils.OS_CODENAME_CACHE_KEY), {
+            'stamp': [1000.0, 4096],
+            'codenames': {'glance-common': 'mitaka'}})
+        # dpkg is not consulted while its status file is unchanged
+        self.installed['glance-common'] = '2:13.0.0-0ubuntu1'
+        self.assertEqual(self.codename(), ('mitaka', 0))
+        self.stamp = (1001.0, 4096)
+        self.assertEqual(self.codename(), ('newton', 1))
+        self.assertEqual(self.kv.get(utils.OS_CODENAME_CACHE_KEY), {
+            'stamp': [1001.0, 4096],
+            'codenames': {'glance-common': 'newton'}})
+
+    def test_unknown_not_cached(self):
+        self.assertEqual(self.codename('glance-api'), (None, 1))
+        self.assertEqual(self.codename('glance-api'), (None, 1))
+        self.assertIsNone(self.kv.get(utils.OS_CODENAME_CACHE_KEY))
+        self.assertEqual(self.exit_callbacks, [])
+
+    def test_no_dpkg_status(self):
+        self.stamp = None
+        self.assertEqual(self.codename(), ('mitaka', 1))
+        self.assertEqual(self.codename(), ('mitaka', 1))
+        self.assertIsNone(self.kv.get(utils.OS_CODENAME_CACHE_KEY))
+
+
+class PausableRollingRestartTestCase(unittest.TestCase):
+
+    RESTART_MAP = OrderedDict([
+        ('/etc/glance/glance-api.conf', ['glance-api']),
+        ('/etc/haproxy/haproxy.cfg', ['haproxy'])])
+
+    def setUp(self):
+        self.restarted = []
+        for name, value in (
+                ('is_unit_paused_set', lambda: False),
+                ('restart_on_change_helper', self.restart_on_change_helper),
+                ('rolling_restart', MagicMock())):
+            _m = patch.object(utils, name, value)
+            _m.start()
+            self.addCleanup(_m.stop)
+
+    def restart_on_change_helper(self, lambda_f, restart_map, stopstart,
+                                 restart_functions, change_tracker):
+        # every file changes
+        r = lambda_f()
+        for services in restart_map.values():
+            for service_name in services:
+                if service_name in restart_functions:
+                    restart_functions[service_name](service_name)
+                else:
+                    self.restarted.append(service_name)
+        return r
+
+    def hook(self, **kwargs):
+        @utils.pausable_rolling_restart_on_change(
+            self.RESTART_MAP, lambda: True, batch=2, timeout=lambda: 60,
+            **kwargs)
+        def hook():
+            return 'done'
+        return hook()
+
+    def test_all_services_rolling(self):
+        self.assertEqual(self.hook(), 'done')
+        self.assertEqual(self.restarted, [])
+        args = utils.rolling_restart.call_args[0]
+        self.assertEqual(args[0], ['glance-api', 'haproxy'])
+        self.assertEqual(args[2:], (False, 2, 60, 'cluster', None))
+
+    def test_rolling_services(self):
+        restart = MagicMock()
+        self.hook(rolling_services=['glance-api'],
+                  restart_functions={'glance-api': restart,
+                                     'haproxy': restart})
+        # haproxy restarts at once, with its restart function
+        restart.assert_called_once_with('haproxy')
+        self.assertEqual(self.restarted, [])
+        self.assertEqual(utils.rolling_restart.call_args[0][0],
+                         ['glance-api'])
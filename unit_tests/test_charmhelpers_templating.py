@@ -0,0 +1,375 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from mock import patch
+
+from charmhelpers.contrib.openstack import templating
+
+from test_utils import SimpleKV
+
+
+class FakeContext(object):
+    interfaces = []
+
+    def __init__(self, ctxt):
+        self.ctxt = ctxt
+
+    def __call__(self):
+        return dict(self.ctxt)
+
+
+class RendererTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.templates = os.path.join(self.tmp, 'templates')
+        os.mkdir(self.templates)
+        self.write_template('app.conf', 'value = {{ value }}\n')
+        self.config_file = os.path.join(self.tmp, 'app.conf')
+        self.kv = SimpleKV()
+        for name, value in (('kv', lambda: self.kv),
+                            ('atexit', lambda f: None),
+                            ('log', lambda *a, **kw: None),
+                            ('charm_dir', lambda: None)):
+            _m = patch.object(templating, name, value)
+            _m.start()
+            self.addCleanup(_m.stop)
+        self.ctxt = FakeContext({'value': 1})
+
+    def write_template(self, name, content):
+        with open(os.path.join(self.templates, name), 'w') as f:
+            f.write(content)
+
+    def renderer(self):
+        renderer = templating.OSConfigRenderer(self.templates, 'mitaka')
+        renderer.register(self.config_file, [self.ctxt])
+        return renderer
+
+    def read(self):
+        with open(self.config_file) as f:
+            return f.read()
+
+    def test_write_reports_change(self):
+        renderer = self.renderer()
+        mark = renderer.change_mark()
+        self.assertTrue(renderer.write(self.config_file))
+        self.assertEqual(self.read(), 'value = 1')
+        self.assertEqual(renderer.changed_since(mark), [self.config_file])
+        self.assertTrue(renderer.tracks(self.config_file))
+        self.assertFalse(renderer.tracks('/etc/other.conf'))
+
+    def test_unchanged_render_skipped(self):
+        self.renderer().write(self.config_file)
+        renderer = self.renderer()
+        mark = renderer.change_mark()
+        with patch.object(renderer, '_get_template') as get_template:
+            self.assertFalse(renderer.write(self.config_file))
+        self.assertFalse(get_template.called)
+        self.assertEqual(renderer.changed_since(mark), [])
+
+    def test_context_change_rerenders(self):
+        self.renderer().write(self.config_file)
+        self.ctxt.ctxt = {'value': 2}
+        renderer = self.renderer()
+        self.assertTrue(renderer.write(self.config_file))
+        self.assertEqual(self.read(), 'value = 2')
+
+    def test_template_change_rerenders(self):
+        self.renderer().write(self.config_file)
+        self.write_template('app.conf', 'value: {{ value }}\n')
+        renderer = self.renderer()
+        self.assertTrue(renderer.write(self.config_file))
+        self.assertEqual(self.read(), 'value: 1')
+
+    def test_modified_file_rewritten(self):
+        self.renderer().write(self.config_file)
+        with open(self.config_file, 'w') as f:
+            f.write('edited\n')
+        renderer = self.renderer()
+        self.assertTrue(renderer.write(self.config_file))
+        self.assertEqual(self.read(), 'value = 1')
+
+    def test_same_output_not_rewritten(self):
+        self.renderer().write(self.config_file)
+        # a new context key the template does not use renders the same
+        self.ctxt.ctxt = {'value': 1, 'unused': True}
+        renderer = self.renderer()
+        mark = renderer.change_mark()
+        st = os.stat(self.config_file)
+        self.assertFalse(renderer.write(self.config_file))
+        self.assertEqual(os.stat(self.config_file).st_mtime, st.st_mtime)
+        self.assertEqual(renderer.changed_since(mark), [])
+
+
+class CountingContext(object):
+    interfaces = []
+    thread_safe = False
+
+    def __init__(self, name, ctxt=None):
+        self.name = name
+        self.ctxt = {name: True} if ctxt is None else ctxt
+        self.calls = []
+
+    def __call__(self):
+        self.calls.append(threading.current_thread().name)
+        return self.ctxt
+
+
+class ThreadSafeContext(CountingContext):
+    thread_safe = True
+
+
+class ContextSchedulerTestCase(unittest.TestCase):
+
+    def test_add_deduplicates_equivalent_generators(self):
+        scheduler = templating.ContextScheduler()
+        first = scheduler.add(CountingContext('a'))
+        self.assertIs(scheduler.add(CountingContext('a')), first)
+        self.assertIsNot(scheduler.add(CountingContext('b')), first)
+        self.assertIsNot(scheduler.add(ThreadSafeContext('a')), first)
+
+    def test_add_functions_by_identity(self):
+        scheduler = templating.ContextScheduler()
+
+        def ctxt():
+            return {}
+
+        def other():
+            return {}
+
+        self.assertIs(scheduler.add(ctxt), ctxt)
+        self.assertIs(scheduler.add(ctxt), ctxt)
+        self.assertIs(scheduler.add(other), other)
+
+    def test_shared_generator_evaluated_once(self):
+        renderer = templating.OSConfigRenderer.__new__(
+            templating.OSConfigRenderer)
+        renderer.scheduler = templating.ContextScheduler()
+        renderer.templates = {}
+        with patch.object(templating, 'log'):
+            for config_file in ('/etc/a.conf', '/etc/b.conf'):
+                renderer.register(config_file, [CountingContext('shared')])
+        contexts = [t.contexts[0] for t in renderer.templates.values()]
+        self.assertIs(contexts[0], contexts[1])
+        with renderer.scheduler.batch():
+            for template in renderer.templates.values():
+                self.assertEqual(template.context(), {'shared': True})
+        self.assertEqual(len(contexts[0].calls), 1)
+
+    def test_evaluate_preserves_order(self):
+        scheduler = templating.ContextScheduler(max_workers=4)
+        generators = [ThreadSafeContext('a'), CountingContext('b'),
+                      ThreadSafeContext('c'), CountingContext('d')]
+        self.assertEqual(scheduler.evaluate(generators),
+                         [g.ctxt for g in generators])
+
+    def test_thread_safe_generators_use_pool(self):
+        scheduler = templating.ContextScheduler(max_workers=4)
+        safe = [ThreadSafeContext(str(i)) for i in range(3)]
+        unsafe = CountingContext('unsafe')
+        scheduler.evaluate(safe + [unsafe])
+        main = threading.current_thread().name
+        self.assertEqual(unsafe.calls, [main])
+        for g in safe:
+            self.assertEqual(len(g.calls), 1)
+            self.assertNotEqual(g.calls[0], main)
+
+    def test_serial_with_one_worker(self):
+        scheduler = templating.ContextScheduler(max_workers=1)
+        safe = [ThreadSafeContext(str(i)) for i in range(3)]
+        with patch.object(templating, 'ThreadPool') as pool:
+            scheduler.evaluate(safe)
+        self.assertFalse(pool.called)
+        main = threading.current_thread().name
+        for g in safe:
+            self.assertEqual(g.calls, [main])
+
+    def test_single_thread_safe_generator_not_pooled(self):
+        scheduler = templating.ContextScheduler(max_workers=4)
+        with patch.object(templating, 'ThreadPool') as pool:
+            scheduler.evaluate([ThreadSafeContext('a'),
+                                CountingContext('b')])
+        self.assertFalse(pool.called)
+
+    def test_memoized_until_invalidated(self):
+        scheduler = templating.ContextScheduler()
+        g = CountingContext('a')
+        with scheduler.batch():
+            scheduler.evaluate([g])
+            scheduler.evaluate([g])
+            self.assertEqual(len(g.calls), 1)
+            scheduler.invalidate()
+            scheduler.evaluate([g])
+        self.assertEqual(len(g.calls), 2)
+
+    def test_reevaluated_outside_batch(self):
+        scheduler = templating.ContextScheduler()
+        g = CountingContext('a')
+        self.assertEqual(scheduler.evaluate([g]), [{'a': True}])
+        # eg after a leader_set or relation_set in the hook
+        g.ctxt = {'a': False}
+        self.assertEqual(scheduler.evaluate([g]), [{'a': False}])
+        self.assertEqual(len(g.calls), 2)
+
+    def test_empty_contexts_evaluated_once_per_batch(self):
+        scheduler = templating.ContextScheduler()
+        g = CountingContext('a', ctxt={})
+        with scheduler.batch():
+            scheduler.evaluate([g])
+            with scheduler.batch():
+                scheduler.evaluate([g])
+            scheduler.evaluate([g])
+        self.assertEqual(len(g.calls), 1)
+        scheduler.evaluate([g])
+        self.assertEqual(len(g.calls), 2)
+
+    def test_renderer_invalidation(self):
+        renderer = templating.OSConfigRenderer.__new__(
+            templating.OSConfigRenderer)
+        renderer.scheduler = templating.ContextScheduler()
+        renderer.templates = {}
+        g = CountingContext('a')
+        with patch.object(templating, 'log'):
+            renderer.register('/etc/a.conf', [g])
+        with renderer.scheduler.batch():
+            renderer.templates['/etc/a.conf'].context()
+            renderer.templates['/etc/a.conf'].context()
+            self.assertEqual(len(g.calls), 1)
+            renderer.invalidate_contexts()
+            renderer.templates['/etc/a.conf'].context()
+        self.assertEqual(len(g.calls), 2)
+
+
+class LoaderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.templates = os.path.join(self.tmp, 'templates')
+        for release in ('icehouse', 'mitaka', 'newton'):
+            os.makedirs(os.path.join(self.templates, release))
+        self.write('app.conf', 'base')
+        self.write('icehouse/app.conf', 'icehouse')
+        self.write('mitaka/app.conf', 'mitaka {{ value }}')
+        self.write('newton/app.conf', 'newton')
+        self.kv = SimpleKV()
+        for name, value in (('kv', lambda: self.kv),
+                            ('atexit', lambda f: None),
+                            ('log', lambda *a, **kw: None)):
+            _m = patch.object(templating, name, value)
+            _m.start()
+            self.addCleanup(_m.stop)
+        self.helper = os.path.join(os.path.dirname(templating.__file__),
+                                   'templates')
+
+    def write(self, name, content):
+        with open(os.path.join(self.templates, name), 'w') as f:
+            f.write(content)
+
+    def render(self, loader, name='app.conf'):
+        return templating.Environment(loader=loader).get_template(
+            name).render(value=1)
+
+    def test_loader_order(self):
+        loader = templating.get_loader(self.templates, 'mitaka')
+        self.assertEqual(
+            [l.searchpath for l in loader.loaders],
+            [[os.path.join(self.templates, 'mitaka')],
+             [os.path.join(self.templates, 'icehouse')],
+             [self.templates],
+             [self.helper]])
+        self.assertEqual(self.render(loader), 'mitaka 1')
+
+    def test_loader_older_release(self):
+        loader = templating.get_loader(self.templates, 'juno')
+        self.assertEqual(
+            [l.searchpath for l in loader.loaders],
+            [[os.path.join(self.templates, 'icehouse')],
+             [self.templates],
+             [self.helper]])
+        self.assertEqual(self.render(loader), 'icehouse')
+
+    def test_precompiled_loader_used(self):
+        templating.precompile_templates(self.templates)
+        loader = templating.get_loader(self.templates, 'mitaka')
+        for l in loader.loaders:
+            self.assertIsInstance(l, templating.PrecompiledLoader)
+        self.assertEqual(self.render(loader), 'mitaka 1')
+
+    def test_precompiled_check_recorded(self):
+        templating.precompile_templates(self.templates)
+        templating.get_loader(self.templates, 'mitaka')
+        with patch.object(templating, '_template_manifest') as manifest:
+            loader = templating.get_loader(self.templates, 'mitaka')
+        self.assertFalse(manifest.called)
+        self.assertIsInstance(loader.loaders[0],
+                              templating.PrecompiledLoader)
+
+    def test_precompiled_check_not_written_to_templates(self):
+        templating.precompile_templates(self.templates)
+        compiled = os.path.join(self.templates,
+                                templating.COMPILED_TEMPLATES_DIR)
+        before = sorted(os.walk(compiled))
+        templating.get_loader(self.templates, 'mitaka')
+        self.assertEqual(sorted(os.walk(compiled)), before)
+        self.assertIn(os.path.join(compiled, 'mitaka'),
+                      self.kv.get(templating.COMPILED_CHECKS_KEY))
+
+    def test_precompiled_stale_after_change(self):
+        templating.precompile_templates(self.templates)
+        templating.get_loader(self.templates, 'mitaka')
+        self.write('mitaka/app.conf', 'changed {{ value }}')
+        loader = templating.get_loader(self.templates, 'mitaka')
+        self.assertNotIsInstance(loader.loaders[0],
+                                 templating.PrecompiledLoader)
+        self.assertIsInstance(loader.loaders[1],
+                              templating.PrecompiledLoader)
+        self.assertEqual(self.render(loader), 'changed 1')
+        # the outcome is recorded for the changed sources too
+        with patch.object(templating, '_template_manifest') as manifest:
+            templating.get_loader(self.templates, 'mitaka')
+        self.assertFalse(manifest.called)
+
+    def test_precompiled_stale_jinja2_version(self):
+        templating.precompile_templates(self.templates)
+        templating.get_loader(self.templates, 'mitaka')
+        with patch.object(templating.jinja2, '__version__', '0.1'):
+            loader = templating.get_loader(self.templates, 'mitaka')
+        for l in loader.loaders:
+            self.assertNotIsInstance(l, templating.PrecompiledLoader)
+
+    def test_bytecode_cache_replaced_on_revision(self):
+        with open(os.path.join(self.tmp, 'revision'), 'w') as f:
+            f.write('1\n')
+        with patch.object(templating, 'charm_dir', lambda: self.tmp):
+            cache = templating.get_bytecode_cache('mitaka')
+            cache_root = os.path.join(self.tmp, templating.BYTECODE_CACHE_DIR)
+            self.assertEqual(cache.directory,
+                             os.path.join(cache_root, '1-mitaka'))
+            with open(os.path.join(self.tmp, 'revision'), 'w') as f:
+                f.write('2\n')
+            templating.get_bytecode_cache('mitaka')
+            templating.get_bytecode_cache('newton')
+        self.assertEqual(os.listdir(cache_root), ['2-newton'])
+
+    def test_no_bytecode_cache_without_charm_dir(self):
+        with patch.object(templating, 'charm_dir', lambda: None):
+            self.assertIsNone(templating.get_bytecode_cache('mitaka'))
@@ -0,0 +1,187 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from mock import patch
+
+from charmhelpers.core import tracing
+
+
+class TracingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.path = os.path.join(self.tmp, tracing.TRACE_FILE)
+        _m = patch.object(tracing.atexit, 'register')
+        self.register = _m.start()
+        self.addCleanup(_m.stop)
+        self.addCleanup(setattr, tracing, '_trace', None)
+
+    def spans(self):
+        return [s[0] for s in tracing._trace['spans']]
+
+    def test_disabled(self):
+        with tracing.span('render', 'foo.conf'):
+            pass
+        self.assertFalse(tracing.enabled())
+        tracing.save()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_enable(self):
+        tracing.enable('config-changed', self.path)
+        self.assertTrue(tracing.enabled())
+        self.register.assert_called_once_with(tracing.save)
+        # enabling again keeps the trace started first
+        tracing.enable('other', self.path)
+        self.assertEqual(tracing._trace['hook'], 'config-changed')
+        self.assertEqual(self.register.call_count, 1)
+
+    def test_nested_spans(self):
+        tracing.enable('config-changed', self.path)
+        with tracing.span('render', 'foo.conf'):
+            with tracing.span('hook-tool', 'relation-get'):
+                self.assertEqual(tracing.current(),
+                                 ['render:foo.conf',
+                                  'hook-tool:relation-get'])
+        with tracing.span('hook-tool', 'config-get'):
+            pass
+        # spans are recorded as they close
+        self.assertEqual(self.spans(), [
+            ['render:foo.conf', 'hook-tool:relation-get'],
+            ['render:foo.conf'],
+            ['hook-tool:config-get']])
+        self.assertEqual(tracing.current(), [])
+
+    def test_span_closed_on_exception(self):
+        tracing.enable('config-changed', self.path)
+        with self.assertRaises(ValueError):
+            with tracing.span('render', 'foo.conf'):
+                raise ValueError()
+        self.assertEqual(self.spans(), [['render:foo.conf']])
+        self.assertEqual(tracing.current(), [])
+
+    def test_parent_in_other_thread(self):
+        tracing.enable('config-changed', self.path)
+
+        def work(parent):
+            with tracing.span('context', 'amqp', parent=parent):
+                pass
+
+        with tracing.span('render', 'foo.conf'):
+            thread = threading.Thread(target=work,
+                                      args=(tracing.current(),))
+            thread.start()
+            thread.join()
+        self.assertEqual(self.spans(), [
+            ['render:foo.conf', 'context:amqp'],
+            ['render:foo.conf']])
+
+    def test_traced(self):
+        @tracing.traced('hook-tool')
+        def relation_get():
+            return 'value'
+
+        self.assertEqual(relation_get(), 'value')
+        tracing.enable('config-changed', self.path)
+        self.assertEqual(relation_get(), 'value')
+        self.assertEqual(self.spans(), [['hook-tool:relation_get']])
+
+    def test_save_and_load(self):
+        tracing.enable('config-changed', self.path)
+        with tracing.span('render', 'foo.conf'):
+            pass
+        tracing.save()
+        self.assertFalse(tracing.enabled())
+        records = tracing.load(path=self.path)
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['hook'], 'config-changed')
+        self.assertEqual([s[0] for s in records[0]['spans']],
+                         [['render:foo.conf']])
+        self.assertEqual(tracing.load(hooks=0, path=self.path), [])
+
+    def test_load_missing(self):
+        self.assertEqual(tracing.load(path=self.path), [])
+
+    @patch.object(tracing, 'TRACE_MAX_HOOKS', 2)
+    def test_save_trims(self):
+        for i in range(5):
+            tracing.enable('hook-{}'.format(i), self.path)
+            tracing.save()
+            hooks = [r['hook'] for r in tracing.load(path=self.path)]
+            if i < 4:
+                self.assertEqual(len(hooks), i + 1)
+        # trimmed to the last TRACE_MAX_HOOKS once over twice as many
+        self.assertEqual(hooks, ['hook-3', 'hook-4'])
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+
+
+class ReportTestCase(unittest.TestCase):
+
+    records = [
+        {'hook': 'config-changed', 'wall': 10.0, 'cpu': 4.0,
+         'spans': [
+             [['render:a'], 3.0, 1.0],
+             [['render:a', 'hook-tool:relation-get'], 1.0, 0.5],
+             [['hook-tool:relation-get'], 2.0, 0.25]]},
+        {'hook': 'update-status', 'wall': 1.0, 'cpu': 0.5,
+         'spans': [[['hook-tool:status-set'], 0.5, 0.5]]},
+    ]
+
+    def test_slowest(self):
+        self.assertEqual(tracing.slowest(self.records, count=3), [
+            ('config-changed', 'render:a', 3.0, 1.0),
+            ('config-changed', 'hook-tool:relation-get', 2.0, 0.25),
+            ('config-changed', 'render:a;hook-tool:relation-get',
+             1.0, 0.5)])
+        self.assertEqual(
+            tracing.slowest(self.records, count=1, metric='cpu'),
+            [('config-changed', 'render:a', 3.0, 1.0)])
+
+    def test_unknown_metric(self):
+        self.assertRaises(ValueError, tracing.slowest, self.records,
+                          metric='rss')
+        self.assertRaises(ValueError, tracing.folded, self.records,
+                          metric='rss')
+
+    def test_folded(self):
+        self.assertEqual(tracing.folded(self.records), [
+            'config-changed 5000000',
+            'config-changed;hook-tool:relation-get 2000000',
+            'config-changed;render:a 2000000',
+            'config-changed;render:a;hook-tool:relation-get 1000000',
+            'update-status 500000',
+            'update-status;hook-tool:status-set 500000'])
+
+    def test_folded_cpu(self):
+        self.assertEqual(tracing.folded(self.records, metric='cpu'), [
+            'config-changed 2750000',
+            'config-changed;hook-tool:relation-get 250000',
+            'config-changed;render:a 500000',
+            'config-changed;render:a;hook-tool:relation-get 500000',
+            'update-status 0',
+            'update-status;hook-tool:status-set 500000'])
+
+    def test_folded_sums_repeated_stacks(self):
+        record = {'hook': 'install', 'wall': 1.0, 'cpu': 1.0,
+                  'spans': [[['render:a'], 0.25, 0],
+                            [['render:a'], 0.25, 0]]}
+        self.assertEqual(tracing.folded([record, record]), [
+            'install 1000000',
+            'install;render:a 1000000'])
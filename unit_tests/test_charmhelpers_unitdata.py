@@ -0,0 +1,329 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from mock import call, patch
+
+from charmhelpers.core import unitdata
+
+
+class StorageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.db_path = os.path.join(self.tmp, 'unit-state.db')
+        self.kv = self.storage()
+
+    def storage(self):
+        kv = unitdata.Storage(self.db_path)
+        self.addCleanup(kv.close)
+        return kv
+
+
+class BatchTestCase(StorageTestCase):
+
+    def test_batch_written_on_success(self):
+        other = self.storage()
+        with self.kv.batch():
+            self.kv.set('a', 1)
+            self.kv.update({'b': 2, 'c': 3})
+            self.assertEqual(self.kv.get('a'), 1)
+            # buffered, nothing has been written yet
+            self.assertEqual(
+                self.kv.conn.execute('select count(*) from kv').fetchone(),
+                (0,))
+        self.assertEqual(self.kv.getrange(''), {'a': 1, 'b': 2, 'c': 3})
+        self.kv.flush()
+        self.assertEqual(other.getrange(''), {'a': 1, 'b': 2, 'c': 3})
+
+    def test_nested_batch_written_by_outermost(self):
+        with self.kv.batch():
+            with self.kv.batch():
+                self.kv.set('a', 1)
+            self.assertEqual(self.kv._pending, {'a': '1'})
+        self.assertIsNone(self.kv._pending)
+        self.assertEqual(self.kv.get('a'), 1)
+
+    def test_batch_rolled_back_on_exception(self):
+        self.kv.update({'a': 0, 'c': 'keep'})
+        self.kv.flush()
+        self.kv.set('before', True)
+
+        def fail():
+            with self.kv.batch():
+                self.kv.set('a', 1)
+                self.kv.set('b', 2)
+                # bulk reads write the buffered changes first
+                self.assertEqual(self.kv.getrange('')['b'], 2)
+                self.kv.unset('c')
+                self.kv.set('d', 4)
+                raise ValueError('fail')
+
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(self.kv.getrange(''),
+                         {'a': 0, 'c': 'keep', 'before': True})
+        self.kv.flush()
+        self.assertEqual(self.storage().getrange(''),
+                         {'a': 0, 'c': 'keep', 'before': True})
+
+    def test_batch_rollback_of_unsetrange(self):
+        self.kv.update({'x.a': 1, 'x.b': 2, 'y': 3})
+
+        def fail():
+            with self.kv.batch():
+                self.kv.unsetrange(prefix='x.')
+                self.kv.unsetrange(['y'])
+                raise ValueError('fail')
+
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(self.kv.getrange(''), {'x.a': 1, 'x.b': 2, 'y': 3})
+
+    def test_hook_scope_rolled_back_on_exception(self):
+        self.kv.set('a', 0)
+        self.kv.flush()
+
+        def fail():
+            with self.kv.hook_scope('install'):
+                self.kv.set('a', 1)
+                raise ValueError('fail')
+
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(self.kv.get('a'), 0)
+        self.assertEqual(self.kv.gethistory('a'), [])
+
+
+class CacheTestCase(StorageTestCase):
+
+    def test_reads_not_cached_outside_transaction(self):
+        other = self.storage()
+        self.assertIsNone(self.kv.get('a'))
+        other.set('a', 1)
+        other.flush()
+        self.assertEqual(self.kv.get('a'), 1)
+        other.set('a', 2)
+        other.flush()
+        self.assertEqual(self.kv.get('a'), 2)
+
+    def test_reads_cached_while_writing(self):
+        self.kv.set('a', 1)
+        self.kv.get('b')
+        self.assertEqual(self.kv._cache, {'a': '1', 'b': None})
+
+    def test_cache_dropped_on_commit(self):
+        other = self.storage()
+        self.kv.set('a', 1)
+        self.kv.flush()
+        self.assertEqual(self.kv._cache, {})
+        other.set('a', 2)
+        other.flush()
+        self.assertEqual(self.kv.get('a'), 2)
+
+    def test_cache_dropped_on_rollback(self):
+        self.kv.set('a', 1)
+        self.kv.flush(False)
+        self.assertEqual(self.kv._cache, {})
+        self.assertIsNone(self.kv.get('a'))
+
+    def test_unchanged_value_not_written(self):
+        self.kv.set('a', 1)
+        self.kv.flush()
+        self.kv.set('a', 1)
+        self.assertFalse(self.kv._writing)
+        self.assertEqual(self.kv._cache, {})
+
+
+class CompactTestCase(StorageTestCase):
+
+    def run_hooks(self, count, size=10):
+        for i in range(count):
+            with self.kv.hook_scope('hook-%d' % i):
+                self.kv.update(dict(('key-%d' % k, 'x' * size + str(i))
+                                    for k in range(10)))
+
+    def count(self, table, kv=None):
+        kv = kv or self.kv
+        return kv.conn.execute(
+            'select count(*) from %s' % table).fetchone()[0]
+
+    def age_hooks(self, versions, days):
+        since = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+        date = since.isoformat()
+        self.kv.conn.execute(
+            'update hooks set date=? where version in (%s)' %
+            ','.join('?' * len(versions)), [date] + list(versions))
+        self.kv.conn.commit()
+
+    def test_prune_keep_revisions(self):
+        self.run_hooks(5)
+        self.assertEqual(self.kv.prune(keep_revisions=2), 3)
+        self.assertEqual(
+            [h for h, in self.kv.conn.execute(
+                'select hook from hooks order by version')],
+            ['hook-3', 'hook-4'])
+        self.assertEqual([r[0] for r in self.kv.gethistory('key-0')], [4, 5])
+        self.assertEqual(self.kv.get('key-0'), 'x' * 10 + '4')
+
+    def test_prune_keep_days(self):
+        self.run_hooks(5)
+        self.age_hooks([1, 2, 3], days=10)
+        self.assertEqual(self.kv.prune(keep_days=3), 3)
+        self.assertEqual(self.count('hooks'), 2)
+        self.assertEqual(self.count('kv_revisions'), 20)
+
+    def test_prune_keeps_union_of_windows(self):
+        self.run_hooks(5)
+        self.age_hooks([1, 2], days=10)
+        # the last hook by revision, the last three by date
+        self.assertEqual(self.kv.prune(keep_revisions=1, keep_days=3), 2)
+        self.assertEqual(self.count('hooks'), 3)
+
+    def test_prune_all_recent(self):
+        self.run_hooks(3)
+        self.assertEqual(self.kv.prune(keep_days=3), 0)
+        self.assertEqual(self.kv.prune(keep_revisions=10), 0)
+        self.assertEqual(self.kv.prune(), 0)
+        self.assertEqual(self.count('hooks'), 3)
+
+    def test_prune_not_committed(self):
+        self.run_hooks(5)
+        other = self.storage()
+        self.kv.prune(keep_revisions=1)
+        self.assertEqual(self.count('hooks', other), 5)
+        self.kv.flush()
+        self.assertEqual(self.count('hooks', other), 1)
+
+    def size(self):
+        stats = self.kv.stats()
+        return stats['db_size'] + stats['wal_size']
+
+    def auto_vacuum(self):
+        return self.kv.conn.execute('pragma auto_vacuum').fetchone()[0]
+
+    def test_compact_small_db_does_not_grow(self):
+        self.run_hooks(1)
+        before = self.size()
+        stats = self.kv.compact()
+        self.assertLessEqual(stats['db_size'] + stats['wal_size'], before)
+        self.assertEqual(stats['wal_size'], 0)
+
+    def test_new_db_incremental(self):
+        self.assertEqual(self.auto_vacuum(), 2)
+
+    def test_compact_releases_pruned_space(self):
+        self.run_hooks(50, size=1000)
+        self.kv.compact()
+        before = self.size()
+        self.kv.prune(keep_revisions=1)
+        stats = self.kv.compact()
+        self.assertLess(stats['db_size'] + stats['wal_size'], before / 2)
+        self.assertEqual(stats['freelist_count'], 0)
+        self.assertEqual(stats['rows']['hooks'], 1)
+
+    def test_compact_incremental(self):
+        self.run_hooks(20, size=1000)
+        self.kv.prune(keep_revisions=1)
+        self.kv.flush()
+        self.assertGreater(self.kv.stats()['freelist_count'], 0)
+        with patch.object(self.kv, 'cursor', wraps=self.kv.cursor) as cursor:
+            stats = self.kv.compact()
+        self.assertNotIn(call('vacuum'), cursor.execute.call_args_list)
+        self.assertEqual(stats['freelist_count'], 0)
+
+    def test_compact_converts_existing_db(self):
+        self.kv.close()
+        os.unlink(self.db_path)
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('create table kv (key text, data text, '
+                     'primary key (key))')
+        conn.commit()
+        conn.close()
+        self.kv = self.storage()
+        self.assertEqual(self.auto_vacuum(), 0)
+        self.run_hooks(20, size=1000)
+        self.kv.prune(keep_revisions=1)
+        stats = self.kv.compact()
+        self.assertEqual(self.auto_vacuum(), 2)
+        self.assertEqual(stats['freelist_count'], 0)
+
+    def test_compact_commits_pending_changes(self):
+        self.kv.set('a', 1)
+        self.kv.compact()
+        self.assertEqual(self.storage().get('a'), 1)
+
+
+class RangeTestCase(StorageTestCase):
+
+    def keys(self, prefix):
+        return sorted(self.kv.getrange(prefix))
+
+    def test_prefix_boundaries(self):
+        self.kv.update(dict.fromkeys(['a', 'a.', 'a.b', 'a.b.c', 'a-', 'a/',
+                                      'a.\x7f', 'b'], 1))
+        self.assertEqual(self.keys('a.'), ['a.', 'a.b', 'a.b.c', 'a.\x7f'])
+        self.assertEqual(self.keys('a.b'), ['a.b', 'a.b.c'])
+        self.assertEqual(self.keys('c'), [])
+        self.assertEqual(len(self.keys('')), 8)
+
+    def test_prefix_case_sensitive(self):
+        self.kv.update({'Config.a': 1, 'config.b': 2})
+        self.assertEqual(self.kv.getrange('config.', strip=True), {'b': 2})
+
+    def test_prefix_wildcards_literal(self):
+        self.kv.update(dict.fromkeys(['a_b', 'axb', 'a%b', 'a%c', 'abc'], 1))
+        self.assertEqual(self.keys('a_'), ['a_b'])
+        self.assertEqual(self.keys('a%'), ['a%b', 'a%c'])
+
+    def test_prefix_ending_in_max_bmp(self):
+        keys = [u'x\uffff', u'x\uffffz', u'x\U00010000', u'y']
+        self.kv.update(dict.fromkeys(keys, 1))
+        self.assertEqual(self.keys(u'x\uffff'), [u'x\uffff', u'x\uffffz'])
+
+    def test_prefix_ending_in_max_code_point(self):
+        keys = [u'x\U0010ffff', u'x\U0010ffffa', u'y', u'x\uffff']
+        self.kv.update(dict.fromkeys(keys, 1))
+        self.assertEqual(self.keys(u'x\U0010ffff'),
+                         [u'x\U0010ffff', u'x\U0010ffffa'])
+        self.assertEqual(self.keys(u'\U0010ffff'), [])
+
+    def test_prefix_before_surrogates(self):
+        keys = [u'x\ud7ff', u'x\ud7ffa', u'x\ue000', u'x']
+        self.kv.update(dict.fromkeys(keys, 1))
+        self.assertEqual(self.keys(u'x\ud7ff'), [u'x\ud7ff', u'x\ud7ffa'])
+
+    def test_encoded_prefix(self):
+        self.kv.update({u'caf\xe9.a': 1, u'caf\xe9s': 2, u'cafe.b': 3})
+        self.assertEqual(
+            self.kv.getrange(u'caf\xe9.'.encode('UTF-8'), strip=True),
+            {u'a': 1})
+
+    def test_unsetrange_prefix(self):
+        self.kv.update(dict.fromkeys(['a.b', 'a.c', 'a/', 'A.b', 'a_b'], 1))
+        self.kv.unsetrange(prefix='a.')
+        self.assertEqual(self.keys(''), ['A.b', 'a/', 'a_b'])
+        self.kv.unsetrange(prefix='a_')
+        self.assertEqual(self.keys(''), ['A.b', 'a/'])
+
+    def test_delta(self):
+        self.kv.update({'a': 1, 'b': 2, 'c': 3, 'd': 4}, prefix='config.')
+        self.kv.set('config-other', 5)
+        delta = self.kv.delta({'a': 1, 'b': 20, 'd': 4, 'e': 5}, 'config.')
+        self.assertEqual(dict(delta),
+                         {'b': (2, 20), 'c': (3, None), 'e': (None, 5)})
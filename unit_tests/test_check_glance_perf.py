@@ -0,0 +1,235 @@
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import imp
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from mock import patch, MagicMock
+
+check_glance_perf = imp.load_source(
+    'check_glance_perf',
+    os.path.join(os.path.dirname(__file__), '..', 'files',
+                 'nrpe-external-master', 'check_glance_perf.py'))
+
+SHOW_STAT = (
+    '# pxname,svname,qcur,scur,slim,status\n'
+    'glance_api,FRONTEND,,12,20000,OPEN\n'
+    'glance_api,glance-0,0,4,,UP\n'
+    'glance_api,BACKEND,3,8,2000,UP\n'
+    'stats,BACKEND,0,1,,UP\n')
+
+
+class FakeSocket(object):
+
+    def __init__(self, responses, path_seen):
+        self.responses = responses
+        self.path_seen = path_seen
+        self.data = []
+
+    def settimeout(self, timeout):
+        pass
+
+    def connect(self, path):
+        self.path_seen.append(path)
+        self.data = [self.responses[path].encode('UTF-8'), b'']
+
+    def sendall(self, data):
+        pass
+
+    def recv(self, size):
+        return self.data.pop(0)
+
+    def close(self):
+        pass
+
+
+class CheckGlancePerfTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.status_file = os.path.join(self.tmp, 'glance-perf.json')
+
+    def args(self, *argv):
+        return check_glance_perf.parse_args(
+            list(argv) + ['--file', self.status_file])
+
+    def write_status(self, **status):
+        status.setdefault('time', time.time())
+        with open(self.status_file, 'w') as f:
+            json.dump(status, f)
+
+    def run_main(self, *argv):
+        with patch('sys.stdout') as stdout:
+            code = check_glance_perf.main(
+                list(argv) + ['--file', self.status_file])
+        return code, ''.join(c[0][0] for c in stdout.write.call_args_list)
+
+    def test_threshold(self):
+        args = self.args('store-rtt', '-w', '500', '-c', '2000')
+        self.assertEqual(check_glance_perf.threshold(args, 100, 'm', 'rtt',
+                                                     'ms'),
+                         (check_glance_perf.OK, 'm',
+                          'rtt=100.0ms;500.0;2000.0'))
+        self.assertEqual(check_glance_perf.threshold(args, 500, 'm')[0],
+                         check_glance_perf.WARNING)
+        self.assertEqual(check_glance_perf.threshold(args, 2000, 'm')[0],
+                         check_glance_perf.CRITICAL)
+        args = self.args('store-rtt')
+        self.assertEqual(check_glance_perf.threshold(args, 1e6, 'm', 'rtt'),
+                         (check_glance_perf.OK, 'm', 'rtt=1000000.0;;'))
+
+    def test_probe_haproxy(self):
+        paths = []
+        with patch.object(check_glance_perf.socket, 'socket',
+                          lambda *args: FakeSocket({'a.sock': SHOW_STAT},
+                                                   paths)):
+            backends = check_glance_perf.probe_haproxy(['a.sock'], 5)
+        self.assertEqual(backends, {
+            'glance_api': {'scur': 8, 'qcur': 3, 'slim': 2000},
+            'stats': {'scur': 1, 'qcur': 0, 'slim': 0}})
+
+    def test_probe_haproxy_processes(self):
+        paths = []
+        responses = {'a.sock': SHOW_STAT, 'b.sock': SHOW_STAT}
+        with patch.object(check_glance_perf.socket, 'socket',
+                          lambda *args: FakeSocket(responses, paths)):
+            backends = check_glance_perf.probe_haproxy(['a.sock', 'b.sock'],
+                                                       5)
+        self.assertEqual(paths, ['a.sock', 'b.sock'])
+        self.assertEqual(backends['glance_api'],
+                         {'scur': 16, 'qcur': 6, 'slim': 4000})
+
+    def test_probe_cache(self):
+        cache_dir = os.path.join(self.tmp, 'image-cache')
+        os.makedirs(os.path.join(cache_dir, 'incomplete'))
+        for path, size in (('image-1', 100), ('image-2', 50),
+                           ('incomplete/image-3', 1000)):
+            with open(os.path.join(cache_dir, path), 'w') as f:
+                f.write('x' * size)
+        conf = check_glance_perf.RawConfigParser()
+        conf.add_section('glance_store')
+        conf.set('DEFAULT', 'image_cache_dir', cache_dir)
+        conf.set('DEFAULT', 'image_cache_max_size', '1000')
+        self.assertEqual(check_glance_perf.probe_cache(conf),
+                         {'size': 150, 'max_size': 1000})
+
+    def test_glance_option(self):
+        conf = check_glance_perf.RawConfigParser()
+        conf.add_section('glance_store')
+        conf.set('glance_store', 'default_store', 'rbd')
+        self.assertEqual(
+            check_glance_perf.glance_option(conf, 'default_store'), 'rbd')
+        self.assertEqual(
+            check_glance_perf.glance_option(conf, 'missing', 'x'), 'x')
+
+    @patch.object(check_glance_perf, 'probe_haproxy')
+    @patch.object(check_glance_perf, 'probe_store')
+    def test_probe_creates_directory(self, probe_store, probe_haproxy):
+        self.status_file = os.path.join(self.tmp, 'nagios', 'perf.json')
+        probe_store.return_value = {'backend': 'file'}
+        probe_haproxy.side_effect = IOError('no socket')
+        code, output = self.run_main('probe')
+        self.assertEqual(code, check_glance_perf.OK)
+        with open(self.status_file) as f:
+            status = json.load(f)
+        self.assertEqual(status['store'], {'backend': 'file'})
+        self.assertEqual(status['haproxy'], {'error': 'no socket'})
+        probe_haproxy.assert_called_once_with(
+            [check_glance_perf.HAPROXY_SOCKET], 10)
+
+    def test_store_rtt(self):
+        self.write_status(store={'backend': 'rbd', 'rtt': 600.0})
+        code, output = self.run_main('store-rtt', '-w', '500', '-c', '2000')
+        self.assertEqual(code, check_glance_perf.WARNING)
+        self.assertEqual(output, 'WARNING: rbd store round trip 600ms | '
+                                 'rtt=600.0ms;500.0;2000.0\n')
+
+    def test_store_rtt_failed(self):
+        self.write_status(store={'backend': 'swift', 'error': 'timeout'})
+        code, output = self.run_main('store-rtt')
+        self.assertEqual(code, check_glance_perf.CRITICAL)
+        self.assertEqual(output,
+                         'CRITICAL: swift store probe failed: timeout\n')
+
+    def test_store_rtt_not_probed(self):
+        self.write_status(store={'backend': 'file'})
+        code, output = self.run_main('store-rtt')
+        self.assertEqual(code, check_glance_perf.UNKNOWN)
+
+    def test_stale_status(self):
+        self.write_status(time=time.time() - 700,
+                          store={'backend': 'rbd', 'rtt': 1.0})
+        code, output = self.run_main('store-rtt')
+        self.assertEqual(code, check_glance_perf.UNKNOWN)
+        self.assertIn('old', output)
+
+    def test_missing_status(self):
+        code, output = self.run_main('cache-fill')
+        self.assertEqual(code, check_glance_perf.UNKNOWN)
+        self.assertIn('cannot read probe status', output)
+
+    def test_cache_fill(self):
+        self.write_status(cache={'size': 900 * 1024 ** 2,
+                                 'max_size': 1000 * 1024 ** 2})
+        code, output = self.run_main('cache-fill', '-w', '80', '-c', '95')
+        self.assertEqual(code, check_glance_perf.WARNING)
+        self.assertEqual(output, 'WARNING: image cache 90.0% full '
+                                 '(900MB of 1000MB) | fill=90.0%;80.0;95.0\n')
+
+    def test_haproxy_sessions(self):
+        self.write_status(haproxy={
+            'glance_api': {'scur': 8, 'qcur': 3, 'slim': 2000},
+            'stats': {'scur': 1, 'qcur': 0, 'slim': 0}})
+        code, output = self.run_main('haproxy-sessions', '-w', '5',
+                                     '-c', '10')
+        self.assertEqual(code, check_glance_perf.WARNING)
+        self.assertEqual(output, 'WARNING: most sessions on glance_api: 8 | '
+                                 'glance_api=8;5.0;10.0 stats=1;5.0;10.0\n')
+
+    def test_haproxy_queue_error(self):
+        self.write_status(haproxy={'error': 'refused'})
+        code, output = self.run_main('haproxy-queue', '-c', '50')
+        self.assertEqual(code, check_glance_perf.UNKNOWN)
+        self.assertEqual(output, 'UNKNOWN: haproxy probe failed: refused\n')
+
+    def test_api_latency(self):
+        with patch.object(check_glance_perf, 'urlopen') as urlopen:
+            code, output = self.run_main('api-latency', '-c', '60000')
+        self.assertEqual(code, check_glance_perf.OK)
+        urlopen.assert_called_once_with('http://127.0.0.1:9292/versions',
+                                        timeout=10)
+
+    def test_api_latency_multiple_choices(self):
+        error = check_glance_perf.HTTPError(
+            'http://127.0.0.1:9292/versions', 300, 'Multiple Choices',
+            {}, None)
+        with patch.object(check_glance_perf, 'urlopen',
+                          MagicMock(side_effect=error)):
+            code, output = self.run_main('api-latency')
+        self.assertEqual(code, check_glance_perf.OK)
+
+    def test_api_latency_server_error(self):
+        error = check_glance_perf.HTTPError(
+            'http://127.0.0.1:9292/versions', 503, 'Unavailable', {}, None)
+        with patch.object(check_glance_perf, 'urlopen',
+                          MagicMock(side_effect=error)):
+            code, output = self.run_main('api-latency')
+        self.assertEqual(code, check_glance_perf.CRITICAL)
+        self.assertIn('returned 503', output)
@@ -12,11 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import sys
+
 from mock import patch, MagicMock
 
 from hooks import glance_contexts as contexts
 from test_utils import (
-    CharmTestCase
+    CharmTestCase,
+    SimpleKV,
 )
 
 TO_PATCH = [
@@ -27,6 +30,8 @@ TO_PATCH = [
     'determine_apache_port',
     'determine_api_port',
     'os_release',
+    'kv',
+    'atexit',
 ]
 
 
@@ -34,6 +39,7 @@ class TestGlanceContexts(CharmTestCase):
 
     def setUp(self):
         super(TestGlanceContexts, self).setUp(contexts, TO_PATCH)
+        self.kv.return_value = SimpleKV()
         from charmhelpers.core.hookenv import cache
         self.cache = cache
         cache.clear()
@@ -159,3 +165,257 @@ class TestGlanceContexts(CharmTestCase):
         ctxt = contexts.GlanceIPv6Context()
         self.assertEqual(ctxt(), {'bind_host': '0.0.0.0',
                                   'registry_host': '0.0.0.0'})
+
+    @patch.object(contexts.psutil, 'process_iter')
+    def test_glance_worker_rss_estimate(self, process_iter):
+        self.config.return_value = None
+        self.relation_ids.side_effect = \
+            lambda r: ['ceph:0'] if r == 'ceph' else []
+        process_iter.return_value = []
+        ctxt = contexts.GlanceWorkerConfigContext('glance-api')
+        self.assertEqual(ctxt.worker_rss(), 160 * 1024 * 1024)
+        ctxt = contexts.GlanceWorkerConfigContext('glance-registry')
+        self.assertEqual(ctxt.worker_rss(), 96 * 1024 * 1024)
+
+    @patch.object(contexts.psutil, 'process_iter')
+    def test_glance_worker_rss_measured(self, process_iter):
+        self.config.return_value = None
+        self.relation_ids.return_value = []
+        api = MagicMock()
+        api.name.return_value = 'glance-api'
+        api.memory_info.return_value.rss = 300 * 1024 * 1024
+        other = MagicMock()
+        other.name.return_value = 'glance-registry'
+        other.memory_info.return_value.rss = 500 * 1024 * 1024
+        process_iter.return_value = [api, other]
+        ctxt = contexts.GlanceWorkerConfigContext('glance-api')
+        # rounded up to WORKER_RSS_STEP
+        self.assertEqual(ctxt.worker_rss(), 320 * 1024 * 1024)
+
+    @patch.object(contexts.time, 'time')
+    @patch.object(contexts.GlanceWorkerConfigContext, '_measured_rss')
+    def test_glance_worker_rss_peak_recorded(self, measured_rss, now):
+        self.config.return_value = None
+        self.relation_ids.return_value = []
+        now.return_value = 1000
+        ctxt = contexts.GlanceWorkerConfigContext('glance-api')
+        measured_rss.return_value = 300 * 1024 * 1024
+        self.assertEqual(ctxt.worker_rss(), 320 * 1024 * 1024)
+        self.atexit.assert_called_once_with(self.kv.return_value.flush)
+        self.assertEqual(self.kv.return_value.get('glance.worker-rss'),
+                         {'glance-api': [320 * 1024 * 1024, 1000]})
+        # smaller workers in a later hook do not change the worker count
+        self.atexit.reset_mock()
+        measured_rss.return_value = 150 * 1024 * 1024
+        self.assertEqual(ctxt.worker_rss(), 320 * 1024 * 1024)
+        measured_rss.return_value = 0
+        self.assertEqual(ctxt.worker_rss(), 320 * 1024 * 1024)
+        self.assertFalse(self.atexit.called)
+        measured_rss.return_value = 330 * 1024 * 1024
+        self.assertEqual(ctxt.worker_rss(), 384 * 1024 * 1024)
+        registry = contexts.GlanceWorkerConfigContext('glance-registry')
+        self.assertEqual(registry.worker_rss(), 384 * 1024 * 1024)
+        self.assertEqual(self.kv.return_value.get('glance.worker-rss'),
+                         {'glance-api': [384 * 1024 * 1024, 1000],
+                          'glance-registry': [384 * 1024 * 1024, 1000]})
+
+    @patch.object(contexts.time, 'time')
+    @patch.object(contexts.GlanceWorkerConfigContext, '_measured_rss')
+    def test_glance_worker_rss_peak_expires(self, measured_rss, now):
+        self.config.return_value = None
+        self.relation_ids.return_value = []
+        ctxt = contexts.GlanceWorkerConfigContext('glance-api')
+        now.return_value = 1000
+        measured_rss.return_value = 1000 * 1024 * 1024
+        self.assertEqual(ctxt.worker_rss(), 1024 * 1024 * 1024)
+        measured_rss.return_value = 200 * 1024 * 1024
+        now.return_value = 1000 + contexts.WORKER_RSS_EXPIRY - 1
+        self.assertEqual(ctxt.worker_rss(), 1024 * 1024 * 1024)
+        # the spike gives way to the memory in use once it expired
+        now.return_value = 1000 + contexts.WORKER_RSS_EXPIRY
+        self.assertEqual(ctxt.worker_rss(), 256 * 1024 * 1024)
+        # but not to stopped workers
+        measured_rss.return_value = 0
+        now.return_value += 2 * contexts.WORKER_RSS_EXPIRY
+        self.assertEqual(ctxt.worker_rss(), 256 * 1024 * 1024)
+
+    def test_glance_workers_share_memory(self):
+        self.config.side_effect = \
+            lambda k: 512 if k == 'worker-memory' else None
+        # the charmhelpers context module glance_contexts was imported with
+        module = sys.modules[contexts.WorkerConfigContext.__module__]
+        with patch.object(module, '_calculate_workers',
+                          return_value=4) as calculate_workers:
+            for service in contexts.WORKER_SERVICES:
+                ctxt = contexts.GlanceWorkerConfigContext(service)
+                self.assertEqual(ctxt(), {'workers': 4})
+                # half of the memory, divided between the services
+                calculate_workers.assert_called_with(512 * 1024 * 1024, 0.25)
+
+    def test_glance_worker_rss_configured(self):
+        self.config.side_effect = \
+            lambda k: 512 if k == 'worker-memory' else None
+        ctxt = contexts.GlanceWorkerConfigContext('glance-api')
+        self.assertEqual(ctxt.worker_rss(), 512 * 1024 * 1024)
+
+    def test_store_tuning_context(self):
+        config = {
+            'rbd-store-chunk-size': 16,
+            'swift-store-large-object-size': 4096,
+            'swift-store-large-object-chunk-size': 512,
+            'swift-buffer-on-upload': False,
+            'swift-upload-buffer-dir': '/var/lib/glance/swift-upload-buffer'}
+        self.config.side_effect = lambda x: config[x]
+        self.os_release.return_value = 'mitaka'
+        self.assertEqual(contexts.StoreTuningContext()(),
+                         {'rbd_store_chunk_size': 16,
+                          'swift_store_large_object_size': 4096,
+                          'swift_store_large_object_chunk_size': 512})
+
+    @patch.object(contexts, 'mkdir')
+    def test_store_tuning_context_buffer_on_upload(self, mkdir):
+        config = {
+            'rbd-store-chunk-size': 8,
+            'swift-store-large-object-size': 5120,
+            'swift-store-large-object-chunk-size': 200,
+            'swift-buffer-on-upload': True,
+            'swift-upload-buffer-dir': '/srv/buffer'}
+        self.config.side_effect = lambda x: config[x]
+        self.relation_ids.return_value = ['object-store:0']
+        self.os_release.return_value = 'pike'
+        ctxt = contexts.StoreTuningContext()()
+        self.assertTrue(ctxt['swift_buffer_on_upload'])
+        self.assertEqual(ctxt['swift_upload_buffer_dir'], '/srv/buffer')
+        mkdir.assert_called_once_with('/srv/buffer', owner='glance',
+                                      group='glance', perms=0o750)
+
+    def test_store_tuning_context_invalid(self):
+        config = {
+            'rbd-store-chunk-size': 12,
+            'swift-store-large-object-size': 5120,
+            'swift-store-large-object-chunk-size': 6000,
+            'swift-buffer-on-upload': False,
+            'swift-upload-buffer-dir': ''}
+        self.config.side_effect = lambda x: config[x]
+        self.os_release.return_value = 'mitaka'
+        self.assertEqual(len(contexts.validate_store_tuning()), 2)
+        self.assertEqual(contexts.StoreTuningContext()(),
+                         {'rbd_store_chunk_size': 8,
+                          'swift_store_large_object_size': 5120,
+                          'swift_store_large_object_chunk_size': 200})
+
+    def test_image_cache_context(self):
+        config = {
+            'image-cache': True,
+            'image-cache-max-size': 2048,
+            'image-cache-stall-time': 3600,
+            'image-cache-prune-schedule': '*/30 * * * *',
+            'image-cache-clean-schedule': '0 1 * * *'}
+        self.config.side_effect = lambda x: config[x]
+        self.assertEqual(contexts.ImageCacheContext()(),
+                         {'image_cache': True,
+                          'image_cache_max_size': 2048 * 1024 * 1024,
+                          'image_cache_stall_time': 3600,
+                          'image_cache_prune_schedule': '*/30 * * * *',
+                          'image_cache_clean_schedule': '0 1 * * *'})
+
+    @patch.object(contexts, 'https')
+    @patch.object(contexts, 'lsb_release')
+    def test_haproxy_tuning_http_mode(self, lsb_release, https):
+        config = {
+            'haproxy-maxconn': 40000,
+            'haproxy-nbproc': None,
+            'haproxy-nbthread': 4,
+            'haproxy-backend-maxconn': 64,
+            'haproxy-backend-maxqueue': 128,
+            'haproxy-http-mode': True}
+        self.config.side_effect = lambda x: config[x]
+        lsb_release.return_value = {'DISTRIB_CODENAME': 'bionic'}
+        https.return_value = False
+        self.assertEqual(contexts.HAProxyContext().tuning(), {
+            'haproxy_maxconn': 40000,
+            'haproxy_nbthread': 4,
+            'frontend_options': {'glance_api': [
+                {'mode': 'http'},
+                {'option': 'httplog'},
+                {'option': 'http-keep-alive'},
+                {'option': 'forwardfor'}]},
+            'backend_options': {'glance_api': [
+                {'mode': 'http'},
+                {'option': 'httpchk GET /versions'},
+                {'http-check': 'expect rstatus ^[23]'},
+                {'http-reuse': 'safe'}]},
+            'server_options': {'glance_api': 'maxconn 64 maxqueue 128'}})
+
+    @patch.object(contexts, 'https')
+    @patch.object(contexts, 'lsb_release')
+    def test_haproxy_tuning_http_mode_https(self, lsb_release, https):
+        config = {
+            'haproxy-maxconn': None,
+            'haproxy-nbproc': None,
+            'haproxy-nbthread': 4,
+            'haproxy-backend-maxconn': None,
+            'haproxy-backend-maxqueue': None,
+            'haproxy-http-mode': True}
+        self.config.side_effect = lambda x: config[x]
+        lsb_release.return_value = {'DISTRIB_CODENAME': 'xenial'}
+        https.return_value = True
+        self.assertEqual(contexts.HAProxyContext().tuning(), {
+            'backend_options': {'glance_api': [
+                {'option': 'httpchk GET /versions'},
+                {'http-check': 'expect rstatus ^[23]'}]},
+            'server_options': {'glance_api': 'check-ssl verify none'}})
+
+    @patch.object(contexts, 'GlanceWorkerConfigContext')
+    @patch.object(contexts.psutil, 'cpu_count')
+    @patch.object(contexts, 'get_total_ram')
+    @patch.object(contexts.BaseMemcacheContext, '__call__')
+    def test_memcache_context(self, base_call, get_total_ram, cpu_count,
+                              worker_ctxt):
+        base_call.return_value = {'use_memcache': True,
+                                  'memcache_port': '11211',
+                                  'memcache_url': 'inet6:[::1]:11211'}
+        get_total_ram.return_value = 32 * 1024 ** 3
+        cpu_count.return_value = 32
+        worker_ctxt.return_value.return_value = {'workers': 64}
+        self.config.return_value = False
+        self.assertEqual(contexts.MemcacheContext()(),
+                         {'use_memcache': True,
+                          'memcache_port': '11211',
+                          'memcache_url': 'inet6:[::1]:11211',
+                          'memcache_memory': 512,
+                          'memcache_threads': 8,
+                          'memcache_connections': 1280})
+
+    @patch.object(contexts, 'relation_get')
+    @patch.object(contexts, 'related_units')
+    @patch.object(contexts, 'get_relation_ip')
+    @patch.object(contexts, 'GlanceWorkerConfigContext')
+    @patch.object(contexts.psutil, 'cpu_count')
+    @patch.object(contexts, 'get_total_ram')
+    @patch.object(contexts.BaseMemcacheContext, '__call__')
+    def test_memcache_context_share_peers(self, base_call, get_total_ram,
+                                          cpu_count, worker_ctxt,
+                                          get_relation_ip, related_units,
+                                          relation_get):
+        base_call.return_value = {'use_memcache': True,
+                                  'memcache_port': '11211',
+                                  'memcache_url': '127.0.0.1:11211'}
+        get_total_ram.return_value = 1024 ** 3
+        cpu_count.return_value = 4
+        worker_ctxt.return_value.return_value = {'workers': 4}
+        self.config.return_value = True
+        get_relation_ip.return_value = '10.0.0.2'
+        self.relation_ids.return_value = ['cluster:0']
+        related_units.return_value = ['glance/1', 'glance/2']
+        peers = {'glance/1': '10.0.0.3', 'glance/2': '10.0.0.1'}
+        relation_get.side_effect = lambda k, rid, unit: {
+            'memcache-address': peers[unit]}.get(k)
+        ctxt = contexts.MemcacheContext()()
+        self.assertTrue(ctxt['memcache_share_peers'])
+        self.assertEqual(ctxt['memcache_listen'], ['10.0.0.2'])
+        self.assertEqual(ctxt['memcache_memory'], 64)
+        self.assertEqual(ctxt['memcache_threads'], 4)
+        self.assertEqual(ctxt['memcache_connections'], 1024)
+        self.assertEqual(ctxt['memcache_url'],
+                         '10.0.0.1:11211,10.0.0.2:11211,10.0.0.3:11211')
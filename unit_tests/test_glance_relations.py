@@ -60,7 +60,8 @@ TO_PATCH = [
     'related_units',
     'service_name',
     # charmhelpers.core.host
-    'apt_install',
+    'apt_plan',
+    'determine_relation_packages',
     'apt_update',
     'restart_on_change',
     'service_reload',
@@ -83,13 +84,18 @@ TO_PATCH = [
     'ensure_ceph_keyring',
     'ceph_config_file',
     'update_nrpe_config',
+    'remove_perf_probe',
     'reinstall_paste_ini',
+    'require_full_restart',
+    'coordinate_rolling_restarts',
+    'update_memcache_access',
+    # hooks.glance_contexts
+    'memcache_address',
     # other
     'call',
     'check_call',
     'execd_preinstall',
     'lsb_release',
-    'filter_installed_packages',
     'get_hacluster_config',
     'get_netmask_for_address',
     'get_iface_for_address',
@@ -115,10 +121,12 @@ class GlanceRelationTests(CharmTestCase):
         relations.install_hook()
         self.configure_installation_source.assert_called_with(repo)
         self.apt_update.assert_called_with(fatal=True)
-        self.apt_install.assert_called_with(
+        plan = self.apt_plan.return_value
+        plan.add.assert_called_with(
             ['apache2', 'glance', 'haproxy', 'memcached', 'python-keystone',
              'python-mysqldb', 'python-psycopg2', 'python-six',
              'python-swiftclient', 'uuid'], fatal=True)
+        self.assertTrue(plan.execute.called)
         self.assertTrue(self.execd_preinstall.called)
 
     @patch.object(utils, 'config')
@@ -295,7 +303,9 @@ class GlanceRelationTests(CharmTestCase):
 
     def test_ceph_joined(self):
         relations.ceph_joined()
-        self.apt_install.assert_called_with(['ceph-common', 'python-ceph'])
+        plan = self.apt_plan.return_value
+        plan.add.assert_called_with(['ceph-common', 'python-ceph'])
+        self.assertTrue(plan.execute.called)
 
     @patch.object(relations, 'CONFIGS')
     def test_ceph_changed_missing_relation_data(self, configs):
@@ -550,6 +560,23 @@ class GlanceRelationTests(CharmTestCase):
         self.assertEqual([call('/etc/glance/glance-api.conf'),
                           call('/etc/haproxy/haproxy.cfg')],
                          configs.write.call_args_list)
+        self.update_memcache_access.assert_called_once_with()
+        self.coordinate_rolling_restarts.assert_called_once_with()
+
+    def test_cluster_joined(self):
+        self.get_relation_ip.side_effect = lambda addr_type, **kwargs: {
+            'internal': '10.0.1.2', 'cluster': '10.0.0.2'}.get(addr_type)
+        self.memcache_address.return_value = '10.0.0.2'
+        relations.cluster_joined('cluster:0')
+        self.relation_set.assert_called_once_with(
+            relation_id='cluster:0',
+            relation_settings={'internal-address': '10.0.1.2',
+                               'private-address': '10.0.0.2',
+                               'memcache-address': '10.0.0.2'})
+
+    def test_leader_changed(self):
+        relations.leader_changed()
+        self.coordinate_rolling_restarts.assert_called_once_with()
 
     @patch.object(relations, 'canonical_url')
     @patch.object(relations, 'relation_set')
@@ -573,12 +600,17 @@ class GlanceRelationTests(CharmTestCase):
     @patch.object(relations, 'CONFIGS')
     def test_upgrade_charm(self, configs, token_cache_pkgs,
                            util_config, mock_update_image_location_policy):
-        self.filter_installed_packages.return_value = ['test']
+        self.determine_relation_packages.return_value = ['python-ceph']
         relations.upgrade_charm()
-        self.apt_install.assert_called_with(['test'], fatal=True)
+        plan = self.apt_plan.return_value
+        plan.add.assert_has_calls([
+            call(relations.determine_packages(), fatal=True),
+            call(['python-ceph'])])
+        self.assertTrue(plan.execute.called)
         self.assertTrue(configs.write_all.called)
         self.assertTrue(self.reinstall_paste_ini.called)
         self.assertTrue(mock_update_image_location_policy.called)
+        self.require_full_restart.assert_called_once_with()
 
     def test_ha_relation_joined(self):
         self.get_hacluster_config.return_value = {
@@ -806,12 +838,15 @@ class GlanceRelationTests(CharmTestCase):
         relations.relation_broken()
         self.assertTrue(configs.write_all.called)
 
+    def test_nrpe_external_master_broken(self):
+        relations.nrpe_external_master_broken()
+        self.remove_perf_probe.assert_called_once_with()
+
     @patch.object(relations, 'CONFIGS')
     def test_cinder_volume_joined(self, configs):
-        self.filter_installed_packages.side_effect = lambda pkgs: pkgs
         relations.cinder_volume_service_relation_joined()
         self.assertTrue(configs.write_all.called)
-        self.apt_install.assert_called_with(
+        self.apt_plan.return_value.add.assert_called_with(
             ["python-cinderclient",
              "python-os-brick",
              "python-oslo.rootwrap"], fatal=True
@@ -819,14 +854,13 @@ class GlanceRelationTests(CharmTestCase):
 
     @patch.object(relations, 'CONFIGS')
     def test_storage_backend_changed(self, configs):
-        self.filter_installed_packages.side_effect = lambda pkgs: pkgs
         configs.complete_contexts = MagicMock()
         configs.complete_contexts.return_value = ['storage-backend']
         configs.write = MagicMock()
         relations.storage_backend_hook()
         self.assertEqual([call('/etc/glance/glance-api.conf')],
                          configs.write.call_args_list)
-        self.apt_install.assert_called_with(
+        self.apt_plan.return_value.add.assert_called_with(
             ["python-cinderclient",
              "python-os-brick",
              "python-oslo.rootwrap"], fatal=True
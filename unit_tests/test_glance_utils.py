@@ -26,6 +26,7 @@ from test_utils import (
 )
 
 TO_PATCH = [
+    'atexit',
     'config',
     'log',
     'relation_ids',
@@ -36,6 +37,7 @@ TO_PATCH = [
     'apt_update',
     'apt_upgrade',
     'apt_install',
+    'apt_plan',
     'mkdir',
     'os_release',
     'service_start',
@@ -82,6 +84,10 @@ class TestGlanceUtils(CharmTestCase):
                      utils.CONFIG_FILES[conf]['hook_contexts'])
             )
         configs.register.assert_has_calls(calls, any_order=True)
+        self.templating.OSConfigRenderer.assert_called_with(
+            templates_dir=utils.TEMPLATES,
+            openstack_release='grizzly',
+            context_workers=utils.CONTEXT_WORKERS)
 
     @patch('os.path.exists')
     def test_register_configs_apache24(self, exists):
@@ -149,33 +155,55 @@ class TestGlanceUtils(CharmTestCase):
         ex.append('memcached')
         self.assertEqual(set(ex), set(utils.determine_packages()))
 
+    def test_determine_relation_packages(self):
+        self.relation_ids.side_effect = \
+            lambda r: ['{}:1'.format(r)] if r != 'ceph' else []
+        self.os_release.return_value = 'liberty'
+        self.assertEqual(utils.determine_relation_packages(),
+                         utils.NRPE_PACKAGES)
+        self.os_release.return_value = 'mitaka'
+        self.assertEqual(utils.determine_relation_packages(),
+                         utils.NRPE_PACKAGES + utils.CINDER_STORE_PACKAGES)
+
+    @patch.object(utils, 'kv')
     @patch.object(utils, 'migrate_database')
-    def test_openstack_upgrade_leader(self, migrate):
+    def test_openstack_upgrade_leader(self, migrate, kv):
+        test_kv = SimpleKV()
+        kv.return_value = test_kv
         self.config.side_effect = None
         self.config.return_value = 'cloud:precise-havana'
         self.is_elected_leader.return_value = True
         self.get_os_codename_install_source.return_value = 'havana'
+        self.relation_ids.return_value = []
         configs = MagicMock()
         utils.do_openstack_upgrade(configs)
         self.assertTrue(configs.write_all.called)
-        self.apt_install.assert_called_with(utils.determine_packages(),
-                                            fatal=True)
+        self.apt_plan.return_value.add.assert_any_call(
+            utils.determine_packages(), fatal=True)
+        self.assertTrue(self.apt_plan.return_value.execute.called)
         self.apt_upgrade.assert_called_with(options=DPKG_OPTS,
                                             fatal=True, dist=True)
         configs.set_release.assert_called_with(openstack_release='havana')
         self.assertTrue(migrate.called)
+        self.assertEqual(test_kv.get(utils.FULL_RESTART_KEY),
+                         ['glance-api', 'glance-registry'])
 
+    @patch.object(utils, 'kv')
     @patch.object(utils, 'migrate_database')
-    def test_openstack_upgrade_not_leader(self, migrate):
+    def test_openstack_upgrade_not_leader(self, migrate, kv):
+        test_kv = SimpleKV()
+        kv.return_value = test_kv
         self.config.side_effect = None
         self.config.return_value = 'cloud:precise-havana'
         self.is_elected_leader.return_value = False
         self.get_os_codename_install_source.return_value = 'havana'
+        self.relation_ids.return_value = []
         configs = MagicMock()
         utils.do_openstack_upgrade(configs)
         self.assertTrue(configs.write_all.called)
-        self.apt_install.assert_called_with(utils.determine_packages(),
-                                            fatal=True)
+        self.apt_plan.return_value.add.assert_any_call(
+            utils.determine_packages(), fatal=True)
+        self.assertTrue(self.apt_plan.return_value.execute.called)
         self.apt_upgrade.assert_called_with(options=DPKG_OPTS,
                                             fatal=True, dist=True)
         configs.set_release.assert_called_with(openstack_release='havana')
@@ -253,7 +281,7 @@ class TestGlanceUtils(CharmTestCase):
             call(utils.GLANCE_API_PASTE),
         ])
         self.assertTrue(test_kv.get(utils.PASTE_INI_MARKER))
-        self.assertTrue(test_kv.flushed)
+        self.atexit.assert_called_once_with(test_kv.flush)
 
     @patch.object(utils, 'kv')
     def test_reinstall_paste_ini_idempotent(self, kv):
@@ -314,3 +342,351 @@ class TestGlanceUtils(CharmTestCase):
                                          call('policy_set_image_location', ''),
                                          call('policy_delete_image_location',
                                               '')])
+
+    @patch.object(utils.glance_contexts, 'memcache_peers')
+    @patch.object(utils.glance_contexts, 'memcache_address')
+    @patch('subprocess.check_output')
+    @patch('subprocess.check_call')
+    @patch('subprocess.call')
+    def test_update_memcache_access(self, _call, check_call, check_output,
+                                    memcache_address, memcache_peers):
+        self.config.side_effect = lambda key: True
+        memcache_address.return_value = '10.0.0.2'
+        memcache_peers.return_value = ['10.0.0.3', '2001:db8::1', '10.0.0.1']
+        check_output.return_value = (b'-N glance-memcached\n'
+                                     b'-A glance-memcached -j DROP\n')
+        # the chain exists, the jump does not, nor does the ip6tables chain
+        _call.side_effect = [1, 1, 1, 1, 1]
+        utils.update_memcache_access()
+        jump = ['INPUT', '-p', 'tcp', '--dport', '11211',
+                '-j', 'glance-memcached']
+        self.assertEqual(check_call.call_args_list, [
+            call(['iptables', '-w', '-A', 'glance-memcached',
+                  '-s', '10.0.0.1', '-j', 'ACCEPT']),
+            call(['iptables', '-w', '-A', 'glance-memcached',
+                  '-s', '10.0.0.3', '-j', 'ACCEPT']),
+            call(['iptables', '-w', '-A', 'glance-memcached',
+                  '-i', 'lo', '-j', 'ACCEPT']),
+            call(['iptables', '-w', '-A', 'glance-memcached', '-j', 'DROP']),
+            call(['iptables', '-w', '-D', 'glance-memcached', '1']),
+            call(['iptables', '-w', '-I'] + jump)])
+        # the ip6tables chain is removed
+        self.assertEqual(
+            [c[0][0] for c in _call.call_args_list[2:]],
+            [['ip6tables', '-w', '-D'] + jump,
+             ['ip6tables', '-w', '-F', 'glance-memcached'],
+             ['ip6tables', '-w', '-X', 'glance-memcached']])
+
+    @patch('subprocess.check_call')
+    @patch('subprocess.call')
+    def test_update_memcache_access_not_shared(self, _call, check_call):
+        self.config.side_effect = lambda key: False
+        # one jump to remove from iptables
+        _call.side_effect = [0, 1, 0, 0, 1, 1, 1]
+        utils.update_memcache_access()
+        self.assertFalse(check_call.called)
+        self.assertEqual([c[0][0][:3] for c in _call.call_args_list], [
+            ['iptables', '-w', '-D'], ['iptables', '-w', '-D'],
+            ['iptables', '-w', '-F'], ['iptables', '-w', '-X'],
+            ['ip6tables', '-w', '-D'], ['ip6tables', '-w', '-F'],
+            ['ip6tables', '-w', '-X']])
+
+    @patch.object(utils, 'atexit')
+    @patch.object(utils, 'kv')
+    def test_compact_unit_state(self, mock_kv, atexit):
+        utils.compact_unit_state()
+        self.assertFalse(mock_kv.return_value.compact.called)
+        atexit.assert_called_with(utils.vacuum_unit_state)
+
+    @patch.object(utils, 'kv')
+    def test_vacuum_unit_state(self, mock_kv):
+        mock_kv.return_value.compact.return_value = {
+            'db_size': 4096, 'wal_size': 0,
+            'rows': {'kv': 10, 'kv_revisions': 5, 'hooks': 5}}
+        utils.vacuum_unit_state()
+        mock_kv.return_value.compact.assert_called_with()
+        self.assertTrue(self.log.called)
+
+    @patch('subprocess.check_call')
+    @patch.object(utils, 'write_file')
+    @patch('os.path.exists')
+    def test_precache_images(self, exists, write_file, check_call):
+        cached = '7a2e7e5b-1f1c-4c38-8a2b-8a0c6c0b9c11'
+        uncached = '0b9a1e2d-5c3f-4e6a-9d7b-2f8e1c4a6b3d'
+        exists.side_effect = lambda p: p.endswith(cached)
+        self.assertEqual(utils.precache_images([cached, uncached]),
+                         [uncached])
+        write_file.assert_called_once_with(
+            '/var/lib/glance/image-cache/queue/' + uncached, '',
+            owner='glance', group='glance', perms=0o640)
+        check_call.assert_called_once_with(
+            ['sudo', '-u', 'glance', 'glance-cache-prefetcher',
+             '--config-file', utils.GLANCE_API_CONF,
+             '--config-file', utils.GLANCE_CACHE_CONF])
+
+    @patch('subprocess.check_call')
+    def test_precache_images_invalid_id(self, check_call):
+        self.assertRaises(ValueError, utils.precache_images,
+                          ['../../etc/passwd'])
+        self.assertFalse(check_call.called)
+
+    @patch.object(utils, 'determine_api_port')
+    @patch.object(utils, 'write_file')
+    def test_update_perf_checks(self, write_file, determine_api_port):
+        self.config.side_effect = self.test_config.get
+        determine_api_port.return_value = 9282
+        rids = {'ceph': ['ceph:1'],
+                'nrpe-external-master': ['nrpe-external-master:2']}
+        self.relation_ids.side_effect = lambda r: rids.get(r, [])
+        self.test_config.set('nrpe-haproxy-queue-warn', None)
+        nrpe_setup = MagicMock()
+        utils.update_perf_checks(nrpe_setup, 'glance/0')
+        write_file.assert_called_once_with(
+            utils.PERF_PROBE_CRON,
+            '* * * * * root {} probe > /dev/null 2>&1\n'.format(
+                utils.PERF_CHECK),
+            perms=0o644)
+        nrpe_setup.remove_check.assert_called_once_with(
+            shortname='glance_image_cache_fill')
+        checks = dict((c[1]['shortname'], c[1]['check_cmd'])
+                      for c in nrpe_setup.add_check.call_args_list)
+        self.assertEqual(checks, {
+            'glance_api_latency': 'check_glance_perf.py api-latency --url '
+                                  'http://127.0.0.1:9282/versions '
+                                  '-w 500 -c 2000',
+            'glance_store_rtt': 'check_glance_perf.py store-rtt '
+                                '-w 500 -c 2000',
+            'glance_haproxy_sessions': 'check_glance_perf.py '
+                                       'haproxy-sessions -w 800 -c 1600',
+            'glance_haproxy_queue': 'check_glance_perf.py haproxy-queue '
+                                    '-c 50',
+        })
+
+    @patch.object(utils, 'remove_perf_probe')
+    @patch.object(utils, 'determine_api_port')
+    @patch.object(utils, 'write_file')
+    def test_update_perf_checks_no_nrpe_relation(self, write_file,
+                                                 determine_api_port,
+                                                 remove_perf_probe):
+        self.config.side_effect = self.test_config.get
+        determine_api_port.return_value = 9282
+        self.relation_ids.return_value = []
+        nrpe_setup = MagicMock()
+        utils.update_perf_checks(nrpe_setup, 'glance/0')
+        self.assertFalse(write_file.called)
+        remove_perf_probe.assert_called_once_with()
+        self.assertTrue(nrpe_setup.add_check.called)
+
+    @patch('os.remove')
+    @patch('os.path.exists')
+    def test_remove_perf_probe(self, exists, remove):
+        exists.return_value = False
+        utils.remove_perf_probe()
+        self.assertFalse(remove.called)
+        exists.return_value = True
+        utils.remove_perf_probe()
+        remove.assert_called_once_with(utils.PERF_PROBE_CRON)
+
+    @patch.object(utils, 'determine_api_port')
+    @patch.object(utils, 'write_file')
+    def test_update_perf_checks_haproxy_processes(self, write_file,
+                                                  determine_api_port):
+        self.config.side_effect = self.test_config.get
+        determine_api_port.return_value = 9282
+        self.test_config.set('haproxy-nbproc', 2)
+        self.relation_ids.return_value = ['nrpe-external-master:2']
+        utils.update_perf_checks(MagicMock(), 'glance/0')
+        write_file.assert_called_once_with(
+            utils.PERF_PROBE_CRON,
+            '* * * * * root {} probe '
+            '--socket /var/run/haproxy/admin.sock '
+            '--socket /var/run/haproxy/admin-2.sock > /dev/null 2>&1\n'
+            .format(utils.PERF_CHECK),
+            perms=0o644)
+
+    @patch.object(utils, 'kv')
+    @patch('subprocess.call')
+    @patch.object(utils, 'init_is_systemd')
+    @patch.object(utils, 'service_running')
+    def test_graceful_restart_reload(self, service_running, init_is_systemd,
+                                     subprocess_call, kv):
+        test_kv = SimpleKV()
+        kv.return_value = test_kv
+        self.os_release.return_value = 'mitaka'
+        service_running.return_value = True
+        init_is_systemd.return_value = True
+        subprocess_call.return_value = 0
+        self.assertTrue(utils.graceful_restart('glance-api'))
+        subprocess_call.assert_called_once_with(
+            ['systemctl', 'kill', '--kill-who=main', '--signal=HUP',
+             'glance-api'])
+        self.assertFalse(self.service_stop.called)
+        outcome = test_kv.get(utils.RESTART_OUTCOMES_KEY)['glance-api']
+        self.assertEqual(outcome['method'], 'reload')
+        self.assertTrue(outcome['success'])
+        self.atexit.assert_called_once_with(test_kv.flush)
+
+    @patch.object(utils, 'kv')
+    @patch('subprocess.call')
+    @patch.object(utils, 'service_running')
+    def test_graceful_restart_after_upgrade(self, service_running,
+                                            subprocess_call, kv):
+        test_kv = SimpleKV()
+        kv.return_value = test_kv
+        self.os_release.return_value = 'mitaka'
+        self.config.side_effect = self.test_config.get
+        service_running.return_value = True
+        subprocess_call.return_value = 0
+        self.service_start.return_value = True
+        utils.require_full_restart()
+        self.atexit.assert_called_once_with(test_kv.flush)
+        with patch.object(utils, 'haproxy_server_stats', return_value={}):
+            self.assertTrue(utils.graceful_restart('glance-api'))
+        self.assertFalse(subprocess_call.called)
+        self.service_stop.assert_called_once_with('glance-api')
+        self.service_start.assert_called_once_with('glance-api')
+        self.assertEqual(test_kv.get(utils.FULL_RESTART_KEY),
+                         ['glance-registry'])
+        # reloaded once restarted
+        with patch.object(utils, 'init_is_systemd', return_value=True):
+            self.assertTrue(utils.graceful_restart('glance-api'))
+        self.assertTrue(subprocess_call.called)
+        outcome = test_kv.get(utils.RESTART_OUTCOMES_KEY)['glance-api']
+        self.assertEqual(outcome['method'], 'reload')
+
+    @patch.object(utils, 'kv')
+    @patch.object(utils, 'haproxy_admin')
+    @patch.object(utils, 'haproxy_server_stats')
+    def test_graceful_restart_drain(self, haproxy_server_stats,
+                                    haproxy_admin, kv):
+        test_kv = SimpleKV()
+        kv.return_value = test_kv
+        self.os_release.return_value = 'kilo'
+        self.test_config.set('restart-drain-timeout', 10)
+        self.config.side_effect = self.test_config.get
+        haproxy_server_stats.side_effect = [
+            {'glance_api_admin': {'scur': '2'}},
+            {'glance_api_admin': {'scur': '0'}},
+        ]
+        self.service_start.return_value = True
+        with patch.object(utils.time, 'sleep'):
+            self.assertTrue(utils.graceful_restart('glance-api'))
+        self.assertEqual(haproxy_admin.call_args_list, [
+            call('disable server glance_api_admin/glance',
+                 utils.HAPROXY_ADMIN_SOCKET),
+            call('enable server glance_api_admin/glance',
+                 utils.HAPROXY_ADMIN_SOCKET)])
+        self.service_stop.assert_called_once_with('glance-api')
+        self.service_start.assert_called_once_with('glance-api')
+        outcome = test_kv.get(utils.RESTART_OUTCOMES_KEY)['glance-api']
+        self.assertEqual(outcome['method'], 'drain-restart')
+        self.assertTrue(outcome['drained'])
+
+    def test_haproxy_admin_sockets(self):
+        self.config.side_effect = self.test_config.get
+        self.assertEqual(utils.haproxy_admin_sockets(),
+                         [utils.HAPROXY_ADMIN_SOCKET])
+        self.test_config.set('haproxy-nbproc', 3)
+        self.assertEqual(utils.haproxy_admin_sockets(), [
+            '/var/run/haproxy/admin.sock',
+            '/var/run/haproxy/admin-2.sock',
+            '/var/run/haproxy/admin-3.sock'])
+
+    @patch.object(utils, 'local_unit')
+    @patch.object(utils, 'haproxy_admin')
+    def test_haproxy_server_stats_processes(self, haproxy_admin, local_unit):
+        local_unit.return_value = 'glance/0'
+        self.config.side_effect = self.test_config.get
+        self.test_config.set('haproxy-nbproc', 2)
+        stats = {
+            '/var/run/haproxy/admin.sock':
+                '# pxname,svname,scur,status\n'
+                'glance_api,FRONTEND,5,OPEN\n'
+                'glance_api,glance-0,2,UP\n'
+                'glance_api,glance-1,1,UP\n'
+                'glance_registry,glance-0,0,no check\n',
+            '/var/run/haproxy/admin-2.sock':
+                '# pxname,svname,scur,status\n'
+                'glance_api,glance-0,3,DOWN 1/2\n'
+                'glance_registry,glance-0,1,no check\n',
+        }
+        haproxy_admin.side_effect = lambda command, path: stats[path]
+        self.assertEqual(utils.haproxy_server_stats(), {
+            'glance_api': {'pxname': 'glance_api', 'svname': 'glance-0',
+                           'scur': '5', 'status': 'DOWN 1/2'},
+            'glance_registry': {'pxname': 'glance_registry',
+                                'svname': 'glance-0', 'scur': '1',
+                                'status': 'no check'},
+        })
+        haproxy_admin.assert_has_calls([
+            call('show stat', '/var/run/haproxy/admin.sock'),
+            call('show stat', '/var/run/haproxy/admin-2.sock')])
+
+    @patch.object(utils, 'local_unit')
+    @patch.object(utils, 'haproxy_admin')
+    def test_haproxy_server_states(self, haproxy_admin, local_unit):
+        local_unit.return_value = 'glance/1'
+        self.config.side_effect = self.test_config.get
+        haproxy_admin.return_value = (
+            '# pxname,svname,qcur,scur,status,\n'
+            'stats,FRONTEND,,0,OPEN,\n'
+            'glance_api_admin,FRONTEND,,3,OPEN,\n'
+            'glance_api_admin,glance-0,0,1,UP,\n'
+            'glance_api_admin,glance-1,0,2,UP 1/3,\n'
+            'glance_api_admin,BACKEND,0,3,UP,\n'
+            'glance_api_public,glance-1,0,0,MAINT,\n'
+            '\n')
+        self.assertEqual(utils.haproxy_server_states(), {
+            'glance_api_admin': 'UP 1/3',
+            'glance_api_public': 'MAINT'})
+        haproxy_admin.assert_called_once_with('show stat',
+                                              utils.HAPROXY_ADMIN_SOCKET)
+
+    @patch.object(utils, 'requests')
+    @patch.object(utils, 'haproxy_server_states')
+    @patch.object(utils, 'determine_api_port')
+    def test_is_healthy(self, determine_api_port, haproxy_server_states,
+                        requests):
+        requests.exceptions.RequestException = IOError
+        determine_api_port.return_value = 9282
+        requests.get.return_value.status_code = 300
+        haproxy_server_states.return_value = {'glance_api': 'UP',
+                                              'glance_registry': 'no check'}
+        self.assertTrue(utils.is_healthy())
+        requests.get.assert_called_once_with(
+            'http://127.0.0.1:9282/versions', timeout=5)
+        haproxy_server_states.return_value = {'glance_api': 'DOWN'}
+        self.assertFalse(utils.is_healthy())
+        haproxy_server_states.return_value = {}
+        requests.get.return_value.status_code = 503
+        self.assertFalse(utils.is_healthy())
+        requests.get.side_effect = IOError()
+        self.assertFalse(utils.is_healthy())
+
+    @patch.object(utils, 'haproxy_admin')
+    def test_haproxy_server_stats_not_running(self, haproxy_admin):
+        self.config.side_effect = self.test_config.get
+        haproxy_admin.return_value = None
+        self.assertEqual(utils.haproxy_server_stats(), {})
+
+    @patch.object(utils, 'haproxy_admin')
+    @patch.object(utils, 'haproxy_server_stats')
+    def test_drain_haproxy_servers_processes(self, haproxy_server_stats,
+                                             haproxy_admin):
+        self.config.side_effect = self.test_config.get
+        self.test_config.set('haproxy-nbproc', 2)
+        haproxy_server_stats.return_value = {'glance_api': {'scur': '0'}}
+        self.assertEqual(utils.drain_haproxy_servers(10),
+                         (['glance_api'], True))
+        self.assertEqual(haproxy_admin.call_args_list, [
+            call('disable server glance_api/glance',
+                 '/var/run/haproxy/admin.sock'),
+            call('disable server glance_api/glance',
+                 '/var/run/haproxy/admin-2.sock')])
+        haproxy_admin.reset_mock()
+        utils.enable_haproxy_servers(['glance_api'])
+        self.assertEqual(haproxy_admin.call_args_list, [
+            call('enable server glance_api/glance',
+                 '/var/run/haproxy/admin.sock'),
+            call('enable server glance_api/glance',
+                 '/var/run/haproxy/admin-2.sock')])
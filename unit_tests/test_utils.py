@@ -131,6 +131,9 @@ class SimpleKV(object):
     def set(self, key, value):
         self.data[key] = value
 
+    def unset(self, key):
+        self.data.pop(key, None)
+
     def flush(self):
         self.flushed = True
 